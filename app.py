@@ -1,15 +1,12 @@
 """app Streamlit"""
 
-import json
 import os
+import uuid
+from concurrent.futures import wait
 import streamlit as st
-import pandas as pd
-from google.cloud import bigquery
-from google.oauth2 import service_account
-from google.api_core.exceptions import GoogleAPIError
-import plotly.express as px
-from google import genai
 from dotenv import load_dotenv
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 load_dotenv()
 # Configuración de la página
@@ -138,355 +135,299 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-# --- CONFIGURACIÓN BIGQUERY ---
-SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-PROJECT_ID = "ai-agent-452404"
-DATASET_ID = "bigquery-public-data"
-DATASET_NAME = "samples"
+# --- MAIN CONTENT - ACTUALIZADO PARA NATALIDAD ---
+st.markdown(
+    """
+<div class="main-header">
+    <h1>👶 Dashboard de Análisis de Natalidad</h1>
+    <p>🤖 Analiza estadísticas de nacimientos en EE.UU. con IA • Obtén insights sobre peso, gestación y tendencias demográficas.</p>
+</div>
+""",
+    unsafe_allow_html=True,
+)
 
+st.markdown("### 💡 ¿Qué puedes preguntar?")
+col1, col2 = st.columns(2)
+# Columnas de ejemplos actualizadas
+with col1:
+    st.markdown(
+        """
+        **📊 Estadísticas Generales**
+        - ¿Cuál es el peso promedio al nacer en el año 2005?
+        - Muestra los 20 pesos más elevados de los recien nacidos en el año 2005
+        """
+    )
+with col2:
+    st.markdown(
+        """
+        **🔬 Análisis y Comparaciones**
+        - Analiza la tendencia de la edad promedio de la madre entre 2000 y 2008.
+        - ¿Cuál es la cantidad de nacimientos de gemelos (plurality=2) por año desde 1990 hasta 1995?
+        """
+    )
 
-# Función actualizada para información de la tabla de natalidad
-@st.cache_data(ttl=3600)
-def get_natality_table_info():
-    """
-    Información estructurada de la tabla de natalidad.
+st.markdown("### 🎯 Ejemplos específicos para copiar y pegar:")
+# Ejemplos de "copia y pega" actualizados
+st.markdown(
     """
-    natality_table = {
-        "natality": {
-            "descripcion": "Contiene datos sobre nacimientos en los Estados Unidos, cubriendo los años 1969 a 2008.",
-            "campos": [
-                "source_year (INTEGER) - Año de la fuente de datos. Ejemplo: 1975",
-                "year (INTEGER) - Año de nacimiento de cuatro dígitos. Ejemplo: 1975",
-                "month (INTEGER) - Mes de nacimiento, donde 1 = Enero.",
-                "day (INTEGER) - Día del nacimiento, empezando desde 1.",
-                "wday (INTEGER) - Día de la semana, donde 1 = Domingo y 7 = Sábado.",
-                "state (STRING) - Abreviatura postal del estado. No disponible después de 2004.",
-                "is_male (BOOLEAN) - Verdadero si el bebé es varón, falso si es mujer.",
-                "child_race (INTEGER) - Raza del bebé (1-Blanco, 2-Negro, 3-Indio Americano, 4-Chino, etc.).",
-                "weight_pounds (FLOAT) - Peso del bebé al nacer, en libras.",
-                "plurality (INTEGER) - Número de bebés de este embarazo (2=gemelos, 3=trillizos, etc.).",
-                "apgar_1min (INTEGER) - Puntaje Apgar a 1 minuto (0-10), años 1978-2002.",
-                "apgar_5min (INTEGER) - Puntaje Apgar a 5 minutos (0-10), años 1978-2002.",
-                "mother_residence_state (STRING) - Estado de residencia de la madre.",
-                "mother_race (INTEGER) - Raza de la madre (mismos códigos que child_race).",
-                "mother_age (INTEGER) - Edad de la madre.",
-                "gestation_weeks (INTEGER) - Semanas de gestación.",
-                "lmp (STRING) - Fecha del último período menstrual (MMDDYYYY). '99' o '9999' indican desconocido.",
-                "mother_married (BOOLEAN) - Verdadero si la madre estaba casada.",
-                "mother_birth_state (STRING) - Estado de nacimiento de la madre.",
-                "cigarette_use (BOOLEAN) - Verdadero si la madre fumó (desde 2003).",
-                "cigarettes_per_day (INTEGER) - Número de cigarrillos por día (desde 2003).",
-                "alcohol_use (BOOLEAN) - Verdadero si la madre consumió alcohol (desde 1989).",
-                "drinks_per_week (INTEGER) - Bebidas alcohólicas por semana (desde 1989).",
-                "weight_gain_pounds (INTEGER) - Aumento de peso de la madre en libras.",
-                "born_alive_alive (INTEGER) - Hijos previos nacidos vivos que siguen vivos.",
-                "born_alive_dead (INTEGER) - Hijos previos nacidos vivos que han fallecido.",
-                "born_dead (INTEGER) - Hijos nacidos muertos.",
-                "ever_born (INTEGER) - Total de hijos nacidos de la madre.",
-                "father_race (INTEGER) - Raza del padre (mismos códigos que child_race).",
-                "father_age (INTEGER) - Edad del padre.",
-                "record_weight (INTEGER) - Peso del registro para muestreo estadístico.",
-            ],
-        }
-    }
-    return natality_table
+- *"Calcula el peso promedio en libras (`weight_pounds`) para los 10 estados con más nacimientos en 2007"*
+- *"Muestra la tendencia del número de nacimientos por año desde 2000 a 2008"*
+- *"Compara las semanas de gestación promedio para madres menores de 20 años vs. madres mayores de 35 en el año 2005"*
+"""
+)
 
+st.markdown("---")
 
-@st.cache_resource
-def initialize_bigquery():
-    try:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE
-        )
-        client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-        dataset_ref = f"{DATASET_ID}.{DATASET_NAME}"
-        dataset = client.get_dataset(dataset_ref)
-        tables = client.list_tables(dataset)
-        tables_info = [
-            f"{DATASET_ID}.{DATASET_NAME}.{table.table_id}" for table in tables
-        ]
-        return client, tables_info
-    except GoogleAPIError as e:
-        st.error(f"❌ Error de conexión a BigQuery:\n\n{e}")
-        return None, []
-    except Exception as e:
-        st.error(f"❌ Error inesperado:\n\n{e}")
-        return None, []
+# La cabecera ya está en el navegador: las dependencias pesadas (pandas, sqlglot,
+# pyarrow...) se importan después de pintarla. La configuración del pipeline se lee
+# del entorno al importarlo, tras cargar el .env
+from cost_gate import CostGate, format_bytes
+from streaming import cleanup_spill_dir
+from history import ChatHistory
+from pipeline import (
+    APPROX_SAMPLE_PERCENT,
+    MAX_BYTES_PER_QUERY,
+    MAX_BYTES_PER_SESSION,
+    MAX_RESULT_ROWS,
+    PREFETCH_FOLLOW_UPS,
+    TurnRenderer,
+    build_tables_context,
+    create_prefetcher,
+    figure_from_spec,
+    get_job_manager,
+    get_model_gateway,
+    get_schema_catalog,
+    get_result_cache,
+    get_single_flight,
+    get_sql_cache,
+    get_worker_pool,
+    load_schema_snapshot,
+    process_query,
+    refine_exact_answer,
+    refresh_schema,
+    set_error_reporter,
+)
 
+set_error_reporter(st.error)
 
-@st.cache_data(ttl=3600)
-def build_tables_context(tables_info):
-    tables_context = []
-    # Renombrado de variable para reflejar el nuevo contexto
-    natality_table_info = get_natality_table_info() 
+# --- CONFIGURACIÓN BIGQUERY ---
+SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+PROJECT_ID = "ai-agent-452404"
+DATASET_ID = "bigquery-public-data"
+DATASET_NAME = "samples"
+
+# --- CONFIGURACIÓN HISTORIAL ---
+HISTORY_DIR = os.getenv("HISTORY_DIR", ".cache/history")
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", str(24 * 3600)))
+HISTORY_PREVIEW_ROWS = int(os.getenv("HISTORY_PREVIEW_ROWS", "100"))
+HISTORY_MEMORY_BUDGET = int(os.getenv("HISTORY_MEMORY_BUDGET", str(8 * 1024 * 1024)))
+HISTORY_RENDER_LAST = int(os.getenv("HISTORY_RENDER_LAST", "4"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
 
-    for table_ref in tables_info:
-        table_name = table_ref.split(".")[-1].replace("`", "")
+# --- CONFIGURACIÓN INTERFAZ ---
+# Cada cuántos segundos se refrescan los contadores de la barra lateral
+SIDEBAR_REFRESH_SECONDS = float(os.getenv("SIDEBAR_REFRESH_SECONDS", "5"))
 
-        # Comparación con la nueva variable
-        if table_name in natality_table_info:
-            table_info = natality_table_info[table_name]
 
-            table_context = f"Tabla: {table_name}\n"
-            table_context += f"Descripción: {table_info['descripcion']}\n"
-            table_context += "Campos:\n"
+def connect_bigquery():
+    """Cliente y tablas del dataset; corre en segundo plano, así que no usa `st`."""
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
 
-            for field in table_info["campos"]:
-                table_context += f"  - {field}\n"
+    credentials = service_account.Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_FILE
+    )
+    client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    dataset_ref = f"{DATASET_ID}.{DATASET_NAME}"
+    dataset = client.get_dataset(dataset_ref)
+    tables = client.list_tables(dataset)
+    tables_info = [
+        f"{DATASET_ID}.{DATASET_NAME}.{table.table_id}" for table in tables
+    ]
+    # Metadatos de las tablas, como mucho una vez cada SCHEMA_CACHE_TTL segundos
+    refresh_schema(client, tables_info)
+    return client, tables_info
 
-            tables_context.append(table_context)
 
-    return tables_context
+@st.cache_resource
+def start_bigquery():
+    """Conexión a BigQuery en segundo plano: la página no espera a la red para pintarse."""
+    return get_worker_pool().submit(connect_bigquery)
 
 
-def initialize_gemini(gemini_api_key):
-    if not gemini_api_key:
-        st.warning(
-            "🔑 Por favor, introduce tu Gemini API key para utilizar el chatbot."
-        )
-        return None
+@st.cache_resource
+def start_gemini(gemini_api_key):
+    """Crea el cliente de Gemini en segundo plano mientras se escribe la primera pregunta."""
+    return get_worker_pool().submit(get_model_gateway, gemini_api_key)
 
+
+def get_bigquery_client():
+    """Cliente de BigQuery; espera a la conexión si aún no ha terminado (None si falló)."""
     try:
-        # La inicialización del cliente se mantiene igual, es genérica.
-        client = genai.Client(api_key=gemini_api_key)
-        generation_config = {
-            "temperature": 0,
-            "top_p": 0.95,
-            "top_k": 64,
-            "max_output_tokens": 8192,
-        }
-
-        model_config = {
-            "model": "gemini-2.0-flash-thinking-exp-1219", # Actualizado a un modelo recomendado
-            "generation_config": generation_config,
-        }
-
-        return client, model_config
+        return start_bigquery().result()[0]
     except Exception as e:
-        st.error(f"❌ Error al inicializar Gemini: {e}")
-        return None, None
+        from google.api_core.exceptions import GoogleAPIError
 
+        if isinstance(e, GoogleAPIError):
+            st.error(f"❌ Error de conexión a BigQuery:\n\n{e}")
+        else:
+            st.error(f"❌ Error inesperado:\n\n{e}")
+        return None
 
-def generate_sql_query(client, model_config, question, tables_info, tables_context):
-    # --- PROMPT COMPLETAMENTE REESCRITO PARA NATALIDAD ---
-    sql_prompt = f"""
-        Eres un experto en análisis de datos de salud pública, especializado en estadísticas de natalidad en EE.UU.
-        Tu tarea es convertir preguntas sobre datos de nacimientos en consultas SQL para BigQuery.
 
-        TABLA DISPONIBLE (Base de datos de natalidad):
-        {chr(10).join(tables_info)}
+def get_tables_info():
+    """Tablas de la conexión si ya terminó; si no, las de la instantánea local."""
+    future = start_bigquery()
+    if future.done() and future.exception() is None:
+        return future.result()[1]
+    return load_schema_snapshot()
 
-        ESTRUCTURA DETALLADA DE LA TABLA:
-        {chr(10).join(tables_context)}
 
-        REGLAS IMPORTANTES:
-        - ¡AVISO CRÍTICO SOBRE LOS DATOS! La tabla `natality` contiene datos HISTÓRICOS, principalmente del periodo 1969 a 2008.
-          Si la pregunta del usuario es sobre un año fuera de este rango (ej. 2020, 2024), la consulta NO devolverá resultados.
-          Evita generar filtros para años posteriores a 2008. Si el usuario no especifica un año, asume que está interesado en el rango histórico o en un año representativo como 2005.
-        - Usa siempre la sintaxis de BigQuery SQL.
-        - Siempre usa backticks (`) alrededor del nombre completo de la tabla, por ejemplo: `bigquery-public-data.samples.natality`.
-        - Las columnas clave para análisis son `weight_pounds`, `mother_age`, `gestation_weeks`, `state`, `year`.
-        - NUNCA uses la columna `_DATA_DATE` si está presente.
+def get_session_id():
+    """
+    Identificador estable de la sesión, usado para repartir la pasarela por turnos y
+    como dueño de sus jobs de BigQuery.
+    """
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            get_runtime_sessions()[st.session_state.session_id] = ctx.session_id
+    return st.session_state.session_id
 
-        PREGUNTA DEL USUARIO: {question}
 
-        Responde ÚNICAMENTE con el código SQL, sin explicaciones adicionales.
+@st.cache_resource
+def get_runtime_sessions():
+    """
+    Sesión de Streamlit de cada `session_id`: el gestor de jobs cancela los de las
+    sesiones que ya no están conectadas.
     """
+    sessions = {}
 
-    try:
-        response = client.models.generate_content(
-            model=model_config["model"],
-            contents=sql_prompt,
-            config=model_config["generation_config"],
+    def is_alive(session_id):
+        runtime_session = sessions.get(session_id)
+        return (
+            runtime_session is None or not runtime.exists()
+            or runtime.get_instance().is_active_session(runtime_session)
         )
-        sql_query = response.text.strip()
-
-        sql_query = sql_query.strip()
-        if sql_query.startswith("```sql"):
-            sql_query = sql_query[6:]
-        if sql_query.endswith("```"):
-            sql_query = sql_query[:-3]
-        return sql_query.strip()
-    except Exception as e:
-        st.error(f"❌ Error al generar la consulta SQL: {e}")
-        return None
 
-
-def execute_sql_query(client, sql_query):
-    try:
-        query_job = client.query(sql_query)
-        df = query_job.to_dataframe()
-
-        is_empty = df is None or df.empty
-        return df, False, is_empty  # Return df, error_occurred, is_empty
-    except Exception as e:
-        st.error(f"❌ Error al ejecutar la consulta SQL: {e}")
-        return None, True, False  # Return None, True, False (error occurred, not empty)
+    get_job_manager().set_liveness(is_alive)
+    return sessions
 
 
-def generate_explanation(client, model_config, question, sql_query, df_result):
-    """
-    Genera una explicación de los resultados, adaptando automáticamente su profundidad
-    a la complejidad de la pregunta del usuario.
-    """
-    try:
-        # --- PROMPT PARA RESULTADOS VACÍOS ACTUALIZADO ---
-        if df_result is None or df_result.empty:
-            explanation_prompt = f"""
-            La consulta SQL sobre estadísticas de natalidad se ejecutó correctamente pero no devolvió resultados. 
-            Esto es común en este dataset, probablemente por una de estas razones:
-            1. La pregunta se refiere a un año reciente (posterior a 2008), y el dataset es histórico.
-            2. Los filtros aplicados son demasiado específicos (ej. una combinación de estado, edad y raza muy particular).
-            
-            Pregunta del usuario: "{question}"
-            Consulta SQL ejecutada: 
-            ```sql
-            {sql_query}
-            ```
-            
-            Tu tarea es explicar amablemente al usuario por qué no se encontraron datos. 
-            - Revisa la consulta y la pregunta.
-            - Si la consulta filtra por un año > 2008, menciona que esa es la causa más probable debido a que los datos son históricos (1969-2008).
-            - Sugiere reformular la pregunta, por ejemplo, probando un rango de años diferente (como 2000-2008) o usando filtros menos restrictivos.
-            - Sé conciso y servicial. No digas que la consulta es errónea, porque no lo es.
-            """
-        else:
-            # --- PROMPT PARA ANÁLISIS DE RESULTADOS ACTUALIZADO ---
-            df_text = df_result.to_string()
-            explanation_prompt = f"""
-            Eres un experto en análisis de datos de salud pública y tu objetivo es explicar los resultados de una consulta sobre natalidad de una manera clara y útil para el usuario.
-
-            PREGUNTA ORIGINAL DEL USUARIO:
-            "{question}"
-
-            RESULTADOS OBTENIDOS:
-            ```
-            {df_text}
-            ```
-
-            TAREA:
-            Analiza los resultados y responde directamente a la pregunta del usuario. Adapta la profundidad de tu respuesta a la naturaleza de la pregunta original:
-            - Para preguntas directas y factuales (ej: "¿Cuál fue el peso promedio al nacer?", "¿Cuántos nacimientos hubo?"), da una respuesta concisa y directa, mencionando el resultado clave de los datos.
-            - Para preguntas que piden análisis, comparaciones o tendencias (ej: "Compara el peso al nacer en dos estados", "Analiza la tendencia de la edad de la madre"), proporciona un análisis más detallado. Destaca 1 o 2 insights importantes, menciona cualquier patrón o dato interesante y, si es posible, ofrece una breve conclusión.
-
-            Utiliza un lenguaje claro y accesible. Si ayuda a la claridad, usa listas o texto en negrita para resaltar la información clave.
-            """
-
-        response = client.models.generate_content(
-            model=model_config["model"],
-            contents=explanation_prompt,
-            config=model_config["generation_config"],
+@st.cache_resource
+def get_history_dir():
+    """Directorio de resultados del historial, purgado al arrancar."""
+    cleanup_spill_dir(HISTORY_DIR, HISTORY_TTL)
+    return HISTORY_DIR
+
+
+def get_history():
+    """Historial compacto de la sesión actual."""
+    if "history" not in st.session_state:
+        st.session_state.history = ChatHistory(
+            get_history_dir(),
+            get_session_id(),
+            preview_rows=HISTORY_PREVIEW_ROWS,
+            memory_budget=HISTORY_MEMORY_BUDGET,
         )
-        return response.text
-    except Exception as e:
-        st.error(f"❌ Error al generar el análisis: {e}")
-        return "Error al generar el análisis de los resultados."
-
-
-def create_visualization(df_result):
-    """Crear visualización si es apropiado"""
-    fig = None
-
-    if df_result is not None and len(df_result) > 0 and len(df_result.columns) >= 2:
-        numeric_cols = df_result.select_dtypes(include=["number"]).columns.tolist()
-        categorical_cols = df_result.select_dtypes(exclude=["number"]).columns.tolist()
-
-        if len(numeric_cols) >= 1 and len(df_result) <= 20: # Límite de barras para legibilidad
-            if len(categorical_cols) >= 1:
-                # Lógica para elegir ejes (prioriza 'year' o 'state' si existen)
-                x_axis = categorical_cols[0]
-                if 'year' in df_result.columns:
-                    x_axis = 'year'
-                elif 'state' in df_result.columns:
-                    x_axis = 'state'
-                
-                fig = px.bar(
-                    df_result,
-                    x=x_axis,
-                    y=numeric_cols[0],
-                    title=f"📈 {numeric_cols[0].replace('_', ' ').title()} por {x_axis.replace('_', ' ').title()}",
-                    color_discrete_sequence=["#2980b9"], # Un color del gradiente
-                )
-                fig.update_layout(
-                    plot_bgcolor="rgba(0,0,0,0)",
-                    paper_bgcolor="rgba(0,0,0,0)",
-                )
+    return st.session_state.history
 
-    return fig
-
-
-def process_query(prompt, gemini_api_key, client, tables_info, tables_context):
-    """Función consolidada para procesar consultas y evitar duplicación"""
-    if not gemini_api_key:
-        error_msg = "🔑 Por favor, proporciona tu API key de Gemini en el sidebar."
-        return {
-            "role": "assistant", "content": error_msg,
-            "data": None, "fig": None, "sql_query": None,
-        }
-
-    model_result = initialize_gemini(gemini_api_key)
-    if not model_result or not model_result[0]: # Se comprueba que el resultado y el cliente no sean nulos
-        error_msg = "❌ Error al inicializar Gemini. Verifica tu API key."
-        return {
-            "role": "assistant", "content": error_msg,
-            "data": None, "fig": None, "sql_query": None,
-        }
-
-    client_ai, model_config = model_result
-    sql_query = generate_sql_query(
-        client_ai, model_config, prompt, tables_info, tables_context
-    )
 
-    if not sql_query:
-        error_msg = "❌ No se pudo generar la consulta SQL. Por favor, reformula tu pregunta."
-        return {
-            "role": "assistant", "content": error_msg,
-            "data": None, "fig": None, "sql_query": None,
-        }
-
-    df_result, error_occurred, is_empty = execute_sql_query(client, sql_query)
-
-    if error_occurred:
-        error_msg = "❌ Error en la consulta. Por favor, verifica la sintaxis o reformula tu pregunta."
-        return {
-            "role": "assistant", "content": error_msg,
-            "data": None, "fig": None, "sql_query": sql_query,
-        }
-    elif is_empty:
-        explanation = generate_explanation(
-            client_ai, model_config, prompt, sql_query, None,
-        )
-        empty_msg = f"""
-        ### 📊 Consulta Ejecutada Correctamente
-        
-        La consulta SQL es válida y se ejecutó sin errores, pero **no se encontraron datos** que coincidan con tu pregunta.
+def get_cost_gate():
+    """Presupuesto de bytes de la sesión actual."""
+    if "cost_gate" not in st.session_state:
+        st.session_state.cost_gate = CostGate(MAX_BYTES_PER_QUERY, MAX_BYTES_PER_SESSION)
+    return st.session_state.cost_gate
 
-        ### 🤔 Análisis del Asistente de IA:
-        {explanation}
-        """
-        return {
-            "role": "assistant", "content": empty_msg,
-            "data": None, "fig": None, "sql_query": sql_query,
-        }
-    else:
-        fig = create_visualization(df_result)
-        explanation = generate_explanation(
-            client_ai, model_config, prompt, sql_query, df_result
-        )
-        full_response = explanation
-        return {
-            "role": "assistant", "content": full_response,
-            "data": df_result, "fig": fig, "sql_query": sql_query,
-        }
 
+def get_prefetcher():
+    """Prefetch de consultas de seguimiento de la sesión actual."""
+    if "prefetcher" not in st.session_state:
+        st.session_state.prefetcher = create_prefetcher()
+    return st.session_state.prefetcher
 
-# Inicializar BigQuery
-client, tables_info = initialize_bigquery()
 
-if not client:
-    st.stop()
+@st.cache_data(ttl=3600)
+def get_tables_context(tables_info, schema_version):
+    # `schema_version` solo forma parte de la clave: al cambiar el esquema se reconstruye
+    return build_tables_context(tables_info)
+
+
+class StreamlitTurnRenderer(TurnRenderer):
+    """Pinta el turno en la burbuja del asistente: tabla, gráfico y explicación en streaming."""
+
+    def __init__(self):
+        self.text_slot = st.container()
+        self.status_slot = st.empty()
+        self.table_slot = st.empty()
+        self.chart_slot = st.empty()
+        self.explained = False
+
+    def waiting(self, seconds):
+        # Pintar aquí es también lo que interrumpe el turno si se cierra la pestaña o la
+        # página se vuelve a ejecutar entera: Streamlit lanza su excepción y el job se cancela
+        self.status_slot.caption(f"⏳ Consulta en BigQuery en curso ({seconds:.0f} s)...")
+
+    def first_page(self, df_page):
+        self.status_slot.empty()
+        self.table_slot.dataframe(df_page, use_container_width=True)
+
+    def result(self, df_result):
+        self.status_slot.empty()
+        self.table_slot.dataframe(df_result, use_container_width=True)
+
+    def figure(self, fig):
+        if fig is not None:
+            self.chart_slot.plotly_chart(fig, use_container_width=True)
+
+    def explanation(self, chunks, header=None):
+        self.explained = True
+        if header:
+            self.text_slot.markdown(header)
+        return self.text_slot.write_stream(chunks)
+
+
+@st.fragment(run_every=SIDEBAR_REFRESH_SECONDS)
+def render_stats(prefetch_mode):
+    """Contadores de la barra lateral; se refrescan solos sin volver a ejecutar la página."""
+    cache_stats = get_sql_cache().stats()
+    st.caption(
+        f"⚡ Caché SQL: {cache_stats['hits']} aciertos • "
+        f"{cache_stats['misses']} fallos • {cache_stats['entries']} plantillas"
+    )
+    result_stats = get_result_cache().stats()
+    st.caption(
+        f"💾 Caché resultados: {result_stats['hits']} aciertos • "
+        f"{result_stats['misses']} fallos • "
+        f"{result_stats['bytes_saved'] / 1024**3:.2f} GB ahorrados"
+    )
+    flight_stats = get_single_flight().stats()
+    st.caption(f"🔗 Peticiones compartidas entre sesiones: {flight_stats['shared']}")
+    cost_gate = get_cost_gate()
+    st.caption(
+        f"💸 Presupuesto de sesión: {format_bytes(cost_gate.spent)} de "
+        f"{format_bytes(cost_gate.max_bytes_per_session)}"
+    )
+    if prefetch_mode:
+        prefetch_stats = get_prefetcher().stats()
+        st.caption(
+            f"🔮 Prefetch: {prefetch_stats['hits']} aciertos en {prefetch_stats['turns']} turnos "
+            f"({prefetch_stats['hit_rate']:.0%}) • {prefetch_stats['completed']} precargadas • "
+            f"{format_bytes(prefetch_stats['bytes_processed'])} procesados"
+        )
+    history_footprint = get_history().footprint()
+    st.caption(
+        f"🧠 Historial: {history_footprint['messages']} mensajes • "
+        f"{format_bytes(history_footprint['memory_bytes'])} en memoria • "
+        f"{format_bytes(history_footprint['disk_bytes'])} en disco"
+    )
+
 
-tables_context = build_tables_context(tables_info=tables_info)
+# BigQuery se conecta en segundo plano; hasta entonces las tablas salen de la instantánea
+bigquery_connection = start_bigquery()
+tables_info = get_tables_info()
+tables_context = get_tables_context(tables_info, get_schema_catalog().version)
 
 # --- SIDEBAR - ACTUALIZADA PARA NATALIDAD ---
 with st.sidebar:
@@ -508,12 +449,48 @@ with st.sidebar:
     )
     if gemini_api_key:
         st.success("✅ API Key configurada")
+        gemini_gateway = start_gemini(gemini_api_key)
+        if not gemini_gateway.done():
+            st.caption("⏳ Preparando el cliente de Gemini...")
+        elif gemini_gateway.exception() is None:
+            gateway_stats = gemini_gateway.result().stats()
+            st.caption(
+                f"🚦 Gemini: {gateway_stats['calls']} llamadas • "
+                f"{gateway_stats['retries']} reintentos • {gateway_stats['waiting']} en cola"
+            )
     else:
         st.warning("⚠️ API Key requerida")
+    approximate_mode = st.toggle(
+        "⚡ Modo aproximado",
+        help=(
+            f"Responde con una muestra del {APPROX_SAMPLE_PERCENT:g} % de la tabla y agregados "
+            "aproximados, con su margen de error. La respuesta exacta se puede pedir después."
+        ),
+    )
+    prefetch_mode = st.toggle(
+        "🔮 Precargar seguimientos",
+        value=PREFETCH_FOLLOW_UPS,
+        help=(
+            "Tras cada respuesta, ejecuta en segundo plano la misma consulta por estado, año, "
+            "sexo y pluralidad, con un presupuesto de bytes propio, para que la siguiente "
+            "pregunta sea inmediata si coincide."
+        ),
+    )
+    if not prefetch_mode and "prefetcher" in st.session_state:
+        get_prefetcher().cancel()
 
     st.markdown("### 📊 Base de Datos")
-    st.success("✅ BigQuery Conectado")
+    if not bigquery_connection.done():
+        st.info("⏳ Conectando con BigQuery...")
+    elif bigquery_connection.exception() is None:
+        st.success("✅ BigQuery Conectado")
+    else:
+        st.error("❌ Sin conexión con BigQuery")
+        if st.button("🔄 Reintentar conexión", key="bigquery_retry"):
+            start_bigquery.clear()
+            st.rerun()
     st.info("Datos de natalidad de EE.UU. (1969-2008)")
+    render_stats(prefetch_mode)
 
     st.markdown("### 📋 Fuente de Datos")
     # Expander actualizado para la tabla de natalidad
@@ -523,95 +500,223 @@ with st.sidebar:
         st.write("• Datos demográficos de los padres")
         st.write("• Información por estado y año")
 
-# --- MAIN CONTENT - ACTUALIZADO PARA NATALIDAD ---
-st.markdown(
-    """
-<div class="main-header">
-    <h1>👶 Dashboard de Análisis de Natalidad</h1>
-    <p>🤖 Analiza estadísticas de nacimientos en EE.UU. con IA • Obtén insights sobre peso, gestación y tendencias demográficas.</p>
-</div>
-""",
-    unsafe_allow_html=True,
-)
+# --- CHAT INTERFACE ---
+STAGE_LABELS = {
+    "sql_generation": "SQL",
+    "validation": "validación",
+    "cube": "cubo",
+    "approximation": "aproximación",
+    "dry_run": "dry run",
+    "execution": "ejecución",
+    "result_cache": "caché",
+    "query": "job",
+    "download": "descarga",
+    "digest": "resumen",
+    "visualization": "gráfico",
+    "explanation": "explicación",
+    "prefetch": "prefetch",
+    "follow_up": "refinamiento",
+}
+
+
+def format_timings(timings):
+    """Desglose de tiempos del turno; las subetapas van entre paréntesis tras su etapa."""
+    parts = []
+    for timing in timings:
+        text = f"{STAGE_LABELS.get(timing['name'], timing['name'])} {timing['ms']:,.0f} ms"
+        if timing["parent"] and parts:
+            head, _, inner = parts[-1].partition(" (")
+            inner = f"{inner[:-1]}, {text}" if inner else text
+            parts[-1] = f"{head} ({inner})"
+        else:
+            parts.append(text)
+    return " • ".join(parts)
+
+
+def render_refinement(message):
+    """Calcula en segundo plano la respuesta exacta de un mensaje aproximado."""
+    refinements = st.session_state.setdefault("refinements", {})
+    refinement = refinements.get(message["id"])
+    if refinement is None:
+        if st.button("🎯 Calcular la respuesta exacta", key=f"refine_{message['id']}"):
+            future, reason = refine_exact_answer(
+                get_bigquery_client(), message["exact_sql"], get_cost_gate(),
+                owner=get_session_id(),
+            )
+            refinements[message["id"]] = {"future": future, "reason": reason, "recorded": False}
+            st.rerun(scope="fragment")
+        return
+    if refinement["reason"]:
+        st.caption(f"💸 No se calculó la respuesta exacta. {refinement['reason']}")
+        return
+    if not refinement["future"].done():
+        st.caption("⏳ Calculando la respuesta exacta en segundo plano...")
+        st.button("🔄 Actualizar", key=f"refine_poll_{message['id']}")
+        return
+    df_exact, error_occurred, _, bytes_processed = refinement["future"].result()
+    if not refinement["recorded"]:
+        get_cost_gate().record(bytes_processed or 0)
+        refinement["recorded"] = True
+    if error_occurred or df_exact is None:
+        st.caption("❌ No se pudo calcular la respuesta exacta")
+        return
+    st.markdown("### 🎯 Respuesta exacta:")
+    st.dataframe(df_exact.head(HISTORY_PREVIEW_ROWS), use_container_width=True)
+
+
+def render_details(message):
+    """SQL generada, tiempos y costes de una respuesta."""
+    if message["role"] == "assistant" and message.get("sql_query"):
+        with st.expander("📝 Ver Consulta SQL Generada", expanded=False):
+            st.code(message["sql_query"], language="sql")
+            if message.get("timings"):
+                st.caption("⏱️ " + format_timings(message["timings"]))
+            if message.get("digest_tokens") is not None:
+                st.caption(
+                    f"🧾 Resumen para el modelo: ~{message['digest_tokens']:,} tokens "
+                    f"({message['digest_ms']:.0f} ms)"
+                )
+            if message.get("prompt_tokens_saved"):
+                st.caption(
+                    f"♻️ Tokens de prompt servidos desde la caché de contexto: "
+                    f"{message['prompt_tokens_saved']:,}"
+                )
+            if message.get("follow_up"):
+                st.caption("🔎 Refinamiento del resultado anterior, sin llamar al modelo")
+            elif message.get("answered_locally"):
+                st.caption("⚡ Respondida desde el cubo local, sin consultar BigQuery")
+            if message.get("prefetch_hit"):
+                st.caption("🔮 Resultado precargado en segundo plano tras la respuesta anterior")
+            if message.get("bytes_estimated") is not None or message.get("bytes_processed") is not None:
+                st.caption(
+                    f"💸 Bytes estimados: {format_bytes(message.get('bytes_estimated'))} • "
+                    f"Bytes procesados: {format_bytes(message.get('bytes_processed'))}"
+                )
 
-st.markdown("### 💡 ¿Qué puedes preguntar?")
-col1, col2 = st.columns(2)
-# Columnas de ejemplos actualizadas
-with col1:
-    st.markdown(
-        """
-        **📊 Estadísticas Generales**
-        - ¿Cuál es el peso promedio al nacer en el año 2005?
-        - Muestra los 20 pesos más elevados de los recien nacidos en el año 2005
-        """
-    )
-with col2:
-    st.markdown(
-        """
-        **🔬 Análisis y Comparaciones**
-        - Analiza la tendencia de la edad promedio de la madre entre 2000 y 2008.
-        - ¿Cuál es la cantidad de nacimientos de gemelos (plurality=2) por año desde 1990 hasta 1995?
-        """
-    )
 
-st.markdown("### 🎯 Ejemplos específicos para copiar y pegar:")
-# Ejemplos de "copia y pega" actualizados
-st.markdown(
+def render_message(message, full=True):
+    """Pinta un mensaje; los antiguos solo cargan sus datos del disco si se piden."""
+    history = get_history()
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        render_details(message)
+        if message.get("exact_sql"):
+            render_refinement(message)
+        if not message.get("data_path"):
+            return
+        if not full and not st.toggle("📊 Mostrar resultados", key=f"show_results_{message['id']}"):
+            return
+        preview = history.preview(message)
+        if preview is None:
+            st.caption("🗑️ Los resultados de este mensaje ya no están disponibles")
+            return
+        st.markdown("### 📊 Resultados:")
+        st.dataframe(preview, use_container_width=True)
+        total_rows = message.get("total_rows") or len(preview)
+        if total_rows > len(preview) or message.get("truncated"):
+            note = f"Mostrando {len(preview):,} de {total_rows:,} filas"
+            if message.get("truncated"):
+                note += f" • descarga limitada a {MAX_RESULT_ROWS:,} filas"
+            if message.get("result_path"):
+                note += f" • resultado completo en `{message['result_path']}`"
+            st.caption(note)
+        if message.get("fig_spec"):
+            # La figura se reconstruye desde su especificación en cada pintado
+            chart_data = preview if len(preview) >= total_rows else history.load_data(message)
+            # Si el fichero ya no está, el gráfico no se puede reconstruir con todas las filas
+            fig = None if chart_data is None else figure_from_spec(chart_data, message["fig_spec"])
+            if fig is not None:
+                st.plotly_chart(fig, use_container_width=True)
+
+
+def answer_pending(history, gemini_api_key, approximate_mode, prefetch_mode):
     """
-- *"Calcula el peso promedio en libras (`weight_pounds`) para los 10 estados con más nacimientos en 2007"*
-- *"Muestra la tendencia del número de nacimientos por año desde 2000 a 2008"*
-- *"Compara las semanas de gestación promedio para madres menores de 20 años vs. madres mayores de 35 en el año 2005"*
-"""
-)
-
-st.markdown("---")
-# --- CHAT INTERFACE (sin cambios en la lógica) ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-message_container = st.container()
-with message_container:
-    for i, message in enumerate(st.session_state.messages):
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if message["role"] == "assistant" and message.get("sql_query"):
-                with st.expander("📝 Ver Consulta SQL Generada", expanded=False):
-                    st.code(message["sql_query"], language="sql")
-            if message.get("data") is not None:
-                st.markdown("### 📊 Resultados:")
-                st.dataframe(message["data"], use_container_width=True)
-            if message.get("fig") is not None:
-                st.plotly_chart(message["fig"], use_container_width=True)
-
-# Placeholder del input actualizado
-if prompt := st.chat_input(
-    "💬 Pregunta sobre peso al nacer, edad de la madre, etc..."
-):
-    st.session_state.messages.append(
-        {
-            "role": "user", "content": prompt,
-            "data": None, "fig": None, "sql_query": None, "processed": False,
-        }
-    )
-    st.rerun()
-
-if (
-    st.session_state.messages
-    and st.session_state.messages[-1]["role"] == "user"
-    and not st.session_state.messages[-1].get("processed")
-):
-    last_message = st.session_state.messages[-1]
+    Responde la última pregunta si aún no tiene respuesta y la pinta en su burbuja tal
+    como llega; la respuesta se añade al historial sin volver a ejecutar nada.
+    """
+    last_message = history[-1]
     prompt = last_message["content"]
-
-    # Spinner actualizado
-    with st.spinner("👶 Analizando datos de natalidad..."):
-        response_data = process_query(
-            prompt, gemini_api_key, client, tables_info, tables_context
+    # La respuesta anterior, por si la pregunta solo la ordena, filtra o recorta
+    previous = history[-2] if len(history) > 1 and history[-2]["role"] == "assistant" else None
+
+    # Aquí sí hace falta la conexión: se espera a que termine si aún está en curso
+    with st.spinner("⏳ Conectando con BigQuery..."):
+        client = get_bigquery_client()
+    if not client:
+        st.stop()
+    tables_info = get_tables_info()
+    tables_context = get_tables_context(tables_info, get_schema_catalog().version)
+    if gemini_api_key:
+        wait([start_gemini(gemini_api_key)])
+
+    # Cada etapa se pinta en la burbuja en cuanto está lista
+    with st.chat_message("assistant"):
+        renderer = StreamlitTurnRenderer()
+        # Spinner actualizado
+        with st.spinner("👶 Analizando datos de natalidad..."):
+            response_data = process_query(
+                prompt, gemini_api_key, client, tables_info, tables_context,
+                cost_gate=get_cost_gate(), renderer=renderer,
+                session_id=get_session_id(), approximate=approximate_mode,
+                prefetcher=get_prefetcher() if prefetch_mode else None,
+                previous=previous,
+            )
+        last_message["processed"] = True
+        message = history.append(response_data)
+        # Las respuestas de error no pasan por el renderer
+        if not renderer.explained:
+            renderer.text_slot.markdown(message["content"])
+        render_details(message)
+        if message.get("exact_sql"):
+            render_refinement(message)
+
+
+@st.fragment
+def render_chat(gemini_api_key, approximate_mode, prefetch_mode):
+    """
+    Conversación de la sesión. Es un fragmento: una pregunta nueva o un botón de un
+    mensaje solo vuelven a ejecutar esta función, y la cabecera, la barra lateral y
+    los ejemplos no se vuelven a pintar.
+    """
+    history = get_history()
+    message_container = st.container()
+    with message_container:
+        # Solo los últimos mensajes se pintan completos; los anteriores se paginan
+        first_full = max(0, len(history) - HISTORY_RENDER_LAST)
+        pages = st.session_state.get("history_pages", 1)
+        first_shown = max(0, first_full - pages * HISTORY_PAGE_SIZE)
+        if first_shown > 0 and st.button(
+            f"⬆️ Cargar mensajes anteriores ({first_shown} ocultos)", key="history_more"
+        ):
+            st.session_state.history_pages = pages + 1
+            st.rerun(scope="fragment")
+        for i in range(first_shown, len(history)):
+            render_message(history[i], full=i >= first_full)
+
+    # Placeholder del input actualizado. Dentro del fragmento el input va tras los
+    # mensajes en vez de fijo abajo; el turno nuevo se pinta encima, en el contenedor
+    if prompt := st.chat_input(
+        "💬 Pregunta sobre peso al nacer, edad de la madre, etc..."
+    ):
+        message = history.append(
+            {
+                "role": "user", "content": prompt,
+                "data": None, "fig": None, "sql_query": None, "processed": False,
+            }
         )
-    
-    last_message["processed"] = True
-    st.session_state.messages.append(response_data)
-    st.rerun()
+        with message_container:
+            render_message(message)
+
+    if (
+        history
+        and history[-1]["role"] == "user"
+        and not history[-1].get("processed")
+    ):
+        with message_container:
+            answer_pending(history, gemini_api_key, approximate_mode, prefetch_mode)
+
+
+render_chat(gemini_api_key, approximate_mode, prefetch_mode)
 
 # --- Footer actualizado ---
 st.markdown("---")
@@ -0,0 +1,349 @@
+"""Modo aproximado: muestreo de la tabla y agregados aproximados con márgenes de error"""
+
+import math
+
+import numpy as np
+import pandas as pd
+import sqlglot
+from sqlglot import exp
+
+from sql_validation import has_aggregate
+
+# Cuantil de la normal para márgenes al 95 %
+Z_95 = 1.96
+# Error relativo típico de APPROX_COUNT_DISTINCT (HyperLogLog++ con precisión 15)
+HLL_RELATIVE_ERROR = 1.04 / math.sqrt(2**15)
+QUANTILE_BUCKETS = 100
+# Prefijo de las columnas auxiliares que solo sirven para calcular márgenes
+_HELPER_PREFIX = "approx_aux_"
+# Agregados que ignoran NULL y admiten `IF(condición, x, NULL)` en lugar del WHERE
+_CONDITIONAL_AGGREGATES = (
+    exp.Count, exp.CountIf, exp.Sum, exp.Avg, exp.Min, exp.Max, exp.ApproxQuantiles,
+    exp.Stddev, exp.StddevSamp, exp.StddevPop, exp.Variance, exp.VariancePop,
+)
+
+
+class ApproximateQuery:
+    """SQL aproximada junto con la exacta y lo necesario para calcular sus márgenes."""
+
+    def __init__(self, sql, exact_sql, sample_percent, bounds, notes, table_rows=None, table_id=None):
+        self.sql = sql
+        self.exact_sql = exact_sql
+        self.sample_percent = sample_percent
+        # [(columna, tipo, columnas auxiliares)]
+        self.bounds = bounds
+        self.notes = notes
+        # Filas de la tabla si se escala con el estimador de razón
+        self.table_rows = table_rows
+        # proyecto.dataset.tabla que se muestrea
+        self.table_id = table_id
+
+
+def _own_aggregates(select):
+    """Agregados de esta SELECT: ni los de subconsultas ni la propia función de ventana."""
+    return [
+        node for node in select.find_all(exp.AggFunc)
+        if node.find_ancestor(exp.Select) is select
+        and not (isinstance(node.parent, exp.Window) and node.arg_key == "this")
+    ]
+
+
+def _distinct_windows_to_group_by(select):
+    """
+    `SELECT DISTINCT g, AGG(x) OVER (PARTITION BY g)` es como el modelo suele escribir
+    medianas exactas; se pasa a `GROUP BY g` para poder usar agregados aproximados.
+    """
+    if not select.args.get("distinct") or select.args.get("group"):
+        return
+    keys, windows = [], []
+    for projection in select.expressions:
+        node = projection.unalias()
+        if isinstance(node, exp.Column):
+            keys.append(node)
+        elif (
+            isinstance(node, exp.Window)
+            and isinstance(node.this, exp.AggFunc)
+            and not node.args.get("order")
+            and not node.args.get("spec")
+        ):
+            windows.append(node)
+        else:
+            return
+    key_names = {key.name.lower() for key in keys}
+    if not windows or any(
+        {column.name.lower() for column in window.args.get("partition_by") or []} != key_names
+        for window in windows
+    ):
+        return
+    for window in windows:
+        window.replace(window.this)
+    select.set("distinct", None)
+    if keys:
+        select.group_by(*[key.copy() for key in keys], copy=False)
+
+
+def _approx_quantile(value, quantile):
+    offset = round(quantile * QUANTILE_BUCKETS)
+    return exp.Bracket(
+        this=exp.ApproxQuantiles(this=value.copy(), expression=exp.Literal.number(QUANTILE_BUCKETS)),
+        expressions=[exp.Literal.number(offset)],
+        offset=0,
+        safe=False,
+    )
+
+
+def _bound_kind(projection):
+    """Tipo de margen de una proyección con alias formada por un único agregado."""
+    if not isinstance(projection, exp.Alias):
+        return None, None
+    node = projection.this
+    while isinstance(node, (exp.Round, exp.Cast, exp.Paren)):
+        node = node.this
+    if isinstance(node, exp.ApproxDistinct):
+        return "distinct", None
+    if isinstance(node, exp.CountIf) or (
+        isinstance(node, exp.Count) and not isinstance(node.this, exp.Distinct)
+    ):
+        return "count", None
+    if isinstance(node, exp.Sum):
+        return "sum", node.this
+    if isinstance(node, exp.Avg):
+        return "avg", node.this
+    return None, None
+
+
+def approximate_query(sql_query, sample_percent, table_name="natality", table_rows=None):
+    """
+    Reescribe una consulta agregada sobre `table_name` para responder en modo aproximado:
+    `TABLESAMPLE SYSTEM` sobre la tabla con COUNT/COUNTIF/SUM escalados,
+    `APPROX_COUNT_DISTINCT` en lugar de COUNT(DISTINCT) y `APPROX_QUANTILES` en lugar
+    de medianas y percentiles exactos.
+
+    Con `table_rows` (filas de la tabla según sus metadatos, o una función que las
+    devuelve a partir del id de la tabla que se muestrea) el escalado usa las filas
+    realmente muestreadas; sin él, el factor nominal 100/p.
+
+    Devuelve None si la consulta no admite la aproximación (devuelve filas sin agregar,
+    usa JOIN, CTE o UNION, o no lee de la tabla).
+    """
+    try:
+        tree = sqlglot.parse_one(sql_query, read="bigquery")
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(tree, exp.Select) or tree.args.get("with") or tree.args.get("joins"):
+        return None
+    source = tree.args.get("from_") or tree.args.get("from")
+    table = source.this if source is not None else None
+    if (
+        not isinstance(table, exp.Table)
+        or table.name.lower() != table_name
+        or table.args.get("sample")
+    ):
+        return None
+
+    _distinct_windows_to_group_by(tree)
+    if not has_aggregate(tree):
+        return None
+    table_id = ".".join(part.name for part in table.parts)
+
+    notes = []
+    approximated = False
+    for node in _own_aggregates(tree):
+        if isinstance(node, exp.Count) and isinstance(node.this, exp.Distinct):
+            node.replace(exp.ApproxDistinct(this=node.this.expressions[0].copy()))
+            approximated = True
+        elif isinstance(node, exp.Median):
+            node.replace(_approx_quantile(node.this, 0.5))
+            approximated = True
+        elif (
+            isinstance(node, (exp.PercentileCont, exp.PercentileDisc))
+            and isinstance(node.expression, exp.Literal)
+        ):
+            node.replace(_approx_quantile(node.this, float(node.expression.this)))
+            approximated = True
+    if tree.find(exp.ApproxQuantiles):
+        notes.append("Medianas y percentiles con `APPROX_QUANTILES` (sin margen calculado).")
+
+    # Un recuento de distintos no se puede escalar desde una muestra: se lee la tabla entera
+    has_distinct = any(isinstance(node, exp.ApproxDistinct) for node in _own_aggregates(tree))
+    if has_distinct:
+        sample_percent = 100
+        notes.append("Recuentos de distintos con `APPROX_COUNT_DISTINCT` sobre toda la tabla.")
+    if sample_percent >= 100 and not approximated:
+        return None
+
+    bounds_plan = []
+    for index, projection in enumerate(tree.expressions):
+        kind, value = _bound_kind(projection)
+        if kind == "distinct" or (kind and sample_percent < 100):
+            bounds_plan.append((projection.alias, kind, value and value.copy(), index))
+
+    # Columnas auxiliares para los márgenes; se quitan del resultado al aplicarlos
+    bounds = []
+    helper_nodes = []
+    for column, kind, value, index in bounds_plan:
+        helpers = []
+        if kind == "sum":
+            squares = exp.Sum(this=exp.Mul(this=value, expression=value.copy()))
+            helpers = [(f"{_HELPER_PREFIX}ss_{index}", squares)]
+        elif kind == "avg":
+            helpers = [
+                (f"{_HELPER_PREFIX}sd_{index}", exp.StddevSamp(this=value)),
+                (f"{_HELPER_PREFIX}n_{index}", exp.Count(this=value.copy())),
+            ]
+        for name, expression in helpers:
+            tree.select(exp.alias_(expression, name, copy=False), copy=False)
+            helper_nodes.append(expression)
+        bounds.append((column, kind, [name for name, _ in helpers]))
+
+    ratio = False
+    if sample_percent < 100:
+        table.set("sample", exp.TableSample(
+            method=exp.var("SYSTEM"), percent=exp.Literal.number(f"{sample_percent:g}")
+        ))
+        if callable(table_rows):
+            table_rows = table_rows(table_id)
+        ratio = bool(table_rows) and _sample_ratio_estimator(tree, table_rows, helper_nodes)
+        if not ratio:
+            _scale_aggregates(
+                tree, exp.Literal.number(f"{100 / sample_percent:.6g}"), helper_nodes
+            )
+        if any(isinstance(node, (exp.Min, exp.Max)) for node in _own_aggregates(tree)):
+            notes.append("MIN y MAX se calculan sobre la muestra y pueden no ser los extremos reales.")
+
+    return ApproximateQuery(
+        tree.sql(dialect="bigquery", pretty=True), sql_query, sample_percent, bounds, notes,
+        table_rows=table_rows if ratio else None, table_id=table_id,
+    )
+
+
+def _scale_aggregates(select, scale, skip):
+    """Multiplica COUNT/COUNTIF/SUM por `scale`, salvo los agregados auxiliares de `skip`."""
+    skip_ids = {id(node) for node in skip}
+    targets = [
+        node for node in _own_aggregates(select)
+        if isinstance(node, (exp.Count, exp.CountIf, exp.Sum)) and id(node) not in skip_ids
+    ]
+    for node in targets:
+        scaled = exp.Mul(this=node.copy(), expression=scale.copy())
+        if isinstance(node, exp.Sum):
+            node.replace(exp.Paren(this=scaled))
+        else:
+            node.replace(exp.Round(this=scaled))
+
+
+def _sample_ratio_estimator(select, table_rows, helper_nodes):
+    """
+    Escala por filas de la tabla / filas realmente muestreadas en lugar de por 100/p.
+
+    `TABLESAMPLE SYSTEM` elige bloques enteros, así que el número de filas leídas varía
+    bastante de una ejecución a otra y escalar por 100/p sesga todos los recuentos a la
+    vez. Para contar las filas de la muestra antes del filtro, el WHERE se convierte en
+    agregados condicionales y los grupos sin filas que lo cumplan se quitan con QUALIFY,
+    que se evalúa después de la ventana que suma la muestra. El HAVING también pasa a
+    QUALIFY: sus agregados quedan escalados por esa ventana y BigQuery no admite
+    funciones analíticas en HAVING. Devuelve False si la consulta usa agregados que no
+    se pueden hacer condicionales o un filtro que no se puede llevar a QUALIFY.
+    """
+    where = select.args.get("where")
+    aggregates = _own_aggregates(select)
+    if where is not None and not all(isinstance(node, _CONDITIONAL_AGGREGATES) for node in aggregates):
+        return False
+    grouped = select.args.get("group") is not None
+    having = select.args.get("having")
+    if (grouped or having is not None) and select.args.get("qualify"):
+        return False
+    # BigQuery solo admite QUALIFY junto a WHERE, GROUP BY o HAVING, y el WHERE se quita
+    if having is not None and not grouped:
+        return False
+
+    if where is not None:
+        condition = where.this
+        select.set("where", None)
+        for node in aggregates:
+            if isinstance(node, exp.Count) and isinstance(node.this, exp.Star):
+                node.replace(exp.CountIf(this=condition.copy()))
+            elif isinstance(node, exp.CountIf):
+                node.set("this", exp.and_(exp.paren(condition.copy()), exp.paren(node.this)))
+            else:
+                node.set("this", exp.If(this=condition.copy(), true=node.this, false=exp.Null()))
+
+    sampled_rows = exp.Window(this=exp.Sum(this=exp.Count(this=exp.Star())))
+    scale = exp.Div(this=exp.Literal.number(table_rows), expression=sampled_rows)
+    _scale_aggregates(select, scale, helper_nodes)
+    select.select(exp.alias_(sampled_rows.copy(), f"{_HELPER_PREFIX}sample_rows"), copy=False)
+
+    keep = None
+    if where is not None and grouped:
+        keep = exp.GT(this=exp.CountIf(this=condition.copy()), expression=exp.Literal.number(0))
+    if having is not None:
+        select.set("having", None)
+        keep = having.this if keep is None else exp.and_(keep, exp.paren(having.this))
+    if keep is not None:
+        select.set("qualify", exp.Qualify(this=keep))
+    return True
+
+
+def apply_error_bounds(df_result, approximation):
+    """
+    Añade `<columna>_margen` (± al 95 %) a las columnas con margen conocido, quita las
+    auxiliares y devuelve `(df, {columna: error relativo máximo})`.
+
+    Los márgenes suponen que las filas están repartidas al azar entre los bloques de la
+    tabla; si los datos están muy agrupados por bloque son optimistas.
+    """
+    df = df_result.copy()
+    relative_errors = {}
+    sample_rows = None
+    if approximation.table_rows and f"{_HELPER_PREFIX}sample_rows" in df.columns:
+        sample_rows = _numeric(df[f"{_HELPER_PREFIX}sample_rows"])
+        total_rows = approximation.table_rows
+        fraction = sample_rows / total_rows
+    else:
+        fraction = approximation.sample_percent / 100
+    for column, kind, helpers in approximation.bounds:
+        if column not in df.columns:
+            continue
+        values = _numeric(df[column])
+        if kind == "avg":
+            margin = Z_95 * _numeric(df[helpers[0]]) / np.sqrt(_numeric(df[helpers[1]]))
+        elif kind == "distinct":
+            margin = Z_95 * HLL_RELATIVE_ERROR * values
+        elif sample_rows is not None:
+            # Estimador de razón: N · media por fila muestreada de la variable
+            mean = values / total_rows
+            if kind == "count":
+                variance = mean * (1 - mean)
+            else:
+                variance = (_numeric(df[helpers[0]]) / sample_rows - mean**2).clip(lower=0)
+            margin = Z_95 * total_rows * np.sqrt(variance * (1 - fraction) / sample_rows)
+        elif kind == "count":
+            margin = Z_95 * np.sqrt(values.clip(lower=0) / fraction * (1 - fraction))
+        else:
+            margin = Z_95 / fraction * np.sqrt((1 - fraction) * _numeric(df[helpers[0]]))
+        df[f"{column}_margen"] = margin.round(6)
+        relative = (margin / values.abs()).replace([np.inf, -np.inf], np.nan).max()
+        relative_errors[column] = None if pd.isna(relative) else round(float(relative), 5)
+    helper_columns = [column for column in df.columns if column.startswith(_HELPER_PREFIX)]
+    df = df.drop(columns=helper_columns)
+    df.attrs = dict(df_result.attrs)
+    return df, relative_errors
+
+
+def _numeric(series):
+    return pd.to_numeric(series, errors="coerce").astype("float64")
+
+
+def approximation_label(approximation, relative_errors):
+    """Etiqueta en markdown que encabeza la explicación de una respuesta aproximada."""
+    parts = []
+    if approximation.sample_percent < 100:
+        parts.append(f"muestra del {approximation.sample_percent:g} % de la tabla")
+    known = [error for error in relative_errors.values() if error is not None]
+    if known:
+        parts.append(f"error máximo ±{max(known) * 100:.2f} % (95 %)")
+    label = "⚡ **Respuesta aproximada**"
+    if parts:
+        label += " · " + " · ".join(parts)
+    notes = "".join(f"\n- {note}" for note in approximation.notes)
+    return f"{label}{notes}\n\n"
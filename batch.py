@@ -0,0 +1,294 @@
+"""
+Modo por lotes sin interfaz: preguntas de un JSONL por el pipeline completo.
+
+Cada línea de entrada es `{"id": ..., "question": ...}` (sin `id` se usa el número
+de línea). En el directorio de salida se escribe, según termina cada pregunta, una
+línea en `results.jsonl` con la SQL, la explicación, el estado y los tiempos, y el
+resultado en `data/<id>.parquet`. Al relanzar con el mismo directorio se saltan las
+preguntas ya respondidas, así que una ejecución interrumpida se reanuda:
+
+    python batch.py preguntas.jsonl --output runs/noche --workers 32
+    python batch.py preguntas.jsonl --output runs/prueba --fake
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# El pipeline lee su configuración del entorno al importarse, tras cargar el .env
+import gateway  # noqa: E402
+import pipeline  # noqa: E402
+from cost_gate import CostGate  # noqa: E402
+from jobs import BATCH, INTERACTIVE  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FILE = "results.jsonl"
+DATA_DIR = "data"
+# Estados que cuentan como respondidos al reanudar; los errores se reintentan
+DONE_STATUSES = ("ok", "empty")
+_UNSAFE_ID = re.compile(r"[^\w.-]+")
+
+
+def read_questions(path):
+    """[(id, pregunta)] del JSONL; las líneas vacías o sin pregunta se ignoran."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                logger.warning("Línea %s de %s no es JSON válido", line_number, path)
+                continue
+            question = item.get("question")
+            if not question:
+                logger.warning("Línea %s de %s sin pregunta", line_number, path)
+                continue
+            questions.append((str(item.get("id", line_number)), question))
+    return questions
+
+
+def completed_ids(output_dir):
+    """Ids ya respondidos en una ejecución anterior con el mismo directorio."""
+    done = set()
+    try:
+        with open(Path(output_dir) / RESULTS_FILE, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Una línea a medias de una ejecución cortada
+                    continue
+                if record.get("status") in DONE_STATUSES:
+                    done.add(record["id"])
+    except OSError:
+        pass
+    return done
+
+
+class BatchWriter:
+    """Escribe cada resultado en cuanto está listo: primero el Parquet y después su línea."""
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        (self.output_dir / DATA_DIR).mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(self.output_dir / RESULTS_FILE, "a", encoding="utf-8")
+
+    def write(self, question_id, question, response, elapsed_ms):
+        data = response.get("data")
+        data_path = None
+        if data is not None:
+            safe_id = _UNSAFE_ID.sub("_", question_id)
+            data_path = Path(DATA_DIR) / f"{safe_id}.parquet"
+            tmp_path = self.output_dir / f"{data_path}.tmp"
+            data.to_parquet(tmp_path, index=False, compression="zstd")
+            os.replace(tmp_path, self.output_dir / data_path)
+        record = {
+            "id": question_id,
+            "question": question,
+            "status": response.get("status", "error"),
+            "sql_query": response.get("sql_query"),
+            "content": response.get("content"),
+            "data_path": data_path and str(data_path),
+            "rows": None if data is None else len(data),
+            "total_rows": response.get("total_rows"),
+            "truncated": response.get("truncated"),
+            "bytes_processed": response.get("bytes_processed"),
+            "answered_locally": response.get("answered_locally"),
+            "elapsed_ms": round(elapsed_ms, 3),
+            "timings": response.get("timings"),
+            "trace_id": response.get("trace_id"),
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class _BatchRenderer(pipeline.TurnRenderer):
+    """Turno sin interfaz; si el lote se interrumpe, cancela su job en la siguiente espera."""
+
+    def __init__(self, session_id, interrupted):
+        self.session_id = session_id
+        self.interrupted = interrupted
+
+    def waiting(self, seconds):
+        if self.interrupted.is_set():
+            pipeline.get_job_manager().cancel_owner(self.session_id, "interrupted")
+
+
+def run_batch(
+    questions, output_dir, bigquery_client, model_gateway, tables_info=None,
+    workers=16, cost_gate=None, approximate=False, on_result=None, priority=BATCH,
+):
+    """
+    Responde `questions` ([(id, pregunta)]) con `process_query` en un pool de
+    `workers` hilos y escribe cada resultado en `output_dir` según termina.
+
+    La concurrencia con el modelo la limita `model_gateway` (su `max_concurrency`) y
+    la de BigQuery, `BIGQUERY_MAX_CONCURRENCY` del pipeline. Las preguntas ya
+    respondidas en `output_dir` se saltan. `on_result(id, estado)` se llama tras
+    escribir cada una. Los jobs salen con prioridad `priority` (batch por defecto:
+    BigQuery los encola hasta tener huecos libres) y, si el lote se interrumpe, los
+    que estén en curso o se lancen después se cancelan. Devuelve {estado: número de preguntas}.
+    """
+    tables_info = tables_info or pipeline.load_schema_snapshot()
+    tables_context = pipeline.build_tables_context(tables_info)
+    model_config = pipeline.default_model_config()
+    done = completed_ids(output_dir)
+    pending = [(question_id, question) for question_id, question in questions if question_id not in done]
+    counts = {"skipped": len(questions) - len(pending)}
+    counts_lock = threading.Lock()
+    interrupted = threading.Event()
+    writer = BatchWriter(output_dir)
+
+    def answer(item):
+        question_id, question = item
+        if interrupted.is_set():
+            return
+        session_id = f"batch-{question_id}"
+        start = time.perf_counter()
+        try:
+            response = pipeline.process_query(
+                question, None, bigquery_client, tables_info, tables_context,
+                cost_gate=cost_gate, session_id=session_id, approximate=approximate,
+                gemini=(model_gateway.session_client(session_id), model_config),
+                priority=priority, renderer=_BatchRenderer(session_id, interrupted),
+            )
+        except Exception as e:
+            logger.exception("Error en la pregunta %s", question_id)
+            response = {"content": f"❌ {e}", "data": None, "sql_query": None, "status": "exception"}
+        writer.write(question_id, question, response, (time.perf_counter() - start) * 1000)
+        status = response.get("status", "error")
+        with counts_lock:
+            counts[status] = counts.get(status, 0) + 1
+        if on_result is not None:
+            on_result(question_id, status)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+            # `answer` no lanza: cada error queda registrado en su propia línea
+            try:
+                for _ in executor.map(answer, pending):
+                    pass
+            except BaseException:
+                # Ctrl+C: no se espera a los jobs en curso, que se reintentan al reanudar; los
+                # turnos que aún no habían lanzado el suyo lo cancelan al empezar a esperarlo
+                interrupted.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                pipeline.get_job_manager().cancel_all("interrupted")
+                raise
+    finally:
+        writer.close()
+    return counts
+
+
+def fake_backends(args):
+    """Cliente de BigQuery y de Gemini locales (ver `fakes.py`) para probar el lote sin red."""
+    import fakes
+
+    bigquery_client = fakes.FakeBigQueryClient(rows=args.fake_rows, latency=args.fake_bq_latency)
+    gemini_client = fakes.FakeGeminiClient(latency=args.fake_model_latency)
+    return bigquery_client, gemini_client
+
+
+def real_backends(args):
+    from google import genai
+    from google.cloud import bigquery
+
+    api_key = args.api_key or os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise SystemExit("🔑 Falta la API key de Gemini (--api-key o GEMINI_API_KEY).")
+    return bigquery.Client(), genai.Client(api_key=api_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("questions", help="JSONL con una pregunta por línea")
+    parser.add_argument("--output", required=True, help="Directorio de resultados (se reanuda)")
+    parser.add_argument("--workers", type=int, default=16, help="Preguntas en paralelo")
+    parser.add_argument("--model-concurrency", type=int, default=8,
+                        help="Llamadas simultáneas al modelo")
+    parser.add_argument("--model-rate", type=float, default=None,
+                        help="Llamadas por segundo al modelo (por defecto GEMINI_RATE_PER_SECOND)")
+    parser.add_argument("--bigquery-concurrency", type=int, default=8,
+                        help="Jobs de BigQuery simultáneos")
+    parser.add_argument("--max-bytes", type=int, default=None,
+                        help="Presupuesto de bytes de todo el lote (por defecto, sin control)")
+    parser.add_argument("--approximate", action="store_true", help="Responder en modo aproximado")
+    parser.add_argument("--priority", choices=("batch", "interactive"), default="batch",
+                        help="Prioridad de los jobs de BigQuery (batch: más lentos en arrancar, "
+                        "no cuentan para el límite de consultas interactivas)")
+    parser.add_argument("--api-key", help="API key de Gemini (por defecto GEMINI_API_KEY)")
+    parser.add_argument("--fake", action="store_true", help="Usar BigQuery y Gemini falsos")
+    parser.add_argument("--fake-rows", type=int, default=1000)
+    parser.add_argument("--fake-bq-latency", type=float, default=0.1)
+    parser.add_argument("--fake-model-latency", type=float, default=0.05)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    # Antes del primer job: el semáforo se crea con el valor vigente
+    pipeline.BIGQUERY_MAX_CONCURRENCY = args.bigquery_concurrency
+    bigquery_client, gemini_client = fake_backends(args) if args.fake else real_backends(args)
+    rate = args.model_rate or pipeline.GEMINI_RATE_PER_SECOND
+    model_gateway = gateway.ModelGateway(
+        gemini_client,
+        rate_per_second=rate,
+        burst=max(pipeline.GEMINI_BURST, int(rate)),
+        max_concurrency=args.model_concurrency,
+        max_retries=pipeline.GEMINI_MAX_RETRIES,
+        backoff_base=pipeline.GEMINI_BACKOFF_BASE,
+        backoff_max=pipeline.GEMINI_BACKOFF_MAX,
+    )
+    tables_info = list(pipeline.DEFAULT_TABLES)
+    if not args.fake:
+        pipeline.refresh_schema(bigquery_client, tables_info)
+    cost_gate = (
+        CostGate(pipeline.MAX_BYTES_PER_QUERY, args.max_bytes) if args.max_bytes else None
+    )
+
+    questions = read_questions(args.questions)
+    total = len(questions)
+    finished = [0]
+    start = time.perf_counter()
+
+    def progress(question_id, status):
+        finished[0] += 1
+        if finished[0] % 10 == 0:
+            elapsed = time.perf_counter() - start
+            logger.info("%s respondidas • %.2f preguntas/s", finished[0], finished[0] / elapsed)
+
+    counts = run_batch(
+        questions, args.output, bigquery_client, model_gateway, tables_info=tables_info,
+        workers=args.workers, cost_gate=cost_gate, approximate=args.approximate,
+        on_result=progress, priority=BATCH if args.priority == "batch" else INTERACTIVE,
+    )
+    elapsed = time.perf_counter() - start
+    answered = total - counts["skipped"]
+    print(
+        f"✅ {total} preguntas: {counts.get('ok', 0)} con datos • {counts.get('empty', 0)} vacías • "
+        f"{answered - counts.get('ok', 0) - counts.get('empty', 0)} sin respuesta • "
+        f"{counts['skipped']} ya respondidas • {answered / elapsed:.2f} preguntas/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
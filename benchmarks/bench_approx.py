@@ -0,0 +1,183 @@
+"""
+Precisión y velocidad del modo aproximado frente a la respuesta exacta.
+
+Crea una tabla de natalidad sintética en DuckDB (`pip install duckdb`), ejecuta cada
+consulta exacta y su versión de `approx.approximate_query` traducidas con sqlglot, y
+mide el error relativo y la cobertura de los márgenes al 95 %. La cobertura mínima
+solo se exige a los agregados escalados desde la muestra: el HyperLogLog de DuckDB no
+es el de BigQuery, así que `APPROX_COUNT_DISTINCT` solo se informa:
+
+    python -m benchmarks.bench_approx --rows 5000000 --percent 5
+    python -m benchmarks.bench_approx --save benchmarks/baselines/approx.json
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import sqlglot
+from sqlglot import exp
+
+from approx import apply_error_bounds, approximate_query
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+TABLE = "`bigquery-public-data.samples.natality`"
+# (nombre, SQL exacta de BigQuery, columnas de agrupación)
+QUERIES = [
+    ("nacimientos_por_año", f"SELECT year, COUNT(*) AS nacimientos FROM {TABLE} GROUP BY year", ["year"]),
+    ("peso_por_estado", f"SELECT state, AVG(weight_pounds) AS peso FROM {TABLE} GROUP BY state", ["state"]),
+    (
+        "nacimientos_ponderados",
+        f"SELECT year, SUM(record_weight) AS nacimientos FROM {TABLE} GROUP BY year",
+        ["year"],
+    ),
+    (
+        "varones_y_edad",
+        f"SELECT COUNTIF(is_male) AS varones, ROUND(AVG(mother_age), 2) AS edad FROM {TABLE} "
+        "WHERE year BETWEEN 2000 AND 2008",
+        [],
+    ),
+    (
+        "edades_distintas",
+        f"SELECT state, COUNT(DISTINCT mother_age) AS edades FROM {TABLE} GROUP BY state",
+        ["state"],
+    ),
+    (
+        "mediana_por_estado",
+        f"SELECT DISTINCT state, PERCENTILE_CONT(weight_pounds, 0.5) OVER (PARTITION BY state) "
+        f"AS mediana FROM {TABLE}",
+        ["state"],
+    ),
+]
+STATES = [f"S{i:02d}" for i in range(50)]
+# Estados de tamaños distintos, para que haya grupos grandes y pequeños
+STATE_WEIGHTS = np.linspace(1, 3, len(STATES)) / np.linspace(1, 3, len(STATES)).sum()
+
+
+def synthetic_natality(rows, seed=0):
+    """Tabla con la forma de `natality`, en orden aleatorio como los bloques de BigQuery."""
+    rng = np.random.default_rng(seed)
+    year = rng.integers(1969, 2009, rows)
+    return pd.DataFrame({
+        "year": year,
+        "state": pd.Categorical(rng.choice(STATES, rows, p=STATE_WEIGHTS)),
+        "weight_pounds": rng.normal(7.3, 1.2, rows).clip(1, 14),
+        "mother_age": rng.normal(27, 6, rows).clip(12, 50).round().astype("int64"),
+        "is_male": rng.random(rows) < 0.512,
+        # Antes de 1985 algunos estados solo enviaban el 50 % de los registros
+        "record_weight": np.where((year < 1985) & (rng.random(rows) < 0.3), 2, 1),
+    })
+
+
+def connect(rows):
+    import duckdb
+
+    connection = duckdb.connect()
+    connection.execute('ATTACH \':memory:\' AS "bigquery-public-data"')
+    connection.execute('CREATE SCHEMA "bigquery-public-data".samples')
+    connection.register("source", synthetic_natality(rows))
+    connection.execute('CREATE TABLE "bigquery-public-data".samples.natality AS SELECT * FROM source')
+    connection.unregister("source")
+    return connection
+
+
+def to_duckdb(sql_query, seed):
+    tree = sqlglot.parse_one(sql_query, read="bigquery")
+    sample = tree.find(exp.TableSample)
+    if sample is not None:
+        # Muestra reproducible para que el resultado no dependa de la ejecución
+        sample.set("seed", exp.Literal.number(seed))
+    return tree.sql(dialect="duckdb")
+
+
+def timed(connection, sql_query, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        df = connection.execute(sql_query).df()
+        samples.append((time.perf_counter() - start) * 1000)
+    return df, summarize(samples)
+
+
+def compare(exact, approximate, keys, relative_errors):
+    """Error relativo y cobertura del margen de cada columna aproximada."""
+    merged = exact.merge(approximate, on=keys, suffixes=("_exacto", "")) if keys else (
+        exact.add_suffix("_exacto").join(approximate)
+    )
+    columns = {}
+    for column in approximate.columns:
+        if column in keys or column.endswith("_margen") or f"{column}_exacto" not in merged:
+            continue
+        truth = merged[f"{column}_exacto"].astype("float64")
+        error = (merged[column].astype("float64") - truth).abs()
+        relative = error / truth.abs().where(truth != 0)
+        summary = {
+            "median_relative_error": round(float(relative.median()), 5),
+            "max_relative_error": round(float(relative.max()), 5),
+            "reported_max_relative_error": relative_errors.get(column),
+        }
+        if f"{column}_margen" in merged:
+            summary["coverage"] = round(float((error <= merged[f"{column}_margen"]).mean()), 3)
+        columns[column] = summary
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--percent", type=float, default=5.0, help="Porcentaje de la muestra")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--min-coverage", type=float, default=0.8,
+                        help="Fracción mínima de grupos cuyo valor exacto cae dentro del margen")
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    try:
+        connection = connect(args.rows)
+    except ImportError:
+        sys.exit("Este benchmark necesita DuckDB: pip install duckdb")
+
+    results = {}
+    failures = []
+    for name, sql_query, keys in QUERIES:
+        approximation = approximate_query(sql_query, args.percent, table_rows=args.rows)
+        exact, exact_timing = timed(connection, to_duckdb(sql_query, args.seed), args.repeats)
+        approximate, approx_timing = timed(
+            connection, to_duckdb(approximation.sql, args.seed), args.repeats
+        )
+        approximate, relative_errors = apply_error_bounds(approximate, approximation)
+        columns = compare(exact, approximate, keys, relative_errors)
+        kinds = {column: kind for column, kind, _ in approximation.bounds}
+        results[name] = {"exact": exact_timing, "approx": approx_timing, "columns": columns}
+        print(
+            f"{name:<24} exacta p50 {exact_timing['p50_ms']:8.1f} ms • "
+            f"aproximada p50 {approx_timing['p50_ms']:8.1f} ms"
+        )
+        for column, summary in columns.items():
+            coverage = summary.get("coverage")
+            print(
+                f"    {column:<14} error mediano {summary['median_relative_error']:.2%} • "
+                f"máximo {summary['max_relative_error']:.2%}"
+                + (f" • cobertura del margen {coverage:.0%}" if coverage is not None else "")
+            )
+            sampled = kinds.get(column) != "distinct"
+            if sampled and coverage is not None and coverage < args.min_coverage:
+                failures.append(f"{name}.{column}: cobertura {coverage:.0%}")
+
+    if args.save:
+        save_baseline(args.save, "approx", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    regressions = compare_to_baseline(args.compare, results, args.tolerance) if args.compare else []
+    for problem in failures + regressions:
+        print(f"REGRESIÓN {problem}")
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
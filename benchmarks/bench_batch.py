@@ -0,0 +1,127 @@
+"""
+Modo por lotes: preguntas por segundo según los hilos y reanudación sin duplicados.
+
+Responde el mismo JSONL de preguntas con distintos `--workers`, con BigQuery y Gemini
+falsos, y mide el rendimiento con los topes de concurrencia del modelo y de BigQuery
+fijos. Después corta un lote a la mitad, lo relanza sobre el mismo directorio y
+comprueba que cada pregunta queda escrita una sola vez:
+
+    python -m benchmarks.bench_batch --questions 200 --workers 1 8 32
+    python -m benchmarks.bench_batch --save benchmarks/baselines/batch.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks.bench_pipeline import question_for, reset_pipeline, responder
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+
+def run(batch, pipeline, fakes, gateway, args, directory, questions, workers):
+    reset_pipeline(pipeline, directory)
+    pipeline.BIGQUERY_MAX_CONCURRENCY = args.bigquery_concurrency
+    pipeline.get_bigquery_slots.cache_clear()
+    bigquery_client = fakes.FakeBigQueryClient(rows=args.rows, latency=args.bq_latency)
+    gemini_client = fakes.FakeGeminiClient(responder=responder, latency=args.gemini_latency)
+    model_gateway = gateway.ModelGateway(
+        gemini_client, rate_per_second=args.model_rate, burst=int(args.model_rate),
+        max_concurrency=args.model_concurrency,
+    )
+    tables_info = ["bigquery-public-data.samples.natality"]
+
+    start = time.perf_counter()
+    counts = batch.run_batch(
+        questions, directory / "out", bigquery_client, model_gateway, tables_info=tables_info,
+        workers=workers,
+    )
+    elapsed = time.perf_counter() - start
+    with open(directory / "out" / batch.RESULTS_FILE, encoding="utf-8") as f:
+        latencies = [json.loads(line)["elapsed_ms"] for line in f]
+    return {
+        "questions_per_s": round((len(questions) - counts["skipped"]) / elapsed, 2),
+        "question": summarize(latencies),
+        "statuses": counts,
+        "queries": len(bigquery_client.queries),
+    }
+
+
+def run_resume(batch, pipeline, fakes, gateway, args, directory, questions):
+    """Mitad de las preguntas, luego todas sobre el mismo directorio."""
+    half = questions[:len(questions) // 2]
+    first = run(batch, pipeline, fakes, gateway, args, directory, half, args.workers[-1])
+    # reset_pipeline vacía las cachés, así que la segunda tanda no las aprovecha
+    second = run(batch, pipeline, fakes, gateway, args, directory, questions, args.workers[-1])
+    with open(directory / "out" / batch.RESULTS_FILE, encoding="utf-8") as f:
+        ids = Counter(json.loads(line)["id"] for line in f)
+    return {
+        "first_answered": len(half) - first["statuses"]["skipped"],
+        "second_skipped": second["statuses"]["skipped"],
+        "second_answered": len(questions) - second["statuses"]["skipped"],
+        "duplicates": sum(count - 1 for count in ids.values()),
+        "missing": len(questions) - len(ids),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--model-concurrency", type=int, default=8)
+    parser.add_argument("--model-rate", type=float, default=100.0)
+    parser.add_argument("--bigquery-concurrency", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=1000, help="Filas de cada resultado")
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--bq-latency", type=float, default=0.2)
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_batch_"))
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    import batch
+    import fakes
+    import gateway
+    import pipeline
+
+    questions = [(f"q{i}", question_for(i)) for i in range(args.questions)]
+    results = {}
+    for workers in args.workers:
+        result = run(batch, pipeline, fakes, gateway, args, work_dir / f"w{workers}", questions, workers)
+        results[f"workers_{workers}"] = result
+        print(
+            f"{workers:>3} hilos: {result['questions_per_s']:7.2f} preguntas/s • "
+            f"p50 {result['question']['p50_ms']:7.1f} ms • p95 {result['question']['p95_ms']:7.1f} ms • "
+            f"{result['queries']} consultas"
+        )
+    resume = run_resume(batch, pipeline, fakes, gateway, args, work_dir / "resume", questions)
+    results["resume"] = resume
+    print(
+        f"reanudación: {resume['first_answered']} en la primera tanda • "
+        f"{resume['second_skipped']} saltadas y {resume['second_answered']} nuevas en la segunda • "
+        f"{resume['duplicates']} duplicadas • {resume['missing']} sin escribir"
+    )
+
+    if args.save:
+        save_baseline(args.save, "batch", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    failed = resume["duplicates"] or resume["missing"]
+    if failed:
+        print("ERROR la reanudación repitió o perdió preguntas")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        failed = failed or regressions
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
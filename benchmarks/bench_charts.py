@@ -0,0 +1,96 @@
+"""
+Tiempo de construcción y tamaño de la figura con 1k, 100k y 1M filas.
+
+Para cada forma de resultado (serie temporal, dispersión, histograma, filas sueltas
+por año) mide `visualization_spec` + `figure_from_spec` (p50/p95) y los bytes del JSON
+que Plotly envía al navegador, que no deben crecer con las filas:
+
+    python -m benchmarks.bench_charts --rows 1000 100000 1000000
+    python -m benchmarks.bench_charts --save benchmarks/baselines/charts.json
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+
+def make_frames(rows, seed=0):
+    """Resultados sintéticos con las formas típicas de las preguntas de natalidad."""
+    rng = np.random.default_rng(seed)
+    return {
+        "serie_temporal": pd.DataFrame({
+            "date": pd.date_range("1969-01-01", periods=rows, freq="h"),
+            "nacimientos": rng.standard_normal(rows).cumsum() + 10000,
+        }),
+        "dispersion": pd.DataFrame({
+            "gestation_weeks": rng.normal(39, 2, rows),
+            "weight_pounds": rng.normal(7.3, 1.2, rows),
+        }),
+        "histograma": pd.DataFrame({"weight_pounds": rng.normal(7.3, 1.2, rows)}),
+        "filas_por_año": pd.DataFrame({
+            "year": rng.integers(1969, 2009, rows),
+            "mother_age": rng.normal(27, 6, rows),
+        }),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-points", type=int, default=2000)
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    import pipeline
+
+    pipeline.MAX_CHART_POINTS = args.max_points
+    # La primera figura paga la carga de las plantillas de Plotly
+    pipeline.create_visualization(make_frames(10)["histograma"])
+
+    results = {}
+    for rows in args.rows:
+        for shape, df in make_frames(rows).items():
+            samples = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                spec = pipeline.visualization_spec(df)
+                fig = pipeline.figure_from_spec(df, spec)
+                samples.append((time.perf_counter() - start) * 1000)
+            # En los mapas de calor cada celda cuenta como un punto
+            points = sum(
+                np.size(trace.z) if trace.type == "heatmap" else len(trace.x) for trace in fig.data
+            )
+            result = {
+                **summarize(samples),
+                "kind": spec["kind"],
+                "traces": sorted({trace.type for trace in fig.data}),
+                "points": points,
+                "payload_bytes": len(fig.to_json().encode("utf-8")),
+            }
+            results[f"{shape}_{rows}"] = result
+            print(
+                f"{shape:<16} {rows:>9,} filas: {result['kind']:<9} {result['points']:>6,} puntos • "
+                f"p50 {result['p50_ms']:8.1f} ms • {result['payload_bytes'] / 1024:8.1f} KB"
+            )
+
+    if args.save:
+        save_baseline(args.save, "charts", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
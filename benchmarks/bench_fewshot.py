@@ -0,0 +1,122 @@
+"""
+Recuperación de ejemplos few-shot: latencia de búsqueda, coste de las altas y acierto.
+
+Llena `fewshot.ExampleIndex` con preguntas sintéticas distintas (1k, 10k y 100k) y
+mide cada búsqueda (p50/p95/p99, que debe quedar por debajo del milisegundo) y cada
+alta. El acierto es la fracción de preguntas reformuladas (sin una palabra y con
+otro orden) cuya pregunta original sale entre las k primeras; al quitar una palabra
+varias originales empatan, así que el acierto en la primera posición no dice nada:
+
+    python -m benchmarks.bench_fewshot --entries 1000 10000 100000
+    python -m benchmarks.bench_fewshot --save benchmarks/baselines/fewshot.json
+"""
+
+import argparse
+import itertools
+import random
+import sys
+import time
+
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+from fewshot import ExampleIndex
+
+METRICS = [
+    "peso al nacer", "edad de la madre", "edad del padre", "semanas de gestación",
+    "nacimientos de gemelos", "puntuación apgar", "cigarrillos por día", "bebidas por semana",
+    "aumento de peso de la madre", "hijos nacidos vivos", "partos de trillizos",
+    "madres casadas", "madres fumadoras", "consumo de alcohol", "nacimientos de varones",
+    "raza del bebé", "raza de la madre", "hijos fallecidos", "registros ponderados",
+    "último periodo menstrual",
+]
+AGGREGATES = ["promedio", "máximo", "mínimo", "total", "mediana", "desviación"]
+DIMENSIONS = [
+    "por año", "por estado", "por mes", "por día de la semana", "por raza", "por pluralidad",
+    "por edad de la madre", "por sexo", "por estado civil", "por estado de residencia",
+]
+FILTERS = [
+    "desde 1990", "en Texas", "en California", "para madres adolescentes", "entre 2000 y 2008",
+    "para bebés prematuros", "en la década de los setenta", "solo gemelos",
+    "para madres mayores de 35", "en Nueva York",
+]
+EXTRAS = [
+    "", "ordenado de mayor a menor", "los diez primeros", "con porcentaje", "y su tendencia",
+    "comparado con la media", "agrupado por décadas", "sin valores nulos", "en libras",
+    "redondeado a dos decimales",
+]
+
+
+def synthetic_questions(count, seed=0):
+    combos = list(itertools.product(METRICS, AGGREGATES, DIMENSIONS, FILTERS, EXTRAS))
+    random.Random(seed).shuffle(combos)
+    return [
+        f"¿Cuál es el {aggregate} de {metric} {dimension} {filter_} {extra}".strip() + "?"
+        for metric, aggregate, dimension, filter_, extra in combos[:count]
+    ]
+
+
+def paraphrase(question, rng):
+    words = question.strip("¿?").split()
+    words.pop(rng.randrange(len(words)))
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--entries", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--max-search-ms", type=float, default=1.0,
+                        help="p95 máximo de una búsqueda")
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    for entries in args.entries:
+        questions = synthetic_questions(entries)
+        index = ExampleIndex(max_entries=entries)
+        add_samples = []
+        for i, question in enumerate(questions):
+            start = time.perf_counter()
+            index.add(question, f"SELECT {i}")
+            add_samples.append((time.perf_counter() - start) * 1000)
+
+        rng = random.Random(1)
+        targets = rng.sample(range(entries), min(args.queries, entries))
+        search_samples, hits = [], 0
+        for target in targets:
+            query = paraphrase(questions[target], rng)
+            start = time.perf_counter()
+            found = index.search(query, k=args.k)
+            search_samples.append((time.perf_counter() - start) * 1000)
+            hits += f"SELECT {target}" in [sql_query for _, _, sql_query in found]
+
+        result = {
+            "add": summarize(add_samples),
+            "search": summarize(search_samples),
+            "recall_at_k": round(hits / len(targets), 3),
+        }
+        results[f"entries_{entries}"] = result
+        print(
+            f"{entries:>7,} entradas: búsqueda p50 {result['search']['p50_ms']:.3f} ms • "
+            f"p95 {result['search']['p95_ms']:.3f} ms • alta p50 {result['add']['p50_ms']:.3f} ms • "
+            f"acierto@{args.k} {result['recall_at_k']:.0%}"
+        )
+        if result["search"]["p95_ms"] > args.max_search_ms:
+            failures.append(f"entries_{entries}: búsqueda p95 {result['search']['p95_ms']:.3f} ms")
+
+    if args.save:
+        save_baseline(args.save, "fewshot", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    regressions = compare_to_baseline(args.compare, results, args.tolerance) if args.compare else []
+    for problem in failures + regressions:
+        print(f"REGRESIÓN {problem}")
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
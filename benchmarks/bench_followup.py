@@ -0,0 +1,218 @@
+"""
+Refinamientos locales: respuesta igual a la de BigQuery y latencia sin modelo ni job.
+
+Cada conversación es una consulta base sobre una tabla de natalidad sintética en
+DuckDB (`pip install duckdb`) seguida de un refinamiento («ordénalo por peso», «solo
+Texas», «los 5 primeros»...). Para cada uno se compara el resultado de
+`followup.apply_follow_up` sobre el DataFrame anterior con el de ejecutar su SQL
+compuesta en DuckDB, y se mide el turno completo de `process_query` con la respuesta
+anterior (local) y sin ella (modelo y BigQuery falsos, con la SQL ya refinada):
+
+    python -m benchmarks.bench_followup --rows 1000000
+    python -m benchmarks.bench_followup --save benchmarks/baselines/followup.json
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import sqlglot
+
+from benchmarks.bench_approx import synthetic_natality
+from benchmarks.bench_pipeline import reset_pipeline
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+from followup import apply_follow_up, follow_up_sql, plan_follow_up
+from sql_cache import STATE_CODES
+
+TABLE = "`bigquery-public-data.samples.natality`"
+# (pregunta base, SQL de BigQuery que devolvería el modelo)
+BASES = [
+    (
+        "¿Cuál es el peso promedio al nacer por estado en 2005?",
+        f"SELECT state, ROUND(AVG(weight_pounds), 4) AS peso_promedio, COUNT(*) AS nacimientos "
+        f"FROM {TABLE} WHERE year = 2005 GROUP BY state ORDER BY state",
+    ),
+    (
+        "¿Cuántos nacimientos hubo cada año y con qué edad media de la madre?",
+        f"SELECT year, COUNT(*) AS nacimientos, ROUND(AVG(mother_age), 4) AS edad_madre "
+        f"FROM {TABLE} GROUP BY year ORDER BY year",
+    ),
+    (
+        "¿Cuántos varones y mujeres nacieron en cada estado entre 2000 y 2008?",
+        f"SELECT state, is_male, COUNT(*) AS nacimientos FROM {TABLE} "
+        f"WHERE year BETWEEN 2000 AND 2008 GROUP BY state, is_male ORDER BY 1, 2",
+    ),
+    (
+        "¿Qué edad media tienen las madres en cada estado?",
+        f"SELECT state, ROUND(AVG(mother_age), 4) AS edad_madre FROM {TABLE} GROUP BY state",
+    ),
+]
+FOLLOW_UPS = [
+    "Ahora ordénalo por peso",
+    "Ordénalo por peso de mayor a menor",
+    "Solo los 5 primeros",
+    "Filtra a Texas",
+    "Filtra a TX y CA",
+    "Los 5 estados con mayor peso",
+    "Los tres con menos nacimientos",
+    "Solo los de 2005",
+    "Solo varones",
+    "Ordena por edad de la madre y quédate con los diez primeros",
+    "Solo Texas, ordenado por nacimientos descendente",
+    "Ordénalo por nacimientos",
+    # No son refinamientos: siguen el camino normal
+    "¿Y en 2006 por estado?",
+    "¿Cuál es la edad media de los padres?",
+]
+
+
+def connect(rows):
+    import duckdb
+
+    df = synthetic_natality(rows)
+    # Estados reales, para que «Texas» exista, y algunos sin estado como en la tabla real
+    df["state"] = df["state"].cat.rename_categories(sorted(STATE_CODES)[:df["state"].cat.categories.size])
+    df["state"] = df["state"].astype(object).where(df["year"] % 17 != 0, None)
+    connection = duckdb.connect()
+    connection.execute('ATTACH \':memory:\' AS "bigquery-public-data"')
+    connection.execute('CREATE SCHEMA "bigquery-public-data".samples')
+    connection.register("source", df)
+    connection.execute('CREATE TABLE "bigquery-public-data".samples.natality AS SELECT * FROM source')
+    connection.unregister("source")
+    return connection
+
+
+def run_sql(connection, sql_query):
+    return connection.cursor().execute(sqlglot.transpile(sql_query, read="bigquery", write="duckdb")[0]).df()
+
+
+def same_result(local, remote):
+    try:
+        pd.testing.assert_frame_equal(
+            local.reset_index(drop=True), remote.reset_index(drop=True),
+            check_dtype=False, check_exact=False, rtol=1e-9,
+        )
+        return True
+    except AssertionError:
+        return False
+
+
+def check_correctness(connection):
+    """Refinamientos planificados, iguales a su SQL en DuckDB y no planificados."""
+    result = {"planned": 0, "matches": 0, "fallbacks": 0, "mismatches": []}
+    conversations = []
+    for question, base_sql in BASES:
+        previous = run_sql(connection, base_sql)
+        for follow_up_question in FOLLOW_UPS:
+            follow_up = plan_follow_up(follow_up_question, previous, base_sql)
+            if follow_up is None:
+                result["fallbacks"] += 1
+                continue
+            result["planned"] += 1
+            sql_query = follow_up_sql(base_sql, follow_up)
+            if sql_query is None:
+                # Sin orden conocido el LIMIT de BigQuery no es reproducible
+                result["fallbacks"] += 1
+                continue
+            local = apply_follow_up(previous, follow_up)
+            if same_result(local, run_sql(connection, sql_query)):
+                result["matches"] += 1
+                conversations.append((question, base_sql, follow_up_question, sql_query))
+            else:
+                result["mismatches"].append(f"{question} → {follow_up_question}")
+    return result, conversations
+
+
+def run_turns(pipeline, fakes, args, connection, directory, conversations, local):
+    """Latencia del refinamiento en `process_query`, con la respuesta anterior o sin ella."""
+    sqls = {question: sql_query for question, sql_query, _, _ in conversations}
+    sqls.update({follow_up: sql_query for _, _, follow_up, sql_query in conversations})
+
+    def responder(contents):
+        if "PREGUNTA DEL USUARIO" not in contents:
+            return "Los datos muestran diferencias moderadas entre grupos."
+        question = contents[contents.index("PREGUNTA DEL USUARIO"):].splitlines()[0]
+        return next(sql_query for text, sql_query in sqls.items() if text in question)
+
+    gemini_client = fakes.FakeGeminiClient(responder=responder, latency=args.gemini_latency)
+    bigquery_client = fakes.FakeBigQueryClient(
+        latency=args.bq_latency,
+        table_factory=lambda sql_query, _: pa.Table.from_pandas(
+            run_sql(connection, sql_query), preserve_index=False
+        ),
+    )
+    gemini = (gemini_client, pipeline.default_model_config())
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+    samples, local_answers = [], 0
+    for i, (question, _, follow_up, _) in enumerate(conversations):
+        # Cachés vacías en cada conversación: «solo los 5 primeros» es la misma plantilla
+        # para todas las consultas base
+        reset_pipeline(pipeline, directory / str(i))
+        previous = pipeline.process_query(
+            question, None, bigquery_client, tables_info, tables_context, gemini=gemini,
+        )
+        queries_before = len(bigquery_client.queries)
+        start = time.perf_counter()
+        response = pipeline.process_query(
+            follow_up, None, bigquery_client, tables_info, tables_context, gemini=gemini,
+            previous=previous if local else None,
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+        local_answers += bool(response.get("follow_up")) and len(bigquery_client.queries) == queries_before
+    return {"follow_up": summarize(samples), "answered_locally": local_answers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--bq-latency", type=float, default=0.3)
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_followup_"))
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    import fakes
+    import pipeline
+
+    connection = connect(args.rows)
+    correctness, conversations = check_correctness(connection)
+    print(
+        f"corrección: {correctness['matches']}/{correctness['planned']} refinamientos iguales a su SQL • "
+        f"{correctness['fallbacks']} por el camino normal"
+    )
+    for mismatch in correctness["mismatches"]:
+        print(f"DISTINTO {mismatch}")
+
+    results = {"correctness": {**correctness, "mismatches": len(correctness["mismatches"])}}
+    for name, local, label in (("remote", False, "modelo + BigQuery"), ("local", True, "local")):
+        result = run_turns(pipeline, fakes, args, connection, work_dir / name, conversations, local)
+        results[name] = result
+        print(
+            f"{label:<18} refinamiento p50 {result['follow_up']['p50_ms']:8.2f} ms • "
+            f"p95 {result['follow_up']['p95_ms']:8.2f} ms • {result['answered_locally']} sin BigQuery"
+        )
+
+    if args.save:
+        save_baseline(args.save, "followup", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    failed = bool(correctness["mismatches"])
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Gestor de jobs: cancelaciones a tiempo y comparaciones como sub-consultas paralelas.
+
+Con un BigQuery falso de latencia controlable por consulta, mide cuánto tarda en
+cancelarse un job que se pasa de tiempo, uno cuyo turno pasa a otra pregunta y uno
+cuya sesión se cierra. Después responde una serie de comparaciones («madres menores
+de 20 frente a mayores de 35») con `process_query` de tres formas: un solo job con
+el UNION ALL, sus ramas como sub-consultas y las ramas con el cubo local. Los
+resultados se comparan con el UNION ALL ejecutado en DuckDB (`pip install duckdb`):
+
+    python -m benchmarks.bench_jobs --bq-latency 0.3
+    python -m benchmarks.bench_jobs --save benchmarks/baselines/jobs.json
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pyarrow as pa
+
+from benchmarks.bench_approx import synthetic_natality
+from benchmarks.bench_followup import connect, run_sql, same_result
+from benchmarks.bench_pipeline import reset_pipeline
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+TABLE = "`bigquery-public-data.samples.natality`"
+# Grupos de madres que se comparan de dos en dos y de tres en tres
+GROUPS = [
+    ("menores de 20", "mother_age < 20"),
+    ("de 20 a 34", "mother_age BETWEEN 20 AND 34"),
+    ("mayores de 35", "mother_age >= 35"),
+    ("mayores de 40", "mother_age >= 40"),
+]
+
+
+class Interrupted(BaseException):
+    """Como la excepción con la que Streamlit corta el guion al llegar otra pregunta."""
+
+
+class InterruptingRenderer:
+    """Renderer que interrumpe el turno en su primer aviso de espera tras `event`."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def waiting(self, seconds):
+        if self.event.is_set():
+            raise Interrupted()
+
+    def first_page(self, df_page):
+        pass
+
+    def result(self, df_result):
+        pass
+
+    def figure(self, fig):
+        pass
+
+    def explanation(self, chunks, header=None):
+        return "".join(chunks)
+
+
+def comparison_sql(groups):
+    branches = [
+        f"SELECT '{label}' AS grupo, ROUND(AVG(weight_pounds), 4) AS peso_promedio, "
+        f"COUNT(*) AS nacimientos FROM {TABLE} WHERE {condition}"
+        for label, condition in groups
+    ]
+    return "\nUNION ALL\n".join(branches) + "\nORDER BY grupo"
+
+
+def comparisons():
+    """[(pregunta, SQL)]: cada pareja y cada trío de grupos."""
+    items = []
+    for size in (2, 3):
+        for groups in itertools.combinations(GROUPS, size):
+            question = "¿Peso al nacer de los hijos de madres " + " frente a ".join(
+                label for label, _ in groups
+            ) + "?"
+            items.append((question, comparison_sql(groups)))
+    return items
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+def measure_timeout(pipeline, fakes, args):
+    """Un job que tardaría 10 veces su tiempo máximo."""
+    pipeline.get_job_manager().timeout = args.job_timeout
+    client = fakes.FakeBigQueryClient(rows=10, latency=args.job_timeout * 10)
+    start = time.perf_counter()
+    _, error_occurred, _, _ = pipeline.execute_sql_query(client, "SELECT 1 AS x", quiet=True)
+    elapsed = time.perf_counter() - start
+    pipeline.get_job_manager().timeout = pipeline.BIGQUERY_JOB_TIMEOUT
+    return {
+        "error": error_occurred,
+        "cancelled": len(client.cancelled),
+        "overshoot_ms": round((elapsed - args.job_timeout) * 1000, 1),
+    }
+
+
+def measure_superseded(pipeline, fakes, args, tables_info, tables_context, sql_query):
+    """Un turno con un job largo al que le llega otra pregunta a los 0,1 s."""
+    client = fakes.FakeBigQueryClient(rows=10, latency=10.0)
+    gemini = (fakes.FakeGeminiClient(responder=lambda _: sql_query), pipeline.default_model_config())
+    event = threading.Event()
+    renderer = InterruptingRenderer(event)
+    threading.Timer(0.1, event.set).start()
+    start = time.perf_counter()
+    try:
+        pipeline.process_query(
+            "¿Peso al nacer de madres menores de 20?", None, client, tables_info, tables_context,
+            renderer=renderer, session_id="superseded", gemini=gemini,
+        )
+        interrupted = False
+    except Interrupted:
+        interrupted = True
+    return {
+        "interrupted": interrupted,
+        "cancelled": len(client.cancelled),
+        "reaction_ms": round((time.perf_counter() - start - 0.1) * 1000, 1),
+        "running": pipeline.get_job_manager().running(),
+    }
+
+
+def measure_orphaned(pipeline, fakes, args, sql_query):
+    """La respuesta exacta en segundo plano de una sesión que se cierra a los 0,1 s."""
+    client = fakes.FakeBigQueryClient(rows=10, latency=10.0)
+    closed = set()
+    pipeline.get_job_manager().set_liveness(lambda owner: owner not in closed)
+    future, _ = pipeline.refine_exact_answer(client, sql_query, owner="closed-session")
+    wait_until(lambda: client.queries)
+    time.sleep(0.1)
+    closed.add("closed-session")
+    start = time.perf_counter()
+    wait_until(lambda: client.cancelled)
+    reaction = time.perf_counter() - start
+    _, error_occurred, _, _ = future.result()
+    pipeline.get_job_manager().set_liveness(None)
+    return {
+        "error": error_occurred,
+        "cancelled": len(client.cancelled),
+        "reaction_ms": round(reaction * 1000, 1),
+    }
+
+
+def measure_parallel(pipeline, fakes, args, sql_query, branches):
+    """Las ramas de una comparación con latencias distintas: la espera es la de la más lenta."""
+    latencies = [args.bq_latency * (i + 1) for i in range(branches)]
+    client = fakes.FakeBigQueryClient(
+        rows=1, latency=lambda sql: next(
+            latency for (label, _), latency in zip(GROUPS, latencies) if label in sql
+        ),
+    )
+    start = time.perf_counter()
+    pipeline.execute_sql_query(client, sql_query, quiet=True)
+    elapsed = time.perf_counter() - start
+    return {
+        "branches": branches,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "slowest_ms": round(max(latencies) * 1000, 1),
+        "sequential_ms": round(sum(latencies) * 1000, 1),
+    }
+
+
+def run_comparisons(pipeline, fakes, args, connection, directory, mode, cube_path):
+    """Todas las comparaciones en una sesión, en el modo pedido."""
+    reset_pipeline(pipeline, directory)
+    pipeline.SUB_QUERY_SPLIT = mode != "union"
+    if mode == "split_cube":
+        pipeline.CUBE_PATH = str(cube_path)
+        pipeline.CUBE_ALLOW_SAMPLE = True
+        pipeline.get_cube_router.cache_clear()
+    items = comparisons()
+    sqls = dict(items)
+
+    def responder(contents):
+        if "PREGUNTA DEL USUARIO" not in contents:
+            return "Los hijos de madres más jóvenes pesan algo menos al nacer."
+        question = contents[contents.index("PREGUNTA DEL USUARIO"):].splitlines()[0]
+        return next(sql_query for text, sql_query in sqls.items() if text in question)
+
+    # Un job tarda lo mismo con una rama o con varias: BigQuery reparte el UNION ALL en
+    # etapas paralelas
+    client = fakes.FakeBigQueryClient(
+        latency=args.bq_latency,
+        table_factory=lambda sql_query, _: pa.Table.from_pandas(
+            run_sql(connection, sql_query), preserve_index=False
+        ),
+    )
+    gemini = (fakes.FakeGeminiClient(responder=responder, latency=args.gemini_latency),
+              pipeline.default_model_config())
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+    samples, matches = [], 0
+    for question, sql_query in items:
+        start = time.perf_counter()
+        response = pipeline.process_query(
+            question, None, client, tables_info, tables_context, gemini=gemini, session_id=mode,
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+        data = response.get("data")
+        matches += data is not None and same_result(data, run_sql(connection, sql_query))
+    pipeline.SUB_QUERY_SPLIT = True
+    return {
+        "turn": summarize(samples),
+        "jobs": len(client.queries),
+        "matches": matches,
+        "questions": len(items),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--bq-latency", type=float, default=0.3)
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--job-timeout", type=float, default=0.5)
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_jobs_"))
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    os.environ["BIGQUERY_POLL_INTERVAL"] = str(args.poll_interval)
+    import fakes
+    import pipeline
+    from cube import build_cube, save_cube
+
+    reset_pipeline(pipeline, work_dir / "control")
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+    single = comparison_sql(GROUPS[:1]).replace("\nORDER BY grupo", "")
+    results = {
+        "timeout": measure_timeout(pipeline, fakes, args),
+        "superseded": measure_superseded(pipeline, fakes, args, tables_info, tables_context, single),
+        "orphaned": measure_orphaned(pipeline, fakes, args, single),
+        "parallel": measure_parallel(pipeline, fakes, args, comparison_sql(GROUPS[:3]), 3),
+    }
+    print(
+        f"tiempo máximo:  cancelado {results['timeout']['cancelled']} job "
+        f"{results['timeout']['overshoot_ms']:.1f} ms después del límite"
+    )
+    print(
+        f"otra pregunta:  cancelado {results['superseded']['cancelled']} job en "
+        f"{results['superseded']['reaction_ms']:.1f} ms • {results['superseded']['running']} en curso"
+    )
+    print(
+        f"sesión cerrada: cancelado {results['orphaned']['cancelled']} job en "
+        f"{results['orphaned']['reaction_ms']:.1f} ms"
+    )
+    parallel = results["parallel"]
+    print(
+        f"{parallel['branches']} ramas:        {parallel['elapsed_ms']:.1f} ms "
+        f"(la más lenta {parallel['slowest_ms']:.0f} ms, en serie {parallel['sequential_ms']:.0f} ms)"
+    )
+
+    connection = connect(args.rows)
+    cube_source = synthetic_natality(args.rows)
+    cube_source["plurality"], cube_source["gestation_weeks"] = 1, 39
+    # Mismas filas que las de DuckDB (misma semilla); los estados, que aquí no se usan, no coinciden
+    cube_path = work_dir / "natality_cube.parquet"
+    save_cube(build_cube(cube_source), cube_path, "bench:synthetic_natality", exact=False)
+    labels = {"union": "un job con UNION ALL", "split": "sub-consultas", "split_cube": "sub-consultas + cubo"}
+    for mode, label in labels.items():
+        result = run_comparisons(pipeline, fakes, args, connection, work_dir / mode, mode, cube_path)
+        results[mode] = result
+        print(
+            f"{label:<22} turno p50 {result['turn']['p50_ms']:8.1f} ms • p95 "
+            f"{result['turn']['p95_ms']:8.1f} ms • {result['jobs']:>2} jobs • "
+            f"{result['matches']}/{result['questions']} iguales a DuckDB"
+        )
+
+    if args.save:
+        save_baseline(args.save, "jobs", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    failed = (
+        not results["timeout"]["cancelled"] or not results["superseded"]["cancelled"]
+        or not results["orphaned"]["cancelled"]
+        or any(results[mode]["matches"] != results[mode]["questions"] for mode in labels)
+    )
+    if failed:
+        print("ERROR un job no se canceló o una comparación no coincide con DuckDB")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        failed = failed or regressions
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""
+Benchmark de extremo a extremo de `process_query` con BigQuery y Gemini falsos.
+
+Mide la latencia por etapa (p50/p95/p99), el rendimiento con N sesiones concurrentes
+y el pico de memoria, y guarda o compara una baseline en JSON:
+
+    python -m benchmarks.bench_pipeline --sessions 1 4 16 --save benchmarks/baselines/pipeline.json
+    python -m benchmarks.bench_pipeline --compare benchmarks/baselines/pipeline.json
+"""
+
+import argparse
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+QUESTION_TEMPLATES = [
+    "¿Cuál es el peso promedio al nacer en el año {year}?",
+    "Muestra el número de nacimientos por estado en {year}",
+    "Analiza la edad promedio de la madre en {year}",
+]
+# Funciones del pipeline cuyo tiempo se mide por separado
+STAGES = ["generate_sql_query", "execute_sql_query", "build_result_digest", "figure_from_spec"]
+
+
+def question_for(index):
+    template = QUESTION_TEMPLATES[index % len(QUESTION_TEMPLATES)]
+    return template.format(year=1969 + index // len(QUESTION_TEMPLATES) % 40)
+
+
+def responder(contents):
+    """SQL que depende del año de la pregunta, para que cada año sea una consulta distinta."""
+    if "PREGUNTA DEL USUARIO" not in contents:
+        return "El peso promedio al nacer se mantuvo estable en torno a **7.3 libras** en el periodo."
+    question = contents[contents.index("PREGUNTA DEL USUARIO"):]
+    match = re.search(r"\d{4}", question)
+    year = match.group(0) if match else "2005"
+    # La tabla falsa no depende de las columnas; solo cambian la SQL y su huella
+    metric = "weight_pounds" if "peso" in question else "mother_age" if "madre" in question else "state"
+    return (
+        f"```sql\nSELECT year, {metric}\n"
+        f"FROM `bigquery-public-data.samples.natality`\nWHERE year = {year}\n```"
+    )
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed_ms):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(elapsed_ms)
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, (time.perf_counter() - start) * 1000)
+        return timed
+
+
+def make_renderer(pipeline, timer):
+    class BenchRenderer(pipeline.TurnRenderer):
+        """Consume la explicación como lo haría la UI y mide el primer fragmento."""
+
+        def explanation(self, chunks, header=None):
+            start = time.perf_counter()
+            parts = []
+            for chunk in chunks:
+                if not parts:
+                    timer.add("explanation_first_chunk", (time.perf_counter() - start) * 1000)
+                parts.append(chunk)
+            timer.add("explanation_stream", (time.perf_counter() - start) * 1000)
+            return "".join(parts)
+
+    return BenchRenderer()
+
+
+def reset_pipeline(pipeline, directory):
+    """Cachés vacías en un directorio propio para que cada nivel parta de cero."""
+    pipeline.SQL_CACHE_PATH = str(directory / "sql_templates.sqlite")
+    pipeline.RESULT_CACHE_DIR = str(directory / "results")
+    pipeline.SPILL_DIR = str(directory / "spill")
+    pipeline.CUBE_PATH = str(directory / "sin_cubo.parquet")
+    pipeline.SCHEMA_SNAPSHOT_PATH = str(directory / "schema_snapshot.json")
+    pipeline.FEW_SHOT_PATH = str(directory / "sql_examples.jsonl")
+    for getter in (
+        pipeline.get_schema_catalog, pipeline._sql_cache, pipeline._result_cache, pipeline.get_spill_dir,
+        pipeline.get_cube_router, pipeline.get_single_flight, pipeline.get_context_cache,
+        pipeline.get_example_index,
+    ):
+        getter.cache_clear()
+    pipeline._table_row_counts.clear()
+
+
+def run_level(pipeline, fakes, gateway, args, sessions, directory, questions):
+    """Ejecuta `sessions` sesiones en paralelo, cada una con sus turnos en secuencia."""
+    reset_pipeline(pipeline, directory)
+    timer = StageTimer()
+    originals = {stage: getattr(pipeline, stage) for stage in STAGES}
+    for stage, function in originals.items():
+        setattr(pipeline, stage, timer.wrap(stage, function))
+
+    bigquery_client = fakes.FakeBigQueryClient(rows=args.rows, latency=args.bq_latency)
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+    model_config = pipeline.default_model_config()
+    errors = []
+
+    def session(session_index):
+        session_id = f"bench-{session_index}"
+        gemini = (gateway.session_client(session_id), model_config)
+        renderer = make_renderer(pipeline, timer)
+        for turn in range(args.turns):
+            question = questions(session_index, turn)
+            start = time.perf_counter()
+            response = pipeline.process_query(
+                question, None, bigquery_client, tables_info, tables_context,
+                renderer=renderer, session_id=session_id, gemini=gemini,
+            )
+            timer.add("turn", (time.perf_counter() - start) * 1000)
+            if response.get("data") is None:
+                errors.append(response["content"])
+
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            list(executor.map(session, range(sessions)))
+    finally:
+        for stage, function in originals.items():
+            setattr(pipeline, stage, function)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "turns_per_s": round(sessions * args.turns / elapsed, 3),
+        "wall_ms": round(elapsed * 1000, 3),
+        "errors": len(errors),
+        "queries": len(bigquery_client.queries),
+        "stages": {stage: summarize(samples) for stage, samples in sorted(timer.samples.items())},
+    }
+    if args.trace_memory:
+        result["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run_burst(pipeline, fakes, args, sessions, directory):
+    """Todas las sesiones hacen la misma pregunta a la vez: mide la agrupación de peticiones."""
+    reset_pipeline(pipeline, directory)
+    gemini_client = fakes.FakeGeminiClient(
+        responder=responder, latency=args.gemini_latency, token_latency=args.token_latency
+    )
+    bigquery_client = fakes.FakeBigQueryClient(rows=args.rows, latency=args.bq_latency)
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+    gemini = (gemini_client, pipeline.default_model_config())
+    barrier = threading.Barrier(sessions)
+
+    def session(session_index):
+        barrier.wait()
+        return pipeline.process_query(
+            question_for(0), None, bigquery_client, tables_info, tables_context,
+            session_id=f"burst-{session_index}", gemini=gemini,
+        )
+
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        responses = list(executor.map(session, range(sessions)))
+    return {
+        "sessions": sessions,
+        "model_calls": len(gemini_client.calls),
+        "queries": len(bigquery_client.queries),
+        "identical_answers": len({response["content"] for response in responses}) == 1,
+    }
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB y macOS en bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--turns", type=int, default=10, help="Turnos por sesión")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="Preguntas distintas en total (0 = todas distintas)")
+    parser.add_argument("--rows", type=int, default=5000, help="Filas de cada resultado")
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.002)
+    parser.add_argument("--bq-latency", type=float, default=0.1)
+    parser.add_argument("--rate", type=float, default=1000.0,
+                        help="Peticiones por segundo de la pasarela del modelo")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Mide el pico de memoria Python con tracemalloc (más lento)")
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_pipeline_"))
+    # El pipeline lee su configuración al importarse
+    os.environ.setdefault("SQL_CACHE_PATH", str(work_dir / "sql_templates.sqlite"))
+    os.environ.setdefault("RESULT_CACHE_DIR", str(work_dir / "results"))
+    # Las métricas de las trazas se siguen calculando; solo se omiten los logs JSON
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    import fakes
+    import gateway
+    import pipeline
+
+    results = {"levels": {}}
+    for sessions in args.sessions:
+        gemini_client = fakes.FakeGeminiClient(
+            responder=responder, latency=args.gemini_latency, token_latency=args.token_latency
+        )
+        model_gateway = gateway.ModelGateway(
+            gemini_client, rate_per_second=args.rate, burst=max(1, int(args.rate)),
+            max_concurrency=pipeline.GEMINI_MAX_CONCURRENCY,
+        )
+
+        def questions(session_index, turn, sessions=sessions):
+            index = session_index * args.turns + turn
+            return question_for(index % args.distinct if args.distinct else index)
+
+        level = run_level(
+            pipeline, fakes, model_gateway, args, sessions, work_dir / f"level-{sessions}", questions
+        )
+        level["model_calls"] = len(gemini_client.calls)
+        results["levels"][f"sessions_{sessions}"] = level
+        turn = level["stages"]["turn"]
+        print(
+            f"{sessions:>3} sesiones: {level['turns_per_s']:8.2f} turnos/s • turno p50 "
+            f"{turn['p50_ms']:.1f} ms • p95 {turn['p95_ms']:.1f} ms • p99 {turn['p99_ms']:.1f} ms"
+        )
+        for stage, summary in level["stages"].items():
+            if stage != "turn":
+                print(f"      {stage:<24} p50 {summary['p50_ms']:8.2f} • p95 {summary['p95_ms']:8.2f} ms")
+
+    burst_sessions = max(args.sessions)
+    results["burst"] = run_burst(pipeline, fakes, args, burst_sessions, work_dir / "burst")
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    print(
+        f"Ráfaga de {burst_sessions} preguntas idénticas: "
+        f"{results['burst']['model_calls']} llamadas al modelo • {results['burst']['queries']} consultas"
+    )
+    print(f"Pico de memoria del proceso: {results['peak_rss_bytes'] / 1024**2:.1f} MB")
+
+    if args.save:
+        save_baseline(args.save, "pipeline", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
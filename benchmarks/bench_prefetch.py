@@ -0,0 +1,163 @@
+"""
+Prefetch de consultas de seguimiento: latencia del segundo turno, acierto y coste.
+
+Cada conversación es una pregunta sobre una métrica y un año seguida, tras un tiempo
+de lectura, de una de seguimiento: la misma métrica por estado, año, sexo o
+pluralidad (que el prefetch predice) o por mes (que no). Se ejecuta sin y con
+prefetch, con BigQuery y Gemini falsos, y se compara la latencia del seguimiento, el
+acierto, los bytes que gasta el prefetch y las cancelaciones cuando el usuario
+pregunta otra cosa sin esperar:
+
+    python -m benchmarks.bench_prefetch --conversations 20
+    python -m benchmarks.bench_prefetch --save benchmarks/baselines/prefetch.json
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.bench_pipeline import reset_pipeline
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+METRICS = {"peso": ("weight_pounds", "peso_promedio"), "edad": ("mother_age", "edad_promedio")}
+# (palabras de la pregunta, columna); "mes" es el seguimiento que el prefetch no predice
+FOLLOW_UPS = [
+    ("por estado", "state"), ("por año", "year"), ("por sexo", "is_male"),
+    ("por pluralidad", "plurality"), ("por mes", "month"),
+]
+
+
+def responder(contents):
+    """SQL con la forma habitual del modelo para la métrica, el año y la dimensión pedidos."""
+    if "PREGUNTA DEL USUARIO" not in contents:
+        return "La métrica se mantiene estable en el periodo."
+    question = contents[contents.index("PREGUNTA DEL USUARIO"):].splitlines()[0]
+    column, alias = METRICS["peso" if "peso" in question else "edad"]
+    year = re.search(r"\d{4}", question).group(0)
+    dimension = next((column for words, column in FOLLOW_UPS if words in question), None)
+    where = "" if dimension == "year" else f"\nWHERE year = {year}"
+    if dimension is None:
+        return f"SELECT AVG({column}) AS {alias}\nFROM `bigquery-public-data.samples.natality`{where}"
+    return (
+        f"SELECT {dimension}, AVG({column}) AS {alias}\n"
+        f"FROM `bigquery-public-data.samples.natality`{where}\n"
+        f"GROUP BY {dimension}\nORDER BY {dimension}"
+    )
+
+
+def conversations(count, seed=0):
+    """[(pregunta, seguimiento)] con métricas, años y seguimientos al azar."""
+    rng = random.Random(seed)
+    result = []
+    for _ in range(count):
+        metric = rng.choice(["peso promedio al nacer", "edad promedio de la madre"])
+        year = rng.randrange(1990, 2005)
+        words, _ = rng.choice(FOLLOW_UPS)
+        result.append((f"¿Cuál es el {metric} en {year}?", f"¿Y el {metric} {words} en {year}?"))
+    return result
+
+
+def run(pipeline, fakes, args, directory, prefetch, think_time):
+    reset_pipeline(pipeline, directory)
+    pipeline.get_prefetch_pool.cache_clear()
+    gemini_client = fakes.FakeGeminiClient(responder=responder, latency=args.gemini_latency)
+    bigquery_client = fakes.FakeBigQueryClient(rows=args.rows, latency=args.bq_latency)
+    gemini = (gemini_client, pipeline.default_model_config())
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+    prefetcher = pipeline.create_prefetcher() if prefetch else None
+
+    follow_up_ms, hits = [], 0
+    for question, follow_up in conversations(args.conversations):
+        pipeline.process_query(
+            question, None, bigquery_client, tables_info, tables_context,
+            gemini=gemini, prefetcher=prefetcher,
+        )
+        time.sleep(think_time)
+        start = time.perf_counter()
+        response = pipeline.process_query(
+            follow_up, None, bigquery_client, tables_info, tables_context,
+            gemini=gemini, prefetcher=prefetcher,
+        )
+        follow_up_ms.append((time.perf_counter() - start) * 1000)
+        hits += bool(response.get("prefetch_hit"))
+    if prefetcher is not None:
+        prefetcher.cancel()
+    pipeline.get_prefetch_pool().shutdown(wait=True)
+
+    result = {
+        "follow_up": summarize(follow_up_ms),
+        "queries": len(bigquery_client.queries),
+        "dry_runs": len(bigquery_client.dry_runs),
+    }
+    if prefetcher is not None:
+        stats = prefetcher.stats()
+        result["prefetch"] = {
+            # Acierto sobre las preguntas de seguimiento, no sobre todos los turnos
+            "hit_rate": round(hits / len(follow_up_ms), 3),
+            "used_rate": round(stats["used_rate"], 3),
+            **{name: stats[name] for name in (
+                "scheduled", "completed", "skipped", "cancelled", "failed", "bytes_processed",
+            )},
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=2000, help="Filas de cada resultado")
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--bq-latency", type=float, default=0.3)
+    parser.add_argument("--think-time", type=float, default=0.5,
+                        help="Segundos entre la respuesta y la pregunta de seguimiento")
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_prefetch_"))
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    import fakes
+    import pipeline
+
+    results = {
+        "baseline": run(pipeline, fakes, args, work_dir / "off", False, args.think_time),
+        "prefetch": run(pipeline, fakes, args, work_dir / "on", True, args.think_time),
+        # Sin tiempo de lectura la siguiente pregunta llega con la precarga en marcha
+        "impatient": run(pipeline, fakes, args, work_dir / "impatient", True, 0.0),
+    }
+    for name, label in (
+        ("baseline", "sin prefetch"), ("prefetch", "con prefetch"), ("impatient", "sin esperar"),
+    ):
+        result = results[name]
+        line = (
+            f"{label:<13} seguimiento p50 {result['follow_up']['p50_ms']:7.1f} ms • "
+            f"p95 {result['follow_up']['p95_ms']:7.1f} ms • {result['queries']} consultas"
+        )
+        if "prefetch" in result:
+            stats = result["prefetch"]
+            line += (
+                f" • acierto {stats['hit_rate']:.0%} • aprovechadas {stats['used_rate']:.0%} • "
+                f"{stats['completed']} precargadas • {stats['cancelled']} canceladas"
+            )
+        print(line)
+
+    if args.save:
+        save_baseline(args.save, "prefetch", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Pintado del chat: tiempo de servidor por pregunta según los mensajes del historial.
+
+Con `streamlit.testing` y un historial de 10, 100 y 500 mensajes ya cargado en la
+sesión se mide una ejecución de la página entera (lo que costaba cada uno de los dos
+`st.rerun()` de una pregunta), una del fragmento del chat solo, y una pregunta
+respondida dentro del fragmento con BigQuery y Gemini falsos sin latencia, que es lo
+que cuesta ahora. `AppTest` solo ejecuta la página entera, así que el fragmento se
+pide a su runner con la misma cola de fragmentos que usa el navegador:
+
+    python -m benchmarks.bench_render --messages 10 100 500
+    python -m benchmarks.bench_render --save benchmarks/baselines/render.json
+"""
+
+import argparse
+import functools
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_pipeline import question_for, responder
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def build_history(ChatHistory, chart_spec, directory, messages, preview_rows):
+    """Historial de `messages` mensajes, la mitad respuestas con tabla y gráfico."""
+    history = ChatHistory(directory, "bench", preview_rows=preview_rows)
+    rng = np.random.default_rng(0)
+    for i in range(messages // 2):
+        history.append({
+            "role": "user", "content": question_for(i),
+            "data": None, "fig": None, "sql_query": None, "processed": True,
+        })
+        df = pd.DataFrame({"year": np.arange(1969, 2009), "nacimientos": rng.integers(1000, 5000, 40)})
+        history.append({
+            "role": "assistant", "content": f"Los nacimientos se mantuvieron estables ({i}).",
+            "data": df, "fig": None, "fig_spec": chart_spec(df),
+            "sql_query": "SELECT year, COUNT(*) AS nacimientos FROM t GROUP BY year",
+            "timings": [{"name": "query", "parent": None, "ms": 12.0}],
+        })
+    return history
+
+
+def use_fakes(fakes, gateway, pipeline):
+    """BigQuery y Gemini falsos y sin latencia para la conexión que abre la app."""
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+
+    class Client(fakes.FakeBigQueryClient):
+        def get_dataset(self, dataset_ref):
+            return dataset_ref
+
+        def list_tables(self, dataset):
+            return [fakes.FakeTable("natality", [])]
+
+    client = Client(rows=40)
+    model_gateway = gateway.ModelGateway(
+        fakes.FakeGeminiClient(responder=responder), rate_per_second=1000, burst=1000,
+        max_concurrency=8,
+    )
+    service_account.Credentials.from_service_account_file = staticmethod(lambda path: None)
+    bigquery.Client = lambda **kwargs: client
+    pipeline.refresh_schema = lambda *args, **kwargs: None
+    pipeline.get_model_gateway = lambda gemini_api_key: model_gateway
+    return client
+
+
+def fragment_id(app, name):
+    """Id del fragmento `name` registrado en la última ejecución de la página."""
+    storage = app._fragment_storage
+    for key, wrapped in storage._fragments.items():
+        for cell in wrapped.__closure__ or ():
+            if getattr(cell.cell_contents, "__name__", None) == name:
+                return key
+    raise LookupError(name)
+
+
+def run_fragment(app, key):
+    """Ejecuta solo el fragmento `key`, como hace el servidor al pulsar algo dentro."""
+    from streamlit.testing.v1 import local_script_runner
+
+    rerun_data = local_script_runner.RerunData
+    local_script_runner.RerunData = functools.partial(rerun_data, fragment_id_queue=[key])
+    try:
+        app.run()
+    finally:
+        local_script_runner.RerunData = rerun_data
+
+
+def timed(function, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def measure(AppTest, ChatHistory, chart_spec, client, args, directory, messages):
+    build_start = time.perf_counter()
+    history = build_history(ChatHistory, chart_spec, directory, messages, args.preview_rows)
+    build_ms = (time.perf_counter() - build_start) * 1000
+
+    app = AppTest.from_file(str(ROOT / "app.py"), default_timeout=120)
+    app.session_state["history"] = history
+    app.run()
+    app.sidebar.text_input[0].input("bench").run()
+    chat = fragment_id(app, "render_chat")
+    page = timed(app.run, args.repeats)
+    fragment = timed(lambda: run_fragment(app, chat), args.repeats)
+
+    questions = iter(range(messages, messages + args.repeats))
+
+    def ask():
+        app.chat_input[0].set_value(question_for(next(questions)))
+        run_fragment(app, chat)
+
+    queries_before = len(client.queries)
+    question = timed(ask, args.repeats)
+    answered = sum(message["role"] == "assistant" for message in history) - messages // 2
+    return {
+        "page": page,
+        "fragment": fragment,
+        "question": question,
+        "build_ms": round(build_ms, 1),
+        "answered": answered,
+        "queries": len(client.queries) - queries_before,
+        "errors": [str(e.value) for e in app.exception],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--preview-rows", type=int, default=100)
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_render_"))
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", str(work_dir / "sin_credenciales.json"))
+    for name, path in (
+        ("HISTORY_DIR", "history"), ("SQL_CACHE_PATH", "sql_templates.sqlite"),
+        ("RESULT_CACHE_DIR", "results"), ("SPILL_DIR", "spill"), ("CUBE_PATH", "sin_cubo.parquet"),
+        ("SCHEMA_SNAPSHOT_PATH", "schema_snapshot.json"), ("FEW_SHOT_PATH", "sql_examples.jsonl"),
+    ):
+        os.environ[name] = str(work_dir / path)
+    sys.path.insert(0, str(ROOT))
+    from streamlit.testing.v1 import AppTest
+
+    import fakes
+    import gateway
+    import pipeline
+    from charts import chart_spec
+    from history import ChatHistory
+
+    client = use_fakes(fakes, gateway, pipeline)
+    results, failed = {}, False
+    for messages in args.messages:
+        result = measure(AppTest, ChatHistory, chart_spec, client, args, work_dir / f"m{messages}", messages)
+        results[f"messages_{messages}"] = result
+        print(
+            f"{messages:>4} mensajes: página {result['page']['p50_ms']:7.1f} ms • "
+            f"fragmento {result['fragment']['p50_ms']:7.1f} ms • "
+            f"pregunta {result['question']['p50_ms']:7.1f} ms "
+            f"(con los 2 reruns de antes {result['question']['p50_ms'] + 2 * result['page']['p50_ms']:7.1f} ms) • "
+            f"historial creado en {result['build_ms']:,.0f} ms"
+        )
+        if result["errors"] or result["answered"] != args.repeats:
+            print(f"ERROR {result['answered']}/{args.repeats} respondidas • {result['errors']}")
+            failed = True
+
+    if args.save:
+        save_baseline(args.save, "render", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
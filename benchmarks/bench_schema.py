@@ -0,0 +1,128 @@
+"""
+Poda del esquema por pregunta: tamaño del prompt SQL, columnas elegidas y cobertura.
+
+Para cada pregunta compara el prompt con el esquema completo y con solo las columnas
+relevantes (`SCHEMA_PRUNING`), comprueba que las columnas que necesita su SQL están
+entre las elegidas y mide lo que tarda el índice. Los metadatos salen del cliente
+falso de BigQuery, así que no hace falta conexión:
+
+    python -m benchmarks.bench_schema
+    python -m benchmarks.bench_schema --save benchmarks/baselines/schema.json
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+# (pregunta, columnas que necesita su SQL)
+QUESTIONS = [
+    ("¿Cuál es el peso promedio al nacer en el año 2005?", {"weight_pounds", "year"}),
+    ("Muestra los 20 pesos más elevados de los recien nacidos en el año 2005", {"weight_pounds", "year"}),
+    ("Analiza la tendencia de la edad promedio de la madre entre 2000 y 2008.", {"mother_age", "year"}),
+    (
+        "¿Cuál es la cantidad de nacimientos de gemelos (plurality=2) por año desde 1990 hasta 1995?",
+        {"plurality", "year"},
+    ),
+    (
+        "Calcula el peso promedio en libras (`weight_pounds`) para los 10 estados con más "
+        "nacimientos en 2007",
+        {"weight_pounds", "state", "year"},
+    ),
+    ("Muestra la tendencia del número de nacimientos por año desde 2000 a 2008", {"year"}),
+    (
+        "Compara las semanas de gestación promedio para madres menores de 20 años vs. madres "
+        "mayores de 35 en el año 2005",
+        {"gestation_weeks", "mother_age", "year"},
+    ),
+    ("¿Qué porcentaje de madres fumaba en 2005?", {"cigarette_use", "year"}),
+    ("Nacimientos por mes en Texas en 2003", {"month", "state", "year"}),
+    ("Proporción de varones por estado", {"is_male", "state"}),
+    ("Edad media del padre según la raza de la madre", {"father_age", "mother_race"}),
+    ("¿Cuánto peso ganan las madres que beben alcohol?", {"weight_gain_pounds", "alcohol_use"}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--max-columns", type=int, default=12)
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    import pipeline
+    from fakes import FakeBigQueryClient
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        pipeline.SCHEMA_SNAPSHOT_PATH = str(Path(cache_dir) / "schema_snapshot.json")
+        pipeline.SCHEMA_MAX_COLUMNS = args.max_columns
+        client = FakeBigQueryClient()
+        tables_info = list(client.tables)
+        start = time.perf_counter()
+        pipeline.refresh_schema(client, tables_info)
+        refresh_ms = (time.perf_counter() - start) * 1000
+
+    def prompt_chars(question, pruning):
+        pipeline.SCHEMA_PRUNING = pruning
+        tables_context = pipeline.build_tables_context(tables_info)
+        prefix = pipeline.build_sql_prompt_prefix(tables_info, tables_context)
+        return len(prefix) + len(pipeline.build_relevant_schema(question, tables_info))
+
+    index = pipeline.get_schema_index()
+    full_chars, pruned_chars, selected, samples, missed = [], [], [], [], []
+    for question, needed in QUESTIONS:
+        full_chars.append(prompt_chars(question, False))
+        pruned_chars.append(prompt_chars(question, True))
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            selection = index.select(question, max_columns=args.max_columns)
+            samples.append((time.perf_counter() - start) * 1000)
+        columns = {field.split(" ", 1)[0] for fields in selection.values() for field in fields}
+        selected.append(len(columns))
+        if needed - columns:
+            missed.append(f"{question!r}: faltan {sorted(needed - columns)}")
+
+    results = {
+        "refresh": {"ms": round(refresh_ms, 3)},
+        "select": summarize(samples),
+        "prompt": {
+            "full_chars": sum(full_chars) // len(full_chars),
+            "pruned_chars": sum(pruned_chars) // len(pruned_chars),
+            "reduction": round(1 - sum(pruned_chars) / sum(full_chars), 3),
+        },
+        "columns": {
+            "schema": len(pipeline.get_table_info()["natality"]["campos"]),
+            "mean_selected": round(sum(selected) / len(selected), 2),
+            "recall": round(1 - len(missed) / len(QUESTIONS), 3),
+        },
+    }
+    print(
+        f"Prompt SQL medio: {results['prompt']['full_chars']:,} -> "
+        f"{results['prompt']['pruned_chars']:,} caracteres "
+        f"({results['prompt']['reduction']:.0%} menos)"
+    )
+    print(
+        f"Columnas: {results['columns']['mean_selected']} de {results['columns']['schema']} "
+        f"de media • cobertura {results['columns']['recall']:.0%}"
+    )
+    print(f"Índice: p50 {results['select']['p50_ms']:.3f} ms • p95 {results['select']['p95_ms']:.3f} ms")
+    for problem in missed:
+        print(f"SIN CUBRIR {problem}")
+
+    if args.save:
+        save_baseline(args.save, "schema", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    regressions = compare_to_baseline(args.compare, results, args.tolerance) if args.compare else []
+    for regression in regressions:
+        print(f"REGRESIÓN {regression}")
+    if missed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Arranque en frío de la app: tiempo de importación y tiempo hasta el primer pintado.
+
+Cada medida corre en un proceso nuevo, como un contenedor recién escalado. Se mide lo
+que tarda en importarse cada módulo y, con `streamlit.testing`, cuánto pasa desde que
+empieza el script hasta que se pinta la cabecera (primer pintado), hasta que termina
+la primera ejecución y lo que tarda una re-ejecución con los módulos ya cargados. Sin
+credenciales, BigQuery falla en segundo plano sin bloquear la página:
+
+    python -m benchmarks.bench_startup --repeats 5
+    python -m benchmarks.bench_startup --save benchmarks/baselines/startup.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from benchmarks.common import compare_to_baseline, save_baseline, summarize
+
+ROOT = Path(__file__).resolve().parent.parent
+MODULES = ["streamlit", "pandas", "cost_gate", "pipeline"]
+
+IMPORT_CHILD = """
+import sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print((time.perf_counter() - start) * 1000)
+"""
+
+APP_CHILD = """
+import json, sys, time
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+marks = {}
+markdown = st.markdown
+
+def timed_markdown(body, *args, **kwargs):
+    if 'class="main-header"' in str(body):
+        marks.setdefault("first_paint", time.perf_counter())
+    return markdown(body, *args, **kwargs)
+
+st.markdown = timed_markdown
+app = AppTest.from_file(sys.argv[1], default_timeout=120)
+start = time.perf_counter()
+app.run()
+end = time.perf_counter()
+app.run()
+print(json.dumps({
+    "first_paint_ms": (marks.get("first_paint", end) - start) * 1000,
+    "script_ms": (end - start) * 1000,
+    "rerun_ms": (time.perf_counter() - end) * 1000,
+    "errors": [str(e.value) for e in app.exception],
+}))
+"""
+
+
+def child_env(cache_dir):
+    """Entorno sin credenciales y con cachés vacías, como un contenedor nuevo."""
+    env = dict(os.environ)
+    env.setdefault("GOOGLE_APPLICATION_CREDENTIALS", str(Path(cache_dir) / "sin_credenciales.json"))
+    env.update({
+        "HISTORY_DIR": str(Path(cache_dir) / "history"),
+        "SQL_CACHE_PATH": str(Path(cache_dir) / "sql_templates.sqlite"),
+        "RESULT_CACHE_DIR": str(Path(cache_dir) / "results"),
+        "SPILL_DIR": str(Path(cache_dir) / "spill"),
+        "SCHEMA_SNAPSHOT_PATH": str(Path(cache_dir) / "schema_snapshot.json"),
+        "FEW_SHOT_PATH": str(Path(cache_dir) / "sql_examples.jsonl"),
+        "PYTHONPATH": str(ROOT),
+    })
+    return env
+
+
+def run_child(code, *args, env):
+    completed = subprocess.run(
+        [sys.executable, "-c", code, *args],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    return completed.stdout.strip().splitlines()[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--app", default=str(ROOT / "app.py"))
+    parser.add_argument("--save", help="Guarda los resultados como baseline JSON")
+    parser.add_argument("--compare", help="Compara con una baseline JSON y falla si hay regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = child_env(cache_dir)
+        for module in MODULES:
+            samples = [
+                float(run_child(IMPORT_CHILD, module, env=env)) for _ in range(args.repeats)
+            ]
+            results[f"import_{module}"] = summarize(samples)
+            print(f"import {module:<12} p50 {results[f'import_{module}']['p50_ms']:8.1f} ms")
+
+        runs = [json.loads(run_child(APP_CHILD, args.app, env=env)) for _ in range(args.repeats)]
+    for stage, label in (
+        ("first_paint_ms", "primer pintado"),
+        ("script_ms", "primera ejecución"),
+        ("rerun_ms", "re-ejecución"),
+    ):
+        results[stage.removesuffix("_ms")] = summarize([run[stage] for run in runs])
+        print(f"{label:<19} p50 {results[stage.removesuffix('_ms')]['p50_ms']:8.1f} ms")
+    errors = sorted({error for run in runs for error in run["errors"]})
+    for error in errors:
+        print(f"Excepción en la app: {error}")
+
+    if args.save:
+        save_baseline(args.save, "startup", vars(args), results)
+        print(f"Baseline guardada en {args.save}")
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
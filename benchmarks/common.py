@@ -0,0 +1,75 @@
+"""Utilidades compartidas por los benchmarks: percentiles y baselines en JSON"""
+
+import json
+import platform
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+def summarize(samples_ms):
+    """p50/p95/p99, media y máximo de una lista de tiempos en milisegundos."""
+    if not samples_ms:
+        return {"count": 0}
+    values = np.asarray(samples_ms, dtype="float64")
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": int(values.size),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(values.mean()), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def save_baseline(path, name, params, results):
+    """Guarda los resultados como baseline con los parámetros que los produjeron."""
+    payload = {
+        "benchmark": name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(payload, indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare_to_baseline(path, results, tolerance=0.2, min_delta_ms=1.0):
+    """
+    Compara con una baseline guardada y devuelve las regresiones encontradas.
+
+    Se comparan los percentiles (`p50_ms`, `p95_ms`, `p99_ms`) y los `*_bytes`, que
+    empeoran al subir, y los `*_per_s`, que empeoran al bajar. Cuenta como regresión
+    una variación mayor que `tolerance` (fracción); en tiempos, además, de al menos
+    `min_delta_ms` para no marcar ruido en etapas de microsegundos.
+    """
+    baseline = dict(_flatten(json.loads(Path(path).read_text(encoding="utf-8"))["results"]))
+    regressions = []
+    for name, value in _flatten(results):
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        if name.endswith(("p50_ms", "p95_ms", "p99_ms")):
+            worse = value > reference * (1 + tolerance) and value - reference >= min_delta_ms
+        elif name.endswith("_bytes"):
+            worse = value > reference * (1 + tolerance)
+        elif name.endswith("_per_s"):
+            worse = value < reference * (1 - tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append(f"{name}: {reference:,.3f} → {value:,.3f}")
+    return regressions
@@ -0,0 +1,249 @@
+"""Elección y construcción de gráficos con un número de puntos acotado"""
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+COLOR = "#2980b9"
+# Filas hasta las que un resultado pequeño se pinta como barras, como siempre
+MAX_BARS = 20
+# Categorías máximas en un gráfico de barras grande (se muestran las mayores)
+MAX_CATEGORIES = 50
+# Series máximas en un gráfico de líneas con color (se muestran las mayores)
+MAX_SERIES = 10
+# A partir de aquí los diagramas de dispersión usan WebGL
+SCATTERGL_THRESHOLD = 1000
+HISTOGRAM_BINS = 50
+# Filas mínimas para una dispersión o un histograma, que no tienen eje de categorías ni
+# de tiempo: con menos, un escalar o un par de cifras se leen mejor en la tabla
+MIN_DISTRIBUTION_ROWS = 20
+# Nombres de columna que se tratan como eje temporal aunque sean enteros
+_TIME_NAMES = ("date", "fecha", "year", "month", "day")
+
+
+def lttb(x, y, threshold):
+    """
+    Índices de los puntos que conserva Largest-Triangle-Three-Buckets: el primero, el
+    último y, en cada tramo, el que forma el triángulo de mayor área con el punto
+    elegido en el tramo anterior y la media del siguiente.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(area.argmax()) if end > start else start
+        selected[bucket + 1] = previous
+    return selected
+
+
+def _is_time(df, column):
+    return pd.api.types.is_datetime64_any_dtype(df[column]) or (
+        column.lower() in _TIME_NAMES and pd.api.types.is_numeric_dtype(df[column])
+    )
+
+
+def chart_spec(df_result, max_points=2000):
+    """
+    Especificación del gráfico según la forma y los tipos del resultado (None si no
+    procede). Es un dict serializable: el historial la guarda para reconstruir la figura.
+    """
+    if df_result is None or len(df_result) == 0 or len(df_result.columns) < 1:
+        return None
+    columns = [column for column in df_result.columns if not column.endswith("_margen")]
+    time_cols = [column for column in columns if _is_time(df_result, column)]
+    numeric_cols = [
+        column for column in columns
+        if column not in time_cols and pd.api.types.is_numeric_dtype(df_result[column])
+        and not pd.api.types.is_bool_dtype(df_result[column])
+    ]
+    categorical_cols = [
+        column for column in columns if column not in time_cols and column not in numeric_cols
+    ]
+    if not numeric_cols:
+        return None
+    y = numeric_cols[0]
+    margin = f"{y}_margen" if f"{y}_margen" in df_result.columns else None
+    spec = {"y": y, "error_y": margin, "max_points": max_points}
+
+    # "year" + "month" se combinan en una fecha para las series mensuales
+    x_month = None
+    if "year" in time_cols and "month" in time_cols:
+        time_cols = ["year"]
+        x_month = "month"
+    x_time = time_cols[0] if time_cols else None
+
+    if len(df_result) <= MAX_BARS and (x_time or categorical_cols) and not x_month:
+        # Resultado pequeño: barras, prefiriendo 'year' o 'state' como eje
+        x_axis = x_time or categorical_cols[0]
+        if "state" in categorical_cols and not x_time:
+            x_axis = "state"
+        return {**spec, "kind": "bar", "x": x_axis, "title": _title(y, x_axis)}
+    if x_time:
+        color = categorical_cols[0] if categorical_cols else None
+        return {
+            **spec, "kind": "line", "x": x_time, "x_month": x_month, "color": color,
+            "title": f"📈 {_label(y)} a lo largo del tiempo",
+        }
+    if categorical_cols:
+        x_axis = categorical_cols[0]
+        return {**spec, "kind": "bar", "x": x_axis, "title": _title(y, x_axis)}
+    if len(df_result) < MIN_DISTRIBUTION_ROWS:
+        return None
+    if len(numeric_cols) >= 2:
+        x_axis, y = numeric_cols[0], numeric_cols[1]
+        kind = "scatter" if len(df_result) <= max_points else "heatmap"
+        return {
+            **spec, "kind": kind, "x": x_axis, "y": y, "error_y": None,
+            "title": f"📈 {_label(y)} frente a {_label(x_axis)}",
+        }
+    return {
+        **spec, "kind": "histogram", "x": y, "error_y": None,
+        "title": f"📊 Distribución de {_label(y)}",
+    }
+
+
+def _label(column):
+    return column.replace("_", " ").title()
+
+
+def _title(y, x):
+    return f"📈 {_label(y)} por {_label(x)}"
+
+
+def _time_values(df, spec):
+    if spec.get("x_month"):
+        return pd.to_datetime(
+            pd.DataFrame({"year": df[spec["x"]], "month": df[spec["x_month"]], "day": 1}),
+            errors="coerce",
+        )
+    return df[spec["x"]]
+
+
+def _bar_traces(df, spec):
+    data = df
+    error = spec.get("error_y")
+    if data[spec["x"]].duplicated().any():
+        # Filas sueltas por categoría: se pinta la media de cada una
+        data = data.groupby(spec["x"], observed=True, as_index=False)[spec["y"]].mean()
+        error = None
+    if len(data) > MAX_CATEGORIES:
+        data = data.nlargest(MAX_CATEGORIES, spec["y"])
+    return [go.Bar(
+        x=data[spec["x"]].astype(str) if not _is_time(data, spec["x"]) else data[spec["x"]],
+        y=data[spec["y"]],
+        error_y={"type": "data", "array": data[error]} if error else None,
+        marker_color=COLOR,
+    )]
+
+
+def _line_traces(df, spec):
+    frame = pd.DataFrame({"x": _time_values(df, spec), "y": df[spec["y"]]})
+    color = spec.get("color")
+    if color:
+        frame["series"] = df[color].astype(str).to_numpy()
+        # Solo las series con más peso, para que la leyenda y los puntos sigan acotados
+        top = frame.groupby("series", observed=True)["y"].sum().nlargest(MAX_SERIES).index
+        groups = list(frame[frame["series"].isin(top)].groupby("series"))
+    else:
+        groups = [(None, frame)]
+    budget = max(3, spec["max_points"] // max(1, len(groups)))
+    series = []
+    for name, group in groups:
+        group = group.dropna()
+        if group["x"].duplicated().any():
+            # Varias filas por instante: la línea sigue la media de cada uno
+            group = group.groupby("x", as_index=False)["y"].mean()
+        group = group.sort_values("x")
+        x_numeric = group["x"].to_numpy()
+        if np.issubdtype(x_numeric.dtype, np.datetime64):
+            x_numeric = x_numeric.astype("datetime64[ns]").astype(np.int64)
+        keep = lttb(x_numeric, group["y"].to_numpy(dtype="float64"), budget)
+        series.append((name, group.iloc[keep]))
+    total = sum(len(group) for _, group in series)
+    trace_type = go.Scattergl if total > SCATTERGL_THRESHOLD else go.Scatter
+    traces = [
+        trace_type(
+            x=group["x"], y=group["y"], mode="lines", name=name,
+            line={"color": COLOR} if name is None else None,
+        )
+        for name, group in series
+    ]
+    return traces
+
+
+def _scatter_traces(df, spec):
+    data = df[[spec["x"], spec["y"]]].dropna()
+    trace_type = go.Scattergl if len(data) > SCATTERGL_THRESHOLD else go.Scatter
+    return [trace_type(
+        x=data[spec["x"]], y=data[spec["y"]], mode="markers",
+        marker={"color": COLOR, "size": 4, "opacity": 0.6},
+    )]
+
+
+def _heatmap_traces(df, spec):
+    data = df[[spec["x"], spec["y"]]].dropna().astype("float64")
+    # Tantas celdas como puntos permitidos
+    bins = max(10, int(np.sqrt(spec["max_points"])))
+    counts, x_edges, y_edges = np.histogram2d(data[spec["x"]], data[spec["y"]], bins=bins)
+    return [go.Heatmap(
+        x=(x_edges[:-1] + x_edges[1:]) / 2,
+        y=(y_edges[:-1] + y_edges[1:]) / 2,
+        # Las celdas vacías se dejan en blanco
+        z=np.where(counts.T > 0, counts.T, np.nan),
+        colorscale="Blues",
+        colorbar={"title": "Filas"},
+    )]
+
+
+def _histogram_traces(df, spec):
+    values = pd.to_numeric(df[spec["x"]], errors="coerce").dropna().to_numpy(dtype="float64")
+    counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+    return [go.Bar(
+        x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges), marker_color=COLOR,
+    )]
+
+
+_TRACE_BUILDERS = {
+    "bar": _bar_traces,
+    "line": _line_traces,
+    "scatter": _scatter_traces,
+    "heatmap": _heatmap_traces,
+    "histogram": _histogram_traces,
+}
+
+
+def build_chart(df_result, spec):
+    """
+    Figura de Plotly a partir de la especificación. Nunca envía al navegador más de
+    `max_points` puntos por gráfico (LTTB en las series y agregación previa en
+    histogramas y mapas de calor), tenga el resultado las filas que tenga.
+    """
+    if spec is None or df_result is None:
+        return None
+    builder = _TRACE_BUILDERS.get(spec.get("kind"))
+    if builder is None:
+        return None
+    fig = go.Figure(builder(df_result, spec))
+    fig.update_layout(
+        title=spec["title"],
+        xaxis_title=_label(spec["x"]),
+        yaxis_title="Filas" if spec["kind"] == "histogram" else _label(spec["y"]),
+        showlegend=spec["kind"] == "line" and bool(spec.get("color")),
+        plot_bgcolor="rgba(0,0,0,0)",
+        paper_bgcolor="rgba(0,0,0,0)",
+    )
+    return fig
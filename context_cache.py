@@ -0,0 +1,176 @@
+"""Prefijos de prompt estáticos y versionados con caché de contexto de Gemini"""
+
+import hashlib
+import threading
+import time
+
+# Aproximación de caracteres por token para estimar el ahorro cuando la API no lo informa
+CHARS_PER_TOKEN = 4
+
+
+class PromptPrefix:
+    """Parte estática de un prompt (esquema, reglas, ejemplos) identificada por su versión."""
+
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.approx_tokens = len(text) // CHARS_PER_TOKEN
+
+
+def _is_unsupported(error):
+    """Errores que no cambian al reintentar: prefijo demasiado corto o modelo sin caché."""
+    code = getattr(error, "code", None)
+    if code == 429 or (isinstance(code, int) and code >= 500):
+        return False
+    text = str(error).lower()
+    return code == 400 or any(
+        hint in text for hint in ("too small", "minimum", "not supported", "no admite")
+    )
+
+
+class ContextCache:
+    """
+    Registra prefijos en la caché de contexto de Gemini (`client.caches`) para que cada
+    turno solo envíe la parte variable del prompt.
+
+    Si el modelo no admite caché, el prefijo es demasiado corto o la API falla, el
+    prefijo se envía en línea como antes; tras un fallo pasajero la caché se vuelve a
+    intentar a los `retry_after` segundos. Cualquier cliente con `caches.create` y
+    `models.generate_content[_stream]` sirve, incluido el cliente falso local.
+    """
+
+    def __init__(self, ttl=3600, min_tokens=1024, retry_after=30):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.retry_after = retry_after
+        # (modelo, versión) -> (nombre o None, válido hasta); None: ahora no hay caché
+        self._entries = {}
+        self._creating = set()
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.cached_turns = 0
+        self.tokens_saved = 0
+
+    def _cache_name(self, client, model, prefix):
+        """Nombre de la caché remota del prefijo, creándola si hace falta; None si no aplica."""
+        if prefix.approx_tokens < self.min_tokens:
+            return None
+        key = (model, prefix.version)
+        now = time.time()
+        with self._lock:
+            name, expires_at = self._entries.get(key, (None, 0))
+            # Se renueva un poco antes de que caduque en el servidor
+            if now < expires_at - (60 if name else 0):
+                return name
+            if key in self._creating:
+                # Otra sesión la está creando: mientras, la anterior si sigue viva o en línea
+                return name if now < expires_at else None
+            self._creating.add(key)
+        # La creación es una llamada de red: fuera del lock, para no parar a las demás sesiones
+        try:
+            cached = client.caches.create(
+                model=model,
+                config={
+                    "system_instruction": prefix.text,
+                    "display_name": f"natality-{prefix.kind}-{prefix.version}",
+                    "ttl": f"{self.ttl}s",
+                },
+            )
+        except Exception as e:
+            # Si el modelo no admite caché para el prefijo no se reintenta hasta pasado el
+            # TTL; un fallo pasajero (429, 5xx, red) se reintenta a los `retry_after` segundos
+            retry = self.ttl if _is_unsupported(e) else self.retry_after
+            with self._lock:
+                self._entries[key] = (None, time.time() + retry)
+                self._creating.discard(key)
+            return None
+        with self._lock:
+            self._entries[key] = (cached.name, time.time() + self.ttl)
+            self._creating.discard(key)
+        return cached.name
+
+    def _invalidate(self, model, prefix):
+        with self._lock:
+            self._entries.pop((model, prefix.version), None)
+
+    def _request(self, client, model_config, prefix, turn_text):
+        name = self._cache_name(client, model_config["model"], prefix)
+        if name is None:
+            return f"{prefix.text}\n\n{turn_text}", model_config["generation_config"], False
+        return turn_text, {**model_config["generation_config"], "cached_content": name}, True
+
+    def _record(self, usage_metadata, prefix, cached, usage):
+        saved = 0
+        if cached:
+            saved = getattr(usage_metadata, "cached_content_token_count", None)
+            if saved is None:
+                saved = prefix.approx_tokens
+        with self._lock:
+            self.turns += 1
+            self.cached_turns += int(cached)
+            self.tokens_saved += saved
+        if usage is not None:
+            usage["prompt_tokens_saved"] = usage.get("prompt_tokens_saved", 0) + saved
+            # Tokens facturados por el modelo, para las trazas y métricas
+            for key, attr in (("prompt_tokens", "prompt_token_count"),
+                              ("output_tokens", "candidates_token_count")):
+                usage[key] = usage.get(key, 0) + (getattr(usage_metadata, attr, None) or 0)
+        return saved
+
+    def generate(self, client, model_config, prefix, turn_text, usage=None):
+        """`generate_content` con el prefijo cacheado (o en línea si no hay caché)."""
+        contents, config, cached = self._request(client, model_config, prefix, turn_text)
+        try:
+            response = client.models.generate_content(
+                model=model_config["model"], contents=contents, config=config
+            )
+        except Exception:
+            if not cached:
+                raise
+            # La caché pudo caducar o borrarse en el servidor: se repite en línea
+            self._invalidate(model_config["model"], prefix)
+            cached = False
+            response = client.models.generate_content(
+                model=model_config["model"],
+                contents=f"{prefix.text}\n\n{turn_text}",
+                config=model_config["generation_config"],
+            )
+        self._record(getattr(response, "usage_metadata", None), prefix, cached, usage)
+        return response
+
+    def generate_stream(self, client, model_config, prefix, turn_text, usage=None):
+        """Versión en streaming de `generate`; entrega los fragmentos de texto."""
+        contents, config, cached = self._request(client, model_config, prefix, turn_text)
+        usage_metadata = None
+        started = False
+        try:
+            for chunk in client.models.generate_content_stream(
+                model=model_config["model"], contents=contents, config=config
+            ):
+                started = True
+                usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                if chunk.text:
+                    yield chunk.text
+        except Exception:
+            if not cached or started:
+                raise
+            self._invalidate(model_config["model"], prefix)
+            cached = False
+            for chunk in client.models.generate_content_stream(
+                model=model_config["model"],
+                contents=f"{prefix.text}\n\n{turn_text}",
+                config=model_config["generation_config"],
+            ):
+                usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                if chunk.text:
+                    yield chunk.text
+        self._record(usage_metadata, prefix, cached, usage)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "cached_turns": self.cached_turns,
+                "tokens_saved": self.tokens_saved,
+            }
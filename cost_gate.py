@@ -0,0 +1,77 @@
+"""Control de coste de consultas mediante dry run y límites de bytes facturados"""
+
+import threading
+
+# BigQuery factura como mínimo 10 MB por tabla referenciada
+MIN_BILLED_BYTES = 10 * 1024 * 1024
+
+
+def format_bytes(num_bytes):
+    """Formatea una cantidad de bytes en la unidad más legible."""
+    if num_bytes is None:
+        return "—"
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+    return f"{size:.2f} TB"
+
+
+class CostGate:
+    """
+    Presupuesto de bytes por consulta y por sesión.
+
+    Antes de ejecutar, `estimate` hace un dry run para obtener `total_bytes_processed`
+    y `check` decide si la consulta cabe en el presupuesto. `job_config` limita además
+    la ejecución real con `maximum_bytes_billed`.
+    """
+
+    def __init__(self, max_bytes_per_query, max_bytes_per_session):
+        self.max_bytes_per_query = max_bytes_per_query
+        self.max_bytes_per_session = max_bytes_per_session
+        self.spent = 0
+        # Los lotes comparten un presupuesto entre hilos
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return max(self.max_bytes_per_session - self.spent, 0)
+
+    def limit(self):
+        """Máximo de bytes que puede facturar la próxima consulta."""
+        return min(self.max_bytes_per_query, self.remaining())
+
+    def estimate(self, client, sql_query):
+        """Bytes que procesaría la consulta según un dry run (no se factura)."""
+        # Se importa al usarse: la app arranca sin cargar el cliente de BigQuery
+        from google.cloud import bigquery
+
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        query_job = client.query(sql_query, job_config=job_config)
+        return int(query_job.total_bytes_processed or 0)
+
+    def check(self, estimated_bytes):
+        """Devuelve (permitida, motivo) para una consulta con el coste estimado."""
+        if estimated_bytes > self.max_bytes_per_query:
+            return False, (
+                f"La consulta procesaría {format_bytes(estimated_bytes)}, más que el límite "
+                f"por consulta de {format_bytes(self.max_bytes_per_query)}."
+            )
+        if estimated_bytes > self.remaining():
+            return False, (
+                f"La consulta procesaría {format_bytes(estimated_bytes)} y solo quedan "
+                f"{format_bytes(self.remaining())} del presupuesto de la sesión."
+            )
+        return True, None
+
+    def job_config(self):
+        """Configuración de ejecución con el tope de bytes facturados."""
+        from google.cloud import bigquery
+
+        return bigquery.QueryJobConfig(
+            maximum_bytes_billed=max(self.limit(), MIN_BILLED_BYTES)
+        )
+
+    def record(self, bytes_processed):
+        with self._lock:
+            self.spent += int(bytes_processed or 0)
@@ -0,0 +1,496 @@
+"""Cubo local preagregado de natalidad y enrutador de consultas"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlglot
+from sqlglot import exp
+
+NATALITY_TABLE = "bigquery-public-data.samples.natality"
+
+# Dimensiones del cubo (grano de agregación) y medidas precalculadas
+CUBE_DIMENSIONS = ["year", "state", "plurality", "mother_age", "gestation_weeks", "is_male"]
+CUBE_MEASURES = ["weight_pounds"]
+# Clave de los metadatos del Parquet con la procedencia del cubo
+PROVENANCE_KEY = b"natality_cube"
+
+_DIMENSION_LIST = ", ".join(CUBE_DIMENSIONS)
+_MEASURE_AGGREGATES = ",\n  ".join(
+    f"COUNT({m}) AS {m}_count, SUM({m}) AS {m}_sum, SUM({m} * {m}) AS {m}_sumsq"
+    for m in CUBE_MEASURES
+)
+CUBE_BUILD_SQL = f"""
+SELECT
+  {_DIMENSION_LIST},
+  COUNT(*) AS n,
+  {_MEASURE_AGGREGATES}
+FROM `{NATALITY_TABLE}`
+GROUP BY {_DIMENSION_LIST}
+"""
+
+
+def build_cube(df):
+    """
+    Agrega un DataFrame de nacimientos (una fila por nacimiento) al grano del cubo.
+
+    Cada celda guarda el número de nacimientos `n` y, por medida, el conteo de
+    valores no nulos, la suma y la suma de cuadrados.
+    """
+    work = df[CUBE_DIMENSIONS].copy()
+    work["n"] = 1
+    for measure in CUBE_MEASURES:
+        values = pd.to_numeric(df[measure], errors="coerce").astype("float64")
+        work[f"{measure}_count"] = values.notna().astype("int64")
+        work[f"{measure}_sum"] = values.fillna(0.0)
+        work[f"{measure}_sumsq"] = (values * values).fillna(0.0)
+
+    cube = (
+        work.groupby(CUBE_DIMENSIONS, dropna=False, observed=True, sort=False)
+        .sum()
+        .reset_index()
+    )
+    return _normalize_cube(cube)
+
+
+def _normalize_cube(cube):
+    # SUM sobre solo nulos devuelve NULL en BigQuery; en el cubo se guarda como 0
+    for measure in CUBE_MEASURES:
+        for suffix in ("count", "sum", "sumsq"):
+            column = f"{measure}_{suffix}"
+            cube[column] = cube[column].fillna(0)
+    cube["n"] = cube["n"].astype("int64")
+    return cube
+
+
+def build_cube_from_file(source_path):
+    """Construye el cubo a partir de un fichero local (CSV o Parquet) de nacimientos."""
+    source_path = Path(source_path)
+    if source_path.suffix == ".csv":
+        df = pd.read_csv(source_path)
+    else:
+        df = pd.read_parquet(source_path)
+    return build_cube(df)
+
+
+def build_cube_from_bigquery(client):
+    """Construye el cubo agregando la tabla completa en BigQuery (un único escaneo)."""
+    return _normalize_cube(client.query(CUBE_BUILD_SQL).to_dataframe())
+
+
+def save_cube(cube, path, source, exact):
+    """
+    Guarda el cubo en Parquet con su procedencia en los metadatos.
+
+    `exact` indica que se construyó a partir de la tabla completa; solo entonces sus
+    respuestas coinciden con las de BigQuery.
+    """
+    table = pa.Table.from_pandas(cube, preserve_index=False)
+    provenance = json.dumps({"source": source, "exact": exact}, ensure_ascii=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), PROVENANCE_KEY: provenance.encode()})
+    pq.write_table(table, path)
+
+
+def read_provenance(path):
+    """Procedencia guardada con el cubo; vacía si el cubo es anterior a guardarla."""
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[PROVENANCE_KEY]) if PROVENANCE_KEY in metadata else {}
+
+
+class NotRoutable(Exception):
+    """La consulta no se puede responder con el cubo."""
+
+
+def _literal_value(node):
+    if isinstance(node, exp.Paren):
+        return _literal_value(node.this)
+    if isinstance(node, exp.Boolean):
+        return node.this
+    if isinstance(node, exp.Neg):
+        return -_literal_value(node.this)
+    if isinstance(node, exp.Literal):
+        if node.is_string:
+            return node.this
+        value = float(node.this)
+        return int(value) if value.is_integer() and "." not in node.this else value
+    raise NotRoutable(f"literal no soportado: {node.sql()}")
+
+
+def _round_half_away(values, digits):
+    # ROUND de BigQuery redondea alejándose de cero, no al par más cercano
+    factor = 10.0 ** digits
+    return np.sign(values) * np.floor(np.abs(values) * factor + 0.5) / factor
+
+
+class CubeRouter:
+    """
+    Responde localmente las consultas agregadas que el cubo puede resolver de forma exacta.
+
+    Soporta un único SELECT sobre la tabla de natalidad con filtros sobre dimensiones,
+    GROUP BY de dimensiones, COUNT/SUM/AVG/STDDEV/VARIANCE (más MIN/MAX y COUNT DISTINCT
+    de dimensiones), ROUND, ORDER BY y LIMIT. Para cualquier otra consulta `try_answer`
+    devuelve None y la consulta debe ir a BigQuery.
+    """
+
+    def __init__(self, cube, provenance=None):
+        self.cube = cube
+        self.provenance = provenance or {}
+        self.columns = set(CUBE_DIMENSIONS) | set(CUBE_MEASURES)
+
+    @property
+    def exact(self):
+        """True si el cubo se construyó a partir de la tabla completa."""
+        return self.provenance.get("exact") is True
+
+    @classmethod
+    def load(cls, path):
+        return cls(pd.read_parquet(path), read_provenance(path))
+
+    def try_answer(self, sql_query):
+        """DataFrame con la respuesta calculada desde el cubo, o None si no es enrutable."""
+        try:
+            return self._execute(self._plan(sql_query))
+        except Exception:
+            # Cualquier fallo local (SQL no parseable, tipos incompatibles...) va a BigQuery
+            return None
+
+    # --- Planificación ---
+
+    def _plan(self, sql_query):
+        tree = sqlglot.parse_one(sql_query, read="bigquery")
+        if not isinstance(tree, exp.Select):
+            raise NotRoutable("no es un SELECT simple")
+        for unsupported in ("joins", "with", "having", "qualify", "distinct", "offset", "windows"):
+            if tree.args.get(unsupported):
+                raise NotRoutable(f"{unsupported} no soportado")
+        if tree.find(exp.Window) or tree.find(exp.Subquery) or \
+                any(isinstance(p.unalias(), exp.Star) for p in tree.expressions):
+            raise NotRoutable("ventanas, subconsultas o SELECT *")
+
+        from_ = tree.args.get("from_") or tree.args.get("from")
+        table = from_.this if from_ is not None else None
+        # Solo la ruta completa: `samples.natality` sería la del proyecto por defecto
+        if not isinstance(table, exp.Table) or \
+                ".".join(part.name for part in table.parts) != NATALITY_TABLE:
+            raise NotRoutable("no consulta la tabla de natalidad")
+        for column in tree.find_all(exp.Column):
+            if column.name not in self.columns and column.name not in {
+                p.alias for p in tree.expressions if isinstance(p, exp.Alias)
+            }:
+                raise NotRoutable(f"columna fuera del cubo: {column.name}")
+
+        plan = {"outputs": [], "group": [], "order": [], "limit": None, "measure_not_null": set()}
+
+        unnamed = 0
+        for projection in tree.expressions:
+            node = projection.unalias()
+            if isinstance(projection, exp.Alias):
+                name = projection.alias
+            elif isinstance(node, exp.Column):
+                name = node.name
+            else:
+                # BigQuery nombra f0_, f1_... las columnas calculadas sin alias
+                name = f"f{unnamed}_"
+                unnamed += 1
+            plan["outputs"].append((name, self._plan_output(node), node))
+
+        group = tree.args.get("group")
+        for node in group.expressions if group else []:
+            plan["group"].append(self._resolve_dimension(node, plan["outputs"]))
+        for _, spec, _node in plan["outputs"]:
+            if spec[0] == "dim" and spec[1] not in plan["group"]:
+                raise NotRoutable("columna no agregada fuera del GROUP BY")
+
+        where = tree.args.get("where")
+        plan["where"] = where.this if where else None
+        if plan["where"] is not None:
+            # Se valida ahora para no descubrir el problema a mitad de la ejecución
+            self._mask(plan["where"], self.cube.head(0), plan["measure_not_null"])
+
+        order = tree.args.get("order")
+        for ordered in order.expressions if order else []:
+            desc = bool(ordered.args.get("desc"))
+            nulls_first = ordered.args.get("nulls_first")
+            if nulls_first is None:
+                nulls_first = not desc
+            plan["order"].append(
+                (self._resolve_output(ordered.this, plan["outputs"]), desc, nulls_first)
+            )
+
+        limit = tree.args.get("limit")
+        if limit is not None:
+            plan["limit"] = int(_literal_value(limit.expression))
+        return plan
+
+    def _plan_output(self, node):
+        digits = None
+        if isinstance(node, exp.Round):
+            decimals = node.args.get("decimals")
+            digits = int(_literal_value(decimals)) if decimals is not None else 0
+            node = node.this
+
+        if isinstance(node, exp.Literal) and digits is None:
+            # Etiquetas constantes, como el `grupo` de cada rama de una comparación
+            return ("literal", _literal_value(node), None)
+
+        if isinstance(node, exp.Column):
+            if digits is not None or node.name not in CUBE_DIMENSIONS:
+                raise NotRoutable(f"columna no agregable: {node.name}")
+            return ("dim", node.name, None)
+
+        if isinstance(node, exp.Count):
+            target = node.this
+            if isinstance(target, exp.Star):
+                return ("count", None, digits)
+            if isinstance(target, exp.Distinct):
+                columns = target.expressions
+                if len(columns) != 1 or not isinstance(columns[0], exp.Column) or \
+                        columns[0].name not in CUBE_DIMENSIONS:
+                    raise NotRoutable("COUNT DISTINCT solo sobre una dimensión")
+                return ("count_distinct", columns[0].name, digits)
+            return ("count", self._aggregated_column(target), digits)
+
+        aggregates = {
+            exp.Sum: "sum", exp.Avg: "avg",
+            exp.Stddev: "stddev_samp", exp.StddevSamp: "stddev_samp",
+            exp.StddevPop: "stddev_pop", exp.Variance: "var_samp",
+            exp.VariancePop: "var_pop", exp.Min: "min", exp.Max: "max",
+        }
+        for aggregate_type, kind in aggregates.items():
+            if type(node) is aggregate_type:
+                column = self._aggregated_column(node.this)
+                if kind in ("min", "max") and column not in CUBE_DIMENSIONS:
+                    raise NotRoutable("MIN/MAX solo sobre dimensiones")
+                if kind not in ("min", "max") and column in ("state", "is_male"):
+                    raise NotRoutable(f"{column} no es numérica")
+                return (kind, column, digits)
+        raise NotRoutable(f"expresión no soportada: {node.sql()}")
+
+    def _aggregated_column(self, node):
+        if not isinstance(node, exp.Column) or node.name not in self.columns:
+            raise NotRoutable("solo se agregan columnas del cubo")
+        return node.name
+
+    def _resolve_dimension(self, node, outputs):
+        if isinstance(node, exp.Literal) and not node.is_string:
+            node = outputs[int(node.this) - 1][2]
+        if isinstance(node, exp.Column):
+            for name, spec, _ in outputs:
+                if name == node.name and spec[0] == "dim":
+                    return spec[1]
+            if node.name in CUBE_DIMENSIONS:
+                return node.name
+        raise NotRoutable(f"GROUP BY no soportado: {node.sql()}")
+
+    def _resolve_output(self, node, outputs):
+        if isinstance(node, exp.Literal) and not node.is_string:
+            return outputs[int(node.this) - 1][0]
+        if isinstance(node, exp.Column):
+            for name, _, _ in outputs:
+                if name == node.name:
+                    return name
+        for name, _, output_node in outputs:
+            if output_node == node:
+                return name
+        raise NotRoutable(f"ORDER BY no soportado: {node.sql()}")
+
+    # --- Ejecución ---
+
+    def _mask(self, node, frame, measure_not_null, conjunctive=True):
+        """Máscara booleana equivalente a la condición WHERE (NULL se trata como falso)."""
+        if isinstance(node, exp.Paren):
+            return self._mask(node.this, frame, measure_not_null, conjunctive)
+        if isinstance(node, exp.And):
+            return self._mask(node.this, frame, measure_not_null, conjunctive) & \
+                self._mask(node.expression, frame, measure_not_null, conjunctive)
+        if isinstance(node, exp.Or):
+            return self._mask(node.this, frame, measure_not_null, False) | \
+                self._mask(node.expression, frame, measure_not_null, False)
+
+        if isinstance(node, exp.Is) and isinstance(node.expression, exp.Null):
+            column = self._filter_column(node.this)
+            return frame[column].isna()
+        if isinstance(node, exp.Not):
+            inner = node.this.unnest()
+            if isinstance(inner, exp.Is) and isinstance(inner.expression, exp.Null):
+                if isinstance(inner.this, exp.Column) and inner.this.name in CUBE_MEASURES:
+                    if not conjunctive:
+                        raise NotRoutable("IS NOT NULL de una medida dentro de un OR")
+                    # Se resuelve con los conteos de no nulos de la medida
+                    measure_not_null.add(inner.this.name)
+                    return pd.Series(True, index=frame.index)
+                return frame[self._filter_column(inner.this)].notna()
+            if isinstance(inner, exp.Column):
+                return frame[self._filter_column(inner)].eq(False).fillna(False).astype(bool)
+            raise NotRoutable("NOT solo sobre IS NULL o columnas booleanas")
+        if isinstance(node, exp.Column):
+            return frame[self._filter_column(node)].eq(True).fillna(False).astype(bool)
+
+        if isinstance(node, exp.Between):
+            series = frame[self._filter_column(node.this)]
+            low, high = _literal_value(node.args["low"]), _literal_value(node.args["high"])
+            return ((series >= low) & (series <= high)).fillna(False).astype(bool)
+        if isinstance(node, exp.In):
+            if node.args.get("query") or node.args.get("unnest"):
+                raise NotRoutable("IN con subconsulta")
+            values = [_literal_value(value) for value in node.expressions]
+            return frame[self._filter_column(node.this)].isin(values).astype(bool)
+
+        comparisons = {
+            exp.EQ: "eq", exp.NEQ: "ne", exp.GT: "gt", exp.GTE: "ge", exp.LT: "lt", exp.LTE: "le",
+        }
+        flipped = {"eq": "eq", "ne": "ne", "gt": "lt", "ge": "le", "lt": "gt", "le": "ge"}
+        for comparison_type, op in comparisons.items():
+            if type(node) is comparison_type:
+                left, right = node.this, node.expression
+                if not isinstance(left, exp.Column):
+                    left, right, op = right, left, flipped[op]
+                series = frame[self._filter_column(left)]
+                value = _literal_value(right)
+                if isinstance(value, str) != (series.dtype.kind not in "iufb"):
+                    raise NotRoutable("comparación entre tipos distintos")
+                result = getattr(series, op)(value)
+                # Comparar con NULL nunca es verdadero en SQL
+                return (result & series.notna()).fillna(False).astype(bool)
+
+        raise NotRoutable(f"condición no soportada: {node.sql()}")
+
+    def _filter_column(self, node):
+        if not isinstance(node, exp.Column) or node.name not in CUBE_DIMENSIONS:
+            raise NotRoutable("solo se filtra por dimensiones del cubo")
+        return node.name
+
+    def _execute(self, plan):
+        cube = self.cube
+        if plan["where"] is not None:
+            cube = cube[self._mask(plan["where"], cube, set()).to_numpy()]
+        weight = cube["n"]
+        for measure in plan["measure_not_null"]:
+            weight = cube[f"{measure}_count"]
+        cube = cube[weight.to_numpy() > 0]
+        weight = weight[weight > 0]
+
+        # Componentes aditivos por celda: conteo, suma y suma de cuadrados
+        parts = pd.DataFrame(index=cube.index)
+        parts["_rows"] = weight
+        for _, (kind, column, _), _ in plan["outputs"]:
+            if kind in ("dim", "literal", "min", "max", "count_distinct") or column is None:
+                continue
+            if column in CUBE_MEASURES:
+                parts[f"{column}_count"] = cube[f"{column}_count"]
+                parts[f"{column}_sum"] = cube[f"{column}_sum"]
+                parts[f"{column}_sumsq"] = cube[f"{column}_sumsq"]
+            else:
+                values = cube[column].astype("float64")
+                parts[f"{column}_count"] = weight.where(values.notna(), 0)
+                parts[f"{column}_sum"] = (values * weight).fillna(0.0)
+                parts[f"{column}_sumsq"] = (values * values * weight).fillna(0.0)
+
+        group = plan["group"]
+        if group:
+            keys = [cube[dimension] for dimension in group]
+            grouped = parts.groupby(keys, dropna=False, observed=True, sort=False)
+            totals = grouped.sum()
+            raw = cube.groupby(keys, dropna=False, observed=True, sort=False)
+        else:
+            totals = parts.sum().to_frame().T
+            raw = None
+
+        result = pd.DataFrame(index=totals.index)
+        for name, (kind, column, digits), _ in plan["outputs"]:
+            if kind == "dim":
+                values = totals.index.get_level_values(group.index(column))
+                result[name] = pd.Series(values, index=totals.index).astype(cube[column].dtype)
+                continue
+            if kind == "literal":
+                result[name] = column
+                continue
+
+            if kind in ("min", "max", "count_distinct"):
+                source = cube[column]
+                if raw is not None:
+                    aggregated = {
+                        "min": raw[column].min, "max": raw[column].max,
+                        "count_distinct": raw[column].nunique,
+                    }[kind]()
+                else:
+                    aggregated = pd.Series(
+                        [{"min": source.min, "max": source.max,
+                          "count_distinct": source.nunique}[kind]()],
+                        index=totals.index,
+                    )
+                values = aggregated.reindex(totals.index)
+            elif kind == "count":
+                values = totals["_rows"] if column is None else totals[f"{column}_count"]
+                values = values.astype("int64")
+            else:
+                count = totals[f"{column}_count"].astype("float64")
+                total = totals[f"{column}_sum"].astype("float64")
+                sumsq = totals[f"{column}_sumsq"].astype("float64")
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    squared_dev = (sumsq - total * total / count).clip(lower=0)
+                    values = {
+                        "sum": total,
+                        "avg": total / count,
+                        "var_samp": squared_dev / (count - 1),
+                        "var_pop": squared_dev / count,
+                        "stddev_samp": np.sqrt(squared_dev / (count - 1)),
+                        "stddev_pop": np.sqrt(squared_dev / count),
+                    }[kind]
+                # Agregados sobre cero filas (o una, para la varianza muestral) son NULL
+                minimum = 2 if kind in ("var_samp", "stddev_samp") else 1
+                values = values.where(count >= minimum)
+
+            if digits is not None:
+                values = _round_half_away(values.astype("float64"), digits)
+            result[name] = values
+
+        result = result.reset_index(drop=True)
+        # Orden estable por claves, de la última a la primera, respetando NULLS FIRST/LAST
+        for name, desc, nulls_first in reversed(plan["order"]):
+            result = result.sort_values(
+                name, ascending=not desc, kind="stable",
+                na_position="first" if nulls_first else "last",
+            )
+        if plan["limit"] is not None:
+            result = result.head(plan["limit"])
+        return result.reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Construye el cubo local de natalidad.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--source", help="Fichero local (CSV o Parquet) con nacimientos")
+    source.add_argument(
+        "--bigquery", action="store_true", help="Agregar la tabla completa en BigQuery"
+    )
+    parser.add_argument(
+        "--output",
+        help="Ruta del cubo (por defecto .cache/natality_cube.parquet; obligatoria con --source)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.bigquery:
+        from google.cloud import bigquery
+
+        cube = build_cube_from_bigquery(bigquery.Client())
+        source, exact = f"bigquery:{NATALITY_TABLE}", True
+    else:
+        # Un cubo de muestra no debe acabar por descuido en la ruta del cubo de producción
+        if args.output is None:
+            parser.error("--source construye un cubo de muestra: indica dónde guardarlo con --output")
+        cube = build_cube_from_file(args.source)
+        source, exact = f"file:{args.source}", False
+
+    output = Path(args.output or ".cache/natality_cube.parquet")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    save_cube(cube, output, source, exact)
+    print(f"Cubo {'exacto' if exact else 'de muestra'} guardado en {output}: {len(cube):,} celdas")
+
+
+if __name__ == "__main__":
+    main()
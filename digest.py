@@ -0,0 +1,162 @@
+"""Resumen estadístico acotado de un resultado para el prompt de explicación"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+# Aproximación habitual de caracteres por token para texto mixto español/inglés
+CHARS_PER_TOKEN = 4
+# Hasta este número de filas se incluye la tabla completa si cabe en el presupuesto
+FULL_TABLE_ROWS = 50
+SAMPLE_HEAD_ROWS = 10
+SAMPLE_TAIL_ROWS = 5
+SAMPLE_MAX_COLUMNS = 20
+TOP_K = 5
+
+
+def _format_number(value):
+    if value is None or pd.isna(value):
+        return "NULL"
+    value = float(value)
+    if value.is_integer() and abs(value) < 1e15:
+        # Sin separador de miles en valores tipo año (1969, 2008)
+        return f"{int(value)}" if abs(value) < 10000 else f"{int(value):,}"
+    return f"{value:,.4g}" if abs(value) >= 1e4 or abs(value) < 1e-3 else f"{value:,.3f}"
+
+
+def _table_text(df):
+    return df.iloc[:, :SAMPLE_MAX_COLUMNS].to_string(index=False, max_colwidth=40)
+
+
+def _schema_section(df):
+    columns = ", ".join(f"{name} ({dtype})" for name, dtype in df.dtypes.items())
+    return f"FILAS: {len(df):,}\nCOLUMNAS: {columns}"
+
+
+def _numeric_section(numeric):
+    if numeric.empty:
+        return None
+    values = numeric.astype("float64")
+    stats = values.agg(["min", "max", "mean", "std"])
+    quantiles = values.quantile([0.25, 0.5, 0.75])
+    nulls = values.isna().sum()
+    lines = ["ESTADÍSTICAS NUMÉRICAS (min / p25 / mediana / p75 / max / media / desv.)"]
+    for column in values.columns:
+        parts = [
+            stats.at["min", column], quantiles.at[0.25, column], quantiles.at[0.5, column],
+            quantiles.at[0.75, column], stats.at["max", column], stats.at["mean", column],
+            stats.at["std", column],
+        ]
+        line = f"- {column}: " + " / ".join(_format_number(v) for v in parts)
+        if nulls[column]:
+            line += f" ({nulls[column]:,} nulos)"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _categorical_section(categorical):
+    if categorical.empty:
+        return None
+    lines = [f"VALORES MÁS FRECUENTES (top {TOP_K})"]
+    for column in categorical.columns:
+        counts = categorical[column].value_counts(dropna=False)
+        top = ", ".join(
+            f"{'NULL' if pd.isna(value) else value}={count:,}"
+            for value, count in counts.head(TOP_K).items()
+        )
+        lines.append(f"- {column} ({len(counts):,} distintos): {top}")
+    return "\n".join(lines)
+
+
+def _trend_section(df, numeric):
+    """Tendencia lineal de cada métrica por año (medias anuales si hay varias filas por año)."""
+    if "year" not in df.columns:
+        return None
+    metrics = [column for column in numeric.columns if column != "year"]
+    if not metrics:
+        return None
+    by_year = numeric.groupby(df["year"])[metrics].mean().sort_index().astype("float64")
+    if len(by_year) < 3:
+        return None
+
+    years = by_year.index.to_numpy(dtype="float64")
+    values = by_year.to_numpy()
+    valid = ~np.isnan(values)
+    # Pendiente por mínimos cuadrados de todas las columnas a la vez, ignorando nulos
+    counts = valid.sum(axis=0)
+    year_matrix = np.where(valid, years[:, None], 0.0)
+    value_matrix = np.where(valid, values, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_year = year_matrix.sum(axis=0) / counts
+        mean_value = value_matrix.sum(axis=0) / counts
+        dx = np.where(valid, years[:, None] - mean_year, 0.0)
+        dy = np.where(valid, values - mean_value, 0.0)
+        slopes = (dx * dy).sum(axis=0) / (dx * dx).sum(axis=0)
+
+    lines = [f"TENDENCIAS POR AÑO ({int(years[0])}-{int(years[-1])})"]
+    for i, column in enumerate(metrics):
+        series = by_year[column].dropna()
+        if len(series) < 3:
+            continue
+        first, last = series.iloc[0], series.iloc[-1]
+        change = (last - first) / abs(first) * 100 if first else np.nan
+        direction = "ascendente" if slopes[i] > 0 else "descendente" if slopes[i] < 0 else "plana"
+        lines.append(
+            f"- {column}: {_format_number(first)} ({int(series.index[0])}) → "
+            f"{_format_number(last)} ({int(series.index[-1])}), cambio "
+            f"{_format_number(change)}%, pendiente {_format_number(slopes[i])}/año "
+            f"({direction}); máximo en {int(series.idxmax())}, mínimo en {int(series.idxmin())}"
+        )
+    return "\n".join(lines) if len(lines) > 1 else None
+
+
+def build_result_digest(df, max_tokens=1500):
+    """
+    Resume un DataFrame en un texto de tamaño acotado para el prompt del modelo.
+
+    Incluye esquema y número de filas, estadísticas por columna numérica, valores más
+    frecuentes de las categóricas, tendencias si hay columna `year` y muestras de
+    cabeza/cola. Los resultados pequeños se incluyen completos. El texto nunca supera
+    `max_tokens` (aprox.), sea cual sea el tamaño del resultado.
+
+    Devuelve un dict con `text`, `chars`, `tokens` y `build_ms`.
+    """
+    start = time.perf_counter()
+    max_chars = max_tokens * CHARS_PER_TOKEN
+
+    numeric = df.select_dtypes(include="number")
+    categorical = df.drop(columns=numeric.columns)
+
+    sections = [_schema_section(df)]
+    full_table = _table_text(df) if len(df) <= FULL_TABLE_ROWS else None
+    if full_table is not None and len(sections[0]) + len(full_table) + 20 <= max_chars:
+        sections.append(f"DATOS COMPLETOS:\n{full_table}")
+    else:
+        sections += [
+            _trend_section(df, numeric),
+            _numeric_section(numeric),
+            _categorical_section(categorical),
+            f"PRIMERAS {SAMPLE_HEAD_ROWS} FILAS:\n{_table_text(df.head(SAMPLE_HEAD_ROWS))}",
+            f"ÚLTIMAS {SAMPLE_TAIL_ROWS} FILAS:\n{_table_text(df.tail(SAMPLE_TAIL_ROWS))}",
+        ]
+
+    # Las secciones van por prioridad; la que no cabe entera se recorta y se para ahí
+    text = ""
+    for section in sections:
+        if not section:
+            continue
+        candidate = f"{text}\n\n{section}" if text else section
+        if len(candidate) > max_chars:
+            remaining = max_chars - len(text) - 3
+            if remaining > 80:
+                text = f"{text}\n\n{section[:remaining - 2]}…"
+            break
+        text = candidate
+
+    return {
+        "text": text,
+        "chars": len(text),
+        "tokens": len(text) // CHARS_PER_TOKEN,
+        "build_ms": (time.perf_counter() - start) * 1000,
+    }
@@ -0,0 +1,305 @@
+"""Backends locales y deterministas para ejecutar el pipeline sin conexión"""
+
+import hashlib
+import itertools
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pyarrow as pa
+
+
+class FakeAPIError(Exception):
+    """Error con código HTTP, como los de `google.genai.errors.APIError`."""
+
+    def __init__(self, code, message="RESOURCE_EXHAUSTED"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=None):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeCachedContent:
+    def __init__(self, name, system_instruction):
+        self.name = name
+        self.system_instruction = system_instruction
+
+
+def default_responder(contents):
+    """Devuelve SQL para los prompts de generación y un texto fijo para el resto."""
+    if "PREGUNTA DEL USUARIO" in contents:
+        return (
+            "```sql\nSELECT year, AVG(weight_pounds) AS peso_promedio\n"
+            "FROM `bigquery-public-data.samples.natality`\n"
+            "WHERE year BETWEEN 2000 AND 2008\nGROUP BY year\nORDER BY year\n```"
+        )
+    return "El peso promedio al nacer se mantuvo estable en torno a **7.3 libras**."
+
+
+class _FakeCaches:
+    def __init__(self, owner):
+        self._owner = owner
+        self._counter = itertools.count()
+        self.contents = {}
+
+    def create(self, model, config):
+        if not self._owner.supports_cache:
+            raise RuntimeError(f"El modelo {model} no admite caché de contexto")
+        name = f"cachedContents/fake-{next(self._counter)}"
+        self.contents[name] = FakeCachedContent(name, config["system_instruction"])
+        return self.contents[name]
+
+
+class _FakeModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def _prepare(self, contents, config):
+        owner = self._owner
+        cached_tokens = None
+        prompt = contents
+        cached_name = (config or {}).get("cached_content")
+        if cached_name:
+            cached = owner.caches.contents[cached_name]
+            cached_tokens = len(cached.system_instruction) // 4
+            prompt = f"{cached.system_instruction}\n\n{contents}"
+        with owner._lock:
+            owner.calls.append({"contents": contents, "config": config})
+            # Simula cuota agotada (429) en las primeras `fail_first` llamadas
+            if len(owner.calls) <= owner.fail_first:
+                raise FakeAPIError(429)
+        return owner.responder(prompt), len(contents) // 4, cached_tokens
+
+    def generate_content(self, model, contents, config=None):
+        text, prompt_tokens, cached_tokens = self._prepare(contents, config)
+        time.sleep(self._owner.latency)
+        usage = FakeUsageMetadata(prompt_tokens, len(text) // 4, cached_tokens)
+        return FakeResponse(text, usage)
+
+    def generate_content_stream(self, model, contents, config=None):
+        text, prompt_tokens, cached_tokens = self._prepare(contents, config)
+        time.sleep(self._owner.latency)
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            last = i == len(words) - 1
+            time.sleep(self._owner.token_latency)
+            usage = FakeUsageMetadata(prompt_tokens, len(text) // 4, cached_tokens) if last else None
+            yield FakeResponse(word if last else f"{word} ", usage)
+
+
+class FakeGeminiClient:
+    """
+    Sustituto local de `genai.Client` con `models` y `caches`.
+
+    `responder(prompt)` decide el texto de cada respuesta; `latency` simula el tiempo
+    hasta el primer token, `token_latency` el tiempo entre fragmentos del streaming y
+    `fail_first` cuántas llamadas iniciales fallan con un 429.
+    """
+
+    def __init__(self, responder=default_responder, latency=0.0, token_latency=0.0,
+                 supports_cache=True, fail_first=0):
+        self.responder = responder
+        self.fail_first = fail_first
+        self.latency = latency
+        self.token_latency = token_latency
+        self.supports_cache = supports_cache
+        self.calls = []
+        self._lock = threading.Lock()
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches(self)
+
+
+def default_table(sql_query, num_rows):
+    """Tabla determinista con columnas de natalidad; la semilla depende de la SQL."""
+    rng = np.random.default_rng(int(hashlib.sha256(sql_query.encode("utf-8")).hexdigest()[:8], 16))
+    states = np.array(["CA", "TX", "NY", "FL", "IL", "PA", "OH", "MI", "GA", "NC"])
+    return pa.table({
+        "year": pa.array(1969 + np.arange(num_rows) % 40, type=pa.int64()),
+        "state": pa.array(states[rng.integers(0, len(states), num_rows)]),
+        "weight_pounds": pa.array(rng.normal(7.3, 1.2, num_rows)),
+        "mother_age": pa.array(rng.integers(15, 45, num_rows), type=pa.int64()),
+    })
+
+
+# Esquema de `bigquery-public-data.samples.natality` tal como lo describen sus metadatos
+NATALITY_SCHEMA = [
+    ("source_year", "INTEGER", "Four-digit year of the birth. Example: 1975."),
+    ("year", "INTEGER", "Four-digit year of the birth. Example: 1975."),
+    ("month", "INTEGER", "Month index of the date of birth, where 1=January."),
+    ("day", "INTEGER", "Day of birth, starting from 1."),
+    ("wday", "INTEGER", "Day of the week, where 1 is Sunday and 7 is Saturday."),
+    ("state", "STRING", "The two character postal code for the state. Entries after 2004 do not include this value."),
+    ("is_male", "BOOLEAN", "TRUE if the child is male, FALSE if female."),
+    ("child_race", "INTEGER", "The race of the child."),
+    ("weight_pounds", "FLOAT", "Weight of the child, in pounds."),
+    ("plurality", "INTEGER", "How many children were born as a result of this pregnancy. twins=2, triplets=3, and so on."),
+    ("apgar_1min", "INTEGER", "Apgar scores measure the health of a newborn child on a scale from 0-10. Value after 1 minute."),
+    ("apgar_5min", "INTEGER", "Apgar scores measure the health of a newborn child on a scale from 0-10. Value after 5 minutes."),
+    ("mother_residence_state", "STRING", "The two-letter postal code of the mother's state of residence."),
+    ("mother_race", "INTEGER", "Race of the mother. Same values as child_race."),
+    ("mother_age", "INTEGER", "Reported age of the mother when giving birth."),
+    ("gestation_weeks", "INTEGER", "The number of weeks of the pregnancy."),
+    ("lmp", "STRING", "Date of the last menstrual period in the format MMDDYYYY."),
+    ("mother_married", "BOOLEAN", "True if the mother was married when she gave birth."),
+    ("mother_birth_state", "STRING", "The two-letter postal code of the mother's birth state."),
+    ("cigarette_use", "BOOLEAN", "True if the mother smoked cigarettes. Available starting 2003."),
+    ("cigarettes_per_day", "INTEGER", "Number of cigarettes smoked by the mother per day. Available starting 2003."),
+    ("alcohol_use", "BOOLEAN", "True if the mother used alcohol. Available starting 1989."),
+    ("drinks_per_week", "INTEGER", "Number of drinks per week consumed by the mother. Available starting 1989."),
+    ("weight_gain_pounds", "INTEGER", "Number of pounds gained by the mother during pregnancy."),
+    ("born_alive_alive", "INTEGER", "Number of children previously born to the mother who are now living."),
+    ("born_alive_dead", "INTEGER", "Number of children previously born to the mother who are now dead."),
+    ("born_dead", "INTEGER", "Number of children who were born dead (i.e. miscarriages)."),
+    ("ever_born", "INTEGER", "Total number of children to whom the woman has ever given birth."),
+    ("father_race", "INTEGER", "Race of the father. Same values as child_race."),
+    ("father_age", "INTEGER", "Age of the father when the child was born."),
+    ("record_weight", "INTEGER", "1 or 2, where 2 means the record was sampled at 50%."),
+]
+
+
+class FakeSchemaField:
+    def __init__(self, name, field_type, description=None):
+        self.name = name
+        self.field_type = field_type
+        self.description = description
+
+
+class FakeTable:
+    def __init__(self, table_id, schema, description="", num_rows=0):
+        self.table_id = table_id.split(".")[-1]
+        self.schema = [FakeSchemaField(*field) for field in schema]
+        self.description = description
+        self.num_rows = num_rows
+
+
+class _FakeRowIterator:
+    def __init__(self, table, page_size):
+        self._table = table
+        self._page_size = page_size or 10_000
+        self.total_rows = table.num_rows
+        self.schema = table.schema
+
+    def to_arrow_iterable(self):
+        yield from self._table.to_batches(max_chunksize=self._page_size)
+
+
+class FakeQueryJob:
+    """
+    Job que corre desde que se crea y termina a los `latency` segundos, como en
+    BigQuery: `done()` no bloquea, `result(timeout=...)` espera como mucho `timeout`
+    y `cancel()` lo detiene (su `result()` lanza entonces un error).
+    """
+
+    def __init__(self, client, sql_query, dry_run, job_id, job_config=None):
+        self._client = client
+        self._sql_query = sql_query
+        self._dry_run = dry_run
+        self._table_cache = None
+        self._cancelled = threading.Event()
+        latency = 0.0 if dry_run else client.latency_for(sql_query)
+        self._finishes_at = time.monotonic() + latency
+        self.job_id = job_id
+        self.priority = getattr(job_config, "priority", None) or "INTERACTIVE"
+        self.total_bytes_processed = client.bytes_per_row * client.rows
+        self.slot_millis = None if dry_run else int(latency * 1000 * 4)
+        self.cache_hit = False
+
+    @property
+    def state(self):
+        return "DONE" if self.done() else "RUNNING"
+
+    def done(self):
+        return self._cancelled.is_set() or time.monotonic() >= self._finishes_at
+
+    def cancel(self):
+        if not self.done():
+            self._cancelled.set()
+            with self._client._lock:
+                self._client.cancelled.append(self.job_id)
+        return True
+
+    def _wait(self, timeout=None):
+        remaining = self._finishes_at - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            if not self._cancelled.wait(max(timeout, 0)):
+                raise FutureTimeoutError(f"El job {self.job_id} sigue en curso")
+        else:
+            self._cancelled.wait(max(remaining, 0))
+        if self._cancelled.is_set():
+            raise RuntimeError(f"Job {self.job_id} cancelado")
+
+    def _table(self, timeout=None):
+        if self._dry_run:
+            raise RuntimeError("Un dry run no tiene resultados")
+        self._wait(timeout)
+        if self._table_cache is None:
+            self._table_cache = self._client.table_factory(self._sql_query, self._client.rows)
+        return self._table_cache
+
+    def result(self, page_size=None, timeout=None):
+        return _FakeRowIterator(self._table(timeout), page_size)
+
+    def to_dataframe(self):
+        return self._table().to_pandas()
+
+
+class FakeBigQueryClient:
+    """
+    Sustituto local de `bigquery.Client` con `query()`, dry runs incluidos.
+
+    Cada consulta tarda `latency` segundos (o `latency(sql)`, para dar a cada una la
+    suya) y devuelve `rows` filas generadas por `table_factory(sql, rows)`; `queries`,
+    `dry_runs` y `cancelled` registran lo ejecutado y los jobs cancelados.
+    `get_table` sirve los metadatos de `tables` ({id: (esquema, descripción, filas)}),
+    por defecto los de la tabla de natalidad, y los registra en `metadata_calls`.
+    """
+
+    def __init__(self, rows=1000, latency=0.0, bytes_per_row=200, table_factory=default_table,
+                 tables=None):
+        self.tables = tables or {
+            "bigquery-public-data.samples.natality": (
+                NATALITY_SCHEMA, "Describes all United States births registered in the 50 "
+                "States, the District of Columbia, and New York City from 1969 to 2008.",
+                137826763,
+            ),
+        }
+        self.metadata_calls = []
+        self.rows = rows
+        self.latency = latency
+        self.bytes_per_row = bytes_per_row
+        self.table_factory = table_factory
+        self.queries = []
+        self.dry_runs = []
+        self.cancelled = []
+        self._lock = threading.Lock()
+
+    def latency_for(self, sql_query):
+        return self.latency(sql_query) if callable(self.latency) else self.latency
+
+    def query(self, sql_query, job_config=None):
+        dry_run = bool(getattr(job_config, "dry_run", False))
+        with self._lock:
+            (self.dry_runs if dry_run else self.queries).append(sql_query)
+            job_id = f"fake-job-{len(self.queries) + len(self.dry_runs)}"
+        return FakeQueryJob(self, sql_query, dry_run, job_id, job_config)
+
+    def get_table(self, table_id):
+        with self._lock:
+            self.metadata_calls.append(table_id)
+        if table_id not in self.tables:
+            raise KeyError(f"Not found: Table {table_id}")
+        schema, description, num_rows = self.tables[table_id]
+        return FakeTable(table_id, schema, description, num_rows)
@@ -0,0 +1,234 @@
+"""Índice local TF-IDF de pares pregunta/SQL verificados para ejemplos few-shot"""
+
+import array
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+from schema import tokenize
+from sql_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Las candidatas salen de las palabras más raras de la pregunta, hasta recorrer unas
+# CANDIDATE_BUDGET entradas; después se puntúan con todas sus palabras a través del
+# índice directo, sin recorrer las listas de las palabras frecuentes
+CANDIDATE_BUDGET = 6144
+# Aproximación de caracteres por token, como en la caché de contexto
+CHARS_PER_TOKEN = 4
+
+
+def question_terms(question):
+    """Palabras de la pregunta con los años, estados y números como marcadores."""
+    template, _ = normalize_question(question)
+    return sorted(set(tokenize(template)))
+
+
+class ExampleIndex:
+    """
+    Pares pregunta/SQL de turnos que se ejecutaron y devolvieron datos, con búsqueda
+    por similitud TF-IDF sobre un índice invertido.
+
+    Las altas son incrementales y se apuntan en un JSONL (`path`) para sobrevivir a
+    reinicios; al superar `max_entries` se desalojan las más antiguas. Una pregunta
+    que ya estaba (misma forma normalizada) sustituye a la anterior.
+    """
+
+    def __init__(self, path=None, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._reset()
+        if path:
+            self._load()
+
+    def _reset(self):
+        self._questions = []
+        self._sqls = []
+        self._keys = []
+        self._alive = bytearray()
+        self._slots = {}
+        # Índice invertido (palabra -> huecos) y directo (una fila de palabras por hueco,
+        # rellena con -1)
+        self._term_ids = {}
+        self._postings = []
+        self._terms = np.full((0, 0), -1, dtype=np.int32)
+        self._weights = array.array("f")
+        self._oldest = 0
+        self._logged = 0
+        self._query_weights = np.zeros(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._insert(entry["q"], entry["sql"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            return
+        self._logged = len(self._questions)
+        self._maybe_compact()
+
+    def _insert(self, question, sql_query):
+        key = normalize_question(question)[0]
+        previous = self._slots.get(key)
+        if previous is not None:
+            self._kill(previous)
+        terms = question_terms(question)
+        slot = len(self._questions)
+        self._questions.append(question)
+        self._sqls.append(sql_query)
+        self._keys.append(key)
+        self._alive.append(1)
+        self._slots[key] = slot
+        term_ids = []
+        for term in terms:
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                term_id = self._term_ids[term] = len(self._postings)
+                self._postings.append(array.array("i"))
+            self._postings[term_id].append(slot)
+            term_ids.append(term_id)
+        rows, width = self._terms.shape
+        if slot >= rows or len(term_ids) > width:
+            grown = np.full(
+                (max(2 * rows, slot + 1, 1024), max(width, len(term_ids))), -1, dtype=np.int32
+            )
+            grown[:rows, :width] = self._terms
+            self._terms = grown
+        self._terms[slot, :len(term_ids)] = term_ids
+        # Peso de la entrada: 1/sqrt(longitud), como un coseno sin idf en el documento
+        self._weights.append(1 / math.sqrt(max(1, len(terms))))
+        while len(self._slots) > self.max_entries:
+            while not self._alive[self._oldest]:
+                self._oldest += 1
+            self._kill(self._oldest)
+
+    def _kill(self, slot):
+        self._alive[slot] = 0
+        self._slots.pop(self._keys[slot], None)
+        self._questions[slot] = self._sqls[slot] = None
+
+    def _maybe_compact(self):
+        # Se reconstruye cuando la mitad de los huecos son entradas desalojadas
+        dead = len(self._questions) - len(self._slots)
+        if dead < 1000 or dead < len(self._slots):
+            return
+        live = [
+            (self._questions[slot], self._sqls[slot])
+            for slot in sorted(self._slots.values())
+        ]
+        self._reset()
+        for question, sql_query in live:
+            self._insert(question, sql_query)
+        if self.path:
+            self._rewrite()
+
+    def _rewrite(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for slot in sorted(self._slots.values()):
+                f.write(json.dumps({"q": self._questions[slot], "sql": self._sqls[slot]}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self._logged = len(self._questions)
+
+    def add(self, question, sql_query):
+        """Añade un par verificado; sustituye al de la misma pregunta normalizada."""
+        with self._lock:
+            self._insert(question, sql_query)
+            if self.path:
+                try:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"q": question, "sql": sql_query}, ensure_ascii=False) + "\n")
+                    self._logged += 1
+                    # El registro crece con las sustituciones; se reescribe al doblar lo vivo
+                    if self._logged > 2 * max(self.max_entries, 1000):
+                        self._rewrite()
+                except OSError as e:
+                    logger.warning("No se pudo guardar el ejemplo en %s: %s", self.path, e)
+            self._maybe_compact()
+
+    def search(self, question, k=3, min_score=0.3):
+        """[(similitud, pregunta, sql)] de las k entradas más parecidas, de mayor a menor."""
+        terms = question_terms(question)
+        if not terms:
+            return []
+        with self._lock:
+            total = max(1, len(self._questions))
+            query_norm, present = 0.0, []
+            for term in terms:
+                term_id = self._term_ids.get(term)
+                postings = self._postings[term_id] if term_id is not None else ()
+                idf = math.log(1 + total / max(1, len(postings)))
+                query_norm += idf
+                if postings:
+                    present.append((term_id, np.frombuffer(postings, dtype=np.int32), idf))
+            if not present:
+                return []
+            present.sort(key=lambda entry: len(entry[1]))
+            parts, used = [], 0
+            for _, slots, _ in present:
+                if used and used + len(slots) > CANDIDATE_BUDGET:
+                    break
+                # Si hasta la palabra más rara es frecuente, cuentan sus altas más recientes
+                parts.append(slots[-CANDIDATE_BUDGET:])
+                used += len(parts[-1])
+            # Ordenar y quitar repetidos cuesta lo mismo con 1k que con 100k entradas
+            candidates = parts[0]
+            if len(parts) > 1:
+                candidates = np.sort(np.concatenate(parts))
+                candidates = candidates[np.diff(candidates, prepend=-1) != 0]
+            alive = np.frombuffer(self._alive, dtype=np.uint8)[candidates].astype(bool)
+            candidates = candidates[alive]
+            if not len(candidates):
+                return []
+
+            # Puntuación completa de cada candidata con las palabras de su índice directo
+            # Con el doble de sitio, la última posición (el relleno -1) siempre pesa 0
+            if len(self._query_weights) <= len(self._postings):
+                self._query_weights = np.zeros(2 * len(self._postings) + 1, dtype=np.float64)
+            query_weights = self._query_weights
+            for term_id, _, idf in present:
+                query_weights[term_id] = idf
+            # take y un producto con unos son bastante más rápidos que indexar y sumar por filas
+            rows = self._terms.take(candidates, axis=0)
+            scores = query_weights.take(rows.ravel()).reshape(rows.shape) @ np.ones(rows.shape[1])
+            scores *= np.frombuffer(self._weights, dtype=np.float32)[candidates]
+            for term_id, _, _ in present:
+                query_weights[term_id] = 0.0
+
+            # Una entrada idéntica a la pregunta puntúa 1
+            scores = np.minimum(scores / (query_norm / math.sqrt(len(terms))), 1.0)
+            top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [
+                (float(scores[i]), self._questions[candidates[i]], self._sqls[candidates[i]])
+                for i in top if scores[i] >= min_score
+            ]
+
+    def examples(self, question, k=3, max_tokens=600, min_score=0.3):
+        """Los pares más parecidos que caben en `max_tokens`, listos para el prompt."""
+        chosen, used = [], 0
+        for _, example_question, sql_query in self.search(question, k, min_score):
+            tokens = (len(example_question) + len(sql_query)) // CHARS_PER_TOKEN
+            if used + tokens > max_tokens:
+                continue
+            chosen.append((example_question, sql_query))
+            used += tokens
+        return chosen
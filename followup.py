@@ -0,0 +1,330 @@
+"""Refinamientos del resultado anterior («ordénalo por peso», «solo Texas») sin volver a BigQuery"""
+
+import re
+import unicodedata
+
+import sqlglot
+from sqlglot import exp
+
+from schema import expand_synonyms, tokenize
+from sql_cache import STATE_CODES, US_STATES
+
+# Números con letra de «los cinco primeros»
+NUMBER_WORDS = {
+    "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6, "siete": 7, "ocho": 8,
+    "nueve": 9, "diez": 10, "quince": 15, "veinte": 20,
+}
+# Palabras de relleno que pueden quedar tras reconocer las operaciones
+FILLER_WORDS = {
+    "ahora", "pero", "vale", "ok", "bien", "favor", "muestrame", "ensename", "dame", "quiero",
+    "ver", "solo", "solamente", "unicamente", "nada", "mas", "tambien", "ademas", "luego",
+    "despues", "entonces", "anterior", "resultado", "tabla", "dato", "fila", "eso", "esto",
+    "mismo", "misma", "me", "lo", "la", "los", "las", "el", "hazlo", "ponlo", "deja", "dejalo",
+    "quedate",
+}
+# Valores que se reconocen en un filtro: (patrón, columna, valor)
+_VALUE_WORDS = [
+    (r"ninos|varones|masculinos?|hombres", "is_male", True),
+    (r"ninas|mujeres|femeninos?|hembras", "is_male", False),
+    (r"gemelos|mellizos", "plurality", 2),
+    (r"trillizos", "plurality", 3),
+]
+# Palabras con las que se busca la columna de cada tipo de valor
+_VALUE_COLUMNS = {"state": "state estado", "year": "year ano", "is_male": "is_male sexo", "plurality": "plurality gemelo"}
+
+_SEP = " | "
+_NUMBER = r"(?P<n>\d+|" + "|".join(NUMBER_WORDS) + r")"
+_DIRECTION_RES = [
+    (re.compile(r"\b(?:de mayor a menor|descendente(?:mente)?|desc)\b"), True),
+    (re.compile(r"\b(?:de menor a mayor|ascendente(?:mente)?|asc)\b"), False),
+]
+# «los 5 primeros», «top 5», «los 5 estados con mayor peso», «los 5 con menos nacimientos»
+_LIMIT_RES = [
+    re.compile(r"\b(?:los |las )?" + _NUMBER + r" (?:\w+ )?(?:con (?:el |la )?)?"
+               r"(?P<kind>primer[oa]s|mayores|menores|mas alt[oa]s|mas baj[oa]s|mayor|menor|mas|menos)\b"),
+    re.compile(r"\b(?:los |las )?(?P<kind>primer[oa]s) " + _NUMBER + r"\b"),
+    re.compile(r"\b(?P<kind>top) ?" + _NUMBER + r"\b"),
+]
+_STATE_RE = "|".join(re.escape(name) for name in sorted(US_STATES, key=len, reverse=True))
+_VALUE_RE = (
+    r"(?:" + _STATE_RE + r"|estado_[a-z]{2}|(?:19|20)\d{2}|"
+    + "|".join(pattern for pattern, _, _ in _VALUE_WORDS) + r")"
+)
+_FILTER_RE = re.compile(
+    r"\b(?:filtra\w*|solo|solamente|unicamente|quedate con|nada mas)"
+    r"(?: (?:a|en|por|para|con|de|del|el|la|los|las|lo|ano|anos|estado|estados|datos|filas))*"
+    r" (?P<values>" + _VALUE_RE + r"(?:(?: ?,| y| e| o)? " + _VALUE_RE + r")*)\b"
+)
+# La columna llega hasta la siguiente operación o conjunción
+_ORDER_RE = re.compile(r"\bordena\w*(?: (?:por|segun) (?P<column>(?:(?! (?:y|e|,) )[^|])+))?")
+
+
+class FollowUp:
+    """Operaciones de un refinamiento ya resueltas sobre las columnas del resultado anterior."""
+
+    def __init__(self, filters, order, limit):
+        # [(columna, [valores])], [(columna, descendente)] y número de filas o None
+        self.filters = filters
+        self.order = order
+        self.limit = limit
+
+    def describe(self):
+        """Descripción corta de las operaciones, para la respuesta."""
+        parts = []
+        for column, values in self.filters:
+            parts.append(f"`{column}` en {', '.join(_format_value(value) for value in values)}")
+        if self.order:
+            parts.append("ordenado por " + ", ".join(
+                f"`{column}` {'descendente' if desc else 'ascendente'}" for column, desc in self.order
+            ))
+        if self.limit is not None:
+            parts.append(f"primeras {self.limit} filas")
+        return "; ".join(parts)
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "varones" if value else "mujeres"
+    return str(value)
+
+
+def _normalize(question):
+    # Las abreviaturas de estado solo cuentan en mayúsculas, antes de pasar a minúsculas
+    text = re.sub(
+        r"\b([A-Z]{2})\b",
+        lambda m: f"estado_{m.group(1).lower()}" if m.group(1) in STATE_CODES else m.group(0),
+        question,
+    )
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[^\w,]+", " ", text).replace(",", " , ").split())
+
+
+def _comparable(value, series):
+    """Si el filtro compara tipos compatibles (el estado con texto, el año con números...)."""
+    if isinstance(value, bool):
+        return series.dtype.kind == "b"
+    if isinstance(value, int):
+        return series.dtype.kind in "iuf"
+    return series.dtype.kind == "O"
+
+
+def _parse_value(word):
+    if word.startswith("estado_"):
+        return "state", word[len("estado_"):].upper()
+    if word in US_STATES:
+        return "state", US_STATES[word]
+    if word.isdigit():
+        return "year", int(word)
+    for pattern, column, value in _VALUE_WORDS:
+        if re.fullmatch(pattern, word):
+            return column, value
+    return None
+
+
+def parse_follow_up(question):
+    """
+    Operaciones de un refinamiento escritas en la pregunta, aún sin resolver columnas:
+    {"filters": [(tipo, valor)], "order": frase o "", "direction": bool o None,
+    "limit": (n, tipo) o None, "rest": palabras sobrantes}. None si la pregunta no
+    pide ordenar, filtrar ni quedarse con las primeras filas.
+    """
+    text = _normalize(question)
+    parsed = {"filters": [], "order": None, "direction": None, "limit": None}
+
+    for pattern, desc in _DIRECTION_RES:
+        if pattern.search(text):
+            parsed["direction"] = desc
+            text = pattern.sub(_SEP, text)
+    for pattern in _LIMIT_RES:
+        match = pattern.search(text)
+        if match:
+            n = match.group("n")
+            parsed["limit"] = (int(n) if n.isdigit() else NUMBER_WORDS[n], match.group("kind"))
+            text = text[:match.start()] + _SEP + text[match.end():]
+            break
+    for match in list(_FILTER_RE.finditer(text)):
+        for word in re.findall(_VALUE_RE, match.group("values")):
+            parsed["filters"].append(_parse_value(word))
+    text = _FILTER_RE.sub(_SEP, text)
+    match = _ORDER_RE.search(text)
+    if match:
+        parsed["order"] = (match.group("column") or "").strip()
+        text = text[:match.start()] + _SEP + text[match.end():]
+
+    if not parsed["filters"] and parsed["order"] is None and parsed["limit"] is None \
+            and parsed["direction"] is None:
+        return None
+    text = text.replace("|", " ")
+    # tokenize descarta los números, y un año suelto cambia la pregunta
+    parsed["rest"] = [word for word in tokenize(text) if word not in FILLER_WORDS] + re.findall(r"\d+", text)
+    return parsed
+
+
+def resolve_column(phrase, columns):
+    """
+    Columna de `columns` que nombra la frase («peso» -> `peso_promedio`), o None si
+    ninguna columna recoge todas sus palabras o hay más de una.
+    """
+    words = tokenize(phrase)
+    if not words:
+        return None
+    scores = {}
+    for column in columns:
+        column_words = set(tokenize(column))
+        scores[column] = sum(
+            word in column_words or any(target in column_words for target in expand_synonyms(word))
+            for word in words
+        )
+    matches = [column for column, score in scores.items() if score == len(words)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def output_names(sql_query):
+    """(columnas de salida, agregadas, orden [(columna, desc)] o None si no se sabe) de una SELECT."""
+    try:
+        tree = sqlglot.parse_one(sql_query, read="bigquery")
+    except sqlglot.errors.ParseError:
+        return [], [], None
+    if not isinstance(tree, exp.Select):
+        return [], [], None
+    names, aggregated, unnamed = [], [], 0
+    for projection in tree.expressions:
+        node = projection.unalias()
+        if isinstance(projection, exp.Alias):
+            name = projection.alias
+        elif isinstance(node, exp.Column):
+            name = node.name
+        else:
+            # BigQuery nombra f0_, f1_... las columnas calculadas sin alias
+            name = f"f{unnamed}_"
+            unnamed += 1
+        names.append(name)
+        if node.find(exp.AggFunc):
+            aggregated.append(name)
+
+    order = []
+    for ordered in (tree.args.get("order").expressions if tree.args.get("order") else []):
+        key = ordered.this
+        if isinstance(key, exp.Literal) and not key.is_string and int(key.this) <= len(names):
+            name = names[int(key.this) - 1]
+        elif isinstance(key, exp.Column) and key.name in names:
+            name = key.name
+        else:
+            name = next((
+                names[i] for i, projection in enumerate(tree.expressions)
+                if projection.unalias() == key
+            ), None)
+        if name is None:
+            return names, aggregated, None
+        order.append((name, bool(ordered.args.get("desc"))))
+    return names, aggregated, order
+
+
+def plan_follow_up(question, df, previous_sql=None):
+    """
+    Refinamiento de `df` (el resultado anterior, de `previous_sql`) que pide la
+    pregunta, o None si no es un refinamiento o le faltan columnas: entonces la
+    pregunta sigue el camino normal. Solo se aceptan las preguntas en las que todas
+    las palabras se entienden como filtro, orden, límite o nombre de columna.
+    """
+    parsed = parse_follow_up(question)
+    if parsed is None:
+        return None
+    columns = list(df.columns)
+    mentioned = []
+    for word in parsed["rest"]:
+        column = resolve_column(word, columns)
+        if column is None:
+            return None
+        mentioned.append(column)
+
+    filters = {}
+    for kind, value in parsed["filters"]:
+        column = resolve_column(_VALUE_COLUMNS[kind], columns)
+        if column is None:
+            return None
+        if not _comparable(value, df[column]):
+            return None
+        filters.setdefault(column, []).append(value)
+
+    def metric():
+        numeric = [column for column in mentioned if df[column].dtype.kind in "iuf"]
+        if len(numeric) == 1:
+            return numeric[0]
+        _, aggregated, _ = output_names(previous_sql) if previous_sql else ([], [], None)
+        aggregated = [column for column in aggregated if column in columns]
+        if aggregated:
+            return aggregated[0]
+        numeric = [column for column in columns if df[column].dtype.kind in "iuf"]
+        return numeric[-1] if numeric else None
+
+    order = []
+    if parsed["order"]:
+        column = resolve_column(parsed["order"], columns)
+        if column is None:
+            return None
+        order.append((column, bool(parsed["direction"])))
+    limit = None
+    if parsed["limit"] is not None:
+        limit, kind = parsed["limit"]
+        # «los 5 mayores» ordena por la métrica; «los 5 primeros» mantiene el orden
+        if not order and kind != "top" and not kind.startswith("primer"):
+            column = metric()
+            if column is None:
+                return None
+            order.append((column, kind.startswith("mayor") or kind in ("mas", "mas altos", "mas altas")))
+    if not order and (parsed["order"] is not None or parsed["direction"] is not None):
+        # «ordénalo de mayor a menor»: por la métrica
+        column = metric()
+        if column is None:
+            return None
+        order.append((column, parsed["direction"] is not False))
+    return FollowUp(list(filters.items()), order, limit)
+
+
+def apply_follow_up(df, follow_up):
+    """Aplica el refinamiento al DataFrame como lo haría la SQL de `follow_up_sql`."""
+    for column, values in follow_up.filters:
+        # En SQL, comparar con NULL nunca es verdadero
+        df = df[df[column].isin(values).fillna(False).to_numpy(dtype=bool)]
+    # Orden estable: a igualdad se conserva el orden anterior, que la SQL repite al final
+    for column, desc in reversed(follow_up.order):
+        # BigQuery pone los NULL primero en ASC y al final en DESC
+        df = df.sort_values(column, ascending=not desc, kind="stable", na_position="last" if desc else "first")
+    if follow_up.limit is not None:
+        df = df.head(follow_up.limit)
+    return df.reset_index(drop=True)
+
+
+def follow_up_sql(previous_sql, follow_up):
+    """
+    SQL de BigQuery equivalente al refinamiento sobre la consulta anterior, o None
+    si el orden anterior (necesario para desempatar o para el LIMIT) no se conoce.
+    """
+    _, _, previous_order = output_names(previous_sql)
+    if previous_order is None:
+        if follow_up.order or follow_up.limit is not None:
+            return None
+        previous_order = []
+    try:
+        query = sqlglot.parse_one(f"SELECT * FROM ({previous_sql}) AS anterior", read="bigquery")
+    except sqlglot.errors.ParseError:
+        return None
+    for column, values in follow_up.filters:
+        condition = (
+            exp.column(column).eq(exp.convert(values[0])) if len(values) == 1
+            else exp.column(column).isin(*[exp.convert(value) for value in values])
+        )
+        query = query.where(condition)
+    # El orden de la subconsulta no se conserva: se repite tras el nuevo
+    ordered = list(follow_up.order)
+    ordered += [key for key in previous_order if key[0] not in {column for column, _ in ordered}]
+    if ordered:
+        query = query.order_by(*[
+            exp.Ordered(this=exp.column(column), desc=desc, nulls_first=not desc)
+            for column, desc in ordered
+        ])
+    if follow_up.limit is not None:
+        query = query.limit(follow_up.limit)
+    return query.sql(dialect="bigquery", pretty=True)
@@ -0,0 +1,171 @@
+"""Pasarela compartida hacia Gemini: cliente único, límite de ritmo, reintentos y cola justa"""
+
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Códigos HTTP que indican un fallo transitorio que merece reintento
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient_error(error):
+    """Cuota agotada, sobrecarga del servicio o fallos de red."""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code in TRANSIENT_STATUS_CODES
+
+
+class TokenBucket:
+    """Limitador de ritmo: `rate` peticiones por segundo con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ModelGateway:
+    """
+    Punto único de acceso al modelo para todas las sesiones que comparten una API key.
+
+    Reutiliza un solo cliente (y sus conexiones HTTP), limita el ritmo con un token bucket
+    y la concurrencia con un número fijo de huecos, reparte los huecos por turnos entre
+    sesiones (una sesión con muchas peticiones no bloquea a las demás) y reintenta los
+    errores transitorios con backoff exponencial con jitter.
+    """
+
+    def __init__(self, client, rate_per_second=5.0, burst=10, max_concurrency=8,
+                 max_retries=4, backoff_base=0.5, backoff_max=8.0):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._active = 0
+        self.calls = 0
+        self.retries = 0
+
+    def _acquire(self, session_id):
+        ticket = object()
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            while True:
+                # Turno rotatorio: se atiende la cabeza de la primera sesión en la cola
+                head_session = next(iter(self._queues))
+                if self._active < self.max_concurrency and self._queues[head_session][0] is ticket:
+                    break
+                self._cond.wait()
+            self._queues[head_session].popleft()
+            if self._queues[head_session]:
+                self._queues.move_to_end(head_session)
+            else:
+                del self._queues[head_session]
+            self._active += 1
+            self.calls += 1
+            self._cond.notify_all()
+        self._bucket.acquire()
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def _backoff(self, attempt):
+        # "Full jitter": espera aleatoria entre 0 y el tope exponencial
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def call(self, session_id, method, *args, **kwargs):
+        """Ejecuta `method(*args, **kwargs)` respetando límites y reintentando fallos transitorios."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire(session_id)
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                with self._cond:
+                    self.retries += 1
+            finally:
+                self._release()
+            self._backoff(attempt)
+
+    def stream(self, session_id, method, *args, **kwargs):
+        """Como `call` para respuestas en streaming; solo reintenta antes del primer fragmento."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire(session_id)
+            started = False
+            try:
+                for chunk in method(*args, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                with self._cond:
+                    self.retries += 1
+            finally:
+                self._release()
+            self._backoff(attempt)
+
+    def session_client(self, session_id):
+        """Cliente con la interfaz de `genai.Client` cuyas llamadas pasan por la pasarela."""
+        return GatewayClient(self, session_id)
+
+    def stats(self):
+        with self._cond:
+            waiting = sum(len(queue) for queue in self._queues.values())
+            return {"calls": self.calls, "retries": self.retries,
+                    "active": self._active, "waiting": waiting}
+
+
+class _GatewayModels:
+    def __init__(self, gateway, session_id):
+        self._gateway = gateway
+        self._session_id = session_id
+
+    def generate_content(self, **kwargs):
+        return self._gateway.call(
+            self._session_id, self._gateway.client.models.generate_content, **kwargs
+        )
+
+    def generate_content_stream(self, **kwargs):
+        return self._gateway.stream(
+            self._session_id, self._gateway.client.models.generate_content_stream, **kwargs
+        )
+
+
+class _GatewayCaches:
+    def __init__(self, gateway, session_id):
+        self._gateway = gateway
+        self._session_id = session_id
+
+    def create(self, **kwargs):
+        return self._gateway.call(self._session_id, self._gateway.client.caches.create, **kwargs)
+
+
+class GatewayClient:
+    """Vista de la pasarela para una sesión; se usa igual que `genai.Client`."""
+
+    def __init__(self, gateway, session_id):
+        self.models = _GatewayModels(gateway, session_id)
+        self.caches = _GatewayCaches(gateway, session_id)
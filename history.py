@@ -0,0 +1,131 @@
+"""Historial de chat compacto: vista previa en memoria y resultados completos en disco"""
+
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+# Claves que nunca se guardan en memoria: el DataFrame completo y la figura construida
+_HEAVY_KEYS = ("data", "fig")
+
+
+def _frame_bytes(df):
+    if df is None:
+        return 0
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _message_bytes(message):
+    size = len(message.get("content") or "") + len(message.get("sql_query") or "")
+    return size + _frame_bytes(message.get("preview"))
+
+
+class ChatHistory:
+    """
+    Mensajes de una sesión con un presupuesto de memoria.
+
+    Cada mensaje es un dict como los de `process_query`. Al añadirlo, el DataFrame
+    completo se escribe en Parquet comprimido (`<session>-<n>.parquet`) y en memoria
+    solo quedan `preview_rows` filas; la figura se sustituye por su especificación
+    (`fig_spec`) para reconstruirla al pintar. Si las vistas previas superan
+    `memory_budget` bytes, se descartan empezando por las más antiguas y se releen
+    del disco cuando hacen falta. Los bytes en memoria y en disco se llevan al día en
+    cada cambio, así que añadir un mensaje o pedir `footprint` no recorre la sesión.
+    """
+
+    def __init__(self, directory, session_id, preview_rows=20, memory_budget=8 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.session_id = session_id
+        self.preview_rows = preview_rows
+        self.memory_budget = memory_budget
+        self._messages = []
+        self._counter = 0
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        # Primer mensaje que puede conservar aún su vista previa
+        self._oldest_preview = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(list(self._messages))
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+    def __bool__(self):
+        return bool(self._messages)
+
+    def append(self, message):
+        """Guarda el mensaje en forma compacta y lo devuelve."""
+        message = dict(message)
+        df = message.get("data")
+        for key in _HEAVY_KEYS:
+            message.pop(key, None)
+        with self._lock:
+            message["id"] = self._counter
+            self._counter += 1
+        message["preview"] = None
+        message["data_path"] = None
+        disk = 0
+        if df is not None:
+            path = self.directory / f"{self.session_id}-{message['id']}.parquet"
+            df.to_parquet(path, index=False, compression="zstd")
+            message["data_path"] = str(path)
+            message["preview"] = df.head(self.preview_rows).copy()
+            message.setdefault("total_rows", len(df))
+            disk = path.stat().st_size
+        with self._lock:
+            self._messages.append(message)
+            self._memory_bytes += _message_bytes(message)
+            self._disk_bytes += disk
+            self._enforce_budget()
+        return message
+
+    def _enforce_budget(self):
+        # El último mensaje conserva siempre su vista previa; las anteriores a
+        # `_oldest_preview` ya se descartaron y no se vuelven a mirar
+        last = len(self._messages) - 1
+        while self._memory_bytes > self.memory_budget and self._oldest_preview < last:
+            message = self._messages[self._oldest_preview]
+            if message.get("preview") is not None:
+                self._memory_bytes -= _frame_bytes(message["preview"])
+                message["preview"] = None
+            self._oldest_preview += 1
+
+    def preview(self, message):
+        """Vista previa del mensaje; se relee del disco si se descartó por el presupuesto."""
+        if message.get("preview") is not None:
+            return message["preview"]
+        df = self.load_data(message)
+        # Sin fichero (purgado por el TTL o borrado) no hay vista previa que releer
+        return None if df is None else df.head(self.preview_rows)
+
+    def load_data(self, message):
+        """Resultado completo del mensaje, leído del disco bajo demanda."""
+        path = message.get("data_path")
+        if not path or not Path(path).exists():
+            return None
+        return pd.read_parquet(path)
+
+    def footprint(self):
+        """Bytes que ocupa la sesión en memoria y en disco."""
+        with self._lock:
+            return {
+                "messages": len(self._messages),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            for message in self._messages:
+                if message.get("data_path"):
+                    Path(message["data_path"]).unlink(missing_ok=True)
+            self._messages = []
+            self._memory_bytes = 0
+            self._disk_bytes = 0
+            self._oldest_preview = 0
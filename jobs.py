@@ -0,0 +1,289 @@
+"""
+Gestor de jobs de BigQuery: lanzamiento sin bloquear, tiempo máximo y cancelación.
+
+`JobManager.submit` lanza el job y `wait` lo espera a tramos cortos de
+`poll_interval` segundos. Entre tramo y tramo se comprueba el tiempo máximo y se
+llama a `on_tick`: si lanza (en Streamlit, la sesión pasó a otra pregunta o se
+cerró), el job se cancela en vez de seguir facturando. Un hilo vigila además los
+jobs cuyo dueño ya no está vivo (`is_alive`) y los que nadie espera ya.
+
+`split_union_all` divide una comparación escrita como `SELECT ... UNION ALL
+SELECT ...` en sub-consultas independientes que se pueden lanzar en paralelo y
+unir en local.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import sqlglot
+from sqlglot import exp
+
+from followup import output_names
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "INTERACTIVE"
+BATCH = "BATCH"
+
+
+class JobCancelled(Exception):
+    """El job se canceló antes de terminar; `reason` dice por qué."""
+
+    def __init__(self, reason, job_id=None):
+        super().__init__(f"Job cancelado ({reason})")
+        self.reason = reason
+        self.job_id = job_id
+
+
+class JobTimeout(JobCancelled):
+    """El job superó su tiempo máximo y se canceló."""
+
+    def __init__(self, timeout, job_id=None):
+        super().__init__("timeout", job_id)
+        self.timeout = timeout
+
+
+class TrackedJob:
+    """Un job en curso con su dueño, prioridad y fecha límite."""
+
+    def __init__(self, job, owner, priority, timeout):
+        self.job = job
+        self.owner = owner
+        self.priority = priority
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.cancel_reason = None
+
+    @property
+    def job_id(self):
+        return getattr(self.job, "job_id", None)
+
+
+def _with_priority(job_config, priority):
+    """`job_config` con la prioridad pedida; la interactiva es la de BigQuery por defecto."""
+    if priority != BATCH:
+        return job_config
+    from google.cloud import bigquery
+
+    if job_config is None:
+        job_config = bigquery.QueryJobConfig()
+    else:
+        job_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+    job_config.priority = bigquery.QueryPriority.BATCH
+    return job_config
+
+
+class JobManager:
+    """
+    Jobs de BigQuery en curso del proceso, por dueño (la sesión que los pidió).
+
+    `timeout` es el tiempo máximo de un job interactivo y `batch_timeout` el de uno
+    en prioridad batch, que BigQuery puede dejar en cola hasta tener huecos libres.
+    `is_alive(dueño)` dice si el dueño sigue ahí; sus jobs se cancelan si no.
+    """
+
+    def __init__(self, timeout=120, batch_timeout=3600, poll_interval=0.5, is_alive=None):
+        self.timeout = timeout
+        self.batch_timeout = batch_timeout
+        self.poll_interval = poll_interval
+        self.is_alive = is_alive
+        self._jobs = set()
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stats = {
+            "submitted": 0, "completed": 0, "failed": 0,
+            "timeout": 0, "superseded": 0, "orphaned": 0, "interrupted": 0,
+        }
+
+    def set_liveness(self, is_alive):
+        self.is_alive = is_alive
+
+    def submit(self, client, sql_query, job_config=None, owner=None, priority=INTERACTIVE, timeout=None):
+        """Lanza el job sin esperar a que termine y lo devuelve envuelto en un `TrackedJob`."""
+        if timeout is None:
+            timeout = self.batch_timeout if priority == BATCH else self.timeout
+        job = client.query(sql_query, job_config=_with_priority(job_config, priority))
+        tracked = TrackedJob(job, owner, priority, timeout)
+        with self._lock:
+            self._jobs.add(tracked)
+            self._stats["submitted"] += 1
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="bigquery-jobs", daemon=True)
+                self._watcher.start()
+        return tracked
+
+    def wait(self, tracked, on_tick=None):
+        """
+        Espera a que termine el job y lo devuelve. Lanza `JobTimeout` si se pasa del
+        tiempo máximo y `JobCancelled` si lo cancela otro; si `on_tick(segundos)` lanza,
+        el job se cancela y la excepción sigue su camino.
+        """
+        while True:
+            remaining = tracked.deadline - time.monotonic()
+            if tracked.cancel_reason is not None:
+                self._forget(tracked)
+                raise JobCancelled(tracked.cancel_reason, tracked.job_id)
+            if remaining <= 0:
+                self._cancel(tracked, "timeout")
+                self._forget(tracked)
+                raise JobTimeout(tracked.timeout, tracked.job_id)
+            try:
+                tracked.job.result(timeout=min(remaining, self.poll_interval))
+            except FutureTimeoutError:
+                pass
+            except Exception:
+                self._forget(tracked)
+                if tracked.cancel_reason is not None:
+                    raise JobCancelled(tracked.cancel_reason, tracked.job_id) from None
+                self._count("failed")
+                raise
+            else:
+                self._forget(tracked)
+                self._count("completed")
+                return tracked.job
+            if on_tick is not None:
+                try:
+                    on_tick(time.monotonic() - tracked.started)
+                except BaseException:
+                    self._cancel(tracked, "superseded")
+                    self._forget(tracked)
+                    raise
+
+    def cancel_owner(self, owner, reason="superseded"):
+        """Cancela los jobs en curso de `owner`; devuelve cuántos."""
+        with self._lock:
+            jobs = [tracked for tracked in self._jobs if tracked.owner == owner]
+        return sum(self._cancel(tracked, reason) for tracked in jobs)
+
+    def cancel_all(self, reason="interrupted"):
+        """Cancela todos los jobs en curso (p. ej. al interrumpir un lote)."""
+        with self._lock:
+            jobs = list(self._jobs)
+        return sum(self._cancel(tracked, reason) for tracked in jobs)
+
+    def running(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "running": len(self._jobs)}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _forget(self, tracked):
+        with self._lock:
+            self._jobs.discard(tracked)
+
+    def _cancel(self, tracked, reason):
+        with self._lock:
+            if tracked.cancel_reason is not None:
+                return False
+            tracked.cancel_reason = reason
+            self._stats[reason] = self._stats.get(reason, 0) + 1
+        try:
+            tracked.job.cancel()
+        except Exception as e:
+            # Si ya había terminado, BigQuery no tiene nada que cancelar
+            logger.warning("No se pudo cancelar el job %s: %s", tracked.job_id, e)
+        return True
+
+    def _watch(self):
+        """Cancela los jobs de dueños que ya no están y los que nadie esperó a tiempo."""
+        while True:
+            time.sleep(self.poll_interval)
+            now = time.monotonic()
+            with self._lock:
+                jobs = list(self._jobs)
+            for tracked in jobs:
+                if tracked.cancel_reason is not None:
+                    continue
+                if tracked.owner is not None and self.is_alive is not None:
+                    try:
+                        alive = self.is_alive(tracked.owner)
+                    except Exception:
+                        alive = True
+                    if not alive:
+                        self._cancel(tracked, "orphaned")
+                        continue
+                # Quien espera cancela a tiempo; esto es para los jobs que ya nadie espera
+                if now > tracked.deadline + self.poll_interval * 4:
+                    self._cancel(tracked, "timeout")
+                    self._forget(tracked)
+
+
+class SubQueries:
+    """Ramas de un UNION ALL y lo que la consulta hace después con su unión."""
+
+    def __init__(self, queries, names, order, limit):
+        self.queries = queries
+        # Columnas de salida (las de la primera rama), [(columna, desc)] y LIMIT o None
+        self.names = names
+        self.order = order
+        self.limit = limit
+
+
+def _flatten_union_all(node):
+    if isinstance(node, exp.Union) and not node.args.get("distinct"):
+        if any(node.args.get(arg) for arg in ("with_", "with", "order", "limit", "offset")):
+            return None
+        left, right = _flatten_union_all(node.this), _flatten_union_all(node.expression)
+        return None if left is None or right is None else left + right
+    if isinstance(node, exp.Subquery) and not node.args.get("alias"):
+        node = node.this
+    return [node] if isinstance(node, exp.Select) else None
+
+
+def split_union_all(sql_query):
+    """
+    `SubQueries` de una consulta `SELECT ... UNION ALL SELECT ... [ORDER BY] [LIMIT]`,
+    o None si no es una unión de SELECT independientes (UNION DISTINCT, CTE
+    compartidas, o un ORDER BY por algo que no es una columna de salida).
+    """
+    try:
+        tree = sqlglot.parse_one(sql_query, read="bigquery")
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(tree, exp.Union) or any(
+        tree.args.get(arg) for arg in ("with_", "with", "offset")
+    ):
+        return None
+    outer = {arg: tree.args.get(arg) for arg in ("order", "limit")}
+    inner = tree.copy()
+    for arg in outer:
+        inner.set(arg, None)
+    branches = _flatten_union_all(inner)
+    if not branches:
+        return None
+    queries = [branch.sql(dialect="bigquery") for branch in branches]
+    names, _, _ = output_names(queries[0])
+    if not names:
+        return None
+
+    order = []
+    for ordered in outer["order"].expressions if outer["order"] else []:
+        key = ordered.this
+        if isinstance(key, exp.Literal) and not key.is_string and 0 < int(key.this) <= len(names):
+            name = names[int(key.this) - 1]
+        elif isinstance(key, exp.Column) and not key.table and key.name in names:
+            name = key.name
+        else:
+            return None
+        # El orden de BigQuery (NULL primero en ASC, al final en DESC) es el de apply_follow_up
+        nulls_first = ordered.args.get("nulls_first")
+        desc = bool(ordered.args.get("desc"))
+        if nulls_first is not None and nulls_first != (not desc):
+            return None
+        order.append((name, desc))
+    limit = None
+    if outer["limit"] is not None:
+        value = outer["limit"].expression
+        if not (isinstance(value, exp.Literal) and value.is_int):
+            return None
+        limit = int(value.this)
+    return SubQueries(queries, names, order, limit)
@@ -0,0 +1,1539 @@
+"""Pipeline pregunta → SQL → resultado → explicación, sin dependencias de la UI"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import pandas as pd
+from sql_cache import SQLTemplateCache, normalize_question
+from result_cache import ResultCache, sql_fingerprint
+from streaming import cleanup_spill_dir, new_spill_path, stream_query_result
+from cube import CubeRouter
+from digest import build_result_digest
+from context_cache import ContextCache, PromptPrefix
+from gateway import ModelGateway
+from singleflight import SingleFlight
+from tracing import Tracer, maybe_span, serve_metrics
+from sql_validation import SQLValidator, schema_from_table_info
+from schema import SchemaCatalog, SchemaIndex, table_name
+from fewshot import ExampleIndex
+from approx import apply_error_bounds, approximate_query, approximation_label
+from charts import build_chart, chart_spec
+from cost_gate import CostGate
+from prefetch import FOLLOW_UP_DIMENSIONS, Prefetcher, follow_up_queries
+from followup import FollowUp, apply_follow_up, follow_up_sql, parse_follow_up, plan_follow_up
+from jobs import INTERACTIVE, JobCancelled, JobManager, JobTimeout, split_union_all
+
+logger = logging.getLogger(__name__)
+
+
+# --- CONFIGURACIÓN CACHÉ ---
+SQL_CACHE_PATH = os.getenv("SQL_CACHE_PATH", ".cache/sql_templates.sqlite")
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "1000"))
+SQL_CACHE_TTL = int(os.getenv("SQL_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", ".cache/results")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# 0: sin caducidad (el dataset es histórico); el cambio de esquema sí vacía la caché
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "0"))
+
+# --- CONFIGURACIÓN COSTE ---
+MAX_BYTES_PER_QUERY = int(os.getenv("MAX_BYTES_PER_QUERY", str(5 * 1024**3)))
+MAX_BYTES_PER_SESSION = int(os.getenv("MAX_BYTES_PER_SESSION", str(50 * 1024**3)))
+MAX_COST_REWRITES = int(os.getenv("MAX_COST_REWRITES", "1"))
+
+# --- CONFIGURACIÓN RESULTADOS ---
+RESULT_STREAMING = os.getenv("RESULT_STREAMING", "1") == "1"
+RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "10000"))
+MAX_RESULT_ROWS = int(os.getenv("MAX_RESULT_ROWS", "200000"))
+MAX_RESULT_BYTES = int(os.getenv("MAX_RESULT_BYTES", str(100 * 1024 * 1024)))
+PREVIEW_ROWS = int(os.getenv("PREVIEW_ROWS", "1000"))
+SPILL_DIR = os.getenv("SPILL_DIR", ".cache/spill")
+SPILL_TTL = int(os.getenv("SPILL_TTL", str(24 * 3600)))
+CUBE_PATH = os.getenv("CUBE_PATH", ".cache/natality_cube.parquet")
+# Usar también un cubo construido a partir de una muestra (sus respuestas no son exactas)
+CUBE_ALLOW_SAMPLE = os.getenv("CUBE_ALLOW_SAMPLE", "0") == "1"
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "8"))
+# Jobs de BigQuery simultáneos en el proceso (turnos, refinamientos, prefetch y lotes)
+BIGQUERY_MAX_CONCURRENCY = int(os.getenv("BIGQUERY_MAX_CONCURRENCY", "16"))
+DIGEST_MAX_TOKENS = int(os.getenv("DIGEST_MAX_TOKENS", "1500"))
+# Puntos máximos que un gráfico envía al navegador
+MAX_CHART_POINTS = int(os.getenv("MAX_CHART_POINTS", "2000"))
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "120"))
+
+# --- CONFIGURACIÓN JOBS DE BIGQUERY ---
+# Tiempo máximo de un job interactivo y de uno en prioridad batch (puede esperar en cola)
+BIGQUERY_JOB_TIMEOUT = float(os.getenv("BIGQUERY_JOB_TIMEOUT", "120"))
+BIGQUERY_BATCH_JOB_TIMEOUT = float(os.getenv("BIGQUERY_BATCH_JOB_TIMEOUT", "3600"))
+# Cada cuánto se comprueba si el job sigue haciendo falta mientras se espera
+BIGQUERY_POLL_INTERVAL = float(os.getenv("BIGQUERY_POLL_INTERVAL", "0.5"))
+# Las comparaciones con UNION ALL se lanzan como sub-consultas en paralelo
+SUB_QUERY_SPLIT = os.getenv("SUB_QUERY_SPLIT", "1") == "1"
+
+# --- CONFIGURACIÓN VALIDACIÓN ---
+# Sin LIMIT, las consultas fila a fila se acotan a las filas que se llegan a descargar
+SQL_ROW_LIMIT = int(os.getenv("SQL_ROW_LIMIT", str(MAX_RESULT_ROWS)))
+MAX_SQL_REPAIRS = int(os.getenv("MAX_SQL_REPAIRS", "2"))
+
+# --- CONFIGURACIÓN MODO APROXIMADO ---
+APPROX_SAMPLE_PERCENT = float(os.getenv("APPROX_SAMPLE_PERCENT", "1"))
+
+# --- CONFIGURACIÓN ESQUEMA ---
+# Tablas y esquemas de la última conexión a BigQuery, para arrancar sin esperar a la red
+SCHEMA_SNAPSHOT_PATH = os.getenv("SCHEMA_SNAPSHOT_PATH", ".cache/schema_snapshot.json")
+SCHEMA_CACHE_TTL = int(os.getenv("SCHEMA_CACHE_TTL", str(24 * 3600)))
+# Solo las columnas relevantes para la pregunta van descritas en el prompt
+SCHEMA_PRUNING = os.getenv("SCHEMA_PRUNING", "1") == "1"
+SCHEMA_MAX_COLUMNS = int(os.getenv("SCHEMA_MAX_COLUMNS", "12"))
+DEFAULT_TABLES = ["bigquery-public-data.samples.natality"]
+
+# --- CONFIGURACIÓN EJEMPLOS FEW-SHOT ---
+# Pares pregunta/SQL que ya devolvieron datos, como ejemplos para preguntas parecidas
+FEW_SHOT_PATH = os.getenv("FEW_SHOT_PATH", ".cache/sql_examples.jsonl")
+FEW_SHOT_MAX_ENTRIES = int(os.getenv("FEW_SHOT_MAX_ENTRIES", "10000"))
+FEW_SHOT_K = int(os.getenv("FEW_SHOT_K", "3"))
+FEW_SHOT_MAX_TOKENS = int(os.getenv("FEW_SHOT_MAX_TOKENS", "600"))
+
+# --- CONFIGURACIÓN PREFETCH ---
+# Variantes de la última respuesta (por estado, año, sexo, pluralidad) precargadas en
+# segundo plano con un presupuesto propio; desactivado salvo que se pida
+PREFETCH_FOLLOW_UPS = os.getenv("PREFETCH_FOLLOW_UPS", "0") == "1"
+PREFETCH_MAX_QUERIES = int(os.getenv("PREFETCH_MAX_QUERIES", "3"))
+PREFETCH_MAX_BYTES_PER_QUERY = int(os.getenv("PREFETCH_MAX_BYTES_PER_QUERY", str(1024**3)))
+PREFETCH_MAX_BYTES_PER_SESSION = int(os.getenv("PREFETCH_MAX_BYTES_PER_SESSION", str(10 * 1024**3)))
+PREFETCH_MAX_CPU_SECONDS = float(os.getenv("PREFETCH_MAX_CPU_SECONDS", "2"))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+
+# --- CONFIGURACIÓN REFINAMIENTOS ---
+# «Ordénalo por peso», «solo Texas», «los 5 primeros» se calculan sobre el resultado
+# anterior, sin modelo ni BigQuery
+FOLLOW_UP_LOCAL = os.getenv("FOLLOW_UP_LOCAL", "1") == "1"
+
+# --- CONFIGURACIÓN TRAZAS ---
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "64"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# --- CONFIGURACIÓN GEMINI ---
+GEMINI_RATE_PER_SECOND = float(os.getenv("GEMINI_RATE_PER_SECOND", "5"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "10"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "8"))
+
+
+# La app lo sustituye por `st.error`; sin UI los errores van al log
+_error_reporter = logger.error
+
+
+def set_error_reporter(reporter):
+    """Cambia la función con la que se muestran los errores del pipeline."""
+    global _error_reporter
+    _error_reporter = reporter
+
+
+def report_error(message):
+    _error_reporter(message)
+
+
+# Función actualizada para información de la tabla de natalidad
+@functools.cache
+def get_natality_table_info():
+    """
+    Información estructurada de la tabla de natalidad. Sus descripciones se prefieren a
+    las de los metadatos y sirven de esquema mientras no hay conexión.
+    """
+    natality_table = {
+        "natality": {
+            "descripcion": "Contiene datos sobre nacimientos en los Estados Unidos, cubriendo los años 1969 a 2008.",
+            "campos": [
+                "source_year (INTEGER) - Año de la fuente de datos. Ejemplo: 1975",
+                "year (INTEGER) - Año de nacimiento de cuatro dígitos. Ejemplo: 1975",
+                "month (INTEGER) - Mes de nacimiento, donde 1 = Enero.",
+                "day (INTEGER) - Día del nacimiento, empezando desde 1.",
+                "wday (INTEGER) - Día de la semana, donde 1 = Domingo y 7 = Sábado.",
+                "state (STRING) - Abreviatura postal del estado. No disponible después de 2004.",
+                "is_male (BOOLEAN) - Verdadero si el bebé es varón, falso si es mujer.",
+                "child_race (INTEGER) - Raza del bebé (1-Blanco, 2-Negro, 3-Indio Americano, 4-Chino, etc.).",
+                "weight_pounds (FLOAT) - Peso del bebé al nacer, en libras.",
+                "plurality (INTEGER) - Número de bebés de este embarazo (2=gemelos, 3=trillizos, etc.).",
+                "apgar_1min (INTEGER) - Puntaje Apgar a 1 minuto (0-10), años 1978-2002.",
+                "apgar_5min (INTEGER) - Puntaje Apgar a 5 minutos (0-10), años 1978-2002.",
+                "mother_residence_state (STRING) - Estado de residencia de la madre.",
+                "mother_race (INTEGER) - Raza de la madre (mismos códigos que child_race).",
+                "mother_age (INTEGER) - Edad de la madre.",
+                "gestation_weeks (INTEGER) - Semanas de gestación.",
+                "lmp (STRING) - Fecha del último período menstrual (MMDDYYYY). '99' o '9999' indican desconocido.",
+                "mother_married (BOOLEAN) - Verdadero si la madre estaba casada.",
+                "mother_birth_state (STRING) - Estado de nacimiento de la madre.",
+                "cigarette_use (BOOLEAN) - Verdadero si la madre fumó (desde 2003).",
+                "cigarettes_per_day (INTEGER) - Número de cigarrillos por día (desde 2003).",
+                "alcohol_use (BOOLEAN) - Verdadero si la madre consumió alcohol (desde 1989).",
+                "drinks_per_week (INTEGER) - Bebidas alcohólicas por semana (desde 1989).",
+                "weight_gain_pounds (INTEGER) - Aumento de peso de la madre en libras.",
+                "born_alive_alive (INTEGER) - Hijos previos nacidos vivos que siguen vivos.",
+                "born_alive_dead (INTEGER) - Hijos previos nacidos vivos que han fallecido.",
+                "born_dead (INTEGER) - Hijos nacidos muertos.",
+                "ever_born (INTEGER) - Total de hijos nacidos de la madre.",
+                "father_race (INTEGER) - Raza del padre (mismos códigos que child_race).",
+                "father_age (INTEGER) - Edad del padre.",
+                "record_weight (INTEGER) - Peso del registro para muestreo estadístico.",
+            ],
+        }
+    }
+    return natality_table
+
+
+@functools.cache
+def get_schema_catalog():
+    """Esquemas de las tablas del dataset, cacheados en disco y versionados."""
+    return SchemaCatalog(
+        SCHEMA_SNAPSHOT_PATH, ttl=SCHEMA_CACHE_TTL, annotations=get_natality_table_info()
+    )
+
+
+def get_table_info():
+    """{tabla: {"descripcion", "campos"}} vigente, con la misma forma que `get_natality_table_info`."""
+    return get_schema_catalog().tables()
+
+
+def refresh_schema(client, tables_info):
+    """Relee los metadatos de las tablas si la instantánea caducó; True si cambió el esquema."""
+    return get_schema_catalog().refresh(client, tables_info)
+
+
+def load_schema_snapshot():
+    """Tablas guardadas en la última conexión; las de por defecto si no hay instantánea."""
+    return get_schema_catalog().table_ids or list(DEFAULT_TABLES)
+
+
+# Lo que se deriva del esquema se reconstruye cuando cambia su versión
+def get_sql_cache():
+    """Caché de plantillas SQL compartida entre sesiones e invalidada si cambia el esquema."""
+    return _sql_cache(get_schema_catalog().version)
+
+
+@functools.lru_cache(maxsize=1)
+def _sql_cache(schema_version):
+    schema_text = json.dumps(get_table_info(), sort_keys=True, ensure_ascii=False)
+    return SQLTemplateCache(
+        SQL_CACHE_PATH,
+        schema_text,
+        max_entries=SQL_CACHE_MAX_ENTRIES,
+        ttl=SQL_CACHE_TTL,
+    )
+
+
+def get_sql_validator():
+    """Validador local de la SQL con las columnas del esquema vigente."""
+    return _sql_validator(get_schema_catalog().version)
+
+
+@functools.lru_cache(maxsize=1)
+def _sql_validator(schema_version):
+    return SQLValidator(
+        schema_from_table_info(get_table_info(), load_schema_snapshot()), row_limit=SQL_ROW_LIMIT
+    )
+
+
+def get_schema_index():
+    """Índice de relevancia de columnas del esquema vigente."""
+    return _schema_index(get_schema_catalog().version)
+
+
+@functools.lru_cache(maxsize=1)
+def _schema_index(schema_version):
+    return SchemaIndex(get_table_info(), default_table=table_name(DEFAULT_TABLES[0]))
+
+
+@functools.cache
+def get_example_index():
+    """Índice de ejemplos verificados compartido entre sesiones."""
+    return ExampleIndex(FEW_SHOT_PATH or None, max_entries=FEW_SHOT_MAX_ENTRIES)
+
+
+# Filas por id de tabla; solo las lecturas correctas, para que un fallo se reintente
+_table_row_counts = {}
+
+
+def get_table_row_count(client, table_id):
+    """Filas de la tabla según sus metadatos (sin coste); None si no se pueden leer."""
+    if table_id in _table_row_counts:
+        return _table_row_counts[table_id]
+    info = get_table_info().get(table_name(table_id), {})
+    if info.get("num_rows") and info.get("id", table_id) == table_id:
+        rows = info["num_rows"]
+    else:
+        try:
+            rows = client.get_table(table_id).num_rows
+        except Exception as e:
+            logger.warning("No se pudieron leer los metadatos de %s: %s", table_id, e)
+            return None
+    if rows:
+        _table_row_counts[table_id] = rows
+    return rows
+
+
+def get_result_cache():
+    """Caché de resultados en disco compartida entre sesiones e invalidada si cambia el esquema."""
+    return _result_cache(get_schema_catalog().version)
+
+
+@functools.lru_cache(maxsize=1)
+def _result_cache(schema_version):
+    return ResultCache(
+        RESULT_CACHE_DIR,
+        max_bytes=RESULT_CACHE_MAX_BYTES,
+        schema_text=json.dumps(get_table_info(), sort_keys=True, ensure_ascii=False),
+        ttl=RESULT_CACHE_TTL or None,
+    )
+
+
+@functools.cache
+def get_spill_dir():
+    """Directorio de resultados completos volcados a disco, purgado al arrancar."""
+    cleanup_spill_dir(SPILL_DIR, SPILL_TTL)
+    return SPILL_DIR
+
+
+@functools.cache
+def get_cube_router():
+    """
+    Enrutador al cubo local; None si el cubo no se ha construido (python cube.py) o si
+    no se construyó a partir de la tabla completa y no se permite (CUBE_ALLOW_SAMPLE).
+    """
+    if not os.path.exists(CUBE_PATH):
+        return None
+    router = CubeRouter.load(CUBE_PATH)
+    if not router.exact and not CUBE_ALLOW_SAMPLE:
+        logger.warning(
+            "El cubo %s no se construyó a partir de la tabla completa (%s); enrutado desactivado",
+            CUBE_PATH, router.provenance.get("source", "procedencia desconocida"),
+        )
+        return None
+    return router
+
+
+@functools.cache
+def get_worker_pool():
+    """Pool de hilos compartido para solapar etapas independientes de cada turno."""
+    return ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE, thread_name_prefix="turn")
+
+
+@functools.cache
+def get_prefetch_pool():
+    """Pool aparte y pequeño para el prefetch: nunca quita hilos a los turnos."""
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+@functools.cache
+def get_bigquery_slots():
+    """Huecos para jobs de BigQuery: el job y su descarga ocupan uno hasta terminar."""
+    return threading.BoundedSemaphore(BIGQUERY_MAX_CONCURRENCY)
+
+
+@functools.cache
+def get_job_manager():
+    """Jobs de BigQuery en curso de todas las sesiones, con tiempo máximo y cancelación."""
+    return JobManager(
+        timeout=BIGQUERY_JOB_TIMEOUT,
+        batch_timeout=BIGQUERY_BATCH_JOB_TIMEOUT,
+        poll_interval=BIGQUERY_POLL_INTERVAL,
+    )
+
+
+@functools.cache
+def get_sub_query_pool():
+    """Pool de las ramas de las comparaciones, aparte: el turno que las espera puede estar en el de turnos."""
+    return ThreadPoolExecutor(max_workers=BIGQUERY_MAX_CONCURRENCY, thread_name_prefix="subquery")
+
+
+@functools.cache
+def get_single_flight():
+    """Agrupa las preguntas y consultas idénticas en curso de todas las sesiones."""
+    return SingleFlight(timeout=SINGLE_FLIGHT_TIMEOUT)
+
+
+@functools.cache
+def get_tracer():
+    """Trazas por turno; con METRICS_PORT también expone /metrics para Prometheus."""
+    tracer = Tracer(sample_rate=TRACE_SAMPLE_RATE, max_spans=TRACE_MAX_SPANS)
+    if METRICS_PORT:
+        try:
+            serve_metrics(tracer.metrics, METRICS_PORT)
+        except OSError as e:
+            logger.warning("No se pudo abrir el puerto de métricas %s: %s", METRICS_PORT, e)
+    return tracer
+
+
+@functools.cache
+def get_context_cache(gemini_api_key):
+    """Registro de prefijos cacheados en Gemini, uno por API key."""
+    return ContextCache(ttl=CONTEXT_CACHE_TTL, min_tokens=CONTEXT_CACHE_MIN_TOKENS)
+
+
+@functools.cache
+def get_model_gateway(gemini_api_key):
+    """Cliente de Gemini único por API key, con límite de ritmo, reintentos y cola justa."""
+    # Importar el SDK cuesta más de medio segundo: se paga al crear el cliente, no al arrancar
+    from google import genai
+
+    return ModelGateway(
+        genai.Client(api_key=gemini_api_key),
+        rate_per_second=GEMINI_RATE_PER_SECOND,
+        burst=GEMINI_BURST,
+        max_concurrency=GEMINI_MAX_CONCURRENCY,
+        max_retries=GEMINI_MAX_RETRIES,
+        backoff_base=GEMINI_BACKOFF_BASE,
+        backoff_max=GEMINI_BACKOFF_MAX,
+    )
+
+
+def build_tables_context(tables_info):
+    """
+    Estructura de las tablas para el prefijo del prompt SQL. Con SCHEMA_PRUNING solo
+    lleva los nombres de las columnas: sus descripciones van con cada pregunta.
+    """
+    tables_context = []
+    schema_info = get_table_info()
+
+    for table_ref in tables_info:
+        name = table_name(table_ref)
+
+        if name in schema_info:
+            table_info = schema_info[name]
+
+            table_context = f"Tabla: {name}\n"
+            table_context += f"Descripción: {table_info['descripcion']}\n"
+            if SCHEMA_PRUNING:
+                columns = [field.split(" ", 1)[0] for field in table_info["campos"]]
+                table_context += f"Columnas: {', '.join(columns)}\n"
+            else:
+                table_context += "Campos:\n"
+                for field in table_info["campos"]:
+                    table_context += f"  - {field}\n"
+
+            tables_context.append(table_context)
+
+    return tables_context
+
+
+def build_relevant_schema(question, tables_info):
+    """Descripción de las columnas que la pregunta necesita; vacía sin SCHEMA_PRUNING."""
+    if not SCHEMA_PRUNING:
+        return ""
+    selection = get_schema_index().select(
+        question, [table_name(table) for table in tables_info], max_columns=SCHEMA_MAX_COLUMNS
+    )
+    lines = ["COLUMNAS RELEVANTES PARA LA PREGUNTA:"]
+    for name, fields in selection.items():
+        lines.append(f"Tabla: {name}")
+        lines.extend(f"  - {field}" for field in fields)
+    return "\n        ".join(lines)
+
+
+def build_few_shot_examples(question):
+    """Pares verificados más parecidos a la pregunta; vacío si no hay o FEW_SHOT_K es 0."""
+    if FEW_SHOT_K <= 0:
+        return ""
+    examples = get_example_index().examples(question, k=FEW_SHOT_K, max_tokens=FEW_SHOT_MAX_TOKENS)
+    if not examples:
+        return ""
+    lines = ["EJEMPLOS SIMILARES YA VERIFICADOS:"]
+    for example_question, sql_query in examples:
+        lines.append(f"Pregunta: {example_question}")
+        lines.append(f"SQL: {' '.join(sql_query.split())}")
+    return "\n        ".join(lines)
+
+
+def default_model_config():
+    generation_config = {
+        "temperature": 0,
+        "top_p": 0.95,
+        "top_k": 64,
+        "max_output_tokens": 8192,
+    }
+
+    return {
+        "model": "gemini-2.0-flash-thinking-exp-1219", # Actualizado a un modelo recomendado
+        "generation_config": generation_config,
+    }
+
+
+def initialize_gemini(gemini_api_key, session_id=None):
+    if not gemini_api_key:
+        report_error(
+            "🔑 Por favor, introduce tu Gemini API key para utilizar el chatbot."
+        )
+        return None
+
+    try:
+        # El cliente real se comparte entre sesiones; cada sesión recibe su vista de la pasarela
+        client = get_model_gateway(gemini_api_key).session_client(session_id)
+        return client, default_model_config()
+    except Exception as e:
+        report_error(f"❌ Error al inicializar Gemini: {e}")
+        return None, None
+
+
+# Ejemplos fijos de pregunta/SQL que forman parte del prefijo estático
+SQL_FEW_SHOT_EXAMPLES = [
+    (
+        "¿Cuál es el peso promedio al nacer por estado en 2005?",
+        """SELECT state, AVG(weight_pounds) AS peso_promedio, COUNT(*) AS total_nacimientos
+FROM `bigquery-public-data.samples.natality`
+WHERE year = 2005 AND weight_pounds IS NOT NULL
+GROUP BY state
+ORDER BY peso_promedio DESC""",
+    ),
+    (
+        "¿Cuántos nacimientos de gemelos hubo por año desde 1990 hasta 1995?",
+        """SELECT year, COUNT(*) AS nacimientos_gemelos
+FROM `bigquery-public-data.samples.natality`
+WHERE plurality = 2 AND year BETWEEN 1990 AND 1995
+GROUP BY year
+ORDER BY year""",
+    ),
+    (
+        "¿Pesan más al nacer los hijos de madres menores de 20 o los de mayores de 35?",
+        """SELECT 'menores de 20' AS grupo, AVG(weight_pounds) AS peso_promedio, COUNT(*) AS nacimientos
+FROM `bigquery-public-data.samples.natality`
+WHERE mother_age < 20 AND weight_pounds IS NOT NULL
+UNION ALL
+SELECT 'mayores de 35' AS grupo, AVG(weight_pounds) AS peso_promedio, COUNT(*) AS nacimientos
+FROM `bigquery-public-data.samples.natality`
+WHERE mother_age > 35 AND weight_pounds IS NOT NULL""",
+    ),
+]
+
+
+def build_sql_prompt_prefix(tables_info, tables_context):
+    """Parte estática del prompt SQL: esquema, reglas y ejemplos. Es igual en todos los turnos."""
+    examples = "\n\n".join(
+        f"Pregunta: {question}\nSQL:\n{sql}" for question, sql in SQL_FEW_SHOT_EXAMPLES
+    )
+    # --- PROMPT COMPLETAMENTE REESCRITO PARA NATALIDAD ---
+    return f"""
+        Eres un experto en análisis de datos de salud pública, especializado en estadísticas de natalidad en EE.UU.
+        Tu tarea es convertir preguntas sobre datos de nacimientos en consultas SQL para BigQuery.
+
+        TABLAS DISPONIBLES (Base de datos de natalidad):
+        {chr(10).join(tables_info)}
+
+        ESTRUCTURA DE LAS TABLAS:
+        {chr(10).join(tables_context)}
+
+        REGLAS IMPORTANTES:
+        - ¡AVISO CRÍTICO SOBRE LOS DATOS! La tabla `natality` contiene datos HISTÓRICOS, principalmente del periodo 1969 a 2008.
+          Si la pregunta del usuario es sobre un año fuera de este rango (ej. 2020, 2024), la consulta NO devolverá resultados.
+          Evita generar filtros para años posteriores a 2008. Si el usuario no especifica un año, asume que está interesado en el rango histórico o en un año representativo como 2005.
+        - Usa siempre la sintaxis de BigQuery SQL.
+        - Siempre usa backticks (`) alrededor del nombre completo de la tabla, por ejemplo: `bigquery-public-data.samples.natality`.
+        - Las columnas clave para análisis son `weight_pounds`, `mother_age`, `gestation_weeks`, `state`, `year`.
+        - NUNCA uses la columna `_DATA_DATE` si está presente.
+        - Para comparar grupos distintos (ej. madres menores de 20 frente a mayores de 35), escribe una SELECT por grupo
+          con una primera columna literal `grupo` y únelas con UNION ALL: cada grupo se calcula por separado y en paralelo.
+        - Responde ÚNICAMENTE con el código SQL, sin explicaciones adicionales.
+
+        EJEMPLOS:
+{examples}
+    """
+
+
+def generate_sql_query(
+    client, model_config, question, tables_info, tables_context, feedback=None,
+    context_cache=None, usage=None,
+):
+    prefix = PromptPrefix("sql", build_sql_prompt_prefix(tables_info, tables_context))
+    # Solo la parte variable cambia de un turno a otro
+    turn_prompt = f"""
+        {build_relevant_schema(question, tables_info)}
+        {build_few_shot_examples(question)}
+        PREGUNTA DEL USUARIO: {question}
+        {f"CORRECCIÓN NECESARIA: {feedback}" if feedback else ""}
+
+        Responde ÚNICAMENTE con el código SQL, sin explicaciones adicionales.
+    """
+
+    try:
+        # Sin registro compartido el prefijo se envía en línea
+        context_cache = context_cache or ContextCache(min_tokens=float("inf"))
+        response = context_cache.generate(
+            client, model_config, prefix, turn_prompt, usage=usage
+        )
+        sql_query = response.text.strip()
+
+        sql_query = sql_query.strip()
+        if sql_query.startswith("```sql"):
+            sql_query = sql_query[6:]
+        if sql_query.endswith("```"):
+            sql_query = sql_query[:-3]
+        return sql_query.strip()
+    except Exception as e:
+        report_error(f"❌ Error al generar la consulta SQL: {e}")
+        return None
+
+
+def validate_sql_query(
+    client_ai, model_config, prompt, sql_query, tables_info, tables_context,
+    context_cache=None, usage=None, trace=None,
+):
+    """
+    Valida la SQL en local antes de enviarla a BigQuery. Si no es válida, devuelve al
+    modelo el diagnóstico exacto para que la corrija, como mucho MAX_SQL_REPAIRS veces.
+    """
+    validator = get_sql_validator()
+    for attempt in range(MAX_SQL_REPAIRS + 1):
+        with maybe_span(trace, "validation", attempt=attempt) as span:
+            checked_query, errors = validator.validate(sql_query)
+            span.set(errors=len(errors))
+        if not errors:
+            return checked_query, [], attempt  # Return sql, errors, repairs
+        if attempt == MAX_SQL_REPAIRS:
+            return sql_query, errors, attempt
+
+        repaired_query = generate_sql_query(
+            client_ai, model_config, prompt, tables_info, tables_context,
+            feedback=f"La consulta anterior no es válida. {' '.join(errors)} "
+            f"Consulta anterior:\n{sql_query}",
+            context_cache=context_cache, usage=usage,
+        )
+        if not repaired_query:
+            return sql_query, errors, attempt
+        sql_query = repaired_query
+
+
+def enforce_query_cost(
+    client, client_ai, model_config, prompt, sql_query, tables_info, tables_context, cost_gate,
+    context_cache=None, usage=None, trace=None,
+):
+    """
+    Estima el coste de la consulta con un dry run antes de ejecutarla.
+    Si supera el presupuesto, pide al modelo una versión más barata.
+    """
+    for attempt in range(MAX_COST_REWRITES + 1):
+        try:
+            with maybe_span(trace, "dry_run", attempt=attempt) as span:
+                bytes_estimated = cost_gate.estimate(client, sql_query)
+                span.set(bytes_estimated=bytes_estimated)
+        except Exception as e:
+            report_error(f"❌ Error al validar la consulta SQL: {e}")
+            return sql_query, None, True, None  # Return sql, bytes, error_occurred, rejection
+
+        allowed, reason = cost_gate.check(bytes_estimated)
+        if allowed:
+            return sql_query, bytes_estimated, False, None
+        if attempt == MAX_COST_REWRITES:
+            return sql_query, bytes_estimated, False, reason
+
+        cheaper_query = generate_sql_query(
+            client_ai, model_config, prompt, tables_info, tables_context,
+            feedback=f"{reason} Reescribe la consulta para que procese menos datos: "
+            "selecciona solo las columnas necesarias, evita SELECT * y filtra por año.",
+            context_cache=context_cache, usage=usage,
+        )
+        if not cheaper_query:
+            return sql_query, bytes_estimated, False, reason
+        # La reescritura pasa por la misma validación local, sin más reparaciones
+        cheaper_query, errors = get_sql_validator().validate(cheaper_query)
+        if errors:
+            return sql_query, bytes_estimated, False, reason
+        sql_query = cheaper_query
+
+
+def execute_sql_query(
+    client, sql_query, job_config=None, on_first_page=None, trace=None, quiet=False,
+    owner=None, priority=INTERACTIVE, on_wait=None, raise_cancelled=False,
+):
+    """
+    Ejecuta la consulta en BigQuery (o la sirve la caché de resultados) y devuelve
+    `(df, error, vacío, bytes procesados)`.
+
+    El job se lanza con `get_job_manager()` a nombre de `owner` y con prioridad
+    `priority`; si supera su tiempo máximo se cancela y el turno queda en estado
+    `timeout`. Mientras se espera se llama a `on_wait(segundos)`: si lanza, el job
+    se cancela. Con `raise_cancelled`, si lo cancela otro (la sesión pasó a otra
+    pregunta o se cerró) se lanza `JobCancelled` en vez de devolver el error. Las
+    comparaciones UNION ALL van por `execute_sub_queries`.
+    """
+    result_cache = get_result_cache()
+    with maybe_span(trace, "result_cache") as span:
+        df = result_cache.get(sql_query)
+        span.set(hit=df is not None)
+    if df is not None:
+        return df, False, df.empty, 0
+
+    sub_queries = split_union_all(sql_query) if SUB_QUERY_SPLIT else None
+    if sub_queries is not None:
+        return execute_sub_queries(
+            client, sql_query, sub_queries, job_config=job_config, trace=trace, quiet=quiet,
+            owner=owner, priority=priority, on_wait=on_wait, raise_cancelled=raise_cancelled,
+        )
+
+    job_manager = get_job_manager()
+    try:
+        # Con los huecos ocupados, el job espera aquí sin llegar a lanzarse
+        with get_bigquery_slots():
+            with maybe_span(trace, "query", priority=priority) as span:
+                tracked = job_manager.submit(
+                    client, sql_query, job_config=job_config, owner=owner, priority=priority,
+                )
+                # Se espera al job aparte para separar su tiempo del de la descarga
+                query_job = job_manager.wait(tracked, on_tick=on_wait)
+                span.set(
+                    job_id=getattr(query_job, "job_id", None),
+                    bytes_processed=query_job.total_bytes_processed or 0,
+                    slot_ms=getattr(query_job, "slot_millis", None),
+                    cache_hit=getattr(query_job, "cache_hit", None),
+                )
+            with maybe_span(trace, "download", streaming=RESULT_STREAMING) as span:
+                if RESULT_STREAMING:
+                    # Descarga por páginas Arrow con tope de filas/bytes; el completo va a disco
+                    df = stream_query_result(
+                        query_job,
+                        new_spill_path(get_spill_dir()),
+                        max_rows=MAX_RESULT_ROWS,
+                        max_bytes=MAX_RESULT_BYTES,
+                        page_size=RESULT_PAGE_SIZE,
+                        on_first_page=on_first_page,
+                    )
+                else:
+                    df = query_job.to_dataframe()
+                span.set(rows=0 if df is None else len(df))
+        bytes_processed = query_job.total_bytes_processed or 0
+        if df is not None:
+            result_cache.put(sql_query, df, bytes_processed=bytes_processed)
+
+        is_empty = df is None or df.empty
+        return df, False, is_empty, bytes_processed  # Return df, error_occurred, is_empty, bytes
+    except JobCancelled as e:
+        if raise_cancelled and not isinstance(e, JobTimeout):
+            raise
+        report_cancelled(e, trace=trace, quiet=quiet)
+        return None, True, False, None
+    except Exception as e:
+        # Las consultas en segundo plano no tienen a quién mostrar el error
+        if quiet:
+            logger.warning("Error al ejecutar la consulta SQL: %s", e)
+        else:
+            report_error(f"❌ Error al ejecutar la consulta SQL: {e}")
+        return None, True, False, None  # Return None, True, False (error occurred, not empty)
+
+
+def report_cancelled(error, trace=None, quiet=False):
+    """Muestra (o registra, con `quiet`) por qué se canceló un job y lo anota en la traza."""
+    if isinstance(error, JobTimeout):
+        status = "timeout"
+        message = f"⏱️ La consulta superó el tiempo máximo de {error.timeout:g} s y se canceló."
+    else:
+        status = "cancelled"
+        message = f"⏹️ La consulta se canceló antes de terminar ({error.reason})."
+    # Si ya había un motivo (otra rama de la comparación se pasó de tiempo), ese se queda
+    if trace is not None and "status" not in trace.attrs:
+        trace.set(status=status)
+    if quiet:
+        logger.warning(message)
+    else:
+        report_error(message)
+
+
+def execute_shared_query(client, sql_query, trace=None, quiet=False, **kwargs):
+    """
+    `execute_sql_query` compartido entre las consultas idénticas en curso; devuelve
+    `(resultado, compartido)`.
+
+    Si se cancela el job del líder porque su sesión pasó a otra pregunta o se cerró,
+    cada seguidor repite la consulta con su propio job en vez de heredar la cancelación.
+    """
+    try:
+        return get_single_flight().do(
+            ("query", sql_fingerprint(sql_query)),
+            lambda: execute_sql_query(
+                client, sql_query, trace=trace, quiet=quiet, raise_cancelled=True, **kwargs
+            ),
+            retry_on=(JobCancelled,),
+        )
+    except JobCancelled as e:
+        report_cancelled(e, trace=trace, quiet=quiet)
+        return (None, True, False, None), False
+
+
+def execute_sub_queries(
+    client, sql_query, sub_queries, job_config=None, trace=None, quiet=False,
+    owner=None, priority=INTERACTIVE, on_wait=None, raise_cancelled=False,
+):
+    """
+    Ejecuta por separado las ramas de una comparación UNION ALL y las une en local.
+
+    Cada rama la responde el cubo si puede y si no su propio job, todas a la vez; el
+    ORDER BY y el LIMIT de la unión se aplican al final. Si una rama falla, las demás
+    se cancelan. Devuelve lo mismo que `execute_sql_query`.
+    """
+    cube_router = get_cube_router()
+    frames = [None] * len(sub_queries.queries)
+    stopped = threading.Event()
+    cancelled = []
+
+    def check_stopped(_):
+        if stopped.is_set():
+            raise JobCancelled("superseded")
+
+    def run_branch(branch):
+        try:
+            return execute_sql_query(
+                client, branch, job_config=job_config, trace=trace, quiet=True,
+                owner=owner, priority=priority, on_wait=check_stopped, raise_cancelled=True,
+            )
+        except JobCancelled as e:
+            # Solo se relanza una cancelación que no venga de otra rama fallida
+            if raise_cancelled and not stopped.is_set():
+                cancelled.append(e)
+            else:
+                report_cancelled(e, trace=trace, quiet=True)
+            return None, True, False, None
+
+    futures = {}
+    with maybe_span(trace, "sub_queries", branches=len(frames)) as span:
+        for i, branch in enumerate(sub_queries.queries):
+            frames[i] = cube_router.try_answer(branch) if cube_router else None
+            if frames[i] is None:
+                future = get_sub_query_pool().submit(run_branch, branch)
+                futures[future] = i
+        span.set(cube=len(frames) - len(futures), jobs=len(futures))
+
+        start = time.monotonic()
+        pending = set(futures)
+        failed = False
+        try:
+            while pending:
+                done, pending = wait(
+                    pending, timeout=get_job_manager().poll_interval, return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    df, error_occurred, _, _ = future.result()
+                    failed = failed or error_occurred or df is None
+                if failed:
+                    stopped.set()
+                elif pending and on_wait is not None:
+                    on_wait(time.monotonic() - start)
+        except BaseException:
+            # El turno ya no espera la comparación: sus ramas cancelan sus jobs
+            stopped.set()
+            raise
+
+        bytes_processed = 0
+        for future, i in futures.items():
+            frames[i], _, _, branch_bytes = future.result()
+            bytes_processed += branch_bytes or 0
+        if failed:
+            if cancelled:
+                raise cancelled[0]
+            if not quiet:
+                report_error("❌ Error al ejecutar una de las sub-consultas de la comparación.")
+            return None, True, False, bytes_processed
+
+        try:
+            # Como en UNION ALL, las columnas se emparejan por posición con las de la primera rama
+            frames = [frame.set_axis(sub_queries.names, axis=1) for frame in frames]
+            df = pd.concat([frame for frame in frames if not frame.empty] or frames[:1], ignore_index=True)
+            df = apply_follow_up(df, FollowUp([], sub_queries.order, sub_queries.limit))
+        except Exception as e:
+            if not quiet:
+                report_error(f"❌ Error al unir las sub-consultas de la comparación: {e}")
+            return None, True, False, bytes_processed
+        truncated = any(frame.attrs.get("truncated") for frame in frames)
+        df.attrs.update(
+            truncated=truncated,
+            total_rows=sum(frame.attrs.get("total_rows", len(frame)) for frame in frames),
+        )
+        span.set(rows=len(df), bytes_processed=bytes_processed)
+    get_result_cache().put(sql_query, df, bytes_processed=bytes_processed)
+    return df, False, df.empty, bytes_processed
+
+
+def refine_exact_answer(client, exact_sql, cost_gate=None, owner=None):
+    """
+    Lanza en segundo plano la consulta exacta de una respuesta aproximada, a nombre
+    de `owner` (se cancela si su sesión se cierra).
+
+    Devuelve `(future, None)`, donde el future resuelve a lo mismo que
+    `execute_sql_query`, o `(None, motivo)` si el control de coste la rechaza.
+    """
+    job_config = None
+    if cost_gate is not None and not get_result_cache().contains(exact_sql):
+        try:
+            bytes_estimated = cost_gate.estimate(client, exact_sql)
+        except Exception as e:
+            return None, f"No se pudo estimar el coste de la consulta exacta: {e}"
+        allowed, reason = cost_gate.check(bytes_estimated)
+        if not allowed:
+            return None, reason
+        job_config = cost_gate.job_config()
+
+    def run():
+        result, _ = execute_shared_query(client, exact_sql, job_config=job_config, owner=owner)
+        return result
+
+    return get_worker_pool().submit(run), None
+
+
+def create_prefetcher():
+    """Prefetch de consultas de seguimiento de una sesión, con su propio presupuesto."""
+    return Prefetcher(
+        get_prefetch_pool(),
+        CostGate(PREFETCH_MAX_BYTES_PER_QUERY, PREFETCH_MAX_BYTES_PER_SESSION),
+        run=_run_prefetch_query,
+        needed=_needs_prefetch,
+        max_queries=PREFETCH_MAX_QUERIES,
+        max_cpu_seconds=PREFETCH_MAX_CPU_SECONDS,
+    )
+
+
+def _run_prefetch_query(client, sql_query, job_config, on_wait=None):
+    # Si el turno pide la misma consulta mientras se precarga, comparten el job
+    result, _ = execute_shared_query(
+        client, sql_query, job_config=job_config, quiet=True, on_wait=on_wait,
+    )
+    return result
+
+
+def _needs_prefetch(sql_query):
+    if get_result_cache().contains(sql_query):
+        return False
+    cube_router = get_cube_router()
+    return cube_router is None or cube_router.try_answer(sql_query) is None
+
+
+def prefetch_follow_ups(prefetcher, client, sql_query):
+    """
+    Precarga en segundo plano las variantes de `sql_query` por estado, año, sexo y
+    pluralidad que pasan la validación local; devuelve cuántas se lanzaron.
+    """
+    validator = get_sql_validator()
+    queries = []
+    for dimension, follow_up in follow_up_queries(sql_query, FOLLOW_UP_DIMENSIONS):
+        # La validación deja la SQL tal y como la ejecutaría el turno
+        follow_up, errors = validator.validate(follow_up)
+        if not errors:
+            queries.append((dimension, follow_up))
+    prefetcher.schedule(client, queries)
+    return min(len(queries), prefetcher.max_queries)
+
+
+def previous_frame(previous):
+    """Resultado completo de la respuesta anterior: en memoria o en su Parquet del historial."""
+    if previous.get("data") is not None:
+        return previous["data"]
+    if not previous.get("data_path"):
+        return None
+    try:
+        return pd.read_parquet(previous["data_path"])
+    except (OSError, ValueError):
+        return None
+
+
+def plan_previous_follow_up(prompt, previous):
+    """
+    (refinamiento, resultado anterior) si la pregunta ordena, filtra o recorta la
+    respuesta `previous` y su resultado tiene las columnas necesarias; si no, (None, None).
+    """
+    if not FOLLOW_UP_LOCAL or not previous or not previous.get("sql_query"):
+        return None, None
+    # El Parquet del historial solo se lee si la pregunta parece un refinamiento
+    if parse_follow_up(prompt) is None:
+        return None, None
+    df_previous = previous_frame(previous)
+    if df_previous is None:
+        return None, None
+    follow_up = plan_follow_up(prompt, df_previous, previous["sql_query"])
+    return (follow_up, df_previous) if follow_up is not None else (None, None)
+
+
+# --- PROMPT PARA RESULTADOS VACÍOS ACTUALIZADO ---
+EMPTY_RESULT_PROMPT_PREFIX = """
+        La consulta SQL sobre estadísticas de natalidad se ejecutó correctamente pero no devolvió resultados. 
+        Esto es común en este dataset, probablemente por una de estas razones:
+        1. La pregunta se refiere a un año reciente (posterior a 2008), y el dataset es histórico.
+        2. Los filtros aplicados son demasiado específicos (ej. una combinación de estado, edad y raza muy particular).
+        
+        Tu tarea es explicar amablemente al usuario por qué no se encontraron datos. 
+        - Revisa la consulta y la pregunta.
+        - Si la consulta filtra por un año > 2008, menciona que esa es la causa más probable debido a que los datos son históricos (1969-2008).
+        - Sugiere reformular la pregunta, por ejemplo, probando un rango de años diferente (como 2000-2008) o usando filtros menos restrictivos.
+        - Sé conciso y servicial. No digas que la consulta es errónea, porque no lo es.
+        """
+
+# --- PROMPT PARA ANÁLISIS DE RESULTADOS ACTUALIZADO ---
+EXPLANATION_PROMPT_PREFIX = """
+        Eres un experto en análisis de datos de salud pública y tu objetivo es explicar los resultados de una consulta sobre natalidad de una manera clara y útil para el usuario.
+
+        TAREA:
+        Analiza los resultados y responde directamente a la pregunta del usuario. Adapta la profundidad de tu respuesta a la naturaleza de la pregunta original:
+        - Para preguntas directas y factuales (ej: "¿Cuál fue el peso promedio al nacer?", "¿Cuántos nacimientos hubo?"), da una respuesta concisa y directa, mencionando el resultado clave de los datos.
+        - Para preguntas que piden análisis, comparaciones o tendencias (ej: "Compara el peso al nacer en dos estados", "Analiza la tendencia de la edad de la madre"), proporciona un análisis más detallado. Destaca 1 o 2 insights importantes, menciona cualquier patrón o dato interesante y, si es posible, ofrece una breve conclusión.
+
+        Utiliza un lenguaje claro y accesible. Si ayuda a la claridad, usa listas o texto en negrita para resaltar la información clave.
+        """
+
+
+def build_explanation_prompt(question, sql_query, df_result, result_digest=None, approximation_note=None):
+    """
+    Construye el prompt de explicación, adaptando automáticamente su profundidad
+    a la complejidad de la pregunta del usuario.
+
+    Devuelve el prefijo estático (instrucciones) y la parte variable del turno.
+    """
+    if df_result is None or df_result.empty:
+        turn_prompt = f"""
+        Pregunta del usuario: "{question}"
+        Consulta SQL ejecutada: 
+        ```sql
+        {sql_query}
+        ```
+        """
+        return PromptPrefix("empty", EMPTY_RESULT_PROMPT_PREFIX), turn_prompt
+
+    # Resumen acotado en lugar de la tabla entera: el prompt no crece con el resultado
+    if result_digest is None:
+        result_digest = build_result_digest(df_result, max_tokens=DIGEST_MAX_TOKENS)
+    df_text = result_digest["text"]
+    turn_prompt = f"""
+        PREGUNTA ORIGINAL DEL USUARIO:
+        "{question}"
+
+        RESULTADOS OBTENIDOS (resumen del resultado completo):
+        ```
+        {df_text}
+        ```
+        """
+    if approximation_note:
+        turn_prompt += f"""
+        AVISO: los resultados son APROXIMADOS ({approximation_note}). Las columnas
+        `*_margen` son el margen de error al 95 %. Menciona que las cifras son estimaciones.
+        """
+    return PromptPrefix("explanation", EXPLANATION_PROMPT_PREFIX), turn_prompt
+
+
+def generate_explanation_stream(
+    client, model_config, question, sql_query, df_result, result_digest=None,
+    context_cache=None, usage=None, approximation_note=None,
+):
+    """Genera la explicación fragmento a fragmento con la API de streaming de Gemini."""
+    prefix, turn_prompt = build_explanation_prompt(
+        question, sql_query, df_result, result_digest, approximation_note
+    )
+    context_cache = context_cache or ContextCache(min_tokens=float("inf"))
+    yield from context_cache.generate_stream(
+        client, model_config, prefix, turn_prompt, usage=usage
+    )
+
+
+def guard_explanation_stream(chunks):
+    """Muestra el error y entrega un texto de respaldo si el streaming falla a mitad."""
+    try:
+        yield from chunks
+    except Exception as e:
+        report_error(f"❌ Error al generar el análisis: {e}")
+        yield "Error al generar el análisis de los resultados."
+
+
+def generate_explanation(client, model_config, question, sql_query, df_result):
+    """
+    Genera una explicación de los resultados, adaptando automáticamente su profundidad
+    a la complejidad de la pregunta del usuario.
+    """
+    return "".join(
+        guard_explanation_stream(
+            generate_explanation_stream(client, model_config, question, sql_query, df_result)
+        )
+    )
+
+
+def visualization_spec(df_result):
+    """Especificación del gráfico apropiado para el resultado (None si no procede)"""
+    return chart_spec(df_result, max_points=MAX_CHART_POINTS)
+
+
+def figure_from_spec(df_result, spec):
+    """Construye la figura de Plotly a partir de su especificación"""
+    return build_chart(df_result, spec)
+
+
+def create_visualization(df_result):
+    """Crear visualización si es apropiado"""
+    return figure_from_spec(df_result, visualization_spec(df_result))
+
+
+class TurnRenderer:
+    """Recibe cada etapa del turno en cuanto está lista. Por defecto no muestra nada."""
+
+    def first_page(self, df_page):
+        pass
+
+    def result(self, df_result):
+        pass
+
+    def figure(self, fig):
+        pass
+
+    def explanation(self, chunks, header=None):
+        return "".join(chunks)
+
+    def waiting(self, seconds):
+        """Se llama mientras el job de BigQuery sigue en curso; si lanza, el job se cancela."""
+        pass
+
+
+def _credential_key(gemini_api_key, client_ai):
+    """Identifica la credencial del modelo sin guardar la API key en las claves de vuelo."""
+    if gemini_api_key:
+        return hashlib.sha256(gemini_api_key.encode("utf-8")).hexdigest()[:16]
+    return id(client_ai)
+
+
+def _token_counts(usage):
+    return {key: usage.get(key, 0) for key in ("prompt_tokens", "output_tokens", "prompt_tokens_saved")}
+
+
+def _set_token_delta(span, usage, before):
+    """Anota en el span los tokens consumidos desde `before`."""
+    after = _token_counts(usage)
+    span.set(
+        prompt_tokens=after["prompt_tokens"] - before["prompt_tokens"],
+        output_tokens=after["output_tokens"] - before["output_tokens"],
+        cached_tokens=after["prompt_tokens_saved"] - before["prompt_tokens_saved"],
+    )
+
+
+def _answer_follow_up(trace, follow_up, df_previous, previous, client, cost_gate, renderer, session_id=None):
+    """
+    Responde un refinamiento sin el modelo. Con todas las filas del resultado anterior
+    se calcula con pandas; si estaba truncado, solo la SQL compuesta va a BigQuery.
+    Devuelve None si hay que seguir el camino normal.
+    """
+    sql_query = follow_up_sql(previous["sql_query"], follow_up)
+    answered_locally = not previous.get("truncated")
+    bytes_estimated, bytes_processed = None, 0
+    if answered_locally:
+        with trace.span("follow_up", local=True) as span:
+            df_result = apply_follow_up(df_previous, follow_up)
+            span.set(rows=len(df_result))
+    else:
+        # Faltan filas: sin una SQL equivalente se vuelve a generar la consulta
+        if sql_query is None:
+            return None
+        job_config = None
+        if cost_gate is not None and not get_result_cache().contains(sql_query):
+            try:
+                with trace.span("dry_run") as span:
+                    bytes_estimated = cost_gate.estimate(client, sql_query)
+                    span.set(bytes_estimated=bytes_estimated)
+            except Exception as e:
+                logger.warning("Dry run del refinamiento fallido: %s", e)
+                return None
+            allowed, reason = cost_gate.check(bytes_estimated)
+            if not allowed:
+                trace.set(status="rejected")
+                return {
+                    "role": "assistant",
+                    "content": f"💸 Consulta rechazada por coste. {reason}",
+                    "data": None, "fig": None, "sql_query": sql_query,
+                    "bytes_estimated": bytes_estimated, "bytes_processed": None,
+                }
+            job_config = cost_gate.job_config()
+        with trace.span("execution") as span:
+            (df_result, error_occurred, _, bytes_processed), shared = execute_shared_query(
+                client, sql_query, job_config=job_config,
+                on_first_page=renderer.first_page, trace=trace, quiet=True,
+                owner=session_id, on_wait=renderer.waiting,
+            )
+            span.set(shared=shared)
+        if error_occurred or df_result is None:
+            return None
+        if shared:
+            bytes_processed = 0
+        if cost_gate is not None:
+            cost_gate.record(bytes_processed)
+
+    source = (
+        "calculado sobre el resultado anterior, sin consultar BigQuery" if answered_locally
+        else "con la consulta anterior en BigQuery, sin volver a generar la SQL"
+    )
+    response = {
+        "role": "assistant", "sql_query": sql_query,
+        "bytes_estimated": bytes_estimated, "bytes_processed": bytes_processed,
+        "answered_locally": answered_locally, "follow_up": follow_up.describe(),
+    }
+    if df_result.empty:
+        trace.set(status="empty")
+        content = renderer.explanation(iter([
+            f"🔎 Refinamiento del resultado anterior ({follow_up.describe()}): "
+            "ninguna fila cumple el filtro."
+        ]))
+        return {**response, "content": content, "data": None, "fig": None}
+
+    fig_spec = visualization_spec(df_result)
+    with trace.span("visualization", kind=fig_spec and fig_spec["kind"]):
+        fig = figure_from_spec(df_result, fig_spec)
+    renderer.result(df_result.head(PREVIEW_ROWS))
+    renderer.figure(fig)
+    content = renderer.explanation(iter([
+        f"🔎 **Refinamiento del resultado anterior**: {follow_up.describe()}, {source}."
+    ]))
+    return {
+        **response, "content": content, "data": df_result, "fig": fig, "fig_spec": fig_spec,
+        "total_rows": df_result.attrs.get("total_rows", len(df_result)),
+        "truncated": df_result.attrs.get("truncated", False),
+        "result_path": df_result.attrs.get("result_path"),
+    }
+
+
+def process_query(
+    prompt, gemini_api_key, client, tables_info, tables_context,
+    cost_gate=None, renderer=None, session_id=None, gemini=None, approximate=False,
+    prefetcher=None, previous=None, priority=INTERACTIVE,
+):
+    """
+    Función consolidada para procesar consultas y evitar duplicación.
+
+    `gemini` permite pasar un `(cliente, model_config)` ya creado (p. ej. el cliente
+    falso de `fakes`); si se omite, se usa la pasarela de `gemini_api_key`.
+
+    Cada turno genera una traza con un span por etapa; el desglose de tiempos se
+    devuelve en `timings` y el estado final (ok, empty, error, rejected...) en `status`.
+
+    Con `approximate=True` las consultas agregadas se reescriben con muestreo y agregados
+    aproximados (ver `approx.py`); la SQL exacta se devuelve en `exact_sql` para
+    refinarla después con `refine_exact_answer`.
+
+    Con un `prefetcher` (ver `create_prefetcher`), la pregunta cancela lo que se
+    estuviera precargando y otra cosa, y una respuesta con datos precarga sus
+    consultas de seguimiento; `prefetch_hit` indica si el turno encontró la suya.
+
+    `previous` es la respuesta anterior de la conversación (con `sql_query` y `data`
+    o `data_path`). Si la pregunta solo la ordena, filtra o recorta («solo Texas», «los
+    5 primeros»), se responde sin el modelo con `followup.py` y el turno lleva la
+    descripción en `follow_up`.
+
+    Los jobs de BigQuery salen a nombre de `session_id` con prioridad `priority`
+    (`jobs.BATCH` en el modo por lotes) y tiempo máximo; mientras se esperan se llama
+    a `renderer.waiting`. Un job que se pasa de tiempo deja el turno en `timeout`.
+    """
+    tracer = get_tracer()
+    trace = tracer.start()
+    try:
+        response = _process_query(
+            trace, prompt, gemini_api_key, client, tables_info, tables_context,
+            cost_gate, renderer, session_id, gemini, approximate, prefetcher, previous, priority,
+        )
+    except Exception:
+        tracer.finish(trace, status="exception")
+        raise
+    tracer.finish(trace, status=trace.attrs.get("status", "ok"))
+    response["status"] = trace.attrs.get("status", "ok")
+    response["trace_id"] = trace.trace_id
+    response["timings"] = trace.breakdown()
+    return response
+
+
+def _process_query(
+    trace, prompt, gemini_api_key, client, tables_info, tables_context,
+    cost_gate, renderer, session_id, gemini, approximate, prefetcher, previous, priority,
+):
+    renderer = renderer or TurnRenderer()
+    # Los refinamientos del resultado anterior no necesitan el modelo
+    follow_up, df_previous = plan_previous_follow_up(prompt, previous)
+    if follow_up is not None:
+        response = _answer_follow_up(
+            trace, follow_up, df_previous, previous, client, cost_gate, renderer, session_id,
+        )
+        if response is not None:
+            return response
+    if gemini is None and not gemini_api_key:
+        trace.set(status="no_api_key")
+        error_msg = "🔑 Por favor, proporciona tu API key de Gemini en el sidebar."
+        return {
+            "role": "assistant", "content": error_msg,
+            "data": None, "fig": None, "sql_query": None,
+        }
+
+    model_result = gemini or initialize_gemini(gemini_api_key, session_id)
+    if not model_result or not model_result[0]: # Se comprueba que el resultado y el cliente no sean nulos
+        trace.set(status="error")
+        error_msg = "❌ Error al inicializar Gemini. Verifica tu API key."
+        return {
+            "role": "assistant", "content": error_msg,
+            "data": None, "fig": None, "sql_query": None,
+        }
+
+    client_ai, model_config = model_result
+    context_cache = get_context_cache(gemini_api_key)
+    usage = {"prompt_tokens_saved": 0}
+    # Las preguntas casi repetidas se resuelven desde la caché sin llamar al modelo
+    sql_cache = get_sql_cache()
+    flights = get_single_flight()
+    template, literals = normalize_question(prompt)
+    # Solo comparten llamada al modelo las sesiones con la misma credencial: una API key
+    # inválida no recibe lo que otra sesión pidió con la suya
+    question_key = (template, tuple(literals), _credential_key(gemini_api_key, client_ai))
+
+    def resolve_sql():
+        sql_query = sql_cache.lookup(prompt)
+        from_cache = sql_query is not None
+        if not from_cache:
+            sql_query = generate_sql_query(
+                client_ai, model_config, prompt, tables_info, tables_context,
+                context_cache=context_cache, usage=usage,
+            )
+            if not sql_query:
+                return None, False, []
+        # Los errores de sintaxis o esquema se corrigen aquí, sin gastar un job de BigQuery
+        sql_query, errors, repairs = validate_sql_query(
+            client_ai, model_config, prompt, sql_query, tables_info, tables_context,
+            context_cache=context_cache, usage=usage, trace=trace,
+        )
+        return sql_query, from_cache and not repairs, errors
+
+    # La misma pregunta en curso en otra sesión comparte una única llamada al modelo
+    with trace.span("sql_generation") as span:
+        tokens_before = _token_counts(usage)
+        (sql_query, from_cache, validation_errors), sql_shared = flights.do(
+            ("sql", question_key), resolve_sql
+        )
+        span.set(from_cache=from_cache, shared=sql_shared)
+        _set_token_delta(span, usage, tokens_before)
+    if prefetcher is not None:
+        # Llega otra pregunta: solo sigue la precarga de su misma consulta, si la había
+        prefetcher.cancel(keep=sql_query)
+
+    if not sql_query:
+        trace.set(status="error")
+        error_msg = "❌ No se pudo generar la consulta SQL. Por favor, reformula tu pregunta."
+        return {
+            "role": "assistant", "content": error_msg,
+            "data": None, "fig": None, "sql_query": None,
+        }
+    if validation_errors:
+        trace.set(status="invalid")
+        error_msg = (
+            "❌ La consulta generada no es válida: " + " ".join(validation_errors)
+            + " Por favor, reformula tu pregunta."
+        )
+        return {
+            "role": "assistant", "content": error_msg,
+            "data": None, "fig": None, "sql_query": sql_query,
+        }
+
+    # El cubo local responde en milisegundos los agregados que cubre
+    cube_router = get_cube_router()
+    with trace.span("cube") as span:
+        df_result = cube_router.try_answer(sql_query) if cube_router else None
+        answered_locally = df_result is not None
+        span.set(answered=answered_locally)
+
+    # Modo aproximado: muestra de la tabla y agregados aproximados, con la SQL exacta a mano
+    approximation = None
+    if approximate and not answered_locally:
+        with trace.span("approximation") as span:
+            # N es el de la tabla que muestrea la consulta, no el de la primera del dataset
+            approximation = approximate_query(
+                sql_query, APPROX_SAMPLE_PERCENT,
+                table_rows=lambda table_id: get_table_row_count(client, table_id),
+            )
+            span.set(
+                applied=approximation is not None,
+                ratio=approximation is not None and approximation.table_rows is not None,
+                table=approximation and approximation.table_id,
+            )
+        if approximation is not None:
+            sql_query = approximation.sql
+
+    # Dry run: las consultas ya cacheadas no cuestan nada y no pasan por el control
+    bytes_estimated = None
+    job_config = None
+    if (
+        not answered_locally
+        and cost_gate is not None
+        and not get_result_cache().contains(sql_query)
+    ):
+        sql_query, bytes_estimated, error_occurred, rejection = enforce_query_cost(
+            client, client_ai, model_config, prompt, sql_query,
+            tables_info, tables_context, cost_gate,
+            context_cache=context_cache, usage=usage, trace=trace,
+        )
+        # Una reescritura por coste es exacta y ya no corresponde a la aproximación
+        if approximation is not None and sql_query != approximation.sql:
+            approximation = None
+        if error_occurred:
+            trace.set(status="error")
+            error_msg = "❌ Error en la consulta. Por favor, verifica la sintaxis o reformula tu pregunta."
+            return {
+                "role": "assistant", "content": error_msg,
+                "data": None, "fig": None, "sql_query": sql_query,
+                "bytes_estimated": None, "bytes_processed": None,
+            }
+        if rejection:
+            trace.set(status="rejected")
+            error_msg = f"💸 Consulta rechazada por coste. {rejection} Prueba a acotar la pregunta (años, estados o columnas concretas)."
+            return {
+                "role": "assistant", "content": error_msg,
+                "data": None, "fig": None, "sql_query": sql_query,
+                "bytes_estimated": bytes_estimated, "bytes_processed": None,
+            }
+        job_config = cost_gate.job_config()
+
+    prefetch_hit = False
+    if answered_locally:
+        error_occurred, is_empty, bytes_processed = False, df_result.empty, 0
+    else:
+        # Las consultas idénticas en curso comparten un único job de BigQuery
+        with trace.span("execution") as span:
+            (df_result, error_occurred, is_empty, bytes_processed), query_shared = execute_shared_query(
+                client, sql_query, job_config=job_config,
+                on_first_page=renderer.first_page, trace=trace,
+                owner=session_id, priority=priority, on_wait=renderer.waiting,
+            )
+            span.set(shared=query_shared)
+            if prefetcher is not None:
+                prefetch_hit = prefetcher.observe(sql_query)
+                span.set(prefetched=prefetch_hit)
+        if query_shared and not error_occurred:
+            # El coste ya lo pagó la sesión que lanzó el job
+            bytes_processed = 0
+        if cost_gate is not None:
+            cost_gate.record(bytes_processed)
+
+    # Solo se cachean consultas que BigQuery ejecutó sin errores, y una sola vez por grupo;
+    # en modo aproximado se guarda la SQL exacta
+    if not error_occurred and not from_cache and not sql_shared:
+        sql_cache.store(prompt, approximation.exact_sql if approximation else sql_query)
+    # Solo las que además devolvieron datos sirven de ejemplo para otras preguntas
+    if not error_occurred and not is_empty and not sql_shared and FEW_SHOT_K > 0:
+        get_example_index().add(prompt, approximation.exact_sql if approximation else sql_query)
+
+    approximation_header = None
+    relative_errors = {}
+    if approximation is not None and not error_occurred and not is_empty:
+        df_result, relative_errors = apply_error_bounds(df_result, approximation)
+        approximation_header = approximation_label(approximation, relative_errors)
+
+    if error_occurred:
+        if trace.attrs.get("status") == "timeout":
+            error_msg = (
+                "⏱️ La consulta tardó demasiado y se canceló. "
+                "Prueba a acotar la pregunta (años, estados o columnas concretas)."
+            )
+        elif trace.attrs.get("status") == "cancelled":
+            error_msg = "⏹️ La consulta se canceló antes de terminar."
+        else:
+            trace.set(status="error")
+            error_msg = "❌ Error en la consulta. Por favor, verifica la sintaxis o reformula tu pregunta."
+        return {
+            "role": "assistant", "content": error_msg,
+            "data": None, "fig": None, "sql_query": sql_query,
+            "bytes_estimated": bytes_estimated, "bytes_processed": bytes_processed,
+            "answered_locally": answered_locally,
+        }
+    elif is_empty:
+        empty_header = """
+        ### 📊 Consulta Ejecutada Correctamente
+        
+        La consulta SQL es válida y se ejecutó sin errores, pero **no se encontraron datos** que coincidan con tu pregunta.
+
+        ### 🤔 Análisis del Asistente de IA:
+        """
+        trace.set(status="empty")
+        chunks = flights.stream(
+            ("empty", question_key, sql_fingerprint(sql_query)),
+            get_worker_pool(),
+            lambda: generate_explanation_stream(
+                client_ai, model_config, prompt, sql_query, None,
+                context_cache=context_cache, usage=usage,
+            ),
+        )
+        with trace.span("explanation") as span:
+            tokens_before = _token_counts(usage)
+            explanation = renderer.explanation(
+                trace.timed_stream(span, guard_explanation_stream(chunks)), header=empty_header
+            )
+            _set_token_delta(span, usage, tokens_before)
+        empty_msg = f"""{empty_header}{explanation}
+        """
+        return {
+            "role": "assistant", "content": empty_msg,
+            "data": None, "fig": None, "sql_query": sql_query,
+            "bytes_estimated": bytes_estimated, "bytes_processed": bytes_processed,
+            "answered_locally": answered_locally,
+            "prompt_tokens_saved": usage["prompt_tokens_saved"],
+        }
+    else:
+        # La explicación (red) y el gráfico (CPU) se solapan en el pool mientras
+        # la tabla ya se muestra; el texto se va pintando según llegan los tokens
+        pool = get_worker_pool()
+        # El resumen también se comparte: así las sesiones agrupadas llegan a la vez a la explicación
+        with trace.span("digest") as span:
+            result_digest, _ = flights.do(
+                ("digest", sql_fingerprint(sql_query)),
+                lambda: build_result_digest(df_result, max_tokens=DIGEST_MAX_TOKENS),
+            )
+            span.set(tokens=result_digest["tokens"])
+        fig_spec = visualization_spec(df_result)
+
+        def build_figure():
+            with trace.span("visualization", kind=fig_spec and fig_spec["kind"]):
+                return figure_from_spec(df_result, fig_spec)
+
+        # El span de la explicación va desde la petición hasta el último fragmento pintado
+        with trace.span("explanation") as span:
+            tokens_before = _token_counts(usage)
+            # Las sesiones con la misma pregunta y consulta reciben el mismo streaming
+            chunks = flights.stream(
+                ("explanation", question_key, sql_fingerprint(sql_query)),
+                pool,
+                lambda: generate_explanation_stream(
+                    client_ai, model_config, prompt, sql_query, df_result, result_digest,
+                    context_cache=context_cache, usage=usage,
+                    approximation_note=approximation_header and approximation_header.strip(),
+                ),
+            )
+            fig_future = pool.submit(build_figure)
+            renderer.result(df_result.head(PREVIEW_ROWS))
+            fig = fig_future.result()
+            renderer.figure(fig)
+            explanation = renderer.explanation(
+                trace.timed_stream(span, guard_explanation_stream(chunks)),
+                header=approximation_header,
+            )
+            _set_token_delta(span, usage, tokens_before)
+        full_response = f"{approximation_header or ''}{explanation}"
+        if prefetcher is not None:
+            with trace.span("prefetch") as span:
+                span.set(scheduled=prefetch_follow_ups(
+                    prefetcher, client, approximation.exact_sql if approximation else sql_query
+                ))
+        # El historial guarda el resultado en disco y solo una vista previa en memoria
+        return {
+            "role": "assistant", "content": full_response,
+            "data": df_result, "fig": fig, "fig_spec": fig_spec, "sql_query": sql_query,
+            "bytes_estimated": bytes_estimated, "bytes_processed": bytes_processed,
+            "answered_locally": answered_locally,
+            "total_rows": df_result.attrs.get("total_rows", len(df_result)),
+            "truncated": df_result.attrs.get("truncated", False),
+            "result_path": df_result.attrs.get("result_path"),
+            "digest_tokens": result_digest["tokens"],
+            "digest_ms": result_digest["build_ms"],
+            "prompt_tokens_saved": usage["prompt_tokens_saved"],
+            "approximate": approximation and {
+                "sample_percent": approximation.sample_percent,
+                "relative_errors": relative_errors,
+                "notes": approximation.notes,
+            },
+            "exact_sql": approximation and approximation.exact_sql,
+            "prefetch_hit": prefetch_hit,
+        }
@@ -0,0 +1,260 @@
+"""Prefetch especulativo de las consultas de seguimiento más probables"""
+
+import logging
+import threading
+import time
+
+import sqlglot
+from sqlglot import exp
+
+from jobs import JobCancelled
+from result_cache import sql_fingerprint
+from sql_validation import has_aggregate
+
+logger = logging.getLogger(__name__)
+
+# Lo siguiente que casi siempre se pregunta: la misma métrica por estado, por año,
+# por sexo o por pluralidad
+FOLLOW_UP_DIMENSIONS = ("state", "year", "is_male", "plurality")
+
+
+def _fixes_column(condition, column):
+    """Si la condición es `columna = literal` (o al revés) sobre `column`."""
+    if not isinstance(condition, exp.EQ):
+        return False
+    sides = (condition.this, condition.expression)
+    return any(
+        isinstance(side, exp.Column) and side.name.lower() == column
+        and isinstance(other, exp.Literal)
+        for side, other in (sides, sides[::-1])
+    )
+
+
+def follow_up_queries(sql_query, dimensions=FOLLOW_UP_DIMENSIONS, table_name="natality"):
+    """
+    Variantes de una consulta agregada sobre `table_name` con una dimensión más en
+    el GROUP BY, en el orden de `dimensions`. Un filtro de igualdad sobre la
+    dimensión desaparece («en 2005» pasa a «por año»); los rangos se conservan.
+
+    Devuelve [(dimensión, sql)]; vacío si la consulta no es una SELECT agregada
+    simple (con JOIN, CTE, ventanas, DISTINCT o LIMIT no se sabe qué se pediría).
+    """
+    try:
+        tree = sqlglot.parse_one(sql_query, read="bigquery")
+    except sqlglot.errors.ParseError:
+        return []
+    if (
+        not isinstance(tree, exp.Select)
+        or any(tree.args.get(arg) for arg in ("with", "joins", "distinct", "limit"))
+        or tree.find(exp.Window, exp.Subquery)
+    ):
+        return []
+    source = tree.args.get("from_") or tree.args.get("from")
+    table = source.this if source is not None else None
+    if not isinstance(table, exp.Table) or table.name.lower() != table_name:
+        return []
+    if not has_aggregate(tree):
+        return []
+
+    group = tree.args.get("group")
+    grouped = {
+        column.name.lower()
+        for key in (group.expressions if group else [])
+        for column in key.find_all(exp.Column)
+    }
+    queries = []
+    for dimension in dimensions:
+        if dimension in grouped:
+            continue
+        variant = tree.copy()
+        where = variant.args.get("where")
+        if where is not None:
+            conditions = [
+                condition for condition in where.this.flatten()
+                if not _fixes_column(condition, dimension)
+            ] if isinstance(where.this, exp.And) else (
+                [] if _fixes_column(where.this, dimension) else [where.this]
+            )
+            variant.set("where", exp.Where(this=exp.and_(*conditions)) if conditions else None)
+        # La dimensión nueva va tras las que ya había, delante de las métricas
+        projections = variant.expressions
+        position = next(
+            (i for i, projection in enumerate(projections) if projection.find(exp.AggFunc)),
+            len(projections),
+        )
+        projections.insert(position, exp.column(dimension))
+        variant.set("expressions", projections)
+        keys = variant.args["group"].expressions if variant.args.get("group") else []
+        variant.set("group", exp.Group(expressions=[*keys, exp.column(dimension)]))
+        if not variant.args.get("order"):
+            variant = variant.order_by(exp.column(dimension))
+        queries.append((dimension, variant.sql(dialect="bigquery", pretty=True)))
+    return queries
+
+
+class Prefetcher:
+    """
+    Ejecuta en segundo plano las consultas de seguimiento de una respuesta para que
+    la siguiente pregunta las encuentre en la caché de resultados.
+
+    `run(client, sql, job_config, on_wait)` ejecuta una consulta y guarda su
+    resultado, llamando a `on_wait(segundos)` mientras espera al job: si lanza, el job
+    se cancela;
+    `needed(sql)` dice si aún hace falta (no está en caché ni la responde el cubo).
+    Antes de ejecutar, cada consulta pasa por un dry run con `cost_gate`, que lleva un
+    presupuesto de bytes propio, aparte del de la sesión: los bytes se reservan con la
+    estimación y el job sale con `maximum_bytes_billed`. Cada tanda tiene además un
+    tope de `max_cpu_seconds` de CPU en los hilos del pool.
+
+    `cancel()` descarta la tanda en curso cuando llega otra pregunta (sus jobs en
+    marcha se cancelan en la siguiente espera); `observe(sql)`
+    anota si la consulta de un turno ya estaba precargada. `stats()` da el acierto.
+    """
+
+    def __init__(self, executor, cost_gate, run, needed, max_queries=3, max_cpu_seconds=2.0):
+        self.executor = executor
+        self.cost_gate = cost_gate
+        self.run = run
+        self.needed = needed
+        self.max_queries = max_queries
+        self.max_cpu_seconds = max_cpu_seconds
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._batch = []
+        # Huella -> bytes de las consultas precargadas que aún no ha pedido nadie, y
+        # huellas de las que tienen el job en marcha
+        self._ready = {}
+        self._running = set()
+        self._stats = {
+            "scheduled": 0, "completed": 0, "skipped": 0, "cancelled": 0, "failed": 0,
+            "turns": 0, "hits": 0, "bytes_processed": 0, "bytes_used": 0,
+        }
+
+    def _add(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def schedule(self, client, queries):
+        """Precarga las consultas [(etiqueta, sql)] en el pool; cancela la tanda anterior."""
+        self.cancel()
+        with self._lock:
+            # Solo cuenta como acierto la pregunta siguiente
+            self._ready.clear()
+            generation = self._generation
+            budget = {"cpu_seconds": 0.0}
+            for label, sql_query in queries[:self.max_queries]:
+                self._stats["scheduled"] += 1
+                future = self.executor.submit(
+                    self._prefetch, generation, budget, client, label, sql_query
+                )
+                self._batch.append((sql_fingerprint(sql_query), future))
+
+    def cancel(self, keep=None):
+        """
+        Descarta lo pendiente y cancela lo que está en marcha, antes de lanzar su job o
+        mientras se espera. La consulta `keep` (la del turno que llega) sigue adelante si
+        estaba precargándose.
+        """
+        keep = keep and sql_fingerprint(keep)
+        with self._lock:
+            self._generation += 1
+            batch, self._batch = self._batch, []
+        for fingerprint, future in batch:
+            if fingerprint == keep:
+                with self._lock:
+                    self._batch.append((fingerprint, future))
+            elif future.cancel():
+                self._add("cancelled")
+
+    def _stale(self, generation, sql_query):
+        with self._lock:
+            if generation == self._generation:
+                return False
+            fingerprint = sql_fingerprint(sql_query)
+            return not any(kept == fingerprint for kept, _ in self._batch)
+
+    def _prefetch(self, generation, budget, client, label, sql_query):
+        start = time.thread_time()
+        try:
+            if self._stale(generation, sql_query):
+                self._add("cancelled")
+                return
+            if budget["cpu_seconds"] >= self.max_cpu_seconds or not self.needed(sql_query):
+                self._add("skipped")
+                return
+            estimated = self.cost_gate.estimate(client, sql_query)
+            with self._lock:
+                allowed, _ = self.cost_gate.check(estimated)
+                if allowed:
+                    job_config = self.cost_gate.job_config()
+                    # Se reserva ya: las consultas paralelas no pueden pasarse del presupuesto
+                    self.cost_gate.record(estimated)
+            if not allowed:
+                self._add("skipped")
+                return
+            if self._stale(generation, sql_query):
+                with self._lock:
+                    self.cost_gate.record(-estimated)
+                    self._stats["cancelled"] += 1
+                return
+
+            def check_stale(_):
+                # Otra pregunta descartó la tanda: el job en marcha deja de facturar
+                if self._stale(generation, sql_query):
+                    raise JobCancelled("superseded")
+
+            fingerprint = sql_fingerprint(sql_query)
+            with self._lock:
+                self._running.add(fingerprint)
+            try:
+                df, error_occurred, _, bytes_processed = self.run(
+                    client, sql_query, job_config, on_wait=check_stale
+                )
+            except Exception:
+                with self._lock:
+                    self._running.discard(fingerprint)
+                raise
+            stale = self._stale(generation, sql_query)
+            with self._lock:
+                self._running.discard(fingerprint)
+                # La reserva se ajusta a lo que procesó el job
+                self.cost_gate.record((bytes_processed or 0) - estimated)
+                if error_occurred or df is None:
+                    self._stats["cancelled" if stale else "failed"] += 1
+                    return
+                self._stats["completed"] += 1
+                self._stats["bytes_processed"] += bytes_processed or 0
+                self._ready[fingerprint] = bytes_processed or 0
+        except Exception as e:
+            logger.warning("Prefetch de %s fallido: %s", label, e)
+            self._add("failed")
+        finally:
+            with self._lock:
+                budget["cpu_seconds"] += time.thread_time() - start
+
+    def observe(self, sql_query):
+        """
+        Anota el turno con `sql_query`; True si su resultado se había precargado o se
+        estaba precargando (el turno comparte entonces el mismo job).
+        """
+        fingerprint = sql_query and sql_fingerprint(sql_query)
+        with self._lock:
+            self._stats["turns"] += 1
+            used = self._ready.pop(fingerprint, None)
+            in_flight = fingerprint in self._running
+            if used is None and not in_flight:
+                return False
+            self._stats["hits"] += 1
+            self._stats["bytes_used"] += used or 0
+            return True
+
+    def stats(self):
+        """
+        Contadores, acierto (turnos que encontraron su consulta precargada) y
+        aprovechamiento (precargas que acabó pidiendo alguien).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hit_rate"] = stats["hits"] / stats["turns"] if stats["turns"] else 0.0
+        stats["used_rate"] = stats["hits"] / stats["completed"] if stats["completed"] else 0.0
+        return stats
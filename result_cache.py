@@ -0,0 +1,231 @@
+"""Caché en disco de resultados de BigQuery indexada por SQL canónica"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    |(?P<quoted>`[^`]*`)
+    |(?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    |(?P<word>[A-Za-z_@][\w]*)
+    |(?P<space>\s+)
+    |(?P<symbol><=|>=|<>|!=|\|\||.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def _tokenize(sql_query):
+    tokens = []
+    for match in _TOKEN_RE.finditer(sql_query):
+        kind = match.lastgroup
+        if kind in ("comment", "space"):
+            continue
+        value = match.group(0)
+        # Mayúsculas/minúsculas no importan en palabras clave ni identificadores sin comillas
+        if kind == "word":
+            value = value.lower()
+        tokens.append((kind, value))
+    while tokens and tokens[-1] == ("symbol", ";"):
+        tokens.pop()
+    return tokens
+
+
+def _sort_in_lists(tokens):
+    """Ordena las listas IN (...) formadas solo por literales."""
+    result = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == ("word", "in") and tokens[i + 1:i + 2] == [("symbol", "(")]:
+            literals = []
+            j = i + 2
+            while j < len(tokens) and tokens[j][0] in ("string", "number"):
+                literals.append(tokens[j])
+                if tokens[j + 1:j + 2] != [("symbol", ",")]:
+                    j += 1
+                    break
+                j += 2
+            if literals and tokens[j:j + 1] == [("symbol", ")")]:
+                result += [tokens[i], ("symbol", "(")]
+                for k, literal in enumerate(sorted(literals)):
+                    if k:
+                        result.append(("symbol", ","))
+                    result.append(literal)
+                result.append(("symbol", ")"))
+                i = j + 1
+                continue
+        result.append(tokens[i])
+        i += 1
+    return result
+
+
+def canonicalize_sql(sql_query):
+    """
+    Forma canónica de una consulta: sin comentarios, espacios normalizados,
+    palabras clave en minúsculas y literales de listas IN ordenados.
+    """
+    tokens = _sort_in_lists(_tokenize(sql_query))
+    return " ".join(value for _, value in tokens)
+
+
+def sql_fingerprint(sql_query):
+    """Hash estable de la forma canónica de la consulta."""
+    return hashlib.sha256(canonicalize_sql(sql_query).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Caché de DataFrames en ficheros Parquet con presupuesto de bytes y desalojo LRU.
+
+    El índice vive en SQLite junto a los ficheros, de modo que la caché se comparte
+    entre sesiones de Streamlit y sobrevive a reinicios del servidor. Se vacía si
+    cambia el texto del esquema (`schema_text`) y, con `ttl`, cada resultado caduca
+    a los `ttl` segundos de guardarse.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, schema_text=None, ttl=None):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.schema_version = schema_text and hashlib.sha256(schema_text.encode("utf-8")).hexdigest()
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.directory / "index.sqlite"), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    bytes_processed INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+                INSERT OR IGNORE INTO stats VALUES
+                    ('hits', 0), ('misses', 0), ('bytes_saved', 0);
+                """
+            )
+            if self.schema_version is not None:
+                row = self._conn.execute(
+                    "SELECT value FROM meta WHERE name = 'schema_version'"
+                ).fetchone()
+                if row is None or row[0] != self.schema_version:
+                    for (key,) in self._conn.execute("SELECT key FROM results").fetchall():
+                        self._path(key).unlink(missing_ok=True)
+                    self._conn.execute("DELETE FROM results")
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)",
+                        (self.schema_version,),
+                    )
+
+    def _path(self, key):
+        return self.directory / f"{key}.parquet"
+
+    def _fresh(self, key):
+        """Si el fichero de `key` existe y no ha caducado (su fecha es la del último `put`)."""
+        try:
+            saved = self._path(key).stat().st_mtime
+        except OSError:
+            return False
+        return self.ttl is None or time.time() - saved <= self.ttl
+
+    def _add(self, name, amount=1):
+        self._conn.execute(
+            "UPDATE stats SET value = value + ? WHERE name = ?", (amount, name)
+        )
+
+    def contains(self, sql_query):
+        """Indica si la consulta está cacheada, sin afectar a los contadores ni al LRU."""
+        key = sql_fingerprint(sql_query)
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+        return row is not None and self._fresh(key)
+
+    def get(self, sql_query):
+        """Devuelve el DataFrame cacheado para la consulta, o None si no está."""
+        key = sql_fingerprint(sql_query)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT bytes_processed FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or not self._fresh(key):
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._path(key).unlink(missing_ok=True)
+                self._add("misses")
+                return None
+            self._conn.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._add("hits")
+            self._add("bytes_saved", row[0])
+
+        try:
+            return pd.read_parquet(self._path(key))
+        except Exception:
+            # Fichero corrupto o borrado por otro proceso: se trata como fallo
+            self.invalidate(sql_query)
+            return None
+
+    def put(self, sql_query, df, bytes_processed=0):
+        """Guarda el resultado de la consulta. Devuelve True si cabe en el presupuesto."""
+        key = sql_fingerprint(sql_query)
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            df.to_parquet(tmp_path, index=False)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            return False
+
+        size = tmp_path.stat().st_size
+        if size > self.max_bytes:
+            tmp_path.unlink(missing_ok=True)
+            return False
+
+        os.replace(tmp_path, path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, size, int(bytes_processed or 0), time.time()),
+            )
+            self._evict()
+        return True
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM results ORDER BY last_used ASC"
+        ).fetchall():
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._path(key).unlink(missing_ok=True)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def invalidate(self, sql_query):
+        key = sql_fingerprint(sql_query)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+        self._path(key).unlink(missing_ok=True)
+
+    def stats(self):
+        """Aciertos, fallos, bytes de BigQuery ahorrados y ocupación en disco."""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM stats"))
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+        return {**counters, "entries": entries, "size_bytes": size}
@@ -0,0 +1,326 @@
+"""Esquema de las tablas leído de sus metadatos, cacheado en disco y podado por pregunta"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from sql_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Sube al cambiar el formato del fichero: las instantáneas anteriores se descartan
+SCHEMA_FORMAT_VERSION = 1
+# "nombre (TIPO) - descripción" en la lista de campos de la tabla
+_FIELD_RE = re.compile(r"^\s*(\w+)\s*\((\w+)\)\s*(?:-\s*(.*))?$")
+_TOKEN_RE = re.compile(r"[a-z][a-z0-9]*")
+_WORD_RE = re.compile(r"\w+")
+# Peso de una palabra según dónde aparece en la columna
+NAME_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+# Las columnas con menos de esta fracción de la mejor puntuación se descartan
+RELATIVE_SCORE = 0.35
+
+_STOPWORDS = {
+    "a", "al", "con", "cual", "cuales", "cuanto", "cuantos", "cuantas", "de", "del", "desde",
+    "donde", "e", "el", "en", "entre", "es", "esta", "este", "hasta", "la", "las", "lo",
+    "los", "mas", "muestra", "o", "para", "por", "que", "se", "si", "sin", "sobre", "su",
+    "sus", "un", "una", "y", "ejemplo", "dato", "numero", "total", "cantidad", "dame",
+    "an", "and", "as", "at", "by", "for", "from", "in", "is", "it", "of", "on", "or",
+    "the", "to", "was", "with", "true", "false", "if", "this", "that", "number",
+}
+
+# Palabras de las preguntas -> palabras de los nombres de columna (en inglés)
+SYNONYMS = {
+    "peso": ["weight"], "pesa": ["weight"], "pesan": ["weight"], "libra": ["pound"],
+    "kilo": ["weight"], "madre": ["mother"], "mama": ["mother"], "materna": ["mother"],
+    "materno": ["mother"], "padre": ["father"], "papa": ["father"], "paterna": ["father"],
+    "paterno": ["father"], "edad": ["age"], "adolescente": ["age"], "joven": ["age"],
+    "ano": ["year"], "anual": ["year"], "tendencia": ["year"], "evolucion": ["year"],
+    "decada": ["year"], "mes": ["month"], "mese": ["month"], "mensual": ["month"],
+    "dia": ["day", "wday"], "estado": ["state"], "region": ["state"], "pais": ["state"],
+    "gestacion": ["gestation"], "prematuro": ["gestation"], "semana": ["week"],
+    "embarazo": ["gestation", "plurality"], "gemelo": ["plurality"], "mellizo": ["plurality"],
+    "trillizo": ["plurality"], "multiple": ["plurality"], "varon": ["male"],
+    "nino": ["male"], "nina": ["male"], "sexo": ["male"], "genero": ["male"],
+    "masculino": ["male"], "femenino": ["male"], "raza": ["race"], "etnia": ["race"],
+    "casada": ["married"], "soltera": ["married"], "matrimonio": ["married"],
+    "fumar": ["cigarette"], "fumadora": ["cigarette"], "fuma": ["cigarette"],
+    "tabaco": ["cigarette"], "cigarrillo": ["cigarette"], "alcohol": ["alcohol", "drink"],
+    "bebida": ["drink"], "hijo": ["born"], "vivo": ["alive"], "muerto": ["dead"],
+    "fallecido": ["dead"], "aumento": ["gain"], "ganancia": ["gain"], "engorde": ["gain"],
+    "residencia": ["residence"], "reside": ["residence"], "ponderado": ["record"],
+    "registro": ["record"], "muestreo": ["record"], "menstrual": ["lmp"],
+    "menor": ["age"], "mayor": ["age"], "boy": ["male"], "girl": ["male"],
+}
+
+
+def table_name(table_id):
+    """Nombre corto de una tabla (`proyecto.dataset.tabla` -> `tabla`)."""
+    return table_id.split(".")[-1].replace("`", "")
+
+
+def parse_field(field):
+    """(nombre, tipo, descripción) de una línea "nombre (TIPO) - descripción"."""
+    match = _FIELD_RE.match(field)
+    if not match:
+        return None
+    return match.group(1), match.group(2), match.group(3) or ""
+
+
+def _stem(token):
+    # Plurales sencillos en español e inglés: "madres" -> "madre", "weeks" -> "week"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Palabras normalizadas (sin tildes, en minúsculas y en singular) de un texto."""
+    normalized = unicodedata.normalize("NFKD", text.replace("_", " "))
+    text = "".join(c for c in normalized if not unicodedata.combining(c)).lower()
+    return [
+        _stem(token) for token in _TOKEN_RE.findall(text)
+        if token not in _STOPWORDS and len(token) > 1
+    ]
+
+
+_SYNONYMS = {_stem(tokenize(word)[0]): targets for word, targets in SYNONYMS.items()}
+# Las claves largas también valen como raíz: "fuman" -> "fuma", "menores" -> "menor"
+_SYNONYM_STEMS = sorted((key for key in _SYNONYMS if len(key) >= 4), key=len, reverse=True)
+
+
+def expand_synonyms(token):
+    """Palabras de columna equivalentes a una palabra de la pregunta."""
+    if token in _SYNONYMS:
+        return _SYNONYMS[token]
+    for key in _SYNONYM_STEMS:
+        if token.startswith(key):
+            return _SYNONYMS[key]
+    return ()
+
+
+def fetch_table_schema(client, table_id, annotations=None):
+    """
+    Esquema de una tabla a partir de `client.get_table` (metadatos, sin coste). Las
+    descripciones curadas de `annotations` se prefieren a las de los metadatos, que se
+    guardan aparte para el índice porque suelen estar en inglés.
+    """
+    table = client.get_table(table_id)
+    curated = {}
+    for field in (annotations or {}).get("campos", []):
+        parsed = parse_field(field)
+        if parsed:
+            curated[parsed[0].lower()] = parsed[2]
+    campos, originales = [], {}
+    for field in table.schema:
+        original = (field.description or "").strip()
+        description = curated.get(field.name.lower()) or original
+        campos.append(f"{field.name} ({field.field_type})" + (f" - {description}" if description else ""))
+        if original and original != description:
+            originales[field.name] = original
+    return {
+        "id": table_id,
+        "descripcion": (annotations or {}).get("descripcion") or table.description or "",
+        "campos": campos,
+        "originales": originales,
+        "num_rows": table.num_rows,
+    }
+
+
+class SchemaCatalog:
+    """
+    Esquemas de las tablas del dataset en un fichero JSON versionado. Se leen de los
+    metadatos como mucho una vez cada `ttl` segundos; sin conexión valen los del último
+    arranque y, si no hay ninguno, las descripciones curadas de `annotations`.
+    """
+
+    def __init__(self, path, ttl=24 * 3600, annotations=None):
+        self.path = path
+        self.ttl = ttl
+        self.annotations = annotations or {}
+        self._lock = threading.Lock()
+        self._set(self._read())
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("format") != SCHEMA_FORMAT_VERSION:
+            return None
+        return data
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _set(self, data):
+        self._data = data
+        tables = self.tables()
+        text = json.dumps(tables, sort_keys=True, ensure_ascii=False)
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def table_ids(self):
+        """Tablas que listó la última conexión (vacío si no hay instantánea)."""
+        return list(self._data["tables"]) if self._data else []
+
+    def tables(self):
+        """{tabla: {"descripcion", "campos", ...}} vigente."""
+        if self._data and self._data.get("schemas"):
+            return self._data["schemas"]
+        return self.annotations
+
+    def is_fresh(self, table_ids):
+        data = self._data
+        return bool(data) and (
+            list(data["tables"]) == list(table_ids)
+            and time.time() - data["saved_at"] < self.ttl
+        )
+
+    def refresh(self, client, table_ids, force=False):
+        """
+        Relee los metadatos de las tablas si la instantánea caducó o la lista cambió y
+        la guarda en disco. Devuelve True si el esquema cambió de versión.
+        """
+        with self._lock:
+            if not force and self.is_fresh(table_ids):
+                return False
+            previous = self.tables()
+            schemas = {}
+            for table_id in table_ids:
+                name = table_name(table_id)
+                try:
+                    schemas[name] = fetch_table_schema(client, table_id, self.annotations.get(name))
+                except Exception as e:
+                    logger.warning("No se pudo leer el esquema de %s: %s", table_id, e)
+                    if name in previous:
+                        schemas[name] = previous[name]
+            data = {
+                "format": SCHEMA_FORMAT_VERSION,
+                "tables": list(table_ids),
+                "schemas": schemas,
+                "saved_at": time.time(),
+            }
+            old_version = self.version
+            try:
+                self._write(data)
+            except OSError as e:
+                logger.warning("No se pudo guardar el esquema en %s: %s", self.path, e)
+            self._set(data)
+            return self.version != old_version
+
+
+class SchemaIndex:
+    """
+    Índice local de palabras clave y sinónimos (español/inglés) sobre las columnas de
+    las tablas. Elige las columnas y tablas que una pregunta necesita para que el
+    prompt no lleve el esquema completo.
+    """
+
+    def __init__(self, tables, core_columns=("year",), default_table="natality"):
+        self.tables = tables
+        self.core_columns = {column.lower() for column in core_columns}
+        # Tabla que se envía entera si la pregunta no coincide con ninguna columna
+        self.default_table = default_table
+        self.columns = []
+        document_frequency = {}
+        for table, info in tables.items():
+            originales = info.get("originales", {})
+            for position, field in enumerate(info["campos"]):
+                parsed = parse_field(field)
+                if not parsed:
+                    continue
+                name, _, description = parsed
+                weights = {}
+                for token in tokenize(f"{description} {originales.get(name, '')}"):
+                    weights[token] = DESCRIPTION_WEIGHT
+                for token in tokenize(name):
+                    weights[token] = NAME_WEIGHT
+                for token in weights:
+                    document_frequency[token] = document_frequency.get(token, 0) + 1
+                self.columns.append((table, position, name.lower(), field, weights))
+            for token in set(tokenize(f"{table} {info.get('descripcion', '')}")):
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        total = max(1, len(self.columns))
+        self.idf = {
+            token: math.log(1 + total / count) for token, count in document_frequency.items()
+        }
+
+    def _query_tokens(self, question):
+        # Los años y los estados ("Texas", "CA") se reconocen como en la caché de SQL
+        _, literals = normalize_question(question)
+        tokens = {kind for kind, _ in literals if kind != "num"}
+        for token in tokenize(question):
+            tokens.add(token)
+            tokens.update(expand_synonyms(token))
+        return tokens
+
+    def score(self, question):
+        """
+        [(puntuación, tabla, columna, en_el_nombre)] de las columnas que comparten
+        palabras con la pregunta, de mayor a menor puntuación.
+        """
+        tokens = self._query_tokens(question)
+        # Palabras enteras: "id" no está en "nacidos" ni "da" en "edad"
+        words = set(_WORD_RE.findall(question.lower()))
+        scores = []
+        for table, _, name, _, weights in self.columns:
+            shared = tokens & weights.keys()
+            score = sum(weights[token] * self.idf[token] for token in shared)
+            named = name in words
+            in_name = any(weights[token] == NAME_WEIGHT for token in shared) or named
+            # Nombrar la columna tal cual la pone la primera
+            if named:
+                score += 10 * NAME_WEIGHT
+            if score > 0:
+                scores.append((score, table, name, in_name))
+        return sorted(scores, reverse=True)
+
+    def select(self, question, tables=None, max_columns=12):
+        """
+        {tabla: [campos]} con las columnas relevantes, en el orden del esquema. Si la
+        pregunta no coincide con ninguna columna se devuelve completa solo la tabla por
+        defecto (o la primera candidata si no está entre ellas).
+        """
+        candidates = [table for table in (tables or self.tables) if table in self.tables]
+        scores = [entry for entry in self.score(question) if entry[1] in candidates]
+        if not scores:
+            if not candidates:
+                return {}
+            table = self.default_table if self.default_table in candidates else candidates[0]
+            return {table: list(self.tables[table]["campos"])}
+        # Las coincidencias en el nombre de la columna siempre cuentan; las que solo
+        # están en la descripción, si se acercan a la mejor
+        threshold = scores[0][0] * RELATIVE_SCORE
+        ranked = [
+            (table, name) for score, table, name, in_name in scores
+            if in_name or score >= threshold
+        ]
+        chosen = set(ranked[:max_columns])
+        # Las columnas que van siempre (`year`) no bastan para traer una tabla más
+        selected_tables = {table for table, name in chosen if name not in self.core_columns}
+        if not selected_tables:
+            tables_chosen = [table for table, _ in ranked[:max_columns]]
+            selected_tables = {
+                self.default_table if self.default_table in tables_chosen else tables_chosen[0]
+            }
+        selection = {}
+        for table, _, name, field, _ in self.columns:
+            if table not in selected_tables:
+                continue
+            if (table, name) in chosen or name in self.core_columns:
+                selection.setdefault(table, []).append(field)
+        return selection
@@ -0,0 +1,135 @@
+"""Agrupación de peticiones idénticas en curso (single-flight) compartida por todas las sesiones"""
+
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+class _SharedStream:
+    """Fragmentos de un iterador que varios consumidores leen desde el principio."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def pump(self, make_iterator):
+        try:
+            for chunk in make_iterator():
+                with self.cond:
+                    self.chunks.append(chunk)
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def read(self, timeout=None):
+        position = 0
+        while True:
+            with self.cond:
+                if position >= len(self.chunks) and not self.done:
+                    if not self.cond.wait_for(
+                        lambda: position < len(self.chunks) or self.done, timeout
+                    ):
+                        raise TimeoutError("Tiempo de espera agotado en una petición compartida")
+                if position < len(self.chunks):
+                    chunk = self.chunks[position]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            position += 1
+            yield chunk
+
+
+class _LeaderInterrupted(Exception):
+    """El líder dejó de esperar sin error propio (su sesión pasó a otra pregunta o se cerró)."""
+
+
+class SingleFlight:
+    """
+    Ejecuta una sola vez el trabajo de las peticiones con la misma clave que coinciden
+    en el tiempo. La primera (líder) lo ejecuta y las demás esperan su resultado; los
+    errores del líder se propagan a todas. Al terminar la clave se libera, así que no
+    actúa como caché: las peticiones posteriores vuelven a ejecutarse.
+
+    El resultado que devuelve `fn` se comparte tal cual: si depende de quién la llamó
+    (p. ej. su sesión canceló el trabajo), `fn` debe lanzar una de las excepciones de
+    `retry_on` para que los seguidores lo repitan en vez de recibirlo.
+    """
+
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn, retry_on=()):
+        """
+        Devuelve `(resultado, compartido)`. Si el líder no termina en `timeout` segundos,
+        se interrumpe o lanza una excepción de `retry_on`, el seguidor deja de esperar y
+        ejecuta `fn` por su cuenta.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            try:
+                return future.result(timeout=self.timeout), True
+            except (FutureTimeoutError, _LeaderInterrupted):
+                return fn(), False
+
+        try:
+            result = fn()
+        except BaseException as e:
+            # Una interrupción del líder no es un error del trabajo: los seguidores lo repiten
+            shared_error = isinstance(e, Exception) and not isinstance(e, retry_on)
+            future.set_exception(e if shared_error else _LeaderInterrupted())
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stream(self, key, executor, make_iterator):
+        """
+        Versión en streaming de `do`: el líder consume `make_iterator()` en el pool y
+        todas las peticiones con la misma clave reciben los mismos fragmentos desde el
+        principio, a medida que llegan.
+        """
+        with self._lock:
+            shared = self._inflight.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._inflight[key] = _SharedStream()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            def pump():
+                try:
+                    shared.pump(make_iterator)
+                finally:
+                    with self._lock:
+                        self._inflight.pop(key, None)
+
+            executor.submit(pump)
+        return shared.read(self.timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "shared": self.shared, "inflight": len(self._inflight)}
@@ -0,0 +1,262 @@
+"""Caché persistente de plantillas pregunta -> SQL"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+# Estados de EE.UU. (nombres en inglés y español, sin tildes) -> abreviatura postal
+US_STATES = {
+    "alabama": "AL", "alaska": "AK", "arizona": "AZ", "arkansas": "AR",
+    "california": "CA", "colorado": "CO", "connecticut": "CT", "delaware": "DE",
+    "district of columbia": "DC", "distrito de columbia": "DC",
+    "florida": "FL", "georgia": "GA", "hawaii": "HI", "hawai": "HI",
+    "idaho": "ID", "illinois": "IL", "indiana": "IN", "iowa": "IA",
+    "kansas": "KS", "kentucky": "KY", "louisiana": "LA", "luisiana": "LA",
+    "maine": "ME", "maryland": "MD", "massachusetts": "MA", "michigan": "MI",
+    "minnesota": "MN", "mississippi": "MS", "misisipi": "MS", "missouri": "MO",
+    "misuri": "MO", "montana": "MT", "nebraska": "NE", "nevada": "NV",
+    "new hampshire": "NH", "nuevo hampshire": "NH", "new jersey": "NJ",
+    "nueva jersey": "NJ", "new mexico": "NM", "nuevo mexico": "NM",
+    "new york": "NY", "nueva york": "NY", "north carolina": "NC",
+    "carolina del norte": "NC", "north dakota": "ND", "dakota del norte": "ND",
+    "ohio": "OH", "oklahoma": "OK", "oregon": "OR", "pennsylvania": "PA",
+    "pensilvania": "PA", "rhode island": "RI", "south carolina": "SC",
+    "carolina del sur": "SC", "south dakota": "SD", "dakota del sur": "SD",
+    "tennessee": "TN", "texas": "TX", "utah": "UT", "vermont": "VT",
+    "virginia": "VA", "washington": "WA", "west virginia": "WV",
+    "virginia occidental": "WV", "wisconsin": "WI", "wyoming": "WY",
+}
+STATE_CODES = set(US_STATES.values())
+
+# Los nombres compuestos van primero para que "west virginia" no se lea como "virginia"
+_STATE_NAME_RE = re.compile(
+    r"\b("
+    + "|".join(re.escape(name) for name in sorted(US_STATES, key=len, reverse=True))
+    + r")\b"
+)
+# Nombres de estado que también son palabras corrientes («la nevada», «pelo colorado»):
+# solo cuentan tras una palabra de lugar («en Nevada», «estado de Florida») o si el
+# usuario los escribió con mayúscula
+_AMBIGUOUS_STATES = {"colorado", "florida", "indiana", "montana", "nevada"}
+_STATE_CONTEXT = {
+    "en", "de", "del", "estado", "estados", "y", "e", "o", "u", "vs", "versus",
+    "contra", "entre", "para", "a",
+}
+_STATE_CODE_RE = re.compile(r"\b([A-Z]{2})\b")
+_LITERAL_RE = re.compile(r"__state_[a-z]{2}__|(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+_YEAR_RE = re.compile(r"^(19|20)\d{2}$")
+
+
+def _strip_accents(text):
+    # La ñ se conserva: «montaña» no es «montana» (Montana)
+    return "".join(
+        c if c in "ñÑ" else "".join(
+            d for d in unicodedata.normalize("NFKD", c) if not unicodedata.combining(d)
+        )
+        for c in unicodedata.normalize("NFC", text)
+    )
+
+
+def _state_name(match, question):
+    """Marcador del estado encontrado, o el texto tal cual si es una palabra corriente."""
+    name = match.group(1)
+    if name in _AMBIGUOUS_STATES:
+        previous = match.string[:match.start()].split()[-1:]
+        capitalized = re.search(rf"\b{name.title()}\b", question)
+        if not (previous and previous[0] in _STATE_CONTEXT) and not capitalized:
+            return name
+    return f"__state_{US_STATES[name].lower()}__"
+
+
+def normalize_question(question):
+    """
+    Normaliza una pregunta extrayendo sus literales (años, estados y números).
+
+    Devuelve la pregunta con marcadores ({year}, {state}, {num}) y la lista
+    ordenada de literales como tuplas (tipo, valor).
+    """
+    # Las abreviaturas solo cuentan si el usuario las escribió en mayúsculas
+    text = _STATE_CODE_RE.sub(
+        lambda m: f" __state_{m.group(1)}__ " if m.group(1) in STATE_CODES else m.group(0),
+        question,
+    )
+    text = _strip_accents(text).lower()
+    text = re.sub(r"[¿?¡!,;:\"'()]|\.(?!\d)", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    text = _STATE_NAME_RE.sub(lambda m: _state_name(m, question), text)
+
+    literals = []
+
+    def replace(match):
+        token = match.group(0)
+        if token.startswith("__state_"):
+            literals.append(("state", token[8:10].upper()))
+            return "{state}"
+        if _YEAR_RE.match(token):
+            literals.append(("year", int(token)))
+            return "{year}"
+        value = float(token) if "." in token else int(token)
+        literals.append(("num", value))
+        return "{num}"
+
+    template = _LITERAL_RE.sub(replace, text)
+    return re.sub(r"\s+", " ", template).strip(), literals
+
+
+def _sql_literal(kind, value):
+    if kind == "state":
+        return f"'{value}'"
+    return str(value)
+
+
+def _literal_pattern(kind, value):
+    if kind == "state":
+        return re.compile(r"(['\"])" + re.escape(value) + r"\1")
+    return re.compile(r"(?<![\w.@])" + re.escape(str(value)) + r"(?![\w.])")
+
+
+def build_template(sql_query, literals):
+    """
+    Convierte la SQL generada en una plantilla con parámetros de BigQuery (@p0, @p1...).
+
+    Devuelve None si algún literal de la pregunta no aparece de forma inequívoca
+    en la SQL, porque entonces no se podría volver a enlazar con seguridad.
+    """
+    values = [value for _, value in literals]
+    if len(set(values)) != len(values):
+        return None
+
+    template = sql_query
+    for i, (kind, value) in enumerate(literals):
+        pattern = _literal_pattern(kind, value)
+        occurrences = len(pattern.findall(template))
+        # Un número genérico puede aparecer en otros contextos (ROUND(x, 2)...)
+        if occurrences == 0 or (kind == "num" and occurrences > 1):
+            return None
+        template = pattern.sub(f"@p{i}", template)
+    return template
+
+
+def bind_template(template, literals):
+    """
+    Enlaza los literales de la nueva pregunta en una plantilla almacenada.
+
+    Los @pN se sustituyen en el texto en vez de pasarse como `ScalarQueryParameter`:
+    la validación, el cubo, la caché de resultados y los refinamientos trabajan sobre
+    la SQL literal. Es seguro porque los valores solo pueden ser números sacados por
+    la expresión regular o abreviaturas de `STATE_CODES`.
+    """
+    # Se sustituye en orden inverso para que @p1 no pise a @p10
+    sql_query = template
+    for i in reversed(range(len(literals))):
+        kind, value = literals[i]
+        sql_query = re.sub(rf"@p{i}(?!\d)", _sql_literal(kind, value), sql_query)
+    return sql_query
+
+
+class SQLTemplateCache:
+    """
+    Caché SQLite de plantillas SQL parametrizadas por pregunta normalizada.
+
+    Aplica expiración por TTL, desalojo LRU por número de entradas y se vacía
+    automáticamente cuando cambia el texto del esquema.
+    """
+
+    def __init__(self, path, schema_text, max_entries=1000, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.schema_version = hashlib.sha256(schema_text.encode("utf-8")).hexdigest()
+        self._lock = threading.Lock()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS templates (
+                    key TEXT PRIMARY KEY,
+                    kinds TEXT NOT NULL,
+                    sql_template TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+                INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0);
+                """
+            )
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE name = 'schema_version'"
+            ).fetchone()
+            if row is None or row[0] != self.schema_version:
+                self._conn.execute("DELETE FROM templates")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)",
+                    (self.schema_version,),
+                )
+
+    def _count(self, name):
+        self._conn.execute("UPDATE stats SET value = value + 1 WHERE name = ?", (name,))
+
+    def lookup(self, question):
+        """Devuelve la SQL enlazada para la pregunta, o None si no hay plantilla válida."""
+        key, literals = normalize_question(question)
+        kinds = ",".join(kind for kind, _ in literals)
+        now = time.time()
+
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT kinds, sql_template, created_at FROM templates WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None or row[0] != kinds:
+                self._count("misses")
+                return None
+            if now - row[2] > self.ttl:
+                self._conn.execute("DELETE FROM templates WHERE key = ?", (key,))
+                self._count("misses")
+                return None
+            self._conn.execute(
+                "UPDATE templates SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self._count("hits")
+
+        return bind_template(row[1], literals)
+
+    def store(self, question, sql_query):
+        """Guarda la SQL de una pregunta como plantilla. Devuelve True si se pudo cachear."""
+        key, literals = normalize_question(question)
+        template = build_template(sql_query, literals)
+        if template is None:
+            return False
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?, ?)",
+                (key, ",".join(kind for kind, _ in literals), template, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM templates WHERE created_at < ?", (now - self.ttl,)
+            )
+            # Desalojo LRU: se conservan solo las max_entries usadas más recientemente
+            self._conn.execute(
+                """
+                DELETE FROM templates WHERE key NOT IN (
+                    SELECT key FROM templates ORDER BY last_used DESC LIMIT ?
+                )
+                """,
+                (self.max_entries,),
+            )
+        return True
+
+    def stats(self):
+        """Contadores de aciertos/fallos y número de plantillas almacenadas."""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM stats"))
+            entries = self._conn.execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+        return {"hits": counters["hits"], "misses": counters["misses"], "entries": entries}
@@ -0,0 +1,164 @@
+"""Validación local de la SQL generada antes de enviarla a BigQuery"""
+
+import re
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+
+# Sentencias que nunca deben llegar a BigQuery desde el chat
+_FORBIDDEN_STATEMENTS = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop,
+    exp.Alter, exp.Command, exp.TruncateTable,
+)
+# "nombre (TIPO) - descripción" en la lista de campos de la tabla
+_FIELD_PATTERN = re.compile(r"^\s*(\w+)\s*\(")
+
+
+def schema_from_table_info(table_info, table_ids=()):
+    """
+    {proyecto.dataset.tabla: {columnas}} a partir de la estructura de
+    `get_natality_table_info`. El id completo sale de la propia tabla o de `table_ids`;
+    si no aparece en ninguno, la tabla queda con su nombre corto.
+    """
+    full_ids = {table_id.split(".")[-1].lower(): table_id for table_id in table_ids}
+    schema = {}
+    for table_name, info in table_info.items():
+        columns = set()
+        for field in info["campos"]:
+            match = _FIELD_PATTERN.match(field)
+            if match:
+                columns.add(match.group(1).lower())
+        table_id = info.get("id") or full_ids.get(table_name.lower(), table_name)
+        schema[table_id.replace("`", "").lower()] = columns
+    return schema
+
+
+def _table_id(table):
+    return ".".join(part.name for part in table.parts).lower()
+
+
+def _syntax_error(error):
+    details = error.errors[0] if getattr(error, "errors", None) else {}
+    description = details.get("description") or str(error).splitlines()[0]
+    if details.get("line"):
+        near = details.get("highlight") or ""
+        return (
+            f"Error de sintaxis en la línea {details['line']}, columna {details['col']}: "
+            f"{description}" + (f" (cerca de '{near}')" if near else "")
+        )
+    return f"Error de sintaxis: {description}"
+
+
+def has_aggregate(select):
+    """Si la SELECT agrega filas (agregados fuera de funciones de ventana y subconsultas)."""
+    if select.args.get("group"):
+        return True
+    for projection in select.expressions:
+        for node in projection.find_all(exp.AggFunc):
+            parent = node.parent
+            nested = False
+            while parent is not None and parent is not projection:
+                if isinstance(parent, (exp.Window, exp.Subquery, exp.Select)):
+                    nested = True
+                    break
+                parent = parent.parent
+            if not nested:
+                return True
+    return False
+
+
+class SQLValidator:
+    """
+    Comprueba la SQL con el parser de sqlglot en dialecto BigQuery: una única
+    sentencia de lectura, tablas y columnas que existen en el esquema y un LIMIT en
+    las consultas que devuelven filas sin agregar.
+    """
+
+    def __init__(self, schema, row_limit=10000):
+        self.schema = schema
+        self.row_limit = row_limit
+
+    def validate(self, sql_query):
+        """
+        Devuelve `(sql, errores)`. Si no hay errores, `sql` es la consulta lista para
+        ejecutar (con el LIMIT aplicado si hacía falta); si los hay, cada error es un
+        diagnóstico concreto para devolver al modelo.
+        """
+        try:
+            statements = [s for s in sqlglot.parse(sql_query, read="bigquery") if s is not None]
+        except ParseError as e:
+            return sql_query, [_syntax_error(e)]
+
+        if len(statements) != 1:
+            return sql_query, [f"Se esperaba una sola sentencia SELECT y hay {len(statements)}."]
+        tree = statements[0]
+        if isinstance(tree, _FORBIDDEN_STATEMENTS) or not isinstance(tree, exp.Query):
+            return sql_query, [
+                f"Solo se permiten consultas SELECT; la sentencia es {tree.key.upper()}."
+            ]
+        nested_statement = next(tree.find_all(*_FORBIDDEN_STATEMENTS), None)
+        if nested_statement is not None:
+            return sql_query, [
+                f"La consulta contiene una sentencia {nested_statement.key.upper()} no permitida."
+            ]
+
+        # Las columnas solo se pueden resolver contra tablas que existen
+        errors = self._check_tables(tree) or self._check_columns(tree)
+        if errors:
+            return sql_query, errors
+        return self._enforce_limit(sql_query, tree), []
+
+    def _check_tables(self, tree):
+        # Se compara el id completo: `otroproyecto.otrodataset.natality` no es la tabla del esquema
+        cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+        errors = []
+        for table in tree.find_all(exp.Table):
+            name = table.name.lower()
+            if not name or (name in cte_names and len(table.parts) == 1):
+                continue
+            if _table_id(table) not in self.schema:
+                known = ", ".join(f"`{table_id}`" for table_id in sorted(self.schema))
+                errors.append(f"La tabla '{table.sql(dialect='bigquery')}' no existe; usa: {known}.")
+        return errors
+
+    def _check_columns(self, tree):
+        # Columnas de cada tabla del esquema citada en la consulta, por su alias y su nombre
+        referenced = {}
+        for table in tree.find_all(exp.Table):
+            columns = self.schema.get(_table_id(table))
+            if columns is not None:
+                referenced[table.alias_or_name.lower()] = columns
+                referenced.setdefault(table.name.lower(), columns)
+        available = set().union(*referenced.values()) if referenced else set()
+        # Nombres válidos además del esquema: alias de columnas, tablas y CTE
+        defined = {alias.alias.lower() for alias in tree.find_all(exp.Alias)}
+        defined |= {alias.name.lower() for alias in tree.find_all(exp.TableAlias) if alias.name}
+        for table_alias in tree.find_all(exp.TableAlias):
+            defined |= {column.name.lower() for column in table_alias.columns}
+        unknown = []
+        for column in tree.find_all(exp.Column):
+            if isinstance(column.this, exp.Star):
+                continue
+            name = column.name.lower()
+            qualifier = column.table.lower()
+            if qualifier in referenced:
+                valid = name in referenced[qualifier]
+            else:
+                valid = name in available or name in defined
+            label = f"{qualifier}.{name}" if qualifier else name
+            if name and not valid and label not in unknown:
+                unknown.append(label)
+        return [f"La columna '{label}' no existe en el esquema." for label in unknown]
+
+    def _enforce_limit(self, sql_query, tree):
+        selects = [tree] if isinstance(tree, exp.Select) else list(tree.find_all(exp.Select))
+        if not selects or any(has_aggregate(select) for select in selects):
+            return sql_query
+        limit = tree.args.get("limit")
+        if limit is None:
+            return f"{sql_query.strip().rstrip(';').rstrip()}\nLIMIT {self.row_limit}"
+        value = limit.expression
+        if isinstance(value, exp.Literal) and value.is_int and int(value.this) > self.row_limit:
+            return tree.limit(self.row_limit).sql(dialect="bigquery", pretty=True)
+        return sql_query
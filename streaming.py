@@ -0,0 +1,110 @@
+"""Descarga de resultados por lotes Arrow con límite de filas/bytes y volcado a disco"""
+
+import time
+import uuid
+from pathlib import Path
+
+import db_dtypes
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columnas de texto con pocos valores distintos (state, etc.) se guardan como categóricas
+CATEGORY_MAX_RATIO = 0.5
+
+
+def _types_mapper(arrow_type):
+    """Tipos pandas compactos y con nulos para cada tipo Arrow de BigQuery."""
+    if pa.types.is_integer(arrow_type):
+        return pd.Int64Dtype()
+    if pa.types.is_boolean(arrow_type):
+        return pd.BooleanDtype()
+    if pa.types.is_date32(arrow_type):
+        return db_dtypes.DateDtype()
+    if pa.types.is_time64(arrow_type):
+        return db_dtypes.TimeDtype()
+    return None
+
+
+def to_compact_dataframe(table):
+    """Convierte una tabla Arrow en un DataFrame con dtypes compactos."""
+    df = table.to_pandas(types_mapper=_types_mapper)
+    for column in df.select_dtypes(include=["object", "string"]).columns:
+        values = df[column].dropna()
+        if len(values) and values.map(type).eq(str).all():
+            if values.nunique() <= max(len(values) * CATEGORY_MAX_RATIO, 1):
+                df[column] = df[column].astype("category")
+    return df
+
+
+def new_spill_path(directory):
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    return path / f"{uuid.uuid4().hex}.parquet"
+
+
+def cleanup_spill_dir(directory, max_age):
+    """Borra los resultados volcados a disco con más de max_age segundos."""
+    path = Path(directory)
+    if not path.exists():
+        return
+    limit = time.time() - max_age
+    for spill_file in path.glob("*.parquet"):
+        try:
+            if spill_file.stat().st_mtime < limit:
+                spill_file.unlink()
+        except OSError:
+            pass
+
+
+def stream_query_result(
+    query_job, spill_path, max_rows, max_bytes, page_size=10_000, on_first_page=None
+):
+    """
+    Descarga el resultado de un job página a página como lotes Arrow.
+
+    Cada lote se escribe en `spill_path` (Parquet) según llega y la descarga se corta
+    al alcanzar `max_rows` filas o `max_bytes` bytes. `on_first_page` recibe el primer
+    lote ya convertido para poder mostrarlo antes de que termine la descarga.
+
+    Devuelve el DataFrame compacto con las filas descargadas; `df.attrs` incluye
+    `total_rows`, `truncated` y `result_path`.
+    """
+    rows = query_job.result(page_size=page_size)
+    batches = []
+    writer = None
+    num_rows = 0
+    num_bytes = 0
+    truncated = False
+
+    try:
+        for batch in rows.to_arrow_iterable():
+            if num_rows + batch.num_rows > max_rows:
+                batch = batch.slice(0, max_rows - num_rows)
+                truncated = True
+            if writer is None:
+                writer = pq.ParquetWriter(str(spill_path), batch.schema)
+            writer.write_batch(batch)
+            batches.append(batch)
+
+            if on_first_page is not None and num_rows == 0 and batch.num_rows:
+                on_first_page(to_compact_dataframe(pa.Table.from_batches([batch])))
+
+            num_rows += batch.num_rows
+            num_bytes += batch.nbytes
+            if truncated or num_bytes >= max_bytes:
+                truncated = truncated or num_rows < (rows.total_rows or 0)
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if batches:
+        df = to_compact_dataframe(pa.Table.from_batches(batches))
+    else:
+        df = pd.DataFrame(columns=[field.name for field in rows.schema])
+
+    df.attrs["total_rows"] = rows.total_rows if rows.total_rows is not None else num_rows
+    df.attrs["truncated"] = truncated
+    df.attrs["result_path"] = str(spill_path) if writer is not None else None
+    return df
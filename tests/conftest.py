@@ -0,0 +1,93 @@
+"""Configuración común: cachés del pipeline en un directorio temporal y sin trazas"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlglot
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# El pipeline lee su configuración del entorno al importarse
+_CACHE_DIR = Path(tempfile.mkdtemp(prefix="tests_cache_"))
+os.environ["TRACE_SAMPLE_RATE"] = "0"
+for name, path in (
+    ("SQL_CACHE_PATH", "sql_templates.sqlite"), ("RESULT_CACHE_DIR", "results"),
+    ("SPILL_DIR", "spill"), ("CUBE_PATH", "sin_cubo.parquet"),
+    ("SCHEMA_SNAPSHOT_PATH", "schema_snapshot.json"), ("FEW_SHOT_PATH", "sql_examples.jsonl"),
+    ("HISTORY_DIR", "history"),
+):
+    os.environ[name] = str(_CACHE_DIR / path)
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    """El módulo `pipeline` con todas sus cachés vacías en `tmp_path`."""
+    import pipeline
+    from benchmarks.bench_pipeline import reset_pipeline
+
+    reset_pipeline(pipeline, tmp_path)
+    return pipeline
+
+
+@pytest.fixture(scope="session")
+def natality():
+    """Tabla de natalidad sintética con todas las dimensiones del cubo y algunos nulos."""
+    from benchmarks.bench_approx import synthetic_natality
+    from sql_cache import STATE_CODES
+
+    rng = np.random.default_rng(1)
+    df = synthetic_natality(20_000, seed=1).drop(columns="record_weight")
+    df["state"] = df["state"].cat.rename_categories(sorted(STATE_CODES)[:df["state"].cat.categories.size])
+    df["state"] = df["state"].astype(object).where(df["year"] % 17 != 0, None)
+    df["plurality"] = rng.choice([1, 1, 1, 1, 1, 1, 1, 1, 2, 3], len(df))
+    df["gestation_weeks"] = pd.array(rng.integers(30, 43, len(df)), dtype="Int64")
+    df.loc[df.index % 23 == 0, "gestation_weeks"] = pd.NA
+    df.loc[df.index % 31 == 0, "weight_pounds"] = np.nan
+    return df
+
+
+@pytest.fixture(scope="session")
+def run_sql(natality):
+    """Ejecuta SQL de BigQuery sobre `natality` en DuckDB, como la consulta completa."""
+    duckdb = pytest.importorskip("duckdb")
+    connection = duckdb.connect()
+    connection.execute('ATTACH \':memory:\' AS "bigquery-public-data"')
+    connection.execute('CREATE SCHEMA "bigquery-public-data".samples')
+    connection.register("source", natality)
+    connection.execute('CREATE TABLE "bigquery-public-data".samples.natality AS SELECT * FROM source')
+    connection.unregister("source")
+
+    def run(sql_query):
+        return connection.cursor().execute(
+            sqlglot.transpile(sql_query, read="bigquery", write="duckdb")[0]
+        ).df()
+
+    return run
+
+
+def assert_same_result(local, remote):
+    pd.testing.assert_frame_equal(
+        local.reset_index(drop=True), remote.reset_index(drop=True),
+        check_dtype=False, check_exact=False, rtol=1e-9,
+    )
+
+
+@pytest.fixture
+def ask(pipeline):
+    """`ask(pregunta, cliente_gemini, cliente_bigquery, **kwargs)`: un turno de `process_query`."""
+    tables_info = ["bigquery-public-data.samples.natality"]
+    tables_context = pipeline.build_tables_context(tables_info)
+
+    def ask(question, gemini_client, bigquery_client, **kwargs):
+        return pipeline.process_query(
+            question, kwargs.pop("gemini_api_key", None), bigquery_client, tables_info, tables_context,
+            gemini=(gemini_client, pipeline.default_model_config()), **kwargs,
+        )
+
+    return ask
@@ -0,0 +1,220 @@
+import pytest
+import sqlglot
+from sqlglot import exp
+
+from approx import apply_error_bounds, approximate_query
+
+TABLE = "`bigquery-public-data.samples.natality`"
+ROWS = 1_000_000
+PERCENT = 10
+SEED = 42
+
+
+def parsed(approximation):
+    return sqlglot.parse_one(approximation.sql, read="bigquery")
+
+
+def windows_in(tree, clause):
+    node = tree.args.get(clause)
+    return [] if node is None else list(node.find_all(exp.Window))
+
+
+@pytest.mark.parametrize("sql_query", [
+    f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state HAVING COUNT(*) > 100",
+    f"SELECT state, COUNT(*) AS n FROM {TABLE} WHERE year > 2000 GROUP BY state HAVING COUNT(*) > 100",
+])
+def test_estimador_de_razon_lleva_el_having_a_qualify(sql_query):
+    approximation = approximate_query(sql_query, 5, table_rows=ROWS)
+    tree = parsed(approximation)
+
+    assert approximation.table_rows == ROWS
+    assert tree.args.get("having") is None
+    # El umbral se compara con el recuento escalado por las filas muestreadas
+    threshold = next(
+        node for node in tree.args["qualify"].find_all(exp.GT) if node.expression.this == "100"
+    )
+    assert threshold.this.find(exp.Window) is not None
+
+
+def test_having_con_alias_compara_la_columna_escalada():
+    sql_query = (
+        f"SELECT state, SUM(record_weight) AS n FROM {TABLE} GROUP BY state "
+        "HAVING n > 100 AND AVG(mother_age) > 20"
+    )
+    tree = parsed(approximate_query(sql_query, 5, table_rows=ROWS))
+
+    assert tree.args.get("having") is None
+    assert tree.args["qualify"].this.sql(dialect="bigquery") == "n > 100 AND AVG(mother_age) > 20"
+    assert tree.expressions[1].this.find(exp.Window) is not None
+
+
+def test_where_y_having_se_combinan_en_qualify():
+    sql_query = f"SELECT state, COUNT(*) AS n FROM {TABLE} WHERE year > 2000 GROUP BY state HAVING COUNT(*) > 100"
+    tree = parsed(approximate_query(sql_query, 5, table_rows=ROWS))
+
+    assert tree.args.get("where") is None
+    conditions = list(tree.args["qualify"].this.flatten())
+    assert len(conditions) == 2
+    assert conditions[0].sql(dialect="bigquery") == "COUNTIF(year > 2000) > 0"
+
+
+def test_qualify_existente_usa_el_escalado_nominal():
+    sql_query = (
+        f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state HAVING COUNT(*) > 100 "
+        "QUALIFY RANK() OVER (ORDER BY COUNT(*) DESC) <= 5"
+    )
+    approximation = approximate_query(sql_query, 5, table_rows=ROWS)
+    tree = parsed(approximation)
+
+    assert approximation.table_rows is None
+    assert windows_in(tree, "having") == []
+    assert tree.args["having"].sql(dialect="bigquery") == "HAVING ROUND(COUNT(*) * 20) > 100"
+
+
+def test_having_sin_group_by_usa_el_escalado_nominal():
+    sql_query = f"SELECT COUNT(*) AS n FROM {TABLE} HAVING COUNT(*) > 100"
+    approximation = approximate_query(sql_query, 5, table_rows=ROWS)
+    tree = parsed(approximation)
+
+    assert approximation.table_rows is None
+    assert tree.args.get("qualify") is None
+    assert windows_in(tree, "having") == []
+
+
+@pytest.mark.parametrize("sql_query", [
+    f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state HAVING COUNT(*) > 100",
+    f"SELECT year, AVG(weight_pounds) AS peso FROM {TABLE} WHERE state = 'CA' GROUP BY year HAVING COUNT(*) > 10",
+    f"SELECT COUNT(*) AS n FROM {TABLE} HAVING COUNT(*) > 100",
+    f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state HAVING COUNT(*) > 1 QUALIFY RANK() OVER (ORDER BY COUNT(*)) < 3",
+])
+@pytest.mark.parametrize("table_rows", [None, ROWS])
+def test_nunca_hay_funciones_analiticas_en_having(sql_query, table_rows):
+    tree = parsed(approximate_query(sql_query, 5, table_rows=table_rows))
+    assert windows_in(tree, "having") == []
+    assert windows_in(tree, "where") == []
+
+
+# --- Precisión frente a la respuesta exacta en DuckDB ---
+
+@pytest.fixture(scope="module")
+def connection():
+    pytest.importorskip("duckdb")
+    from benchmarks.bench_approx import connect
+
+    return connect(ROWS)
+
+
+def run(connection, sql_query):
+    from benchmarks.bench_approx import to_duckdb
+
+    return connection.execute(to_duckdb(sql_query, SEED)).df()
+
+
+def compared(connection, sql_query, keys):
+    """(exacta, aproximada con márgenes) unidas por las claves de grupo."""
+    approximation = approximate_query(sql_query, PERCENT, table_rows=ROWS)
+    approximate, relative_errors = apply_error_bounds(run(connection, approximation.sql), approximation)
+    exact = run(connection, sql_query)
+    if keys:
+        merged = exact.merge(approximate, on=keys, suffixes=("_exacto", ""))
+    else:
+        merged = exact.add_suffix("_exacto").join(approximate)
+    return approximation, merged, relative_errors
+
+
+@pytest.mark.parametrize("sql_query, keys", [
+    (f"SELECT year, COUNT(*) AS valor FROM {TABLE} GROUP BY year", ["year"]),
+    (f"SELECT state, SUM(record_weight) AS valor FROM {TABLE} GROUP BY state", ["state"]),
+    (f"SELECT state, AVG(weight_pounds) AS valor FROM {TABLE} GROUP BY state", ["state"]),
+    (f"SELECT year, COUNTIF(is_male) AS valor FROM {TABLE} WHERE mother_age < 25 GROUP BY year", ["year"]),
+    (f"SELECT COUNT(*) AS valor FROM {TABLE} WHERE year BETWEEN 2000 AND 2008", []),
+])
+def test_precision_y_cobertura_del_margen(connection, sql_query, keys):
+    approximation, merged, relative_errors = compared(connection, sql_query, keys)
+    truth = merged["valor_exacto"].astype("float64")
+    error = (merged["valor"].astype("float64") - truth).abs()
+
+    assert approximation.table_rows == ROWS
+    assert (error / truth).median() < 0.05
+    assert (error <= merged["valor_margen"]).mean() >= 0.8
+    assert relative_errors["valor"] is not None
+
+
+def test_having_aproximado_conserva_los_grupos_claros(connection):
+    threshold = 20_000
+    sql_query = f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state HAVING COUNT(*) > {threshold}"
+    approximation = approximate_query(sql_query, PERCENT, table_rows=ROWS)
+    approximate, _ = apply_error_bounds(run(connection, approximation.sql), approximation)
+    counts = run(connection, f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state")
+    counts = counts.set_index("state")["n"]
+
+    kept = set(approximate["state"])
+    # Solo se pueden confundir los estados cerca del umbral
+    assert set(counts[counts > threshold * 1.15].index) <= kept
+    assert kept <= set(counts[counts > threshold * 0.85].index)
+    assert approximate["n"].min() > threshold
+
+
+# --- Filas de la tabla muestreada en el pipeline ---
+
+NATALITY_ROWS = 137_826_763
+OTHER_TABLES = {
+    "bigquery-public-data.samples.github_nested": ([("repository", "RECORD", "Repositorio")], "", 2_541_639),
+    "bigquery-public-data.samples.gsod": ([("station_number", "INTEGER", "Estación")], "", 114_420_316),
+}
+
+
+def test_el_escalado_usa_las_filas_de_la_tabla_muestreada(pipeline):
+    import fakes
+
+    tables = {**OTHER_TABLES, "bigquery-public-data.samples.natality": (fakes.NATALITY_SCHEMA, "", NATALITY_ROWS)}
+    bigquery = fakes.FakeBigQueryClient(rows=40, tables=tables)
+    gemini = fakes.FakeGeminiClient(responder=lambda prompt: (
+        f"SELECT year, COUNT(*) AS nacimientos FROM {TABLE} GROUP BY year"
+        if "PREGUNTA DEL USUARIO" in prompt else "Los nacimientos se mantienen estables."
+    ))
+    # Catálogo con varias tablas en orden alfabético: natality no es la primera
+    tables_info = sorted(tables)
+    pipeline.refresh_schema(bigquery, tables_info)
+
+    response = pipeline.process_query(
+        "¿Cuántos nacimientos hubo por año?", None, bigquery, tables_info,
+        pipeline.build_tables_context(tables_info),
+        gemini=(gemini, pipeline.default_model_config()), approximate=True,
+    )
+
+    assert response["approximate"] is not None
+    sampled = bigquery.queries[-1]
+    assert "TABLESAMPLE SYSTEM" in sampled
+    assert f"{NATALITY_ROWS}" in sampled
+    assert not any(f"{rows}" in sampled for _, _, rows in OTHER_TABLES.values())
+
+
+def test_las_filas_se_leen_de_los_metadatos_de_la_tabla_muestreada():
+    seen = []
+
+    def table_rows(table_id):
+        seen.append(table_id)
+        return NATALITY_ROWS
+
+    approximation = approximate_query(
+        f"SELECT state, COUNT(*) AS n FROM {TABLE} GROUP BY state", 5, table_rows=table_rows
+    )
+    assert seen == ["bigquery-public-data.samples.natality"]
+    assert approximation.table_id == "bigquery-public-data.samples.natality"
+    assert approximation.table_rows == NATALITY_ROWS
+
+
+def test_un_fallo_de_metadatos_no_se_guarda(pipeline):
+    import fakes
+
+    table_id = "bigquery-public-data.samples.natality"
+    bigquery = fakes.FakeBigQueryClient(tables=OTHER_TABLES)
+    assert pipeline.get_table_row_count(bigquery, table_id) is None
+
+    bigquery.tables[table_id] = (fakes.NATALITY_SCHEMA, "", NATALITY_ROWS)
+    assert pipeline.get_table_row_count(bigquery, table_id) == NATALITY_ROWS
+    assert bigquery.metadata_calls == [table_id, table_id]
+    # Las lecturas correctas sí se guardan
+    assert pipeline.get_table_row_count(bigquery, table_id) == NATALITY_ROWS
+    assert len(bigquery.metadata_calls) == 2
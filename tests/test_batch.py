@@ -0,0 +1,133 @@
+import json
+import re
+import time
+
+import pandas as pd
+import pytest
+
+import fakes
+from gateway import ModelGateway
+from jobs import JobManager
+
+TABLES_INFO = ["bigquery-public-data.samples.natality"]
+QUESTIONS = [
+    ("q1", "¿Peso promedio por estado en 2001?"),
+    ("q2", "¿Peso promedio por estado en 2002?"),
+    ("q/3", "¿Peso promedio por estado en 2003?"),
+]
+
+
+def responder(contents):
+    """SQL con el año de la pregunta, para que cada una tenga su propia consulta."""
+    if "PREGUNTA DEL USUARIO" not in contents:
+        return "El peso promedio se mantuvo estable."
+    year = re.search(r"PREGUNTA DEL USUARIO: .*?(\d{4})", contents).group(1)
+    return (
+        "SELECT state, AVG(weight_pounds) AS peso_promedio\n"
+        f"FROM `bigquery-public-data.samples.natality`\nWHERE year = {year}\nGROUP BY state"
+    )
+
+
+class Backend:
+    """BigQuery falso en el que 2002 no tiene datos y 2003 falla mientras `broken`."""
+
+    def __init__(self, latency=0.0):
+        self.broken = True
+        self.bigquery = fakes.FakeBigQueryClient(rows=20, latency=latency, table_factory=self.table)
+        self.gemini = fakes.FakeGeminiClient(responder=responder)
+        self.gateway = ModelGateway(self.gemini, rate_per_second=1000, burst=100)
+
+    def table(self, sql_query, rows):
+        if "2003" in sql_query and self.broken:
+            raise RuntimeError("Fallo transitorio de BigQuery")
+        return fakes.default_table(sql_query, 0 if "2002" in sql_query else rows)
+
+
+@pytest.fixture
+def batch(pipeline, monkeypatch):
+    import batch
+
+    manager = JobManager(timeout=30, batch_timeout=30, poll_interval=0.02)
+    monkeypatch.setattr(pipeline, "get_job_manager", lambda: manager)
+    return batch
+
+
+def records(output_dir):
+    with open(output_dir / "results.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def run(batch, backend, output_dir, questions=QUESTIONS, **kwargs):
+    return batch.run_batch(
+        questions, output_dir, backend.bigquery, backend.gateway, tables_info=TABLES_INFO,
+        workers=4, **kwargs,
+    )
+
+
+def test_resultados_y_parquet_por_pregunta(batch, tmp_path):
+    backend = Backend()
+    counts = run(batch, backend, tmp_path)
+
+    assert counts == {"skipped": 0, "ok": 1, "empty": 1, "error": 1}
+    by_id = {record["id"]: record for record in records(tmp_path)}
+    assert set(by_id) == {"q1", "q2", "q/3"}
+    assert [by_id[question_id]["status"] for question_id in ("q1", "q2", "q/3")] == ["ok", "empty", "error"]
+
+    ok = by_id["q1"]
+    assert "WHERE year = 2001" in ok["sql_query"] and ok["content"]
+    data = pd.read_parquet(tmp_path / ok["data_path"])
+    assert len(data) == ok["rows"] and list(data.columns) == ["year", "state", "weight_pounds", "mother_age"]
+    assert ok["elapsed_ms"] > 0 and ok["timings"]
+    # Sin datos no hay Parquet
+    assert by_id["q2"]["data_path"] is None and by_id["q/3"]["data_path"] is None
+    assert sorted(path.name for path in (tmp_path / "data").iterdir()) == ["q1.parquet"]
+
+
+def test_reanudar_salta_lo_respondido_y_reintenta_los_errores(batch, tmp_path):
+    backend = Backend()
+    run(batch, backend, tmp_path)
+    queries = list(backend.bigquery.queries)
+
+    backend.broken = False
+    seen = []
+    counts = run(batch, backend, tmp_path, on_result=lambda question_id, status: seen.append(question_id))
+
+    assert counts == {"skipped": 2, "ok": 1}
+    assert seen == ["q/3"]
+    assert backend.bigquery.queries[len(queries):] == [query for query in queries if "2003" in query]
+    assert batch.completed_ids(tmp_path) == {"q1", "q2", "q/3"}
+    # Los ids se limpian para el nombre del fichero
+    assert (tmp_path / "data" / "q_3.parquet").exists()
+    # La línea del error se conserva: el fichero solo crece
+    assert [record["status"] for record in records(tmp_path) if record["id"] == "q/3"] == ["error", "ok"]
+
+
+def test_linea_a_medias_no_cuenta_como_respondida(batch, tmp_path):
+    (tmp_path / "results.jsonl").write_text(
+        json.dumps({"id": "q1", "status": "ok"}) + '\n{"id": "q2", "sta', encoding="utf-8"
+    )
+    assert batch.completed_ids(tmp_path) == {"q1"}
+
+
+def test_interrupcion_cancela_los_jobs_en_curso(batch, pipeline, tmp_path):
+    backend = Backend(latency=lambda sql_query: 0.0 if "2001" in sql_query else 30)
+    questions = QUESTIONS + [(f"lenta{year}", f"¿Peso promedio por estado en {year}?") for year in (2004, 2005, 2006)]
+
+    def interrupt(question_id, status):
+        if question_id == "q1":
+            raise KeyboardInterrupt()
+
+    start = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        run(batch, backend, tmp_path, questions=questions, on_result=interrupt)
+
+    assert time.monotonic() - start < 5
+    manager = pipeline.get_job_manager()
+    assert manager.running() == 0
+    # Todos los jobs en marcha, menos el de la pregunta ya respondida, se cancelaron;
+    # las preguntas que seguían en la cola no llegaron a lanzar el suyo
+    launched = len(backend.bigquery.queries)
+    assert 4 <= launched < len(questions)
+    assert len(backend.bigquery.cancelled) == launched - 1
+    assert manager.stats()["interrupted"] == launched - 1
+    assert batch.completed_ids(tmp_path) == {"q1"}
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from charts import HISTOGRAM_BINS, MIN_DISTRIBUTION_ROWS, build_chart, chart_spec
+
+
+@pytest.mark.parametrize("df", [
+    pd.DataFrame({"peso_promedio": [7.3]}),
+    pd.DataFrame({"nacimientos": [3_000_000], "peso_promedio": [7.3]}),
+    pd.DataFrame({"madres": [10, 12, 9], "edad_media": [25.1, 26.4, 27.0]}),
+    pd.DataFrame({"total": np.arange(MIN_DISTRIBUTION_ROWS - 1)}),
+    pd.DataFrame({"peso": [7.1, 7.2]}),
+    pd.DataFrame({"nacimientos": pd.Series([], dtype="int64")}),
+])
+def test_escalares_y_pocas_filas_sin_eje_no_tienen_grafico(df):
+    assert chart_spec(df) is None
+
+
+def test_sin_columnas_numericas_no_hay_grafico():
+    assert chart_spec(pd.DataFrame({"state": ["CA", "TX"], "nombre": ["a", "b"]})) is None
+    assert chart_spec(None) is None
+
+
+def test_una_fila_con_categoria_sigue_siendo_una_barra():
+    spec = chart_spec(pd.DataFrame({"state": ["CA"], "nacimientos": [500_000]}))
+    assert (spec["kind"], spec["x"], spec["y"]) == ("bar", "state", "nacimientos")
+
+
+def test_resultado_pequeno_por_estado_o_anio_en_barras():
+    by_state = pd.DataFrame({"year": [2005] * 3, "state": ["CA", "TX", "NY"], "n": [3, 2, 1]})
+    assert chart_spec(by_state)["kind"] == "bar"
+    assert chart_spec(by_state)["x"] == "year"
+
+    by_year = pd.DataFrame({"year": range(2000, 2009), "peso": np.linspace(7.2, 7.4, 9)})
+    assert (chart_spec(by_year)["kind"], chart_spec(by_year)["x"]) == ("bar", "year")
+
+
+def test_serie_larga_en_lineas_con_los_puntos_acotados():
+    df = pd.DataFrame({
+        "year": np.repeat(np.arange(1969, 2009), 300),
+        "peso": np.random.default_rng(0).normal(7, 1, 12_000),
+    })
+    spec = chart_spec(df, max_points=500)
+    assert spec["kind"] == "line"
+    fig = build_chart(df, spec)
+    assert sum(len(trace.x) for trace in fig.data) <= 500
+
+
+@pytest.mark.parametrize("rows, kind", [
+    (MIN_DISTRIBUTION_ROWS, "scatter"),
+    (1_500, "scatter"),
+    (5_000, "heatmap"),
+])
+def test_dos_numeros_con_filas_suficientes(rows, kind):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"mother_age": rng.integers(15, 45, rows), "weight_pounds": rng.normal(7, 1, rows)})
+    spec = chart_spec(df)
+    assert spec["kind"] == kind
+    assert build_chart(df, spec) is not None
+
+
+def test_histograma_de_una_columna_con_filas_suficientes():
+    df = pd.DataFrame({"weight_pounds": np.random.default_rng(0).normal(7, 1, 1_000)})
+    spec = chart_spec(df)
+    assert spec["kind"] == "histogram"
+    fig = build_chart(df, spec)
+    assert len(fig.data[0].x) == HISTOGRAM_BINS
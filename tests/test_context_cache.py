@@ -0,0 +1,81 @@
+import threading
+import time
+
+import fakes
+from context_cache import ContextCache, PromptPrefix
+
+PREFIX = PromptPrefix("sql", "Esquema y reglas de la tabla de natalidad. " * 200)
+MODEL_CONFIG = {"model": "fake-model", "generation_config": {"temperature": 0}}
+
+
+class SlowCaches(fakes._FakeCaches):
+    """`caches.create` lento, que falla con `errors` mientras queden."""
+
+    def __init__(self, owner, delay=0.0, errors=()):
+        super().__init__(owner)
+        self.delay = delay
+        self.errors = list(errors)
+        self.creates = 0
+
+    def create(self, model, config):
+        self.creates += 1
+        time.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return super().create(model, config)
+
+
+def client_with(**kwargs):
+    client = fakes.FakeGeminiClient(responder=lambda prompt: "SELECT 1")
+    client.caches = SlowCaches(client, **kwargs)
+    return client
+
+
+def test_el_prefijo_se_cachea_y_ahorra_tokens():
+    cache = ContextCache(min_tokens=100)
+    client = client_with()
+    usage = {}
+    for _ in range(3):
+        cache.generate(client, MODEL_CONFIG, PREFIX, "PREGUNTA", usage=usage)
+    assert client.caches.creates == 1
+    assert all(call["contents"] == "PREGUNTA" for call in client.calls)
+    assert usage["prompt_tokens_saved"] == 3 * PREFIX.approx_tokens
+    assert cache.stats()["cached_turns"] == 3
+
+
+def test_una_creacion_lenta_no_bloquea_a_las_demas_sesiones():
+    cache = ContextCache(min_tokens=100)
+    client = client_with(delay=0.5)
+    creating = threading.Thread(target=cache.generate, args=(client, MODEL_CONFIG, PREFIX, "A"))
+    creating.start()
+    time.sleep(0.05)
+    start = time.perf_counter()
+    cache.generate(client, MODEL_CONFIG, PREFIX, "B")
+    # La otra sesión va en línea sin esperar a la creación
+    assert time.perf_counter() - start < 0.2
+    creating.join()
+    assert client.caches.creates == 1
+    inline = next(call for call in client.calls if call["contents"].endswith("B"))
+    assert inline["contents"].startswith(PREFIX.text)
+
+
+def test_un_fallo_pasajero_se_reintenta():
+    cache = ContextCache(min_tokens=100, retry_after=0.1)
+    client = client_with(errors=[fakes.FakeAPIError(429)])
+    cache.generate(client, MODEL_CONFIG, PREFIX, "A")
+    cache.generate(client, MODEL_CONFIG, PREFIX, "B")
+    assert client.caches.creates == 1
+    time.sleep(0.15)
+    cache.generate(client, MODEL_CONFIG, PREFIX, "C")
+    assert client.caches.creates == 2
+    assert client.calls[-1]["contents"] == "C"
+
+
+def test_un_modelo_sin_cache_no_se_reintenta_en_cada_turno():
+    cache = ContextCache(min_tokens=100, retry_after=0)
+    client = client_with(errors=[RuntimeError("El modelo fake-model no admite caché de contexto")] * 3)
+    for turn in ("A", "B", "C"):
+        cache.generate(client, MODEL_CONFIG, PREFIX, turn)
+    assert client.caches.creates == 1
+    assert all(call["contents"].startswith(PREFIX.text) for call in client.calls)
+    assert cache.stats()["cached_turns"] == 0
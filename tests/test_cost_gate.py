@@ -0,0 +1,157 @@
+import re
+
+import pytest
+
+import fakes
+from cost_gate import MIN_BILLED_BYTES, CostGate, format_bytes
+
+GB = 1024**3
+MB = 1024**2
+# Un SELECT * lee la tabla entera; una consulta con pocas columnas, una parte
+TABLE_BYTES = 20 * GB
+COLUMN_BYTES = 500 * MB
+ROWS = 40
+
+
+class PricedBigQueryClient(fakes.FakeBigQueryClient):
+    """BigQuery falso cuyos dry runs estiman según la consulta, como el real."""
+
+    def __init__(self, **kwargs):
+        super().__init__(rows=ROWS, bytes_per_row=COLUMN_BYTES // ROWS, **kwargs)
+        self.job_configs = []
+
+    def query(self, sql_query, job_config=None):
+        job = super().query(sql_query, job_config)
+        if getattr(job_config, "dry_run", False):
+            job.total_bytes_processed = (
+                TABLE_BYTES if re.search(r"SELECT\s+\*", sql_query, re.IGNORECASE) else COLUMN_BYTES
+            )
+        else:
+            self.job_configs.append(job_config)
+        return job
+
+
+def responder(cheap_rewrite):
+    """SQL con el año de la pregunta: SELECT * salvo, si `cheap_rewrite`, al pedir una más barata."""
+    def respond(contents):
+        if "PREGUNTA DEL USUARIO" not in contents:
+            return "El peso promedio se mantuvo estable."
+        year = re.search(r"PREGUNTA DEL USUARIO: .*?(\d{4})", contents).group(1)
+        if cheap_rewrite and "Reescribe la consulta" in contents:
+            columns = "AVG(weight_pounds) AS peso_promedio"
+        else:
+            columns = "*"
+        return f"SELECT {columns} FROM `bigquery-public-data.samples.natality` WHERE year = {year}"
+    return respond
+
+
+def test_tope_por_consulta():
+    gate = CostGate(max_bytes_per_query=GB, max_bytes_per_session=10 * GB)
+    assert gate.check(GB) == (True, None)
+    allowed, reason = gate.check(GB + 1)
+    assert not allowed and "límite por consulta de 1.0 GB" in reason
+
+
+def test_presupuesto_de_la_sesion():
+    gate = CostGate(max_bytes_per_query=GB, max_bytes_per_session=2 * GB)
+    gate.record(1.5 * GB)
+    assert gate.remaining() == 0.5 * GB
+    assert gate.limit() == 0.5 * GB
+    allowed, reason = gate.check(0.6 * GB)
+    assert not allowed and "quedan 512.0 MB del presupuesto de la sesión" in reason
+
+    gate.record(GB)
+    assert gate.remaining() == 0 and not gate.check(1)[0]
+
+
+def test_maximum_bytes_billed_con_el_minimo_facturable():
+    gate = CostGate(max_bytes_per_query=GB, max_bytes_per_session=10 * GB)
+    assert gate.job_config().maximum_bytes_billed == GB
+    gate.record(10 * GB - MB)
+    # BigQuery factura al menos 10 MB: un tope menor rechazaría cualquier consulta
+    assert gate.job_config().maximum_bytes_billed == MIN_BILLED_BYTES
+
+
+def test_la_estimacion_es_un_dry_run():
+    client = PricedBigQueryClient()
+    gate = CostGate(GB, 10 * GB)
+    assert gate.estimate(client, "SELECT * FROM t") == TABLE_BYTES
+    assert gate.estimate(client, "SELECT year FROM t") == COLUMN_BYTES
+    assert client.queries == [] and len(client.dry_runs) == 2
+    assert gate.spent == 0
+
+
+@pytest.mark.parametrize("num_bytes, text", [
+    (None, "—"), (512, "512 B"), (1536, "1.5 KB"), (5 * GB, "5.0 GB"), (3 * 1024 * GB, "3.00 TB"),
+])
+def test_formato_de_bytes(num_bytes, text):
+    assert format_bytes(num_bytes) == text
+
+
+# --- Control de coste en el pipeline ---
+
+def gate():
+    return CostGate(max_bytes_per_query=GB, max_bytes_per_session=2 * COLUMN_BYTES)
+
+
+def test_consulta_cara_se_rechaza_sin_ejecutarse(ask):
+    gemini = fakes.FakeGeminiClient(responder=responder(cheap_rewrite=False))
+    bigquery = PricedBigQueryClient()
+    cost_gate = gate()
+
+    response = ask("Peso promedio de los bebés en 2005", gemini, bigquery, cost_gate=cost_gate)
+
+    assert response["content"].startswith("💸 Consulta rechazada por coste.")
+    assert response["data"] is None
+    assert (response["bytes_estimated"], response["bytes_processed"]) == (TABLE_BYTES, None)
+    # Se pidió una reescritura más barata antes de rechazarla, y nada llegó a BigQuery
+    assert any("Reescribe la consulta" in call["contents"] for call in gemini.calls)
+    assert len(bigquery.dry_runs) == 2 and bigquery.queries == []
+    assert cost_gate.spent == 0
+
+
+def test_la_reescritura_barata_se_ejecuta_con_su_tope(ask):
+    gemini = fakes.FakeGeminiClient(responder=responder(cheap_rewrite=True))
+    bigquery = PricedBigQueryClient()
+    cost_gate = gate()
+
+    response = ask("Peso promedio de los bebés en 2005", gemini, bigquery, cost_gate=cost_gate)
+
+    assert response["data"] is not None
+    assert "AVG(weight_pounds)" in response["sql_query"]
+    assert (response["bytes_estimated"], response["bytes_processed"]) == (COLUMN_BYTES, COLUMN_BYTES)
+    assert len(bigquery.queries) == 1
+    # El tope es lo que quedaba de la sesión, menor que el de la consulta
+    assert bigquery.job_configs[0].maximum_bytes_billed == 2 * COLUMN_BYTES < GB
+    assert cost_gate.spent == COLUMN_BYTES
+
+
+def test_el_presupuesto_de_la_sesion_se_agota(ask):
+    gemini = fakes.FakeGeminiClient(responder=responder(cheap_rewrite=True))
+    bigquery = PricedBigQueryClient()
+    cost_gate = gate()
+
+    responses = [
+        ask(f"Peso promedio de los bebés en {year}", gemini, bigquery, cost_gate=cost_gate)
+        for year in (2001, 2002, 2003)
+    ]
+
+    assert [response["data"] is not None for response in responses] == [True, True, False]
+    assert "presupuesto de la sesión" in responses[2]["content"]
+    assert len(bigquery.queries) == 2
+    assert cost_gate.spent == 2 * COLUMN_BYTES
+    # El último tope que salió a BigQuery era lo que quedaba del presupuesto
+    assert bigquery.job_configs[1].maximum_bytes_billed == COLUMN_BYTES
+
+
+def test_resultado_en_cache_no_pasa_por_el_control(ask):
+    gemini = fakes.FakeGeminiClient(responder=responder(cheap_rewrite=True))
+    bigquery = PricedBigQueryClient()
+    cost_gate = gate()
+    ask("Peso promedio de los bebés en 2005", gemini, bigquery, cost_gate=cost_gate)
+    dry_runs = len(bigquery.dry_runs)
+
+    response = ask("Peso promedio de los bebés en 2005", gemini, bigquery, cost_gate=cost_gate)
+    assert response["data"] is not None
+    assert len(bigquery.dry_runs) == dry_runs and len(bigquery.queries) == 1
+    assert cost_gate.spent == COLUMN_BYTES
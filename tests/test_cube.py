@@ -0,0 +1,94 @@
+import pytest
+from conftest import assert_same_result
+
+from cube import CubeRouter, build_cube, main, read_provenance, save_cube
+
+TABLE = "`bigquery-public-data.samples.natality`"
+ROUTABLE = [
+    f"SELECT year, COUNT(*) AS nacimientos FROM {TABLE} GROUP BY year ORDER BY year",
+    f"SELECT state, ROUND(AVG(weight_pounds), 4) AS peso FROM {TABLE} "
+    f"WHERE year = 2005 GROUP BY state ORDER BY state",
+    f"SELECT is_male, AVG(weight_pounds) AS peso, STDDEV(weight_pounds) AS desviacion "
+    f"FROM {TABLE} WHERE year BETWEEN 2000 AND 2008 GROUP BY is_male ORDER BY is_male",
+    f"SELECT plurality, COUNT(*) AS n, SUM(weight_pounds) AS total FROM {TABLE} "
+    f"WHERE state IN ('TX', 'CA') AND gestation_weeks >= 37 GROUP BY plurality ORDER BY plurality",
+    f"SELECT COUNT(DISTINCT state) AS estados, MIN(mother_age) AS minima, MAX(mother_age) AS maxima "
+    f"FROM {TABLE} WHERE is_male",
+    f"SELECT mother_age, COUNT(*) AS n FROM {TABLE} GROUP BY mother_age "
+    f"ORDER BY n DESC, mother_age LIMIT 5",
+    f"SELECT year, AVG(gestation_weeks) AS semanas FROM {TABLE} "
+    f"WHERE gestation_weeks IS NOT NULL GROUP BY year ORDER BY year",
+    f"SELECT state, COUNT(weight_pounds) AS con_peso FROM {TABLE} "
+    f"WHERE state IS NULL OR state = 'OH' GROUP BY state ORDER BY state",
+]
+NOT_ROUTABLE = [
+    # Otra tabla con el mismo nombre, o la del proyecto por defecto
+    "SELECT year, COUNT(*) AS n FROM `otherproject.samples.natality` GROUP BY year",
+    "SELECT year, COUNT(*) AS n FROM samples.natality GROUP BY year",
+    f"SELECT year, COUNT(*) AS n FROM {TABLE} GROUP BY year HAVING COUNT(*) > 10",
+    f"SELECT weight_pounds FROM {TABLE} LIMIT 10",
+    f"SELECT year, AVG(father_age) AS edad FROM {TABLE} GROUP BY year",
+]
+
+
+@pytest.fixture(scope="module")
+def router(natality):
+    return CubeRouter(build_cube(natality))
+
+
+@pytest.mark.parametrize("sql_query", ROUTABLE)
+def test_respuesta_del_cubo_igual_al_escaneo_completo(router, run_sql, sql_query):
+    local = router.try_answer(sql_query)
+    assert local is not None
+    assert_same_result(local, run_sql(sql_query))
+
+
+@pytest.mark.parametrize("sql_query", NOT_ROUTABLE)
+def test_consultas_fuera_del_cubo_van_a_bigquery(router, sql_query):
+    assert router.try_answer(sql_query) is None
+
+
+# --- Procedencia del cubo ---
+
+def test_la_procedencia_viaja_con_el_cubo(natality, tmp_path):
+    cube = build_cube(natality.head(1_000))
+    save_cube(cube, tmp_path / "exacto.parquet", "bigquery:natality", exact=True)
+    save_cube(cube, tmp_path / "muestra.parquet", "file:muestra.parquet", exact=False)
+    cube.to_parquet(tmp_path / "antiguo.parquet", index=False)
+
+    exact = CubeRouter.load(tmp_path / "exacto.parquet")
+    assert exact.exact and exact.provenance == {"source": "bigquery:natality", "exact": True}
+    assert len(exact.cube) == len(cube)
+    assert not CubeRouter.load(tmp_path / "muestra.parquet").exact
+    # Un cubo guardado sin procedencia no se da por exacto
+    assert read_provenance(tmp_path / "antiguo.parquet") == {}
+    assert not CubeRouter.load(tmp_path / "antiguo.parquet").exact
+
+
+def test_cubo_de_muestra_exige_una_ruta_explicita(natality, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    natality.head(1_000).to_parquet("muestra.parquet")
+
+    with pytest.raises(SystemExit):
+        main(["--source", "muestra.parquet"])
+    assert not (tmp_path / ".cache").exists()
+
+    main(["--source", "muestra.parquet", "--output", "cubos/muestra.parquet"])
+    assert read_provenance(tmp_path / "cubos" / "muestra.parquet") == {
+        "source": "file:muestra.parquet", "exact": False,
+    }
+
+
+@pytest.mark.parametrize("exact, allow_sample, routed", [
+    (True, False, True), (False, False, False), (False, True, True),
+])
+def test_el_pipeline_solo_usa_cubos_exactos(pipeline, natality, tmp_path, monkeypatch, exact, allow_sample, routed):
+    save_cube(build_cube(natality.head(1_000)), tmp_path / "cubo.parquet", "prueba", exact=exact)
+    monkeypatch.setattr(pipeline, "CUBE_PATH", str(tmp_path / "cubo.parquet"))
+    monkeypatch.setattr(pipeline, "CUBE_ALLOW_SAMPLE", allow_sample)
+    pipeline.get_cube_router.cache_clear()
+
+    router = pipeline.get_cube_router()
+    assert (router is not None) == routed
+    if routed:
+        assert router.try_answer(ROUTABLE[0]) is not None
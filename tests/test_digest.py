@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from digest import build_result_digest
+from pipeline import build_explanation_prompt
+
+ROWS = [10, 1_000, 100_000, 1_000_000]
+SQL = "SELECT year, state, weight_pounds FROM `bigquery-public-data.samples.natality`"
+
+
+def result(rows):
+    rng = np.random.default_rng(rows)
+    return pd.DataFrame({
+        "year": 1969 + np.arange(rows) % 40,
+        "state": rng.choice(["CA", "TX", "NY", "FL"], rows),
+        "weight_pounds": rng.normal(7.3, 1.2, rows),
+    })
+
+
+@pytest.fixture(scope="module")
+def prompts():
+    sizes = {}
+    for rows in ROWS:
+        digest = build_result_digest(result(rows), max_tokens=1500)
+        _, turn_prompt = build_explanation_prompt("¿Cómo cambia el peso?", SQL, result(rows), digest)
+        sizes[rows] = (digest, len(turn_prompt))
+    return sizes
+
+
+def test_longitud_del_prompt_plana_de_10_a_1m_filas(prompts):
+    digest_chars = [prompts[rows][0]["chars"] for rows in ROWS]
+    assert max(digest_chars) <= 1500 * 4
+    prompt_chars = [prompts[rows][1] for rows in ROWS[1:]]
+    # Por encima de la tabla completa el tamaño apenas varía con las filas
+    assert max(prompt_chars) - min(prompt_chars) <= 0.1 * min(prompt_chars)
+    assert prompts[1_000_000][1] < len(result(1_000).to_string())
+
+
+def test_resultado_pequeno_va_completo(prompts):
+    digest = prompts[10][0]
+    assert "DATOS COMPLETOS" in digest["text"]
+    assert digest["tokens"] == digest["chars"] // 4
+    assert digest["build_ms"] >= 0
+
+
+def test_resumen_con_estadisticas_categorias_y_tendencia():
+    df = result(100_000)
+    text = build_result_digest(df, max_tokens=1500)["text"]
+    assert "100,000" in text or "100000" in text
+    for expected in ("weight_pounds", "state", "PRIMERAS", "ÚLTIMAS", "TENDENCIAS POR AÑO (1969-2008)"):
+        assert expected in text
+
+
+def test_tendencia_ascendente_por_ano():
+    df = pd.DataFrame({"year": np.arange(1969, 2009), "nacimientos": np.arange(40) * 1000 + 5000})
+    df = pd.concat([df] * 3, ignore_index=True)
+    text = build_result_digest(df, max_tokens=1500)["text"]
+    assert "nacimientos: 5000 (1969) → 44000 (2008)" in text.replace(",", "")
+    assert "ascendente" in text
+
+
+@pytest.mark.parametrize("max_tokens", [200, 800, 3000])
+def test_el_presupuesto_se_respeta(max_tokens):
+    digest = build_result_digest(result(100_000), max_tokens=max_tokens)
+    assert digest["chars"] <= max_tokens * 4
@@ -0,0 +1,97 @@
+import pyarrow as pa
+import pytest
+
+import fakes
+from benchmarks.bench_followup import BASES, FOLLOW_UPS
+from conftest import assert_same_result
+from followup import apply_follow_up, follow_up_sql, plan_follow_up
+
+# No son refinamientos: siguen el camino normal con cualquier consulta base
+NEW_QUESTIONS = ["¿Y en 2006 por estado?", "¿Cuál es la edad media de los padres?"]
+
+
+@pytest.mark.parametrize("base_sql", [sql for _, sql in BASES], ids=[f"base{i}" for i in range(len(BASES))])
+def test_refinamiento_local_igual_a_su_sql(run_sql, base_sql):
+    previous = run_sql(base_sql)
+    compared = 0
+    for question in FOLLOW_UPS:
+        follow_up = plan_follow_up(question, previous, base_sql)
+        # Sin orden anterior conocido el LIMIT de BigQuery no es reproducible
+        sql_query = follow_up and follow_up_sql(base_sql, follow_up)
+        if sql_query is None:
+            continue
+        assert_same_result(apply_follow_up(previous, follow_up), run_sql(sql_query))
+        compared += 1
+    assert compared >= 4
+
+
+@pytest.mark.parametrize("question, base_index, expected", [
+    ("Filtra a Texas", 0, ([("state", ["TX"])], [], None)),
+    ("Filtra a TX y CA", 3, ([("state", ["TX", "CA"])], [], None)),
+    ("Los 5 estados con mayor peso", 0, ([], [("peso_promedio", True)], 5)),
+    ("Los tres con menos nacimientos", 1, ([], [("nacimientos", False)], 3)),
+    ("Solo varones", 2, ([("is_male", [True])], [], None)),
+    ("Solo Texas, ordenado por nacimientos descendente", 2, ([("state", ["TX"])], [("nacimientos", True)], None)),
+])
+def test_plan_del_refinamiento(run_sql, question, base_index, expected):
+    base_sql = BASES[base_index][1]
+    follow_up = plan_follow_up(question, run_sql(base_sql), base_sql)
+    assert (follow_up.filters, follow_up.order, follow_up.limit) == expected
+
+
+@pytest.mark.parametrize("question", NEW_QUESTIONS + ["Ordénalo por peso del padre", "Solo varones"])
+def test_preguntas_nuevas_o_sin_columnas_no_se_planifican(run_sql, question):
+    # La base por año no tiene ni `is_male` ni el peso
+    base_sql = BASES[1][1]
+    assert plan_follow_up(question, run_sql(base_sql), base_sql) is None
+
+
+def test_filtro_no_coincide_con_nulos(run_sql):
+    base_sql = BASES[3][1]
+    previous = run_sql(base_sql)
+    assert previous["state"].isna().any()
+    follow_up = plan_follow_up("Filtra a TX y CA", previous, base_sql)
+    assert sorted(apply_follow_up(previous, follow_up)["state"]) == ["CA", "TX"]
+
+
+@pytest.fixture
+def conversation(ask, run_sql):
+    """Primer turno con la consulta base; devuelve la respuesta y los clientes falsos."""
+    question, base_sql = BASES[0]
+    gemini = fakes.FakeGeminiClient(
+        responder=lambda prompt: base_sql if "PREGUNTA DEL USUARIO" in prompt
+        else "El peso se mantiene estable entre estados."
+    )
+    bigquery = fakes.FakeBigQueryClient(
+        table_factory=lambda sql_query, _: pa.Table.from_pandas(run_sql(sql_query), preserve_index=False),
+    )
+    previous = ask(question, gemini, bigquery)
+    assert previous["sql_query"] is not None and previous["data"] is not None
+    return previous, gemini, bigquery
+
+
+def test_turno_de_refinamiento_sin_modelo_ni_bigquery(ask, run_sql, conversation):
+    previous, gemini, bigquery = conversation
+    calls, queries = len(gemini.calls), len(bigquery.queries)
+
+    response = ask("Los 5 estados con mayor peso", gemini, bigquery, previous=previous)
+
+    assert response["answered_locally"]
+    assert (len(gemini.calls), len(bigquery.queries)) == (calls, queries)
+    assert_same_result(response["data"], run_sql(response["sql_query"]))
+    assert len(response["data"]) == 5
+
+
+def test_resultado_truncado_envia_solo_la_sql_compuesta(ask, run_sql, conversation):
+    previous, gemini, bigquery = conversation
+    calls, queries = len(gemini.calls), len(bigquery.queries)
+
+    response = ask("Filtra a Texas", gemini, bigquery, previous={**previous, "truncated": True})
+
+    assert not response["answered_locally"]
+    assert len(gemini.calls) == calls
+    assert len(bigquery.queries) == queries + 1
+    assert bigquery.queries[-1] == response["sql_query"]
+    # La descarga lee los textos como categorías
+    assert_same_result(response["data"].astype({"state": str}), run_sql(response["sql_query"]))
+    assert list(response["data"]["state"]) == ["TX"]
@@ -0,0 +1,203 @@
+import threading
+import time
+
+import pytest
+
+import fakes
+import gateway
+from gateway import ModelGateway, TokenBucket, is_transient_error
+
+PROMPT = "PREGUNTA DEL USUARIO: ¿Cuántos nacimientos hubo en 2005?"
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def run_threads(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def generate(client):
+    return client.models.generate_content(model="fake", contents=PROMPT)
+
+
+# --- Ritmo ---
+
+def test_rafaga_inmediata_y_luego_el_ritmo_del_bucket():
+    bucket = TokenBucket(rate=20, capacity=5)
+    start = time.monotonic()
+    times = []
+    for _ in range(15):
+        bucket.acquire()
+        times.append(time.monotonic() - start)
+
+    assert times[4] < 0.05
+    # Las 10 siguientes esperan a que se repongan fichas a 20 por segundo
+    assert 0.45 <= times[-1] < 0.8
+
+
+def test_el_ritmo_se_aplica_a_todas_las_sesiones():
+    client = fakes.FakeGeminiClient()
+    model_gateway = ModelGateway(client, rate_per_second=20, burst=4, max_concurrency=16)
+    start = time.monotonic()
+    run_threads([
+        lambda i=i: generate(model_gateway.session_client(f"s{i % 4}")) for i in range(12)
+    ])
+
+    assert len(client.calls) == 12
+    assert 0.35 <= time.monotonic() - start < 0.8
+
+
+# --- Concurrencia ---
+
+def test_nunca_mas_llamadas_en_curso_que_huecos():
+    client = fakes.FakeGeminiClient(latency=0.05)
+    model_gateway = ModelGateway(client, rate_per_second=1000, burst=100, max_concurrency=3)
+    lock = threading.Lock()
+    active = peak = 0
+
+    def method():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        try:
+            return generate(client)
+        finally:
+            with lock:
+                active -= 1
+
+    run_threads([lambda i=i: model_gateway.call(f"s{i % 5}", method) for i in range(15)])
+
+    assert peak == 3
+    assert len(client.calls) == 15
+    assert model_gateway.stats() == {"calls": 15, "retries": 0, "active": 0, "waiting": 0}
+
+
+# --- Reintentos ---
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    """Topes de cada espera de backoff; las esperas en sí no se hacen."""
+    caps = []
+
+    def uniform(low, high):
+        caps.append(high)
+        return 0
+
+    monkeypatch.setattr(gateway.random, "uniform", uniform)
+    return caps
+
+
+def test_429_se_reintenta_con_backoff_exponencial(backoffs):
+    client = fakes.FakeGeminiClient(fail_first=3)
+    model_gateway = ModelGateway(client, backoff_base=0.5, backoff_max=1.5)
+
+    response = generate(model_gateway.session_client("s1"))
+
+    assert response.text
+    assert len(client.calls) == 4
+    assert model_gateway.stats()["retries"] == 3
+    assert backoffs == [0.5, 1.0, 1.5]
+
+
+@pytest.mark.parametrize("code", [500, 502, 503, 504])
+def test_errores_5xx_se_reintentan(backoffs, code):
+    failures = [fakes.FakeAPIError(code, "UNAVAILABLE")]
+
+    def method():
+        if failures:
+            raise failures.pop()
+        return "ok"
+
+    model_gateway = ModelGateway(fakes.FakeGeminiClient(), backoff_base=0.1)
+    assert model_gateway.call("s1", method) == "ok"
+    assert model_gateway.retries == 1 and backoffs == [0.1]
+
+
+def test_error_permanente_no_se_reintenta(backoffs):
+    calls = []
+
+    def method():
+        calls.append(1)
+        raise fakes.FakeAPIError(400, "INVALID_ARGUMENT")
+
+    model_gateway = ModelGateway(fakes.FakeGeminiClient())
+    with pytest.raises(fakes.FakeAPIError):
+        model_gateway.call("s1", method)
+    assert len(calls) == 1 and backoffs == []
+    assert not is_transient_error(ValueError("SQL inválida"))
+    assert is_transient_error(ConnectionError())
+
+
+def test_se_rinde_tras_max_retries(backoffs):
+    client = fakes.FakeGeminiClient(fail_first=10)
+    model_gateway = ModelGateway(client, max_retries=2)
+
+    with pytest.raises(fakes.FakeAPIError) as error:
+        generate(model_gateway.session_client("s1"))
+    assert error.value.code == 429
+    assert len(client.calls) == 3 and len(backoffs) == 2
+    assert model_gateway.stats()["active"] == 0
+
+
+def test_streaming_solo_se_reintenta_antes_del_primer_fragmento(backoffs):
+    client = fakes.FakeGeminiClient(fail_first=1)
+    model_gateway = ModelGateway(client)
+    chunks = model_gateway.session_client("s1").models.generate_content_stream(
+        model="fake", contents=PROMPT,
+    )
+    assert "".join(chunk.text for chunk in chunks) == fakes.default_responder(PROMPT)
+    assert model_gateway.retries == 1
+
+    def broken_stream():
+        yield "primer fragmento"
+        raise fakes.FakeAPIError(503, "UNAVAILABLE")
+
+    chunks = model_gateway.stream("s1", broken_stream)
+    assert next(chunks) == "primer fragmento"
+    with pytest.raises(fakes.FakeAPIError):
+        next(chunks)
+    assert model_gateway.retries == 1
+
+
+# --- Reparto entre sesiones ---
+
+def test_una_sesion_con_muchas_peticiones_no_bloquea_a_otra():
+    model_gateway = ModelGateway(fakes.FakeGeminiClient(), rate_per_second=1000, burst=100, max_concurrency=1)
+    release = threading.Event()
+    order = []
+
+    def blocked():
+        release.wait()
+
+    def queued(session_id):
+        return lambda: model_gateway.call(session_id, order.append, session_id)
+
+    holder = threading.Thread(target=model_gateway.call, args=("otra", blocked))
+    holder.start()
+    assert wait_until(lambda: model_gateway.stats()["active"] == 1)
+
+    # La sesión "a" encola cuatro peticiones antes de que "b" pida dos
+    threads = [threading.Thread(target=queued("a")) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert wait_until(lambda: model_gateway.stats()["waiting"] == 4)
+    threads += [threading.Thread(target=queued("b")) for _ in range(2)]
+    for thread in threads[4:]:
+        thread.start()
+    assert wait_until(lambda: model_gateway.stats()["waiting"] == 6)
+
+    release.set()
+    holder.join()
+    for thread in threads:
+        thread.join()
+    assert order == ["a", "b", "a", "b", "a", "a"]
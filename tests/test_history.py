@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from history import ChatHistory, _message_bytes
+
+
+def answer(rows, content="Respuesta"):
+    df = pd.DataFrame({"year": np.arange(rows) % 40 + 1969, "nacimientos": np.arange(rows)})
+    return {"role": "assistant", "content": content, "data": df, "fig": None, "sql_query": "SELECT 1"}
+
+
+def test_solo_la_vista_previa_queda_en_memoria(tmp_path):
+    history = ChatHistory(tmp_path, "s", preview_rows=5)
+    message = history.append(answer(1000))
+    assert "data" not in message and len(message["preview"]) == 5
+    assert message["total_rows"] == 1000
+    assert len(history.load_data(message)) == 1000
+
+
+def test_presupuesto_descarta_las_vistas_previas_mas_antiguas(tmp_path):
+    history = ChatHistory(tmp_path, "s", preview_rows=50, memory_budget=4000)
+    for i in range(20):
+        history.append(answer(100, f"Respuesta {i}"))
+    assert history[-1]["preview"] is not None
+    assert history[0]["preview"] is None
+    # Las descartadas se releen del disco
+    assert len(history.preview(history[0])) == 50
+    footprint = history.footprint()
+    assert footprint["memory_bytes"] == sum(_message_bytes(m) for m in history) <= 4000
+    assert footprint["disk_bytes"] == sum(Path(m["data_path"]).stat().st_size for m in history)
+
+
+def test_sin_fichero_no_hay_vista_previa(tmp_path):
+    history = ChatHistory(tmp_path, "s", preview_rows=5, memory_budget=0)
+    first = history.append(answer(100))
+    history.append(answer(100))
+    assert first["preview"] is None
+    Path(first["data_path"]).unlink()
+    assert history.load_data(first) is None
+    assert history.preview(first) is None
+
+
+def test_clear_borra_los_ficheros(tmp_path):
+    history = ChatHistory(tmp_path, "s")
+    message = history.append(answer(10))
+    history.clear()
+    assert not Path(message["data_path"]).exists()
+    assert history.footprint() == {"messages": 0, "memory_bytes": 0, "disk_bytes": 0}
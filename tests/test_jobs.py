@@ -0,0 +1,227 @@
+import threading
+import time
+
+import pyarrow as pa
+import pytest
+
+import fakes
+from benchmarks.bench_jobs import GROUPS, comparison_sql
+from conftest import assert_same_result
+from jobs import BATCH, JobCancelled, JobManager, JobTimeout, split_union_all
+
+POLL = 0.02
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_job_que_termina_a_tiempo():
+    manager = JobManager(timeout=5, poll_interval=POLL)
+    client = fakes.FakeBigQueryClient(rows=10, latency=0.05)
+    job = manager.wait(manager.submit(client, "SELECT 1 AS x", owner="s1"))
+
+    assert job.done()
+    assert client.cancelled == []
+    assert manager.stats()["completed"] == 1 and manager.running() == 0
+
+
+def test_tiempo_maximo_cancela_el_job():
+    manager = JobManager(timeout=0.2, poll_interval=POLL)
+    client = fakes.FakeBigQueryClient(rows=10, latency=10)
+    tracked = manager.submit(client, "SELECT 1 AS x")
+    start = time.monotonic()
+
+    with pytest.raises(JobTimeout) as error:
+        manager.wait(tracked)
+
+    assert time.monotonic() - start < 0.2 + 5 * POLL
+    assert error.value.timeout == 0.2
+    assert client.cancelled == [tracked.job_id]
+    assert manager.stats()["timeout"] == 1 and manager.running() == 0
+
+
+def test_otra_pregunta_cancela_el_job_en_espera():
+    class Superseded(BaseException):
+        pass
+
+    manager = JobManager(timeout=10, poll_interval=POLL)
+    client = fakes.FakeBigQueryClient(rows=10, latency=10)
+    tracked = manager.submit(client, "SELECT 1 AS x", owner="s1")
+
+    def on_tick(seconds):
+        if seconds > 0.1:
+            raise Superseded()
+
+    with pytest.raises(Superseded):
+        manager.wait(tracked, on_tick=on_tick)
+    assert client.cancelled == [tracked.job_id]
+    assert manager.stats()["superseded"] == 1 and manager.running() == 0
+
+
+def test_cancelar_los_jobs_de_un_dueno_desde_otro_hilo():
+    manager = JobManager(timeout=10, poll_interval=POLL)
+    client = fakes.FakeBigQueryClient(rows=10, latency=10)
+    mine = manager.submit(client, "SELECT 1 AS x", owner="s1")
+    other = manager.submit(client, "SELECT 2 AS x", owner="s2")
+    threading.Timer(0.1, manager.cancel_owner, args=("s1",)).start()
+
+    with pytest.raises(JobCancelled) as error:
+        manager.wait(mine)
+    assert error.value.reason == "superseded"
+    assert client.cancelled == [mine.job_id]
+    assert manager.cancel_all() == 1
+    assert client.cancelled == [mine.job_id, other.job_id]
+
+
+def test_sesion_cerrada_cancela_sus_jobs_sin_nadie_esperando():
+    closed = set()
+    manager = JobManager(timeout=10, poll_interval=POLL, is_alive=lambda owner: owner not in closed)
+    client = fakes.FakeBigQueryClient(rows=10, latency=10)
+    orphan = manager.submit(client, "SELECT 1 AS x", owner="cerrada")
+    alive = manager.submit(client, "SELECT 2 AS x", owner="abierta")
+    time.sleep(3 * POLL)
+    assert client.cancelled == []
+
+    closed.add("cerrada")
+    assert wait_until(lambda: client.cancelled)
+    time.sleep(3 * POLL)
+    assert client.cancelled == [orphan.job_id]
+    assert manager.stats()["orphaned"] == 1
+    with pytest.raises(JobCancelled, match="orphaned"):
+        manager.wait(orphan)
+    manager.cancel_all()
+    assert alive.job_id in client.cancelled
+
+
+def test_prioridad_batch_con_su_propio_tiempo_maximo():
+    manager = JobManager(timeout=1, batch_timeout=60, poll_interval=POLL)
+    client = fakes.FakeBigQueryClient(rows=10)
+    batch = manager.submit(client, "SELECT 1 AS x", priority=BATCH)
+    interactive = manager.submit(client, "SELECT 2 AS x")
+
+    assert (batch.job.priority, batch.timeout) == ("BATCH", 60)
+    assert (interactive.job.priority, interactive.timeout) == ("INTERACTIVE", 1)
+    manager.wait(batch)
+    manager.wait(interactive)
+
+
+# --- split_union_all ---
+
+def test_ramas_orden_y_limite_de_la_union():
+    sql_query = comparison_sql(GROUPS[:3]) + "\nLIMIT 2"
+    sub_queries = split_union_all(sql_query)
+
+    assert len(sub_queries.queries) == 3
+    assert all("UNION" not in query and "ORDER BY" not in query for query in sub_queries.queries)
+    assert sub_queries.names == ["grupo", "peso_promedio", "nacimientos"]
+    assert (sub_queries.order, sub_queries.limit) == ([("grupo", False)], 2)
+
+
+def test_orden_por_posicion_descendente():
+    sub_queries = split_union_all(comparison_sql(GROUPS[:2]).replace("ORDER BY grupo", "ORDER BY 3 DESC"))
+    assert sub_queries.order == [("nacimientos", True)]
+
+
+@pytest.mark.parametrize("sql_query", [
+    "SELECT 1 AS x",
+    "SELECT 1 AS x UNION DISTINCT SELECT 2 AS x",
+    "WITH t AS (SELECT 1 AS x) SELECT x FROM t UNION ALL SELECT x FROM t",
+    "SELECT 1 AS x UNION ALL SELECT 2 AS x ORDER BY x + 1",
+    "SELECT 1 AS x UNION ALL SELECT 2 AS x ORDER BY x NULLS LAST",
+    "SELECT 1 AS x UNION ALL SELECT 2 AS x LIMIT 1 OFFSET 1",
+])
+def test_uniones_que_no_se_dividen(sql_query):
+    assert split_union_all(sql_query) is None
+
+
+# --- Sub-consultas en el pipeline ---
+
+@pytest.fixture
+def job_manager(pipeline, monkeypatch):
+    manager = JobManager(timeout=5, poll_interval=POLL)
+    monkeypatch.setattr(pipeline, "get_job_manager", lambda: manager)
+    return manager
+
+
+def branch_latency(latencies):
+    return lambda sql_query: next(
+        latency for (label, _), latency in zip(GROUPS, latencies) if label in sql_query
+    )
+
+
+def test_sub_consultas_en_paralelo_igual_que_la_union(pipeline, job_manager, run_sql):
+    sql_query = comparison_sql(GROUPS[:3])
+    latencies = [0.1, 0.2, 0.3]
+    client = fakes.FakeBigQueryClient(
+        latency=branch_latency(latencies),
+        table_factory=lambda query, _: pa.Table.from_pandas(run_sql(query), preserve_index=False),
+    )
+    start = time.monotonic()
+    df, error_occurred, is_empty, _ = pipeline.execute_sql_query(client, sql_query, quiet=True)
+    elapsed = time.monotonic() - start
+
+    assert (error_occurred, is_empty) == (False, False)
+    assert len(client.queries) == 3
+    assert not any("UNION" in query for query in client.queries)
+    assert elapsed < sum(latencies)
+    assert_same_result(df.astype({"grupo": str}), run_sql(sql_query))
+
+
+def test_rama_que_se_pasa_de_tiempo_cancela_las_demas(pipeline, job_manager):
+    job_manager.timeout = 0.2
+    client = fakes.FakeBigQueryClient(rows=1, latency=branch_latency([0.05, 10, 10]))
+    _, error_occurred, _, _ = pipeline.execute_sql_query(client, comparison_sql(GROUPS[:3]), quiet=True)
+
+    assert error_occurred
+    assert wait_until(lambda: job_manager.running() == 0)
+    assert len(client.cancelled) == 2
+
+
+def test_consulta_que_se_pasa_de_tiempo(pipeline, job_manager):
+    job_manager.timeout = 0.2
+    client = fakes.FakeBigQueryClient(rows=1, latency=10)
+    df, error_occurred, _, _ = pipeline.execute_sql_query(client, "SELECT 1 AS x", quiet=True)
+
+    assert df is None and error_occurred
+    assert len(client.cancelled) == 1
+    assert job_manager.stats()["timeout"] == 1
+
+
+@pytest.mark.parametrize("sql_query", ["SELECT 1 AS x", comparison_sql(GROUPS[:2])], ids=["simple", "union"])
+def test_cancelar_al_lider_no_cancela_a_los_seguidores(pipeline, job_manager, run_sql, sql_query):
+    client = fakes.FakeBigQueryClient(
+        latency=0.3,
+        table_factory=lambda query, _: pa.Table.from_pandas(run_sql(query), preserve_index=False),
+    )
+    flights = pipeline.get_single_flight()
+    shared = flights.stats()["shared"]
+    sub_queries = split_union_all(sql_query)
+    leader_jobs = len(sub_queries.queries) if sub_queries else 1
+    results = {}
+
+    def session(owner):
+        results[owner] = pipeline.execute_shared_query(client, sql_query, quiet=True, owner=owner)
+
+    leader = threading.Thread(target=session, args=("s1",))
+    leader.start()
+    assert wait_until(lambda: job_manager.running() == leader_jobs)
+    follower = threading.Thread(target=session, args=("s2",))
+    follower.start()
+    assert wait_until(lambda: flights.stats()["shared"] == shared + 1)
+
+    # La sesión del líder pasa a otra pregunta mientras el seguidor espera su resultado
+    job_manager.cancel_owner("s1")
+    leader.join()
+    follower.join()
+
+    (_, error_occurred, _, _), was_shared = results["s1"]
+    assert error_occurred and not was_shared
+    (df, error_occurred, _, _), was_shared = results["s2"]
+    assert not error_occurred and not was_shared
+    assert_same_result(df.astype({column: str for column in df.select_dtypes("category")}), run_sql(sql_query))
+    assert len(client.cancelled) == leader_jobs
+    assert len(client.queries) == 2 * leader_jobs
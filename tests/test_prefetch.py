@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import fakes
+from cost_gate import CostGate
+from jobs import JobManager
+from prefetch import Prefetcher, follow_up_queries
+
+POLL = 0.02
+BASE_SQL = (
+    "SELECT AVG(weight_pounds) AS peso_promedio\n"
+    "FROM `bigquery-public-data.samples.natality`\nWHERE year = 2005"
+)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+@pytest.fixture
+def job_manager(pipeline, monkeypatch):
+    manager = JobManager(timeout=30, poll_interval=POLL)
+    monkeypatch.setattr(pipeline, "get_job_manager", lambda: manager)
+    return manager
+
+
+@pytest.fixture
+def prefetcher(pipeline, job_manager):
+    """Prefetch de un solo hilo: lo que no está en marcha queda pendiente en el pool."""
+    executor = ThreadPoolExecutor(max_workers=1)
+    yield Prefetcher(
+        executor, CostGate(10 * 1024**3, 100 * 1024**3),
+        run=pipeline._run_prefetch_query, needed=lambda sql_query: True,
+    )
+    executor.shutdown(wait=True)
+
+
+def test_otra_pregunta_cancela_el_job_en_marcha_y_descarta_lo_pendiente(prefetcher, job_manager):
+    client = fakes.FakeBigQueryClient(rows=10, latency=30)
+    queries = follow_up_queries(BASE_SQL)[:3]
+    prefetcher.schedule(client, queries)
+    assert wait_until(lambda: job_manager.running() == 1)
+
+    start = time.monotonic()
+    prefetcher.cancel()
+    assert wait_until(lambda: client.cancelled)
+    assert time.monotonic() - start < 10 * POLL
+    prefetcher.executor.shutdown(wait=True)
+
+    # Un solo job lanzado, y cancelado; el resto ni llegó a empezar
+    assert len(client.queries) == 1 and len(client.cancelled) == 1
+    assert job_manager.running() == 0
+    stats = prefetcher.stats()
+    assert (stats["cancelled"], stats["completed"], stats["failed"]) == (len(queries), 0, 0)
+    # La reserva del presupuesto se devuelve
+    assert prefetcher.cost_gate.spent == 0
+
+
+def test_la_consulta_que_pide_el_turno_sigue_precargandose(prefetcher, job_manager):
+    client = fakes.FakeBigQueryClient(rows=10, latency=0.3)
+    queries = follow_up_queries(BASE_SQL)[:3]
+    prefetcher.schedule(client, queries)
+    assert wait_until(lambda: job_manager.running() == 1)
+
+    prefetcher.cancel(keep=queries[0][1])
+    prefetcher.executor.shutdown(wait=True)
+
+    assert client.cancelled == [] and len(client.queries) == 1
+    stats = prefetcher.stats()
+    assert (stats["completed"], stats["cancelled"]) == (1, len(queries) - 1)
+    assert prefetcher.observe(queries[0][1])
+
+
+def test_tanda_descartada_antes_de_lanzar_no_toca_bigquery(prefetcher, job_manager):
+    client = fakes.FakeBigQueryClient(rows=10)
+    blocker = prefetcher.executor.submit(time.sleep, 0.2)
+    prefetcher.schedule(client, follow_up_queries(BASE_SQL))
+    prefetcher.cancel()
+    blocker.result()
+    prefetcher.executor.shutdown(wait=True)
+
+    assert client.queries == [] and client.dry_runs == []
+    assert prefetcher.stats()["cancelled"] == 3
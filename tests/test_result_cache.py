@@ -0,0 +1,149 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from result_cache import ResultCache, canonicalize_sql, sql_fingerprint
+
+SQL = (
+    "SELECT state, COUNT(*) AS nacimientos FROM `bigquery-public-data.samples.natality` "
+    "WHERE year = 2005 AND state IN ('TX', 'CA') GROUP BY state"
+)
+
+
+def frame(rows=10):
+    return pd.DataFrame({"state": ["TX", "CA"] * (rows // 2), "nacimientos": range(rows)})
+
+
+def age(cache, sql_query, seconds):
+    """Retrasa la fecha de guardado de una entrada `seconds` segundos."""
+    path = cache.directory / f"{sql_fingerprint(sql_query)}.parquet"
+    saved = path.stat().st_mtime - seconds
+    os.utime(path, (saved, saved))
+
+
+@pytest.mark.parametrize("variant", [
+    SQL.replace("SELECT", "select").replace("GROUP BY", "group by").replace("COUNT", "count"),
+    SQL.replace(" ", "\n  "),
+    SQL.replace("('TX', 'CA')", "('CA', 'TX')"),
+    f"-- peso por estado\n{SQL};",
+    f"/* generado */ {SQL}",
+])
+def test_variantes_de_la_misma_consulta_comparten_clave(variant):
+    assert sql_fingerprint(variant) == sql_fingerprint(SQL)
+
+
+@pytest.mark.parametrize("other", [
+    SQL.replace("2005", "2006"),
+    SQL.replace("'TX'", "'tx'"),
+    SQL.replace("`bigquery-public-data.samples.natality`", "`bigquery-public-data.samples.NATALITY`"),
+])
+def test_literales_y_nombres_entre_comillas_si_distinguen(other):
+    assert sql_fingerprint(other) != sql_fingerprint(SQL)
+
+
+def test_forma_canonica():
+    assert canonicalize_sql("SELECT  x\nFROM t WHERE y IN (3, 1, 2) -- fin\n;") == (
+        "select x from t where y in ( 1 , 2 , 3 )"
+    )
+
+
+def test_acierto_devuelve_lo_guardado_y_cuenta_los_bytes(tmp_path):
+    cache = ResultCache(tmp_path)
+    assert cache.get(SQL) is None
+    assert cache.put(SQL, frame(), bytes_processed=1_000)
+
+    pd.testing.assert_frame_equal(cache.get(SQL.replace(" ", "  ")), frame())
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["bytes_saved"], stats["entries"]) == (1, 1, 1_000, 1)
+    # Otra instancia sobre el mismo directorio (otro proceso, o tras reiniciar) la encuentra
+    assert ResultCache(tmp_path).contains(SQL)
+
+
+def test_tipos_compactos_sobreviven_al_parquet(tmp_path):
+    df = pd.DataFrame({
+        "state": pd.Categorical(["TX", None, "CA"]),
+        "plurality": pd.array([1, None, 2], dtype="Int64"),
+        "is_male": pd.array([True, None, False], dtype="boolean"),
+        "weight_pounds": [7.1, 6.8, None],
+    })
+    cache = ResultCache(tmp_path)
+    cache.put(SQL, df)
+    pd.testing.assert_frame_equal(cache.get(SQL), df)
+
+
+def test_desalojo_lru_dentro_del_presupuesto(tmp_path):
+    queries = [SQL.replace("2005", str(year)) for year in (2001, 2002, 2003)]
+    probe = ResultCache(tmp_path / "medida")
+    probe.put(queries[0], frame(1_000))
+    size = probe.stats()["size_bytes"]
+
+    cache = ResultCache(tmp_path / "cache", max_bytes=int(size * 2.5))
+    cache.put(queries[0], frame(1_000))
+    time.sleep(0.01)
+    cache.put(queries[1], frame(1_000))
+    time.sleep(0.01)
+    # Usar la primera la vuelve la más reciente: sale la segunda
+    assert cache.get(queries[0]) is not None
+    time.sleep(0.01)
+    cache.put(queries[2], frame(1_000))
+
+    assert [cache.contains(query) for query in queries] == [True, False, True]
+    assert cache.stats()["size_bytes"] <= cache.max_bytes
+    assert len(list(cache.directory.glob("*.parquet"))) == 2
+
+
+def test_resultado_mayor_que_el_presupuesto_no_se_guarda(tmp_path):
+    cache = ResultCache(tmp_path, max_bytes=100)
+    assert not cache.put(SQL, frame(1_000))
+    assert not cache.contains(SQL)
+    assert list(cache.directory.glob("*.parquet")) == []
+
+
+def test_caducidad(tmp_path):
+    cache = ResultCache(tmp_path, ttl=60)
+    cache.put(SQL, frame())
+    age(cache, SQL, 30)
+    assert cache.get(SQL) is not None
+
+    age(cache, SQL, 60)
+    assert not cache.contains(SQL)
+    assert cache.get(SQL) is None
+    assert cache.stats()["entries"] == 0
+    assert list(cache.directory.glob("*.parquet")) == []
+
+
+def test_sin_ttl_no_caduca(tmp_path):
+    cache = ResultCache(tmp_path)
+    cache.put(SQL, frame())
+    age(cache, SQL, 10 * 365 * 24 * 3600)
+    assert cache.get(SQL) is not None
+
+
+def test_cambio_de_esquema_vacia_la_cache(tmp_path):
+    cache = ResultCache(tmp_path, schema_text="esquema")
+    cache.put(SQL, frame())
+    assert ResultCache(tmp_path, schema_text="esquema").contains(SQL)
+
+    other = ResultCache(tmp_path, schema_text="otro esquema")
+    assert not other.contains(SQL)
+    assert other.stats()["entries"] == 0
+    assert list(other.directory.glob("*.parquet")) == []
+
+
+def test_el_pipeline_no_sirve_resultados_de_otro_esquema(pipeline):
+    import fakes
+
+    client = fakes.FakeBigQueryClient(
+        tables={"bigquery-public-data.samples.natality": (fakes.NATALITY_SCHEMA, "", 100)},
+    )
+    tables_info = ["bigquery-public-data.samples.natality"]
+    pipeline.refresh_schema(client, tables_info)
+    pipeline.get_result_cache().put(SQL, frame())
+    assert pipeline.get_result_cache().contains(SQL)
+
+    # La tabla cambia (más filas) y la instantánea del esquema se relee
+    client.tables["bigquery-public-data.samples.natality"] = (fakes.NATALITY_SCHEMA, "", 200)
+    pipeline.get_schema_catalog().refresh(client, tables_info, force=True)
+    assert not pipeline.get_result_cache().contains(SQL)
@@ -0,0 +1,91 @@
+import pytest
+
+import fakes
+from benchmarks.bench_schema import QUESTIONS
+from schema import SchemaCatalog, SchemaIndex
+
+# Otras tablas de `bigquery-public-data.samples` con columnas de nombre corto
+OTHER_TABLES = {
+    "bigquery-public-data.samples.gsod": ([
+        ("station_number", "INTEGER", "The World Meteorological Organization (WMO) station number."),
+        ("year", "INTEGER", "The year the data was collected in."),
+        ("mo", "INTEGER", "The month the data was collected in."),
+        ("da", "INTEGER", "The day the data was collected in."),
+        ("mean_temp", "FLOAT", "The mean temperature of the day in degrees Fahrenheit."),
+    ], "Weather data from 1929 to 2010.", 114420316),
+    "bigquery-public-data.samples.wikipedia": ([
+        ("title", "STRING", "The title of the page."),
+        ("id", "INTEGER", "A unique ID for the article that was revised."),
+        ("contributor_username", "STRING", "Username of the contributor."),
+    ], "Revisions of Wikipedia articles.", 314000000),
+}
+
+
+@pytest.fixture(scope="module")
+def catalog(tmp_path_factory):
+    """Catálogo leído de un BigQuery falso con natality y otras tablas del dataset."""
+    client = fakes.FakeBigQueryClient(tables={
+        **OTHER_TABLES,
+        "bigquery-public-data.samples.natality": (fakes.NATALITY_SCHEMA, "Births 1969-2008.", 137826763),
+    })
+    catalog = SchemaCatalog(str(tmp_path_factory.mktemp("schema") / "snapshot.json"))
+    catalog.refresh(client, sorted(client.tables))
+    return catalog
+
+
+@pytest.fixture(scope="module")
+def index(catalog):
+    return SchemaIndex(catalog.tables())
+
+
+@pytest.mark.parametrize("question", [
+    "¿Cuántos bebés nacidos en Texas en 2005?",
+    "Edad promedio de la madre",
+    "Como evoluciona el peso",
+    "¿Cuántos días de gestación idos y venidos?",
+])
+def test_los_nombres_cortos_no_coinciden_dentro_de_palabras(index, question):
+    selection = index.select(question)
+    assert list(selection) == ["natality"]
+
+
+def test_el_nombre_exacto_de_una_columna_si_cuenta(index):
+    scores = index.score("Media de mean_temp por mo")
+    assert scores[0][1:] == ("gsod", "mean_temp", True)
+    assert ("gsod", "mo") in {(table, name) for _, table, name, _ in scores}
+    assert "da" not in {name for _, _, name, _ in scores}
+
+
+@pytest.mark.parametrize("question, columns", QUESTIONS)
+def test_las_columnas_necesarias_siguen_elegidas(index, question, columns):
+    selection = index.select(question)
+    chosen = {field.split(" ")[0] for field in selection.get("natality", [])}
+    assert columns <= chosen
+    assert set(selection) == {"natality"}
+
+
+def test_sin_coincidencias_solo_la_tabla_por_defecto(index, catalog):
+    selection = index.select("Hola, ¿qué tal?")
+    assert selection == {"natality": catalog.tables()["natality"]["campos"]}
+
+    # Si la tabla por defecto no es candidata, solo la primera de las pedidas
+    selection = index.select("Hola, ¿qué tal?", tables=["wikipedia", "gsod"])
+    assert list(selection) == ["wikipedia"]
+    assert index.select("Hola", tables=["no_existe"]) == {}
+
+
+def test_el_prompt_no_lleva_tablas_ajenas(pipeline):
+    client = fakes.FakeBigQueryClient(tables={
+        **OTHER_TABLES,
+        "bigquery-public-data.samples.natality": (fakes.NATALITY_SCHEMA, "Births 1969-2008.", 137826763),
+    })
+    tables_info = sorted(client.tables)
+    pipeline.refresh_schema(client, tables_info)
+
+    relevant = pipeline.build_relevant_schema("¿Cuántos bebés nacidos en Texas en 2005?", tables_info)
+    assert "Tabla: natality" in relevant
+    assert "wikipedia" not in relevant and "gsod" not in relevant
+
+    fallback = pipeline.build_relevant_schema("Hola, ¿qué tal?", tables_info)
+    assert "Tabla: natality" in fallback
+    assert "wikipedia" not in fallback and "gsod" not in fallback
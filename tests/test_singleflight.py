@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+import fakes
+from singleflight import SingleFlight
+
+QUESTION = "¿Cuál es el peso promedio por año entre 2000 y 2008?"
+
+
+def burst(ask, sessions, gemini, bigquery, api_keys=None):
+    """`sessions` turnos con la misma pregunta, lanzados a la vez desde hilos distintos."""
+    barrier = threading.Barrier(sessions)
+    responses = [None] * sessions
+
+    def session(i):
+        barrier.wait()
+        responses[i] = ask(
+            QUESTION, gemini, bigquery, session_id=f"s{i}",
+            gemini_api_key=api_keys[i] if api_keys else None,
+        )
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def model_calls(gemini):
+    sql = sum("PREGUNTA DEL USUARIO" in call["contents"] for call in gemini.calls)
+    return sql, len(gemini.calls) - sql
+
+
+@pytest.mark.parametrize("sessions", [2, 8, 32])
+def test_preguntas_identicas_una_llamada_al_modelo_y_un_job(ask, sessions):
+    gemini = fakes.FakeGeminiClient(latency=0.1)
+    bigquery = fakes.FakeBigQueryClient(rows=40, latency=0.2)
+    responses = burst(ask, sessions, gemini, bigquery)
+
+    assert model_calls(gemini) == (1, 1)
+    assert len(bigquery.queries) == 1
+    assert len({response["sql_query"] for response in responses}) == 1
+    assert len({response["content"] for response in responses}) == 1
+    first = responses[0]["data"]
+    assert all(response["data"].equals(first) for response in responses)
+
+
+def test_otra_api_key_no_comparte_las_respuestas_del_modelo(ask):
+    gemini = fakes.FakeGeminiClient(latency=0.1)
+    bigquery = fakes.FakeBigQueryClient(rows=40, latency=0.2)
+    burst(ask, 4, gemini, bigquery, api_keys=["clave-a", "clave-a", "clave-b", "clave-b"])
+    # Un vuelo por credencial en el modelo; el job de BigQuery sí se comparte
+    assert model_calls(gemini) == (2, 2)
+    assert len(bigquery.queries) == 1
+
+
+def test_el_fallo_del_modelo_llega_a_todas_las_sesiones(ask):
+    def responder(contents):
+        time.sleep(0.2)
+        raise fakes.FakeAPIError(500, "INTERNAL")
+
+    gemini = fakes.FakeGeminiClient(responder=responder)
+    bigquery = fakes.FakeBigQueryClient(rows=40)
+    responses = burst(ask, 8, gemini, bigquery)
+    assert len(gemini.calls) == 1
+    assert not bigquery.queries
+    assert all(response["data"] is None and response["sql_query"] is None for response in responses)
+    assert len({response["content"] for response in responses}) == 1
+
+
+# --- SingleFlight ---
+
+class Cancelled(Exception):
+    pass
+
+
+def leader_and_follower(flights, leader_fn, follower_fn):
+    """El líder entra en `do` y, con su trabajo en curso, llega un seguidor con la misma clave."""
+    started = threading.Event()
+    results = {}
+
+    def leader():
+        def work():
+            started.set()
+            return leader_fn()
+
+        try:
+            results["leader"] = flights.do("clave", work, retry_on=(Cancelled,))
+        except Exception as e:
+            results["leader"] = e
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait()
+    try:
+        results["follower"] = flights.do("clave", follower_fn, retry_on=(Cancelled,))
+    except Exception as e:
+        results["follower"] = e
+    thread.join()
+    return results
+
+
+def slow(value):
+    time.sleep(0.2)
+    if isinstance(value, Exception):
+        raise value
+    return value
+
+
+def test_el_seguidor_recibe_el_resultado_del_lider():
+    flights = SingleFlight()
+    results = leader_and_follower(flights, lambda: slow("lider"), lambda: "seguidor")
+    assert results == {"leader": ("lider", False), "follower": ("lider", True)}
+    assert flights.stats() == {"leaders": 1, "shared": 1, "inflight": 0}
+
+
+def test_el_error_del_lider_llega_al_seguidor():
+    results = leader_and_follower(SingleFlight(), lambda: slow(ValueError("fallo")), lambda: "seguidor")
+    assert isinstance(results["leader"], ValueError)
+    assert results["follower"] is results["leader"]
+
+
+def test_resultado_propio_del_lider_el_seguidor_lo_repite():
+    results = leader_and_follower(SingleFlight(), lambda: slow(Cancelled()), lambda: "seguidor")
+    assert isinstance(results["leader"], Cancelled)
+    assert results["follower"] == ("seguidor", False)
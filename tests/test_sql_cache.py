@@ -0,0 +1,55 @@
+from sql_cache import SQLTemplateCache, bind_template, build_template, normalize_question
+
+SQL_2005 = (
+    "SELECT AVG(weight_pounds) FROM `bigquery-public-data.samples.natality` "
+    "WHERE year = 2005 AND state = 'TX'"
+)
+
+
+def test_literales_de_la_pregunta():
+    template, literals = normalize_question("¿Peso promedio en Texas en 2005?")
+    assert template == "peso promedio en {state} en {year}"
+    assert literals == [("state", "TX"), ("year", 2005)]
+
+
+def test_abreviaturas_solo_en_mayusculas():
+    assert normalize_question("Nacimientos en CA")[1] == [("state", "CA")]
+    assert normalize_question("nacimientos en ca")[1] == []
+
+
+def test_palabras_corrientes_no_son_estados():
+    assert normalize_question("Nacimientos en la montaña en 2005")[1] == [("year", 2005)]
+    assert normalize_question("¿Más partos tras la nevada de 2005?")[1] == [("year", 2005)]
+    assert normalize_question("bebés de pelo colorado")[1] == []
+
+
+def test_estados_ambiguos_con_contexto_o_mayuscula():
+    assert normalize_question("peso en nevada")[1] == [("state", "NV")]
+    assert normalize_question("estado de colorado")[1] == [("state", "CO")]
+    assert normalize_question("Florida vs Texas")[1] == [("state", "FL"), ("state", "TX")]
+
+
+def test_plantilla_reenlaza_otros_literales():
+    _, literals = normalize_question("Peso promedio en Texas en 2005")
+    template = build_template(SQL_2005, literals)
+    assert "2005" not in template and "'TX'" not in template
+    _, other = normalize_question("Peso promedio en California en 2007")
+    assert bind_template(template, other) == SQL_2005.replace("2005", "2007").replace("'TX'", "'CA'")
+
+
+def test_numero_ambiguo_no_se_cachea():
+    _, literals = normalize_question("Los 2 estados con más nacimientos")
+    assert build_template("SELECT ROUND(AVG(x), 2) FROM t LIMIT 2", literals) is None
+
+
+def test_cache_acierta_con_otra_pregunta_de_la_misma_plantilla(tmp_path):
+    cache = SQLTemplateCache(tmp_path / "templates.sqlite", "esquema")
+    assert cache.store("Peso promedio en Texas en 2005", SQL_2005)
+    assert cache.lookup("Peso promedio en Ohio en 2001") == (
+        SQL_2005.replace("2005", "2001").replace("'TX'", "'OH'")
+    )
+    assert cache.lookup("Peso promedio en la montaña en 2001") is None
+    # Cambiar el esquema vacía la caché
+    assert SQLTemplateCache(tmp_path / "templates.sqlite", "otro esquema").lookup(
+        "Peso promedio en Ohio en 2001"
+    ) is None
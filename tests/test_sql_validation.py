@@ -0,0 +1,140 @@
+import pytest
+
+import fakes
+
+TABLE = "`bigquery-public-data.samples.natality`"
+
+
+@pytest.fixture
+def validator(pipeline):
+    """El validador del pipeline sin conexión: esquema curado y tablas por defecto."""
+    return pipeline.get_sql_validator()
+
+
+def test_consulta_valida_pasa_sin_cambios(validator):
+    sql_query = f"SELECT year, AVG(weight_pounds) AS peso FROM {TABLE} GROUP BY year"
+    assert validator.validate(sql_query) == (sql_query, [])
+
+
+def test_error_de_sintaxis_con_linea_y_columna(validator):
+    _, errors = validator.validate(
+        f"SELECT year, COUNT(*) AS n\nFROM {TABLE} WHERE (year > 2000 GROUP BY year"
+    )
+    assert len(errors) == 1
+    assert errors[0].startswith("Error de sintaxis en la línea 2")
+
+
+def test_columna_inexistente(validator):
+    _, errors = validator.validate(f"SELECT year, baby_name FROM {TABLE} LIMIT 10")
+    assert errors == ["La columna 'baby_name' no existe en el esquema."]
+
+
+def test_alias_y_cte_no_cuentan_como_columnas_desconocidas(validator):
+    sql_query = (
+        f"WITH por_anio AS (SELECT year AS anio, COUNT(*) AS total FROM {TABLE} GROUP BY anio)\n"
+        "SELECT p.anio, p.total FROM por_anio AS p ORDER BY p.total DESC"
+    )
+    _, errors = validator.validate(sql_query)
+    assert errors == []
+
+
+@pytest.mark.parametrize("sql_query", [
+    f"DELETE FROM {TABLE} WHERE year < 1980",
+    f"UPDATE {TABLE} SET year = 2000 WHERE TRUE",
+    f"INSERT INTO {TABLE} (year) VALUES (2000)",
+    f"DROP TABLE {TABLE}",
+    f"CREATE TABLE copia AS SELECT * FROM {TABLE}",
+])
+def test_solo_se_permiten_lecturas(validator, sql_query):
+    _, errors = validator.validate(sql_query)
+    assert len(errors) == 1
+    assert "no permitida" in errors[0] or "Solo se permiten consultas SELECT" in errors[0]
+
+
+def test_varias_sentencias(validator):
+    _, errors = validator.validate(f"SELECT year FROM {TABLE} LIMIT 1; SELECT 1")
+    assert errors == ["Se esperaba una sola sentencia SELECT y hay 2."]
+
+
+def test_limit_en_filas_sin_agregar(validator, pipeline):
+    checked, errors = validator.validate(f"SELECT year, state FROM {TABLE}")
+    assert errors == []
+    assert checked.endswith(f"LIMIT {pipeline.SQL_ROW_LIMIT}")
+
+    checked, _ = validator.validate(f"SELECT year FROM {TABLE} LIMIT 99999999")
+    assert f"LIMIT {pipeline.SQL_ROW_LIMIT}" in checked
+
+    small = f"SELECT year FROM {TABLE} LIMIT 5"
+    assert validator.validate(small) == (small, [])
+
+
+@pytest.mark.parametrize("table", [
+    "`otroproyecto.otrodataset.natality`",
+    "`bigquery-public-data.otrodataset.natality`",
+    "natality",
+])
+def test_tabla_de_otro_proyecto_o_dataset(validator, table):
+    _, errors = validator.validate(f"SELECT year, COUNT(*) AS n FROM {table} GROUP BY year")
+    assert len(errors) == 1
+    assert errors[0].startswith(f"La tabla '{table}' no existe")
+    assert TABLE in errors[0]
+
+
+def test_columnas_por_tabla_referenciada():
+    from sql_validation import SQLValidator
+
+    validator = SQLValidator({
+        "proyecto.datos.natality": {"year", "weight_pounds"},
+        "proyecto.datos.deaths": {"year", "cause"},
+    })
+    # `cause` existe, pero no en la tabla que lee la consulta
+    _, errors = validator.validate(
+        "SELECT year, cause, COUNT(*) AS n FROM `proyecto.datos.natality` GROUP BY year, cause"
+    )
+    assert errors == ["La columna 'cause' no existe en el esquema."]
+
+    _, errors = validator.validate(
+        "SELECT n.year, n.cause, d.cause AS causa FROM `proyecto.datos.natality` AS n "
+        "JOIN `proyecto.datos.deaths` AS d ON n.year = d.year LIMIT 10"
+    )
+    assert errors == ["La columna 'n.cause' no existe en el esquema."]
+
+
+def test_el_id_completo_sale_de_la_instantanea():
+    from sql_validation import schema_from_table_info
+
+    table_info = {
+        "natality": {"campos": ["year (INTEGER) - Año"]},
+        "deaths": {"id": "otro.dataset.deaths", "campos": ["cause (STRING)"]},
+    }
+    schema = schema_from_table_info(table_info, ["bigquery-public-data.samples.natality"])
+    assert schema == {
+        "bigquery-public-data.samples.natality": {"year"},
+        "otro.dataset.deaths": {"cause"},
+    }
+
+
+def test_reparacion_con_el_diagnostico_del_validador(pipeline):
+    good = f"SELECT year, COUNT(*) AS nacimientos FROM {TABLE} GROUP BY year"
+    gemini = fakes.FakeGeminiClient(responder=lambda prompt: good)
+    bad = f"SELECT year, COUNT(*) AS nacimientos FROM {TABLE} GROUP BY anio_nacimiento"
+
+    checked, errors, repairs = pipeline.validate_sql_query(
+        gemini, pipeline.default_model_config(), "nacimientos por año", bad, [TABLE], [],
+    )
+    assert (checked, errors, repairs) == (good, [], 1)
+    assert len(gemini.calls) == 1
+    assert "La columna 'anio_nacimiento' no existe en el esquema." in gemini.calls[0]["contents"]
+
+
+def test_reparacion_limitada(pipeline):
+    bad = f"SELECT peso FROM {TABLE} LIMIT 10"
+    gemini = fakes.FakeGeminiClient(responder=lambda prompt: bad)
+
+    checked, errors, repairs = pipeline.validate_sql_query(
+        gemini, pipeline.default_model_config(), "pesos", bad, [TABLE], [],
+    )
+    assert checked == bad
+    assert errors == ["La columna 'peso' no existe en el esquema."]
+    assert repairs == pipeline.MAX_SQL_REPAIRS
+    assert len(gemini.calls) == pipeline.MAX_SQL_REPAIRS
@@ -0,0 +1,105 @@
+import os
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import fakes
+from streaming import cleanup_spill_dir, new_spill_path, stream_query_result, to_compact_dataframe
+
+SQL = "SELECT year, state, weight_pounds, mother_age FROM `bigquery-public-data.samples.natality`"
+PAGE = 1_000
+
+
+def stream(tmp_path, rows, max_rows=10**9, max_bytes=10**12, **kwargs):
+    job = fakes.FakeBigQueryClient(rows=rows).query(SQL)
+    return stream_query_result(
+        job, new_spill_path(tmp_path / "spill"), max_rows=max_rows, max_bytes=max_bytes,
+        page_size=PAGE, **kwargs,
+    )
+
+
+def page_bytes():
+    return fakes.default_table(SQL, 25_000).to_batches(max_chunksize=PAGE)[0].nbytes
+
+
+def test_sin_tope_se_descarga_todo(tmp_path):
+    df = stream(tmp_path, rows=5_000, max_rows=10_000)
+    assert len(df) == 5_000
+    assert (df.attrs["truncated"], df.attrs["total_rows"]) == (False, 5_000)
+
+
+@pytest.mark.parametrize("max_rows", [1, PAGE, 2_500, 12_345])
+def test_tope_de_filas(tmp_path, max_rows):
+    df = stream(tmp_path, rows=25_000, max_rows=max_rows)
+    assert len(df) == max_rows
+    assert (df.attrs["truncated"], df.attrs["total_rows"]) == (True, 25_000)
+
+
+def test_tope_de_filas_igual_al_resultado_no_lo_trunca(tmp_path):
+    df = stream(tmp_path, rows=5_000, max_rows=5_000)
+    assert len(df) == 5_000 and not df.attrs["truncated"]
+
+
+def test_tope_de_bytes_corta_tras_la_pagina_que_lo_alcanza(tmp_path):
+    df = stream(tmp_path, rows=25_000, max_bytes=int(page_bytes() * 2.5))
+    assert len(df) == 3 * PAGE
+    assert (df.attrs["truncated"], df.attrs["total_rows"]) == (True, 25_000)
+
+
+def test_tope_de_bytes_en_la_ultima_pagina_no_trunca(tmp_path):
+    df = stream(tmp_path, rows=3 * PAGE, max_bytes=int(page_bytes() * 2.5))
+    assert len(df) == 3 * PAGE and not df.attrs["truncated"]
+
+
+def test_primera_pagina_antes_del_resto_con_tipos_compactos(tmp_path):
+    pages = []
+    df = stream(tmp_path, rows=5_000, on_first_page=pages.append)
+
+    assert len(pages) == 1 and len(pages[0]) == PAGE
+    pd.testing.assert_frame_equal(pages[0], df.iloc[:PAGE])
+    assert isinstance(df["state"].dtype, pd.CategoricalDtype)
+    assert df["year"].dtype == pd.Int64Dtype() and df["mother_age"].dtype == pd.Int64Dtype()
+
+
+def test_lo_descargado_se_vuelca_a_parquet(tmp_path):
+    df = stream(tmp_path, rows=25_000, max_rows=2_500)
+    spilled = to_compact_dataframe(pq.read_table(df.attrs["result_path"]))
+    pd.testing.assert_frame_equal(spilled, df)
+
+
+def test_resultado_vacio(tmp_path):
+    df = stream(tmp_path, rows=0)
+    assert df.empty and list(df.columns) == ["year", "state", "weight_pounds", "mother_age"]
+    assert (df.attrs["truncated"], df.attrs["total_rows"], df.attrs["result_path"]) == (False, 0, None)
+
+
+def test_limpieza_de_volcados_antiguos(tmp_path):
+    old, recent = new_spill_path(tmp_path), new_spill_path(tmp_path)
+    for path in (old, recent):
+        path.write_bytes(b"")
+    stale = time.time() - 3_600
+    os.utime(old, (stale, stale))
+
+    cleanup_spill_dir(tmp_path, max_age=60)
+    assert not old.exists() and recent.exists()
+    cleanup_spill_dir(tmp_path / "no_existe", max_age=60)
+
+
+# --- En el pipeline ---
+
+def test_respuesta_truncada_indica_el_total(ask, pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "MAX_RESULT_ROWS", 2_500)
+    monkeypatch.setattr(pipeline, "RESULT_PAGE_SIZE", PAGE)
+    gemini = fakes.FakeGeminiClient()
+    bigquery = fakes.FakeBigQueryClient(rows=25_000)
+
+    response = ask("¿Peso promedio por año entre 2000 y 2008?", gemini, bigquery)
+    assert len(response["data"]) == 2_500
+    assert (response["truncated"], response["total_rows"]) == (True, 25_000)
+
+    # Servida desde la caché de resultados sigue constando como truncada
+    cached = ask("¿Peso promedio por año entre 2000 y 2008?", gemini, bigquery)
+    assert len(bigquery.queries) == 1
+    assert (cached["truncated"], cached["total_rows"]) == (True, 25_000)
@@ -0,0 +1,83 @@
+import time
+
+import fakes
+from pipeline import TurnRenderer
+
+EXPLANATION = "El peso promedio al nacer se mantuvo estable en torno a 7.3 libras en todo el periodo."
+
+
+class RecordingRenderer(TurnRenderer):
+    """Anota cuándo llega cada etapa del turno."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+
+    def _mark(self, name):
+        self.events.append((name, time.perf_counter() - self.start))
+
+    def result(self, df_result):
+        self._mark("result")
+        # Pintar la tabla en el navegador lleva su tiempo
+        time.sleep(0.2)
+        self._mark("result_done")
+
+    def figure(self, fig):
+        self._mark("figure")
+
+    def explanation(self, chunks, header=None):
+        parts = []
+        for chunk in chunks:
+            self._mark("chunk")
+            parts.append(chunk)
+        return "".join(parts)
+
+    def first(self, name):
+        return next(t for event, t in self.events if event == name)
+
+
+def test_tabla_antes_que_la_explicacion_y_explicacion_por_fragmentos(ask):
+    requested = {}
+
+    def responder(contents):
+        if "PREGUNTA DEL USUARIO" in contents:
+            return fakes.default_responder(contents)
+        requested["explanation"] = time.perf_counter()
+        return EXPLANATION
+
+    gemini = fakes.FakeGeminiClient(responder=responder, latency=0.05, token_latency=0.01)
+    bigquery = fakes.FakeBigQueryClient(rows=40, latency=0.05)
+    renderer = RecordingRenderer()
+    response = ask("¿Peso promedio por año entre 2000 y 2008?", gemini, bigquery, renderer=renderer)
+
+    chunks = [t for event, t in renderer.events if event == "chunk"]
+    assert len(chunks) == len(EXPLANATION.split(" "))
+    assert response["content"] == EXPLANATION
+    # La tabla y el gráfico se pintan antes del primer token de la explicación...
+    assert renderer.first("result") < renderer.first("figure") <= chunks[0]
+    # ...y la explicación se pide mientras se pinta la tabla, no después
+    assert requested["explanation"] - renderer.start < renderer.first("result_done") - 0.1
+    # La tabla no espera a la explicación entera: el streaming sigue después
+    assert chunks[-1] - renderer.first("result") >= 0.05
+
+
+def test_fallo_del_streaming_a_mitad_deja_texto_de_respaldo(ask):
+    errors = []
+
+    class BrokenModels(fakes._FakeModels):
+        def generate_content_stream(self, model, contents, config=None):
+            yield fakes.FakeResponse("El peso ")
+            raise fakes.FakeAPIError(500, "INTERNAL")
+
+    import pipeline
+
+    gemini = fakes.FakeGeminiClient()
+    gemini.models = BrokenModels(gemini)
+    pipeline.set_error_reporter(errors.append)
+    try:
+        response = ask("¿Peso promedio por año entre 2000 y 2008?", gemini, fakes.FakeBigQueryClient(rows=40))
+    finally:
+        pipeline.set_error_reporter(pipeline.logger.error)
+    assert response["data"] is not None
+    assert response["content"] == "El peso Error al generar el análisis de los resultados."
+    assert errors and "Error al generar el análisis" in errors[0]
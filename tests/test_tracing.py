@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+import fakes
+import tracing
+from tracing import Trace, Tracer
+
+QUESTION = "¿Peso promedio por año entre 2000 y 2008?"
+MODEL_LATENCY = 0.05
+QUERY_LATENCY = 0.1
+ROWS = 40
+
+
+class JsonLines(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.traces = []
+
+    def emit(self, record):
+        self.traces.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def tracer(pipeline, monkeypatch):
+    """Tracer propio que escribe todas las trazas; devuelve (tracer, trazas escritas)."""
+    tracer = Tracer(sample_rate=1.0)
+    monkeypatch.setattr(pipeline, "get_tracer", lambda: tracer)
+    handler = JsonLines()
+    tracing.logger.addHandler(handler)
+    yield tracer, handler.traces
+    tracing.logger.removeHandler(handler)
+
+
+def spans_by_name(trace):
+    return {span["name"]: span for span in trace["spans"]}
+
+
+def metric(tracer, line_start):
+    """Valor de la primera línea de /metrics que empieza por `line_start`."""
+    for line in tracer.metrics.render().splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+# --- Trace ---
+
+def test_spans_anidados_con_padre_y_duracion():
+    trace = Trace(sampled=True)
+    with trace.span("execution") as outer:
+        with trace.span("query", priority="INTERACTIVE") as inner:
+            time.sleep(0.02)
+            inner.set(job_id="j1")
+        outer.set(shared=False)
+
+    spans = trace.to_dict()["spans"]
+    assert [(span["name"], span["parent"]) for span in spans] == [("execution", None), ("query", "execution")]
+    assert spans[1]["priority"] == "INTERACTIVE" and spans[1]["job_id"] == "j1"
+    assert 20 <= spans[1]["duration_ms"] <= spans[0]["duration_ms"]
+    assert spans[1]["start_ms"] >= spans[0]["start_ms"]
+    assert [entry["name"] for entry in trace.breakdown()] == ["execution", "query"]
+
+
+def test_etapas_de_otros_hilos_son_de_primer_nivel():
+    trace = Trace(sampled=True)
+    with trace.span("explanation"):
+        thread = threading.Thread(target=lambda: trace.span("visualization").__enter__())
+        thread.start()
+        thread.join()
+    parents = {span.name: span.parent for span in trace.spans}
+    assert parents == {"explanation": None, "visualization": None}
+
+
+def test_tope_de_spans():
+    trace = Trace(sampled=True, max_spans=3)
+    for i in range(10):
+        with trace.span(f"etapa{i}") as span:
+            span.set(i=i)
+    assert [span.name for span in trace.spans] == ["etapa0", "etapa1", "etapa2"]
+
+
+def test_tiempo_hasta_el_primer_fragmento():
+    trace = Trace(sampled=True)
+
+    def chunks():
+        time.sleep(0.03)
+        yield "a"
+        time.sleep(0.03)
+        yield "b"
+
+    with trace.span("explanation") as span:
+        assert list(trace.timed_stream(span, chunks())) == ["a", "b"]
+    attrs = trace.spans[0].attrs
+    assert 30 <= attrs["first_chunk_ms"] < trace.spans[0].duration_ms
+
+
+# --- Un turno en los backends falsos ---
+
+def test_spans_y_tiempos_de_un_turno(ask, tracer):
+    tracer, traces = tracer
+    gemini = fakes.FakeGeminiClient(latency=MODEL_LATENCY)
+    bigquery = fakes.FakeBigQueryClient(rows=ROWS, latency=QUERY_LATENCY)
+
+    response = ask(QUESTION, gemini, bigquery)
+
+    (trace,) = traces
+    assert (trace["trace_id"], trace["status"]) == (response["trace_id"], "ok")
+    spans = spans_by_name(trace)
+    assert [(entry["name"], entry["parent"]) for entry in response["timings"]] == [
+        (span["name"], span["parent"]) for span in trace["spans"]
+    ]
+    for name in ("sql_generation", "execution", "explanation", "visualization"):
+        assert spans[name]["parent"] is None
+    assert spans["validation"]["parent"] == "sql_generation"
+    assert {spans[name]["parent"] for name in ("result_cache", "query", "download")} == {"execution"}
+
+    # Los tiempos reflejan las latencias de los backends
+    assert spans["sql_generation"]["duration_ms"] >= MODEL_LATENCY * 1000
+    assert spans["query"]["duration_ms"] >= QUERY_LATENCY * 1000
+    assert spans["execution"]["duration_ms"] >= (
+        spans["result_cache"]["duration_ms"] + spans["query"]["duration_ms"] + spans["download"]["duration_ms"]
+    )
+    assert spans["query"]["start_ms"] >= spans["sql_generation"]["start_ms"] + spans["sql_generation"]["duration_ms"]
+    assert trace["duration_ms"] >= max(span["start_ms"] + span["duration_ms"] for span in trace["spans"])
+
+    # Atributos de cada etapa
+    assert spans["sql_generation"]["from_cache"] is False and spans["sql_generation"]["prompt_tokens"] > 0
+    assert spans["result_cache"]["hit"] is False
+    assert spans["query"]["job_id"] == "fake-job-1"
+    assert spans["query"]["bytes_processed"] == ROWS * 200
+    assert spans["download"]["rows"] == ROWS
+    assert spans["execution"]["shared"] is False
+
+    assert metric(tracer, 'natality_turns_total{status="ok"}') == 1
+    assert metric(tracer, "natality_bigquery_bytes_processed_total") == ROWS * 200
+    assert metric(tracer, 'natality_stage_duration_seconds_count{stage="query"}') == 1
+
+
+def test_turno_servido_por_las_caches(ask, tracer):
+    tracer, traces = tracer
+    gemini = fakes.FakeGeminiClient(latency=MODEL_LATENCY)
+    bigquery = fakes.FakeBigQueryClient(rows=ROWS, latency=QUERY_LATENCY)
+    ask(QUESTION, gemini, bigquery)
+    ask(QUESTION, gemini, bigquery)
+
+    spans = spans_by_name(traces[1])
+    assert spans["sql_generation"]["from_cache"] is True
+    assert spans["result_cache"]["hit"] is True
+    assert "query" not in spans and "download" not in spans
+    assert spans["execution"]["duration_ms"] < QUERY_LATENCY * 1000
+
+    assert metric(tracer, 'natality_turns_total{status="ok"}') == 2
+    assert metric(tracer, 'natality_stage_duration_seconds_count{stage="execution"}') == 2
+    assert metric(tracer, 'natality_stage_duration_seconds_count{stage="query"}') == 1
+    # Solo el primer turno procesó bytes en BigQuery
+    assert metric(tracer, "natality_bigquery_bytes_processed_total") == ROWS * 200
+
+
+def test_turno_con_error_queda_en_la_traza_y_las_metricas(ask, tracer):
+    tracer, traces = tracer
+
+    def broken(sql_query, rows):
+        raise RuntimeError("Fallo de BigQuery")
+
+    response = ask(QUESTION, fakes.FakeGeminiClient(), fakes.FakeBigQueryClient(table_factory=broken))
+
+    assert response["status"] == "error"
+    assert traces[0]["status"] == "error"
+    assert "explanation" not in spans_by_name(traces[0])
+    assert metric(tracer, 'natality_turns_total{status="error"}') == 1
+
+
+def test_sin_muestreo_solo_metricas(pipeline, ask, monkeypatch):
+    tracer = Tracer(sample_rate=0.0)
+    monkeypatch.setattr(pipeline, "get_tracer", lambda: tracer)
+    handler = JsonLines()
+    tracing.logger.addHandler(handler)
+    try:
+        response = ask(QUESTION, fakes.FakeGeminiClient(), fakes.FakeBigQueryClient(rows=ROWS))
+    finally:
+        tracing.logger.removeHandler(handler)
+
+    assert handler.traces == []
+    assert response["timings"]
+    assert metric(tracer, 'natality_turns_total{status="ok"}') == 1
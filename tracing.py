@@ -0,0 +1,266 @@
+"""Trazas por etapa de cada turno, logs JSON y métricas en formato Prometheus"""
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("natality.trace")
+
+# Límites (segundos) de los histogramas de duración por etapa
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Span:
+    def __init__(self, name, parent, start):
+        self.name = name
+        self.parent = parent
+        self.start = start
+        self.duration_ms = None
+        self.attrs = {}
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration_ms or 0.0, 3),
+            **self.attrs,
+        }
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+
+def maybe_span(trace, name, **attrs):
+    """`trace.span(...)` o un span que no registra nada si no hay traza."""
+    if trace is None:
+        return nullcontext(_NullSpan())
+    return trace.span(name, **attrs)
+
+
+class Trace:
+    """
+    Spans de un turno. Solo se guardan nombre, tiempos y unos pocos atributos, y como
+    mucho `max_spans`; las etapas que corren en otros hilos son spans de primer nivel.
+    """
+
+    def __init__(self, sampled, max_spans=64):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.sampled = sampled
+        self.max_spans = max_spans
+        self.start = time.perf_counter()
+        self.spans = []
+        self.attrs = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, **attrs):
+        with self._lock:
+            if len(self.spans) >= self.max_spans:
+                span = None
+            else:
+                stack = self._stack()
+                span = Span(name, stack[-1].name if stack else None, time.perf_counter())
+                span.attrs.update(attrs)
+                self.spans.append(span)
+        if span is None:
+            yield _NullSpan()
+            return
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.duration_ms = (time.perf_counter() - span.start) * 1000
+            stack.pop()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def timed_stream(self, span, chunks):
+        """Entrega `chunks` anotando en el span el tiempo hasta el primer fragmento."""
+        first = True
+        for chunk in chunks:
+            if first:
+                span.set(first_chunk_ms=round((time.perf_counter() - span.start) * 1000, 3))
+                first = False
+            yield chunk
+
+    def breakdown(self):
+        """Duración de cada etapa para mostrarla junto al mensaje."""
+        return [
+            {"name": span.name, "parent": span.parent, "ms": round(span.duration_ms, 1)}
+            for span in self.spans
+            if span.duration_ms is not None
+        ]
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            **self.attrs,
+            "spans": [span.to_dict(self.start) for span in self.spans],
+        }
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        for i, limit in enumerate(self.buckets):
+            if value <= limit:
+                self.counts[i] += 1
+                break
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Contadores e histogramas en memoria con salida en formato de texto de Prometheus."""
+
+    def __init__(self, prefix="natality"):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, help_text="", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("counter", help_text))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, help_text="", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help_text))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(DURATION_BUCKETS)
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in sorted(self._help.items()):
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                if kind == "counter":
+                    for (key_name, labels), value in sorted(self._counters.items()):
+                        if key_name == name:
+                            lines.append(f"{full_name}{_labels(labels)} {value}")
+                    continue
+                for (key_name, labels), histogram in sorted(
+                    self._histograms.items(), key=lambda item: item[0]
+                ):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for limit, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        bucket_labels = _labels(labels + (("le", limit),))
+                        lines.append(f"{full_name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{full_name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.total}")
+                    lines.append(f"{full_name}_sum{_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{full_name}_count{_labels(labels)} {histogram.total}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port, host="0.0.0.0"):
+    """Expone `metrics` en http://host:port/metrics desde un hilo en segundo plano."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+class Tracer:
+    """
+    Crea una traza por turno y, al cerrarla, actualiza las métricas agregadas (siempre)
+    y escribe la traza completa como una línea JSON (solo en la fracción `sample_rate`
+    de los turnos, para que el coste en producción sea bajo).
+    """
+
+    def __init__(self, sample_rate=0.1, max_spans=64, metrics=None):
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.metrics = metrics or Metrics()
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    def start(self):
+        return Trace(random.random() < self.sample_rate, self.max_spans)
+
+    def finish(self, trace, status="ok"):
+        trace.set(status=status)
+        metrics = self.metrics
+        metrics.inc("turns_total", help_text="Turnos procesados", status=status)
+        for span in trace.spans:
+            if span.duration_ms is None:
+                continue
+            metrics.observe(
+                "stage_duration_seconds", span.duration_ms / 1000,
+                help_text="Duración de cada etapa del turno", stage=span.name,
+            )
+            attrs = span.attrs
+            if attrs.get("bytes_processed"):
+                metrics.inc("bigquery_bytes_processed_total", attrs["bytes_processed"],
+                            help_text="Bytes procesados por BigQuery")
+            if attrs.get("slot_ms"):
+                metrics.inc("bigquery_slot_ms_total", attrs["slot_ms"],
+                            help_text="Slot-ms consumidos en BigQuery")
+            if attrs.get("cache_hit"):
+                metrics.inc("bigquery_cache_hits_total", help_text="Consultas servidas por la caché de BigQuery")
+            for kind in ("prompt_tokens", "output_tokens", "cached_tokens"):
+                if attrs.get(kind):
+                    metrics.inc("model_tokens_total", attrs[kind],
+                                help_text="Tokens del modelo por tipo", kind=kind.removesuffix("_tokens"))
+        if trace.sampled:
+            logger.info(json.dumps(trace.to_dict(), ensure_ascii=False, default=str))